@@ -0,0 +1,47 @@
+"""
+Pluggable queue storage backends.
+"""
+
+from helga_queue.backends.base import Backend, ConflictError
+from helga_queue.backends.memory import MemoryBackend
+from helga_queue.backends.mongo import MongoBackend
+from helga_queue.backends.segmented import SegmentedMongoBackend
+from helga_queue.backends.sqlite import SQLiteBackend
+
+__all__ = [
+    'Backend', 'ConflictError', 'MemoryBackend', 'MongoBackend', 'SegmentedMongoBackend',
+    'SQLiteBackend', 'make_backend'
+]
+
+
+def make_backend(kind, db=None, segment_size=1000, sqlite_path='helga_queue.sqlite', history_size=0):
+    """
+    Construct a backend by name.
+
+    :param kind: one of ``mongo``, ``mongo-segmented``, ``memory`` or ``sqlite``
+    :type kind: string
+    :param db: pymongo database, for the MongoDB backends
+    :type db: pymongo.database.Database
+    :param segment_size: items per segment, for ``mongo-segmented``
+    :type segment_size: int
+    :param sqlite_path: database file path, for ``sqlite``
+    :type sqlite_path: string
+    :param history_size: number of changes recorded per queue, for undo;
+      ignored by ``mongo-segmented``, which doesn't record history
+    :type history_size: int
+    :returns: the backend, or None if a MongoDB backend was requested but
+      ``db`` is None
+    :rtype: :py:class:`~helga_queue.backends.base.Backend` or None
+    :raises: ValueError if ``kind`` is not a known backend
+    """
+    if kind == 'memory':
+        return MemoryBackend(history_size=history_size)
+    if kind == 'sqlite':
+        return SQLiteBackend(sqlite_path, history_size=history_size)
+    if kind not in ['mongo', 'mongo-segmented']:
+        raise ValueError("unknown queue backend '{k}'".format(k=kind))
+    if db is None:
+        return None
+    if kind == 'mongo-segmented':
+        return SegmentedMongoBackend(db, segment_size=segment_size)
+    return MongoBackend(db, history_size=history_size)
@@ -0,0 +1,673 @@
+"""
+Storage backend interface.
+"""
+
+import random
+import re
+import time
+from collections import deque
+
+# how many times :py:meth:`Backend.update` retries after a conflicting write,
+# and the bounds of its exponential backoff between attempts, in seconds
+CAS_RETRIES = 8
+CAS_BACKOFF = 0.005
+CAS_MAX_BACKOFF = 0.2
+
+
+class ConflictError(Exception):
+    """
+    Raised when a read-modify-write of a queue keeps losing to concurrent
+    writers.
+    """
+    pass
+
+
+def tokenize(text):
+    """
+    Split text into lower-case words, as used for searching.
+
+    :param text: text to split
+    :type text: string
+    :rtype: list
+    """
+    return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+
+def matches(item, terms):
+    """
+    Return whether every one of ``terms`` is a word of ``item``.
+
+    :param item: queue item
+    :type item: string
+    :param terms: words from :py:func:`tokenize`
+    :type terms: list
+    :rtype: bool
+    """
+    words = set(tokenize(item))
+    return all(t in words for t in terms)
+
+
+def carry_over(old, items, default=None):
+    """
+    Pair each of ``items`` with the stored attributes (such as expiry and
+    priority) of an equal entry of ``old``, in order and using each entry at
+    most once, so that the items kept by a read-modify-write keep them.
+
+    :param old: ``(item, attributes)`` entries the items were read from
+    :type old: list
+    :param items: new queue contents
+    :type items: list
+    :param default: attributes of items not in ``old``
+    :returns: list of ``(item, attributes)``
+    :rtype: list
+    """
+    pending = {}
+    for item, attrs in old:
+        pending.setdefault(item, deque()).append(attrs)
+    res = []
+    for item in items:
+        left = pending.get(item)
+        res.append((item, left.popleft() if left else default))
+    return res
+
+
+def revert(entries, change):
+    """
+    Return the entries of a queue with a recorded change reverted: each
+    appended item still in the queue loses its last occurrence with the
+    priority it was appended with, and popped items go back at their
+    indexes (or the end, if the queue is now shorter).
+
+    :param entries: ``(item, (expires, priority))`` entries of the queue,
+      in queue order
+    :type entries: list
+    :param change: the change, as recorded by the backend: a dict of ``op``,
+      ``items``, ``attrs`` (``(expires, priority)`` of each item) and, for
+      pops, ``idxs``
+    :type change: dict
+    :returns: list of ``(item, (expires, priority))``
+    :rtype: list
+    """
+    entries = list(entries)
+    if change['op'] == 'append':
+        for item, attrs in reversed(list(zip(change['items'], change['attrs']))):
+            for i in range(len(entries) - 1, -1, -1):
+                if entries[i][0] == item and entries[i][1][1] == attrs[1]:
+                    del entries[i]
+                    break
+    else:
+        for idx, item, attrs in zip(change['idxs'], change['items'], change['attrs']):
+            entries.insert(min(idx, len(entries)), (item, tuple(attrs)))
+    return entries
+
+
+def public_change(change):
+    """
+    Return a recorded change without its stored attributes, as returned
+    by :py:meth:`Backend.history`.
+
+    :param change: the change, as recorded by the backend
+    :type change: dict
+    :rtype: dict
+    """
+    return dict((k, v) for k, v in change.items() if k != 'attrs')
+
+
+class Backend(object):
+    """
+    Base class for queue storage backends.
+
+    Subclasses must implement :py:meth:`get` and :py:meth:`set`; every other
+    operation has a read-modify-write default built on those two, which
+    backends should override with something atomic and cheaper where they
+    can.
+
+    Read-modify-writes go through :py:meth:`update`, which uses optimistic
+    concurrency control: every write bumps a per-queue version, and the
+    modified queue is only written if the version hasn't changed since it
+    was read. Backends shared between processes must implement
+    :py:meth:`get_versioned` and :py:meth:`compare_and_set` for this to
+    protect anything.
+
+    Backends supporting item expiry store an expiry time with items appended
+    with one. Reads leave out expired items as if they had already been
+    removed, and indexes count only the items that haven't expired; the
+    expired items themselves are deleted in batches by :py:meth:`expire`.
+
+    Backends supporting priorities keep each queue ordered by priority,
+    highest first, and by insertion within a priority; queues whose items all
+    have the default priority of 0 are plain FIFO queues.
+
+    Backends supporting history record every :py:meth:`append`,
+    :py:meth:`append_many`, :py:meth:`pop` and :py:meth:`pop_many` in a
+    per-queue log of the last :py:attr:`history_size` changes, written
+    together with the change itself, which :py:meth:`undo` reverts.
+    """
+
+    #: short name of the backend, used in messages
+    name = 'base'
+
+    #: number of changes recorded per queue; 0 records none
+    history_size = 0
+
+    def get(self, name):
+        """
+        Return the full contents of a queue.
+
+        :param name: name of the queue
+        :type name: string
+        :rtype: list
+        """
+        raise NotImplementedError()
+
+    def set(self, name, q):
+        """
+        Replace the full contents of a queue.
+
+        :param name: name of the queue
+        :type name: string
+        :param q: new queue contents
+        :type q: list
+        """
+        raise NotImplementedError()
+
+    def get_versioned(self, name):
+        """
+        Return the full contents of a queue, and its version.
+
+        :param name: name of the queue
+        :type name: string
+        :returns: ``(contents, version)``; version is None if the queue does
+          not exist, or if the backend doesn't keep versions
+        :rtype: tuple
+        """
+        return self.get(name), None
+
+    def compare_and_set(self, name, q, version):
+        """
+        Replace the full contents of a queue, only if its version is still
+        ``version``.
+
+        :param name: name of the queue
+        :type name: string
+        :param q: new queue contents
+        :type q: list
+        :param version: version returned by :py:meth:`get_versioned`
+        :returns: whether the queue was written
+        :rtype: bool
+        """
+        self.set(name, q)
+        return True
+
+    def stamp(self, name):
+        """
+        Return a cheap token for what a queue shows: its version, which
+        changes with every write, and its number of live items, which
+        changes when items expire without a write. Rendered views of a queue
+        can be reused while its stamp is unchanged.
+
+        :param name: name of the queue
+        :type name: string
+        :returns: ``(version, length)``, or None if the backend doesn't keep
+          versions
+        :rtype: tuple or None
+        """
+        return None
+
+    def update(self, name, fn, on_conflict=None):
+        """
+        Read-modify-write a queue with optimistic concurrency control,
+        retrying with bounded, jittered exponential backoff when another
+        writer got there first.
+
+        :param name: name of the queue
+        :type name: string
+        :param fn: called with the current contents of the queue (a list it
+          may modify); returns ``(new contents, result)``, where new contents
+          of None means nothing needs writing
+        :type fn: callable
+        :param on_conflict: called after each conflicting write
+        :type on_conflict: callable
+        :returns: the result returned by ``fn``
+        :raises: :py:exc:`ConflictError` if every attempt conflicted
+        """
+        delay = CAS_BACKOFF
+        for _ in range(CAS_RETRIES):
+            q, version = self.get_versioned(name)
+            new_q, res = fn(q)
+            if new_q is None or self.compare_and_set(name, new_q, version):
+                return res
+            if on_conflict is not None:
+                on_conflict()
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, CAS_MAX_BACKOFF)
+        raise ConflictError("update to queue '{n}' conflicted {c} times".format(n=name, c=CAS_RETRIES))
+
+    def append(self, name, item, expires=None, priority=0):
+        """
+        Append an item to the end of a queue (or of its priority within the
+        queue), creating the queue if needed.
+
+        :param name: name of the queue
+        :type name: string
+        :param item: item to append
+        :type item: string
+        :param expires: unix time the item expires at, or None to keep it
+          until it is removed
+        :type expires: float
+        :param priority: priority of the item, 0 or more; higher comes first
+        :type priority: int
+        :raises: NotImplementedError if ``expires`` or a priority is given
+          and the backend doesn't support item expiry or priorities
+        """
+        self.append_many(name, [item], expires, priority)
+
+    def append_many(self, name, items, expires=None, priority=0):
+        """
+        Append several items, in order, to the end of a queue (or of their
+        priority within the queue), creating the queue if needed.
+
+        :param name: name of the queue
+        :type name: string
+        :param items: items to append
+        :type items: list
+        :param expires: unix time the items expire at, or None to keep them
+          until they are removed
+        :type expires: float
+        :param priority: priority of the items, 0 or more; higher comes first
+        :type priority: int
+        :raises: NotImplementedError if ``expires`` or a priority is given
+          and the backend doesn't support item expiry or priorities
+        """
+        if expires is not None or priority != 0:
+            raise NotImplementedError()
+        self.update(name, lambda q: (q + list(items), None))
+
+    def pop(self, name, idx=0):
+        """
+        Remove and return the item at ``idx`` in a queue.
+
+        :param name: name of the queue
+        :type name: string
+        :param idx: index of the item to remove
+        :type idx: int
+        :returns: the removed item, or None if there is no item at ``idx``
+        :rtype: string or None
+        """
+        def _pop(q):
+            if idx >= len(q):
+                return None, None
+            val = q.pop(idx)
+            return q, val
+        return self.update(name, _pop)
+
+    def pop_many(self, name, idxs):
+        """
+        Remove and return the items at several indexes of a queue, all or
+        nothing.
+
+        :param name: name of the queue
+        :type name: string
+        :param idxs: indexes of the items to remove, sorted and unique
+        :type idxs: list
+        :returns: the removed items, in index order, or None (and nothing is
+          removed) if there is no item at one of ``idxs``
+        :rtype: list or None
+        """
+        def _pop_many(q):
+            if idxs[-1] >= len(q):
+                return None, None
+            drop = set(idxs)
+            return [item for i, item in enumerate(q) if i not in drop], [q[i] for i in idxs]
+        return self.update(name, _pop_many)
+
+    def length(self, name):
+        """
+        Return the number of items in a queue.
+
+        :param name: name of the queue
+        :type name: string
+        :rtype: int
+        """
+        return len(self.get(name))
+
+    def range(self, name, start, count):
+        """
+        Return up to ``count`` items of a queue beginning at index ``start``.
+
+        :param name: name of the queue
+        :type name: string
+        :param start: index of the first item
+        :type start: int
+        :param count: maximum number of items to return
+        :type count: int
+        :rtype: list
+        """
+        return self.get(name)[start:start + count]
+
+    def peek(self, name):
+        """
+        Return the first item in a queue without removing it.
+
+        :param name: name of the queue
+        :type name: string
+        :rtype: string or None
+        """
+        q = self.range(name, 0, 1)
+        if len(q) == 0:
+            return None
+        return q[0]
+
+    def set_owner(self, name, owner, channel):
+        """
+        Record the nick and channel a queue was created by, unless they are
+        already recorded. Backends that don't keep queue metadata ignore it.
+
+        :param name: name of the queue
+        :type name: string
+        :param owner: nick of the queue's creator
+        :type owner: string
+        :param channel: channel the queue was created in
+        :type channel: string
+        """
+        pass
+
+    def queues(self, owner=None, channel=None):
+        """
+        Summarize every queue, in name order.
+
+        :param owner: only include queues created by this nick
+        :type owner: string
+        :param channel: only include queues created in a channel starting
+          with this prefix
+        :type channel: string
+        :returns: list of dicts with ``name``, ``length``, ``head`` (the
+          first item, or None), ``owner`` and ``channel`` (None if unknown)
+        :rtype: list
+        :raises: NotImplementedError if the backend can't enumerate queues
+        """
+        raise NotImplementedError()
+
+    def search(self, terms, name=None):
+        """
+        Find the items containing every one of ``terms`` as a whole word,
+        ignoring case. This default scans every item; backends should
+        override it with an index lookup.
+
+        :param terms: words to search for, from :py:func:`tokenize`
+        :type terms: list
+        :param name: only search this queue; None to search every queue
+        :type name: string
+        :returns: list of ``(queue name, index, item)``, in queue name and
+          index order
+        :rtype: list
+        :raises: NotImplementedError if ``name`` is None and the backend
+          can't enumerate queues
+        """
+        if name is None:
+            names = [q['name'] for q in self.queues()]
+        else:
+            names = [name]
+        res = []
+        for n in names:
+            res.extend((n, idx, item) for idx, item in enumerate(self.get(n)) if matches(item, terms))
+        return res
+
+    def is_empty(self, name):
+        """
+        Return whether a queue is empty (or doesn't exist).
+
+        :param name: name of the queue
+        :type name: string
+        :rtype: bool
+        """
+        return self.length(name) == 0
+
+    def claim(self, name, nick, expires):
+        """
+        Atomically remove the first item of a queue and lease it to ``nick``.
+        Until it is acked, released or its lease expires, the item is held
+        apart from the queue, so no one else can claim it.
+
+        :param name: name of the queue
+        :type name: string
+        :param nick: nick claiming the item
+        :type nick: string
+        :param expires: unix time the lease expires at
+        :type expires: float
+        :returns: ``(claim id, item)``, or None if the queue is empty
+        :rtype: tuple or None
+        :raises: NotImplementedError if the backend doesn't support claims
+        """
+        raise NotImplementedError()
+
+    def ack(self, name, nick, claim_id):
+        """
+        Finish with a claimed item, dropping it for good.
+
+        :param name: name of the queue
+        :type name: string
+        :param nick: nick holding the claim
+        :type nick: string
+        :param claim_id: id returned by :py:meth:`claim`
+        :type claim_id: int
+        :returns: the item, or None if ``nick`` holds no such claim (it may
+          have expired)
+        :rtype: string or None
+        :raises: NotImplementedError if the backend doesn't support claims
+        """
+        raise NotImplementedError()
+
+    def release(self, name, nick, claim_id):
+        """
+        Give up a claim, putting its item back at the head of the queue
+        (with the priority of the item it goes in front of).
+
+        :param name: name of the queue
+        :type name: string
+        :param nick: nick holding the claim
+        :type nick: string
+        :param claim_id: id returned by :py:meth:`claim`
+        :type claim_id: int
+        :returns: the item, or None if ``nick`` holds no such claim
+        :rtype: string or None
+        :raises: NotImplementedError if the backend doesn't support claims
+        """
+        raise NotImplementedError()
+
+    def reap(self, now):
+        """
+        Put the items of every claim whose lease expired before ``now`` back
+        at the head of their queues, oldest claim first.
+
+        :param now: current unix time
+        :type now: float
+        :returns: names of the queues items were returned to
+        :rtype: list
+        :raises: NotImplementedError if the backend doesn't support claims
+        """
+        raise NotImplementedError()
+
+    def schedule(self, name, item, due, channel=None):
+        """
+        Store an item to be appended to a queue once it is due; until then it
+        isn't part of the queue.
+
+        :param name: name of the queue
+        :type name: string
+        :param item: item to append
+        :type item: string
+        :param due: unix time the item is due at
+        :type due: float
+        :param channel: channel to announce the item in when it is due, or
+          None
+        :type channel: string
+        :raises: NotImplementedError if the backend doesn't support
+          scheduled items
+        """
+        raise NotImplementedError()
+
+    def scheduled_times(self):
+        """
+        Return the due times of every scheduled item not yet delivered,
+        for rebuilding the in-process timers after a restart.
+
+        :rtype: list
+        :raises: NotImplementedError if the backend doesn't support
+          scheduled items
+        """
+        raise NotImplementedError()
+
+    def deliver_due(self, now):
+        """
+        Append every scheduled item due by ``now`` to its queue, in due
+        order.
+
+        :param now: current unix time
+        :type now: float
+        :returns: list of ``(queue name, item, channel)`` for the delivered
+          items
+        :rtype: list
+        :raises: NotImplementedError if the backend doesn't support
+          scheduled items
+        """
+        raise NotImplementedError()
+
+    def ttls(self):
+        """
+        Return the time-to-live of every queue that has one.
+
+        :returns: dict of queue name to whole seconds
+        :rtype: dict
+        """
+        return {}
+
+    def set_ttl(self, name, ttl):
+        """
+        Set how long items appended to a queue last. Only the items appended
+        afterwards are affected.
+
+        :param name: name of the queue
+        :type name: string
+        :param ttl: seconds, or None for items that don't expire
+        :type ttl: float
+        :raises: NotImplementedError if the backend doesn't support item
+          expiry
+        """
+        raise NotImplementedError()
+
+    def expire(self, now, limit):
+        """
+        Delete items that expired by ``now``, using an index on expiry time
+        to find them, in a batch of about ``limit``.
+
+        :param now: current unix time
+        :type now: float
+        :param limit: batch size
+        :type limit: int
+        :returns: ``(names, more)``: the names of the queues items were
+          deleted from, and whether more expired items may be left
+        :rtype: tuple
+        :raises: NotImplementedError if the backend doesn't support item
+          expiry
+        """
+        raise NotImplementedError()
+
+    def history(self, name, count):
+        """
+        Return the most recent recorded changes to a queue.
+
+        :param name: name of the queue
+        :type name: string
+        :param count: maximum number of changes to return
+        :type count: int
+        :returns: list of dicts, oldest first, of ``op`` (``append`` or
+          ``pop``), ``at`` (unix time), ``items`` and, for pops, ``idxs``
+        :rtype: list
+        :raises: NotImplementedError if the backend doesn't record history
+        """
+        raise NotImplementedError()
+
+    def undo(self, name):
+        """
+        Atomically revert the most recent recorded change to a queue (see
+        :py:func:`revert`), and drop it from the history, so that undoing
+        again reverts the change before it. Items put back keep the expiry
+        and priority they had.
+
+        :param name: name of the queue
+        :type name: string
+        :returns: the change reverted, as returned by :py:meth:`history`, or
+          None if there is no recorded change
+        :rtype: dict or None
+        :raises: NotImplementedError if the backend doesn't record history;
+          :py:exc:`ConflictError` if the undo kept conflicting with other
+          writers
+        """
+        raise NotImplementedError()
+
+    def move(self, name, target, idxs=None):
+        """
+        Atomically move items from one queue to the end of another (of their
+        priority within it), keeping their expiry and priority. Moves
+        aren't recorded in the history.
+
+        :param name: name of the queue to move items from
+        :type name: string
+        :param target: name of the queue to move them to, which is created
+          if needed
+        :type target: string
+        :param idxs: sorted, unique indexes of the items to move, or None to
+          move every item
+        :type idxs: list
+        :returns: the items moved, in queue order, or None if there is no
+          item at one of ``idxs``
+        :rtype: list or None
+        :raises: NotImplementedError if the backend can't move items
+          atomically
+        """
+        raise NotImplementedError()
+
+    def recover_moves(self, now):
+        """
+        Finish moves between queues that were interrupted part way, for
+        backends whose moves take more than one step.
+
+        :param now: current unix time
+        :type now: float
+        :returns: names of the queues involved in the moves finished
+        :rtype: list
+        """
+        return []
+
+    def export(self, name=None, batch_size=1000):
+        """
+        Iterate over the items of one or every queue, with their expiry and
+        priority, for backups and migrations. Storage is read in batches, so
+        memory use doesn't grow with the size of the queues. This default
+        pages through each queue with :py:meth:`range`.
+
+        :param name: only export this queue; None to export every queue
+        :type name: string
+        :param batch_size: number of items (queues, for MongoDB, which keeps
+          each queue in one document) read per storage call
+        :type batch_size: int
+        :returns: iterator of ``(queue name, item, expires, priority)`` in
+          queue name and queue order, leaving out expired items
+        :rtype: iterator
+        :raises: NotImplementedError if ``name`` is None and the backend
+          can't enumerate queues
+        """
+        if name is None:
+            names = [q['name'] for q in self.queues()]
+        else:
+            names = [name]
+        for n in names:
+            start = 0
+            while True:
+                items = self.range(n, start, batch_size)
+                for item in items:
+                    yield n, item, None, 0
+                if len(items) < batch_size:
+                    break
+                start += batch_size
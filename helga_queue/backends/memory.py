@@ -0,0 +1,411 @@
+"""
+In-process backend, for small deployments without MongoDB and for tests
+and benchmarks. Contents are lost when the bot restarts.
+"""
+
+import heapq
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import islice
+
+from helga_queue.backends.base import Backend, carry_over, public_change, revert
+
+
+class PriorityLevels(object):
+    """
+    The entries of one queue, ``(item, expires, priority)``, kept as a FIFO
+    :py:class:`collections.deque` per priority plus a heap of the priorities
+    in use. Appending is O(1) (O(log levels) for a new priority), and taking
+    the head is O(log levels). Iterates in queue order: highest priority
+    first, then insertion order.
+
+    :param entries: initial entries, in queue order
+    :type entries: iterable
+    """
+
+    def __init__(self, entries=()):
+        self._levels = {}
+        # negated priorities, so the highest is at the top of the heap
+        self._heap = []
+        self._size = 0
+        for entry in entries:
+            self.append(entry)
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for priority in sorted(self._levels, reverse=True):
+            for entry in self._levels[priority]:
+                yield entry
+
+    def _level(self, priority):
+        level = self._levels.get(priority)
+        if level is None:
+            level = self._levels[priority] = deque()
+            heapq.heappush(self._heap, -priority)
+        return level
+
+    def append(self, entry):
+        """add an entry at the end of its priority"""
+        self._level(entry[2]).append(entry)
+        self._size += 1
+
+    def appendleft(self, item):
+        """put an item at the head, with the priority of the current head"""
+        priority = -self._heap[0] if len(self._heap) > 0 else 0
+        self._level(priority).appendleft((item, None, priority))
+        self._size += 1
+
+    def pop(self, idx):
+        """remove and return the entry at ``idx``, which must exist"""
+        top = -self._heap[0]
+        if idx < len(self._levels[top]):
+            priority = top
+        else:
+            for priority in sorted(self._levels, reverse=True):
+                if idx < len(self._levels[priority]):
+                    break
+                idx -= len(self._levels[priority])
+        level = self._levels[priority]
+        level.rotate(-idx)
+        entry = level.popleft()
+        level.rotate(idx)
+        self._size -= 1
+        if len(level) == 0:
+            del self._levels[priority]
+            if priority == top:
+                heapq.heappop(self._heap)
+            else:
+                self._heap.remove(-priority)
+                heapq.heapify(self._heap)
+        return entry
+
+
+class MemoryBackend(Backend):
+    """
+    Backend keeping each queue in a :py:class:`PriorityLevels`. All
+    operations are thread-safe, and every write bumps the queue's version.
+    Expiry times are also kept in a heap, for :py:meth:`expire` to find
+    expired items without scanning every queue. Each queue's history is a
+    :py:class:`collections.deque` with a ``maxlen``.
+
+    :param history_size: number of changes recorded per queue
+    :type history_size: int
+    """
+
+    name = 'memory'
+
+    def __init__(self, history_size=0):
+        self.history_size = history_size
+        self._history = {}
+        self._queues = {}
+        self._owners = {}
+        self._versions = {}
+        # queue name -> OrderedDict of claim id -> (item, nick, expires)
+        self._claims = {}
+        self._claim_seqs = {}
+        # heap of (due, seq, queue name, item, channel)
+        self._scheduled = []
+        self._schedule_seq = 0
+        self._ttls = {}
+        # queue name -> number of its entries with an expiry
+        self._expiring = {}
+        # heap of (expires, queue name)
+        self._expiries = []
+        self._lock = threading.RLock()
+
+    def _bump(self, name):
+        self._versions[name] = self._versions.get(name, 0) + 1
+
+    def _live(self, name, now):
+        """iterate over the items of a queue that haven't expired"""
+        entries = self._queues.get(name, ())
+        if self._expiring.get(name, 0) == 0:
+            return (e[0] for e in entries)
+        return (e[0] for e in entries if e[1] is None or e[1] > now)
+
+    def _raw_index(self, name, idx, now):
+        """index in the queue's entries of the ``idx``'th item that hasn't expired, or None"""
+        entries = self._queues.get(name, ())
+        if self._expiring.get(name, 0) == 0:
+            return idx if idx < len(entries) else None
+        live = (i for i, e in enumerate(entries) if e[1] is None or e[1] > now)
+        return next(islice(live, idx, idx + 1), None)
+
+    def _take(self, name, raw):
+        """remove and return the entry at ``raw`` in the queue's entries"""
+        entry = self._queues[name].pop(raw)
+        if entry[1] is not None:
+            self._expiring[name] -= 1
+        self._bump(name)
+        return entry
+
+    def _add(self, name, entries):
+        q = self._queues.setdefault(name, PriorityLevels())
+        for entry in entries:
+            q.append(entry)
+        expiring = [e[1] for e in entries if e[1] is not None]
+        if len(expiring) > 0:
+            self._expiring[name] = self._expiring.get(name, 0) + len(expiring)
+            for expires in set(expiring):
+                heapq.heappush(self._expiries, (expires, name))
+        self._bump(name)
+
+    def _replace(self, name, entries):
+        self._queues[name] = PriorityLevels(entries)
+        self._expiring[name] = sum(1 for e in entries if e[1] is not None)
+        for expires in set(e[1] for e in entries if e[1] is not None):
+            heapq.heappush(self._expiries, (expires, name))
+        self._bump(name)
+
+    def _record(self, name, op, entries, idxs=None):
+        """record a change to a queue, if keeping history"""
+        if self.history_size == 0:
+            return
+        change = {'op': op, 'at': time.time(), 'items': [e[0] for e in entries], 'attrs': [e[1:] for e in entries]}
+        if idxs is not None:
+            change['idxs'] = list(idxs)
+        self._history.setdefault(name, deque(maxlen=self.history_size)).append(change)
+
+    def get(self, name):
+        with self._lock:
+            return list(self._live(name, time.time()))
+
+    def get_versioned(self, name):
+        with self._lock:
+            return list(self._live(name, time.time())), self._versions.get(name)
+
+    def stamp(self, name):
+        with self._lock:
+            return self._versions.get(name, 0), self._length(name, time.time())
+
+    def set(self, name, q):
+        with self._lock:
+            self._replace(name, [(item, None, 0) for item in q])
+
+    def compare_and_set(self, name, q, version):
+        """items kept from the queue as read keep their expiry and priority"""
+        with self._lock:
+            if self._versions.get(name) != version:
+                return False
+            now = time.time()
+            old = [(e[0], e[1:]) for e in self._queues.get(name, ()) if e[1] is None or e[1] > now]
+            self._replace(name, [(item,) + attrs for item, attrs in carry_over(old, q, (None, 0))])
+            return True
+
+    def append(self, name, item, expires=None, priority=0):
+        self.append_many(name, [item], expires, priority)
+
+    def append_many(self, name, items, expires=None, priority=0):
+        with self._lock:
+            entries = [(item, expires, priority) for item in items]
+            self._add(name, entries)
+            self._record(name, 'append', entries)
+
+    def pop(self, name, idx=0):
+        with self._lock:
+            raw = self._raw_index(name, idx, time.time())
+            if raw is None:
+                return None
+            entry = self._take(name, raw)
+            self._record(name, 'pop', [entry], [idx])
+            return entry[0]
+
+    def pop_many(self, name, idxs):
+        with self._lock:
+            now = time.time()
+            entries = list(self._queues.get(name, ()))
+            live = [i for i, e in enumerate(entries) if e[1] is None or e[1] > now]
+            if idxs[-1] >= len(live):
+                return None
+            drop = set(live[i] for i in idxs)
+            self._queues[name] = PriorityLevels(e for i, e in enumerate(entries) if i not in drop)
+            self._expiring[name] = self._expiring.get(name, 0) - sum(
+                1 for i in drop if entries[i][1] is not None
+            )
+            self._bump(name)
+            self._record(name, 'pop', [entries[live[i]] for i in idxs], idxs)
+            return [entries[live[i]][0] for i in idxs]
+
+    def _length(self, name, now):
+        if self._expiring.get(name, 0) == 0:
+            return len(self._queues.get(name, ()))
+        return sum(1 for _ in self._live(name, now))
+
+    def length(self, name):
+        with self._lock:
+            return self._length(name, time.time())
+
+    def range(self, name, start, count):
+        with self._lock:
+            return list(islice(self._live(name, time.time()), start, start + count))
+
+    def set_owner(self, name, owner, channel):
+        with self._lock:
+            self._owners.setdefault(name, (owner, channel))
+            self._queues.setdefault(name, PriorityLevels())
+
+    def queues(self, owner=None, channel=None):
+        with self._lock:
+            now = time.time()
+            res = []
+            for name in sorted(self._queues):
+                q_owner, q_channel = self._owners.get(name, (None, None))
+                if owner is not None and q_owner != owner:
+                    continue
+                if channel is not None and not (q_channel or '').startswith(channel):
+                    continue
+                res.append({
+                    'name': name, 'length': self._length(name, now), 'head': next(self._live(name, now), None),
+                    'owner': q_owner, 'channel': q_channel
+                })
+            return res
+
+    def peek(self, name):
+        with self._lock:
+            return next(self._live(name, time.time()), None)
+
+    def claim(self, name, nick, expires):
+        with self._lock:
+            raw = self._raw_index(name, 0, time.time())
+            if raw is None:
+                return None
+            item = self._take(name, raw)[0]
+            claim_id = self._claim_seqs.get(name, 0) + 1
+            self._claim_seqs[name] = claim_id
+            self._claims.setdefault(name, OrderedDict())[claim_id] = (item, nick, expires)
+            return claim_id, item
+
+    def _take_claim(self, name, nick, claim_id):
+        claims = self._claims.get(name, {})
+        if claim_id not in claims or claims[claim_id][1] != nick:
+            return None
+        return claims.pop(claim_id)[0]
+
+    def ack(self, name, nick, claim_id):
+        with self._lock:
+            return self._take_claim(name, nick, claim_id)
+
+    def release(self, name, nick, claim_id):
+        with self._lock:
+            item = self._take_claim(name, nick, claim_id)
+            if item is not None:
+                self._queues.setdefault(name, PriorityLevels()).appendleft(item)
+                self._bump(name)
+            return item
+
+    def reap(self, now):
+        with self._lock:
+            names = []
+            for name in sorted(self._claims):
+                claims = self._claims[name]
+                expired = [cid for cid, (_, _, expires) in claims.items() if expires < now]
+                if len(expired) == 0:
+                    continue
+                # newest first, so the oldest ends up at the head
+                q = self._queues.setdefault(name, PriorityLevels())
+                for cid in reversed(expired):
+                    q.appendleft(claims.pop(cid)[0])
+                self._bump(name)
+                names.append(name)
+            return names
+
+    def schedule(self, name, item, due, channel=None):
+        with self._lock:
+            self._schedule_seq += 1
+            heapq.heappush(self._scheduled, (due, self._schedule_seq, name, item, channel))
+
+    def scheduled_times(self):
+        with self._lock:
+            return sorted(entry[0] for entry in self._scheduled)
+
+    def deliver_due(self, now):
+        with self._lock:
+            delivered = []
+            while len(self._scheduled) > 0 and self._scheduled[0][0] <= now:
+                _, _, name, item, channel = heapq.heappop(self._scheduled)
+                self._add(name, [(item, None, 0)])
+                delivered.append((name, item, channel))
+            return delivered
+
+    def ttls(self):
+        with self._lock:
+            return dict(self._ttls)
+
+    def set_ttl(self, name, ttl):
+        with self._lock:
+            if ttl is None:
+                self._ttls.pop(name, None)
+            else:
+                self._ttls[name] = ttl
+
+    def expire(self, now, limit):
+        """
+        pops up to ``limit`` due expiry times off the heap, then drops every
+        expired item from their queues
+        """
+        with self._lock:
+            due = set()
+            while len(self._expiries) > 0 and self._expiries[0][0] <= now and len(due) < limit:
+                due.add(heapq.heappop(self._expiries)[1])
+            names = []
+            for name in sorted(due):
+                if self._expiring.get(name, 0) == 0:
+                    # the items were already removed
+                    continue
+                q = self._queues[name]
+                keep = PriorityLevels(e for e in q if e[1] is None or e[1] > now)
+                if len(keep) == len(q):
+                    continue
+                self._queues[name] = keep
+                self._expiring[name] = sum(1 for e in keep if e[1] is not None)
+                self._bump(name)
+                names.append(name)
+            more = len(self._expiries) > 0 and self._expiries[0][0] <= now
+            return names, more
+
+    def history(self, name, count):
+        with self._lock:
+            changes = list(self._history.get(name, ()))
+        return [public_change(c) for c in changes[-count:]]
+
+    def undo(self, name):
+        with self._lock:
+            changes = self._history.get(name)
+            if not changes:
+                return None
+            change = changes.pop()
+            now = time.time()
+            old = [(e[0], e[1:]) for e in self._queues.get(name, ()) if e[1] is None or e[1] > now]
+            self._replace(name, [(item,) + tuple(attrs) for item, attrs in revert(old, change)])
+            return public_change(change)
+
+    def move(self, name, target, idxs=None):
+        with self._lock:
+            now = time.time()
+            if idxs is None:
+                moved = [e for e in self._queues.get(name, ()) if e[1] is None or e[1] > now]
+                if len(moved) == 0:
+                    return []
+                self._replace(name, [])
+            else:
+                raws = [self._raw_index(name, idx, now) for idx in idxs]
+                if None in raws:
+                    return None
+                # highest first, so the lower indexes are still valid
+                moved = [self._take(name, raw) for raw in reversed(raws)][::-1]
+            self._add(target, moved)
+            return [e[0] for e in moved]
+
+    def export(self, name=None, batch_size=1000):
+        """copies the live entries of one queue at a time under the lock"""
+        with self._lock:
+            names = sorted(self._queues) if name is None else [name]
+        for n in names:
+            with self._lock:
+                now = time.time()
+                entries = [e for e in self._queues.get(n, ()) if e[1] is None or e[1] > now]
+            for item, expires, priority in entries:
+                yield n, item, expires, priority
@@ -0,0 +1,841 @@
+"""
+MongoDB backend storing each queue as one document in ``helga_queue``::
+
+    {'_id': <queue name>, 'queue': [<item>, ...], 'version': <int>,
+     'owner': <creator nick>, 'channel': <channel created in>,
+     'ttl': <seconds items appended last>,
+     'claims': [{'id': <int>, 'item': <item>, 'nick': <nick>,
+                 'expires': <unix time>}, ...], 'claim_seq': <int>,
+     'scheduled': [{'item': <item>, 'due': <unix time>,
+                    'channel': <channel to announce in>}, ...],
+     'history': [{'op': 'append' or 'pop', 'at': <unix time>,
+                  'entries': [<queue entry>, ...], 'idxs': [<int>, ...]}, ...],
+     'moving': [{'id': <move id>, 'to': <target queue>, 'at': <unix time>,
+                 'entries': [<queue entry>, ...]}, ...],
+     'moved_in': [<move id>, ...]}
+
+``owner`` and ``channel`` are indexed, for listing queues, and ``queue`` has
+a text index, for searching. Every write to ``queue`` increments
+``version``, so that read-modify-writes can be made compare-and-set.
+Claimed items move from ``queue`` to ``claims`` in the same document, so
+claiming, releasing and reaping are single atomic updates; ``claims.expires``
+is indexed for the reaper. Likewise, scheduled items wait in ``scheduled``,
+kept in due order and indexed on ``scheduled.due``, and are moved into
+``queue`` by one update per queue when they are due.
+
+Items that expire or have a priority are stored in ``queue`` as ``{'item':
+<item>, 'expires': <unix time>, 'p': <priority>}``, leaving out an expiry
+of never and a priority of 0, and ``queue.expires`` is indexed for the
+reaper. ``queue`` is kept in priority order: items appended with a
+priority above 0 are inserted after the last item of at least their
+priority, and released items take the priority of the head. Reads
+filter expired items out on the server. Writes addressing items by index
+only match documents without expired items, so that raw and visible
+indexes agree; in the rare case that one has expired items the reaper
+hasn't got to yet, they are purged from that document first.
+
+Recorded changes are kept in ``history``, capped with ``$slice`` in the
+same update that makes the change; pops copy the removed entries into it on
+the server. Undoing is a compare-and-set on ``version``.
+
+Moving items to another queue spans two documents, so it is a recoverable
+two-phase update: the items move from ``queue`` to a ``moving`` record in
+one update, are added to the target's ``queue`` by an update that also
+adds the move's id to the target's ``moved_in`` (and so only applies once),
+and then the ``moving`` record is dropped. Moves left in ``moving`` by a
+crash are found through an index on ``moving.at`` and finished.
+"""
+
+import random
+import re
+import time
+
+from bson import ObjectId
+from pymongo import ASCENDING, TEXT, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from helga_queue.backends.base import (
+    CAS_BACKOFF, CAS_MAX_BACKOFF, CAS_RETRIES, Backend, ConflictError, carry_over, public_change, revert
+)
+
+# pipeline update expression for the next version
+NEXT_VERSION = {'$add': [{'$ifNull': ['$version', 0]}, 1]}
+
+# seconds after which a move between queues that hasn't finished is taken
+# to have been interrupted, and finished by :py:meth:`MongoBackend.recover_moves`
+MOVE_TIMEOUT = 30
+
+# number of ids of recent moves into a queue kept in ``moved_in``, so that
+# finishing a move twice doesn't add its items twice
+MOVED_IN_SIZE = 100
+
+
+def entry_of(item, expires, priority=0):
+    """
+    Return the ``queue`` entry for an item.
+
+    :param item: the item
+    :type item: string
+    :param expires: unix time the item expires at, or None
+    :type expires: float
+    :param priority: priority of the item
+    :type priority: int
+    """
+    if expires is None and priority == 0:
+        return item
+    entry = {'item': item}
+    if expires is not None:
+        entry['expires'] = expires
+    if priority != 0:
+        entry['p'] = priority
+    return entry
+
+
+def item_of(entry):
+    """
+    Return the item of a ``queue`` entry, which is either the item itself or
+    a dict holding it, its expiry and its priority.
+
+    :param entry: the entry
+    :rtype: string
+    """
+    return entry['item'] if isinstance(entry, dict) else entry
+
+
+def unpack(entry):
+    """
+    Return ``(item, expires, priority)`` for a ``queue`` entry.
+
+    :param entry: the entry
+    :rtype: tuple
+    """
+    if not isinstance(entry, dict):
+        return entry, None, 0
+    return entry['item'], entry.get('expires'), entry.get('p', 0)
+
+
+def live_entries(entries, now):
+    """
+    Return ``(item, expires, priority)`` for each of the ``queue`` entries
+    that haven't expired by ``now``.
+
+    :param entries: entries of ``queue``
+    :type entries: list
+    :param now: current unix time
+    :type now: float
+    :rtype: list
+    """
+    res = [unpack(e) for e in entries]
+    return [e for e in res if e[1] is None or e[1] > now]
+
+
+def change_of(record):
+    """
+    Return a change recorded in ``history`` in the form taken by
+    :py:func:`~helga_queue.backends.base.revert`.
+
+    :param record: entry of ``history``
+    :type record: dict
+    :rtype: dict
+    """
+    entries = [unpack(e) for e in record['entries']]
+    change = {'op': record['op'], 'at': record['at'], 'items': [e[0] for e in entries],
+              'attrs': [e[1:] for e in entries]}
+    if 'idxs' in record:
+        change['idxs'] = record['idxs']
+    return change
+
+
+def live(now):
+    """
+    Expression for the entries of ``queue`` that haven't expired by ``now``.
+
+    :param now: current unix time
+    :type now: float
+    """
+    return {'$filter': {'input': {'$ifNull': ['$queue', []]}, 'as': 'e', 'cond': {'$or': [
+        {'$ne': [{'$type': '$$e'}, 'object']},
+        {'$eq': [{'$type': '$$e.expires'}, 'missing']},
+        {'$gt': ['$$e.expires', now]},
+    ]}}}
+
+
+def priority_of(entry):
+    """
+    Expression for the priority of a ``queue`` entry.
+
+    :param entry: expression for the entry, which must be a variable
+    :type entry: string
+    """
+    return {'$ifNull': [entry + '.p', 0]}
+
+
+def unwrap(entry):
+    """
+    Expression for the item of a ``queue`` entry (see :py:func:`item_of`).
+
+    :param entry: expression for the entry
+    """
+    return {'$let': {'vars': {'e': entry}, 'in': {
+        '$cond': [{'$eq': [{'$type': '$$e'}, 'object']}, '$$e.item', '$$e']
+    }}}
+
+
+def live_items(now):
+    """
+    Expression for the items of ``queue`` that haven't expired by ``now``.
+
+    :param now: current unix time
+    :type now: float
+    """
+    return {'$map': {'input': live(now), 'as': 'e', 'in': unwrap('$$e')}}
+
+
+class MongoBackend(Backend):
+    """
+    MongoDB single-document-per-queue backend. Mutations are single atomic
+    server-side operations, and reads use projections so only the data
+    needed is transferred.
+
+    :param db: pymongo database
+    :type db: pymongo.database.Database
+    :param history_size: number of changes recorded per queue
+    :type history_size: int
+    """
+
+    name = 'mongo'
+
+    def __init__(self, db, history_size=0):
+        self.db = db
+        self.history_size = history_size
+        self._indexed = False
+
+    def _ensure_indexes(self):
+        if self._indexed:
+            return
+        self.db.helga_queue.create_index([('owner', ASCENDING)])
+        self.db.helga_queue.create_index([('channel', ASCENDING)])
+        self.db.helga_queue.create_index([('queue', TEXT)], default_language='none')
+        self.db.helga_queue.create_index([('claims.expires', ASCENDING)], sparse=True)
+        self.db.helga_queue.create_index([('scheduled.due', ASCENDING)], sparse=True)
+        self.db.helga_queue.create_index([('queue.expires', ASCENDING)], sparse=True)
+        self.db.helga_queue.create_index([('ttl', ASCENDING)], sparse=True)
+        self.db.helga_queue.create_index([('queue.p', ASCENDING)], sparse=True)
+        self.db.helga_queue.create_index([('moving.at', ASCENDING)], sparse=True)
+        self._indexed = True
+
+    def get(self, name):
+        res = self.db.helga_queue.find_one({'_id': name})
+        if res is None:
+            return []
+        return [e[0] for e in live_entries(res['queue'], time.time())]
+
+    def get_versioned(self, name):
+        res = self.db.helga_queue.find_one({'_id': name}, {'queue': 1, 'version': 1})
+        if res is None:
+            return [], None
+        # documents written before versioning count as version 0
+        return [e[0] for e in live_entries(res.get('queue', []), time.time())], res.get('version', 0)
+
+    def set(self, name, q):
+        """replaces only ``queue``, keeping the owner metadata"""
+        self.db.helga_queue.update_one(
+            {'_id': name}, {'$set': {'queue': q}, '$inc': {'version': 1}}, upsert=True
+        )
+
+    def compare_and_set(self, name, q, version):
+        """
+        conditional update on ``version``, or an insert if the queue didn't
+        exist when read; if the queue has items that expire or have a
+        priority, it is read again so that the items kept keep their expiry
+        and priority (and stay in priority order)
+        """
+        if version is None:
+            try:
+                self.db.helga_queue.insert_one({'_id': name, 'queue': q, 'version': 1})
+            except DuplicateKeyError:
+                return False
+            return True
+        if version == 0:
+            query = {'_id': name, 'version': {'$exists': False}}
+        else:
+            query = {'_id': name, 'version': version}
+        plain = dict(query, **{'queue.item': {'$exists': False}})
+        res = self.db.helga_queue.update_one(plain, {'$set': {'queue': q}, '$inc': {'version': 1}})
+        if res.matched_count == 1:
+            return True
+        res = self.db.helga_queue.find_one(query, {'queue': 1})
+        if res is None:
+            return False
+        old = [(e[0], e[1:]) for e in live_entries(res.get('queue', []), time.time())]
+        kept = sorted(carry_over(old, q, (None, 0)), key=lambda e: -e[1][1])
+        entries = [entry_of(item, expires, priority) for item, (expires, priority) in kept]
+        res = self.db.helga_queue.update_one(query, {'$set': {'queue': entries}, '$inc': {'version': 1}})
+        return res.matched_count == 1
+
+    def append(self, name, item, expires=None, priority=0):
+        """
+        single upserting ``$push``, or with a priority, a pipeline update
+        inserting it after the last item of at least that priority
+        """
+        if expires is not None or priority != 0:
+            self._ensure_indexes()
+        entry = entry_of(item, expires, priority)
+        if priority == 0:
+            update = {'$push': {'queue': entry}, '$inc': {'version': 1}}
+        else:
+            update = self._insert([entry], priority)
+        self._record_append(update, [entry])
+        self.db.helga_queue.update_one({'_id': name}, update, upsert=True)
+
+    def append_many(self, name, items, expires=None, priority=0):
+        """
+        single upserting ``$push`` with ``$each``, or with a priority, a
+        pipeline update inserting them after the last item of at least that
+        priority
+        """
+        if expires is not None or priority != 0:
+            self._ensure_indexes()
+        entries = [entry_of(item, expires, priority) for item in items]
+        if priority == 0:
+            update = {'$push': {'queue': {'$each': entries}}, '$inc': {'version': 1}}
+        else:
+            update = self._insert(entries, priority)
+        self._record_append(update, entries)
+        self.db.helga_queue.update_one({'_id': name}, update, upsert=True)
+
+    def _insert(self, entries, priority):
+        """
+        pipeline update inserting ``entries`` into ``queue`` after the last
+        entry of at least ``priority``
+        """
+        return [{'$set': {'queue': self._inserted(entries, priority), 'version': NEXT_VERSION}}]
+
+    def _inserted(self, entries, priority):
+        """
+        expression for ``queue`` with ``entries`` inserted after the last
+        entry of at least ``priority``
+        """
+        q = {'$ifNull': ['$queue', []]}
+        at = {'$size': {'$filter': {'input': q, 'as': 'e', 'cond': {'$gte': [priority_of('$$e'), priority]}}}}
+        return {'$let': {'vars': {'q': q, 'at': at}, 'in': {'$concatArrays': [
+            {'$slice': ['$$q', '$$at']},
+            {'$literal': entries},
+            {'$slice': ['$$q', '$$at', {'$add': [{'$size': '$$q'}, 1]}]}
+        ]}}}
+
+    def _without(self, idxs):
+        """expression for ``queue`` without the entries at ``idxs``"""
+        first, last = idxs[0], idxs[-1]
+        if last - first + 1 == len(idxs):
+            # a contiguous range: splice it out
+            return {'$concatArrays': [
+                {'$slice': ['$queue', first]},
+                {'$slice': ['$queue', last + 1, {'$size': '$queue'}]}
+            ]}
+        return {'$map': {
+            'input': {'$filter': {
+                'input': {'$range': [0, {'$size': '$queue'}]},
+                'as': 'i',
+                'cond': {'$not': [{'$in': ['$$i', list(idxs)]}]}
+            }},
+            'as': 'i',
+            'in': {'$arrayElemAt': ['$queue', '$$i']}
+        }}
+
+    def _history(self, record):
+        """
+        pipeline expression for ``history`` with ``record`` (an expression)
+        added, keeping the last ``history_size``
+        """
+        return {'$slice': [{'$concatArrays': [{'$ifNull': ['$history', []]}, [record]]}, -self.history_size]}
+
+    def _record_append(self, update, entries):
+        """add the recording of an append of ``entries`` to an update, if keeping history"""
+        if self.history_size == 0:
+            return
+        record = {'op': 'append', 'at': time.time(), 'entries': entries}
+        if isinstance(update, list):
+            update[0]['$set']['history'] = self._history({'$literal': record})
+        else:
+            update['$push']['history'] = {'$each': [record], '$slice': -self.history_size}
+
+    def _record_pop(self, update, idxs):
+        """
+        add the recording of a pop of the entries at ``idxs`` to a pipeline
+        update, if keeping history
+        """
+        if self.history_size == 0:
+            return
+        update[0]['$set']['history'] = self._history({
+            'op': 'pop', 'at': time.time(), 'idxs': {'$literal': list(idxs)},
+            'entries': [{'$arrayElemAt': ['$queue', i]} for i in idxs],
+        })
+
+    def _purge(self, name, now):
+        """
+        remove the items of a queue that expired by ``now``, returning
+        whether there were any
+        """
+        res = self.db.helga_queue.update_one(
+            {'_id': name, 'queue.expires': {'$lte': now}},
+            [{'$set': {'queue': live(now), 'version': NEXT_VERSION}}]
+        )
+        return res.modified_count == 1
+
+    def _modify_live(self, name, query, update, **kwargs):
+        """
+        find-and-modify that only matches a queue without expired items, so
+        that indexes into ``queue`` are the same as those seen by reads,
+        purging expired items and trying again if needed
+        """
+        now = time.time()
+        query['queue.expires'] = {'$not': {'$lte': now}}
+        res = self.db.helga_queue.find_one_and_update(query, update, **kwargs)
+        if res is None and self._purge(name, now):
+            res = self.db.helga_queue.find_one_and_update(query, update, **kwargs)
+        return res
+
+    def pop(self, name, idx=0):
+        """single find-and-modify that only returns the removed item"""
+        if idx == 0 and self.history_size == 0:
+            update = {'$pop': {'queue': -1}, '$inc': {'version': 1}}
+        else:
+            # aggregation pipeline update (MongoDB >= 4.2) splicing out idx
+            update = [{'$set': {
+                'queue': {'$concatArrays': [
+                    {'$slice': ['$queue', idx]},
+                    {'$slice': ['$queue', idx + 1, {'$size': '$queue'}]}
+                ]},
+                'version': NEXT_VERSION,
+            }}]
+            self._record_pop(update, [idx])
+        res = self._modify_live(
+            name,
+            {'_id': name, 'queue.{i}'.format(i=idx): {'$exists': True}},
+            update,
+            projection={'queue': {'$slice': [idx, 1]}}
+        )
+        if res is None or len(res['queue']) == 0:
+            return None
+        return item_of(res['queue'][0])
+
+    def pop_many(self, name, idxs):
+        """
+        single find-and-modify with a pipeline update, returning only the
+        span of the queue holding the removed items
+        """
+        first, last = idxs[0], idxs[-1]
+        update = [{'$set': {'queue': self._without(idxs), 'version': NEXT_VERSION}}]
+        self._record_pop(update, idxs)
+        res = self._modify_live(
+            name,
+            {'_id': name, 'queue.{i}'.format(i=last): {'$exists': True}},
+            update,
+            projection={'queue': {'$slice': [first, last - first + 1]}}
+        )
+        if res is None or len(res['queue']) <= last - first:
+            return None
+        return [item_of(res['queue'][i - first]) for i in idxs]
+
+    def length(self, name):
+        """computed on the server with ``$size`` of the items not expired"""
+        res = list(self.db.helga_queue.aggregate([
+            {'$match': {'_id': name}},
+            {'$project': {'n': {'$size': live(time.time())}}}
+        ]))
+        if len(res) == 0:
+            return 0
+        return res[0]['n']
+
+    def stamp(self, name):
+        """the version and the ``$size`` of the items not expired, in one aggregation"""
+        res = list(self.db.helga_queue.aggregate([
+            {'$match': {'_id': name}},
+            {'$project': {'version': 1, 'n': {'$size': live(time.time())}}}
+        ]))
+        if len(res) == 0:
+            return 0, 0
+        return res[0].get('version', 0), res[0]['n']
+
+    def range(self, name, start, count):
+        """
+        ``$slice`` of the items not expired, on the server, so only that
+        page is transferred
+        """
+        res = list(self.db.helga_queue.aggregate([
+            {'$match': {'_id': name}},
+            {'$project': {'queue': {'$slice': [live_items(time.time()), start, count]}}}
+        ]))
+        if len(res) == 0:
+            return []
+        return res[0]['queue']
+
+    def set_owner(self, name, owner, channel):
+        """single upserting pipeline update that keeps existing values"""
+        self._ensure_indexes()
+        self.db.helga_queue.update_one({'_id': name}, [{'$set': {
+            'queue': {'$ifNull': ['$queue', []]},
+            'owner': {'$ifNull': ['$owner', owner]},
+            'channel': {'$ifNull': ['$channel', channel]},
+        }}], upsert=True)
+
+    def queues(self, owner=None, channel=None):
+        """one aggregation, using the ``owner`` / ``channel`` indexes to filter"""
+        self._ensure_indexes()
+        match = {}
+        if owner is not None:
+            match['owner'] = owner
+        if channel is not None:
+            match['channel'] = {'$regex': '^' + re.escape(channel)}
+        now = time.time()
+        res = self.db.helga_queue.aggregate([
+            {'$match': match},
+            {'$sort': {'_id': 1}},
+            {'$project': {
+                'length': {'$size': live(now)},
+                'head': {'$arrayElemAt': [live_items(now), 0]},
+                'owner': 1,
+                'channel': 1,
+            }},
+        ])
+        return [
+            {'name': doc['_id'], 'length': doc['length'], 'head': doc.get('head'),
+             'owner': doc.get('owner'), 'channel': doc.get('channel')}
+            for doc in res
+        ]
+
+    def search(self, terms, name=None):
+        """
+        ``$text`` index lookup of the queues holding all of ``terms``, plus
+        those with items that expire or have a priority (which the text
+        index doesn't cover),
+        then a server-side filter of their items, so only matches are
+        transferred
+        """
+        self._ensure_indexes()
+        now = time.time()
+        match = {'$or': [
+            {'$text': {'$search': ' '.join('"{t}"'.format(t=t) for t in terms)}},
+            {'queue.expires': {'$gt': now}},
+            {'queue.p': {'$gt': 0}},
+        ]}
+        if name is not None:
+            match['_id'] = name
+        item = {'$arrayElemAt': ['$$items', '$$i']}
+        cond = {'$and': [
+            {'$regexMatch': {'input': item, 'regex': r'\b' + re.escape(t) + r'\b', 'options': 'i'}}
+            for t in terms
+        ]}
+        res = self.db.helga_queue.aggregate([
+            {'$match': match},
+            {'$sort': {'_id': 1}},
+            {'$project': {'hits': {'$let': {'vars': {'items': live_items(now)}, 'in': {'$map': {
+                'input': {'$filter': {'input': {'$range': [0, {'$size': '$$items'}]}, 'as': 'i', 'cond': cond}},
+                'as': 'i',
+                'in': {'idx': '$$i', 'item': item}
+            }}}}}},
+        ])
+        return [(doc['_id'], hit['idx'], hit['item']) for doc in res for hit in doc['hits']]
+
+    def claim(self, name, nick, expires):
+        """
+        single find-and-modify with a pipeline update moving the first item
+        into ``claims``, returning only the new claim
+        """
+        self._ensure_indexes()
+        res = self._modify_live(
+            name,
+            {'_id': name, 'queue.0': {'$exists': True}},
+            [
+                {'$set': {'claim_seq': {'$add': [{'$ifNull': ['$claim_seq', 0]}, 1]}}},
+                {'$set': {
+                    'claims': {'$concatArrays': [{'$ifNull': ['$claims', []]}, [{
+                        'id': '$claim_seq',
+                        'item': unwrap({'$arrayElemAt': ['$queue', 0]}),
+                        'nick': {'$literal': nick},
+                        'expires': {'$literal': expires},
+                    }]]},
+                    'queue': {'$slice': ['$queue', 1, {'$size': '$queue'}]},
+                    'version': NEXT_VERSION,
+                }},
+            ],
+            projection={'claims': {'$slice': -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if res is None:
+            return None
+        return res['claims'][0]['id'], res['claims'][0]['item']
+
+    def ack(self, name, nick, claim_id):
+        """single find-and-modify ``$pull``, returning only that claim"""
+        res = self.db.helga_queue.find_one_and_update(
+            {'_id': name, 'claims': {'$elemMatch': {'id': claim_id, 'nick': nick}}},
+            {'$pull': {'claims': {'id': claim_id}}},
+            projection={'claims': {'$elemMatch': {'id': claim_id}}}
+        )
+        if res is None:
+            return None
+        return res['claims'][0]['item']
+
+    def release(self, name, nick, claim_id):
+        """
+        single find-and-modify with a pipeline update moving the claimed
+        item back to the front of ``queue``
+        """
+        res = self.db.helga_queue.find_one_and_update(
+            {'_id': name, 'claims': {'$elemMatch': {'id': claim_id, 'nick': nick}}},
+            self._unclaim({'$eq': ['$$c.id', claim_id]}),
+            projection={'claims': {'$elemMatch': {'id': claim_id}}}
+        )
+        if res is None:
+            return None
+        return res['claims'][0]['item']
+
+    def reap(self, now):
+        """
+        finds the queues holding expired claims with the ``claims.expires``
+        index, then returns their items with one multi-document pipeline
+        update
+        """
+        self._ensure_indexes()
+        names = sorted(self.db.helga_queue.distinct('_id', {'claims.expires': {'$lt': now}}))
+        if len(names) > 0:
+            self.db.helga_queue.update_many(
+                {'_id': {'$in': names}}, self._unclaim({'$lt': ['$$c.expires', now]})
+            )
+        return names
+
+    def _unclaim(self, cond):
+        """
+        pipeline update moving the items of the claims matching ``cond``
+        (an expression on ``$$c``) to the front of ``queue``, in claim order,
+        with the priority of the head
+        """
+        q = {'$ifNull': ['$queue', []]}
+        head = {'$let': {'vars': {'h': {'$arrayElemAt': [q, 0]}}, 'in': priority_of('$$h')}}
+        return [{'$set': {
+            'queue': {'$let': {'vars': {'p': head}, 'in': {'$concatArrays': [
+                {'$map': {'input': {'$filter': {'input': '$claims', 'as': 'c', 'cond': cond}}, 'as': 'c', 'in': {
+                    '$cond': [{'$gt': ['$$p', 0]}, {'item': '$$c.item', 'p': '$$p'}, '$$c.item']
+                }}},
+                q
+            ]}}},
+            'claims': {'$filter': {'input': '$claims', 'as': 'c', 'cond': {'$not': [cond]}}},
+            'version': NEXT_VERSION,
+        }}]
+
+    def schedule(self, name, item, due, channel=None):
+        """single upserting ``$push``, keeping ``scheduled`` sorted by due time"""
+        self._ensure_indexes()
+        self.db.helga_queue.update_one(
+            {'_id': name},
+            {
+                '$push': {'scheduled': {
+                    '$each': [{'item': item, 'due': due, 'channel': channel}], '$sort': {'due': 1}
+                }},
+                '$setOnInsert': {'queue': []},
+            },
+            upsert=True
+        )
+
+    def scheduled_times(self):
+        """reads only the due times, from the queues the index says have any"""
+        self._ensure_indexes()
+        res = self.db.helga_queue.find({'scheduled.due': {'$exists': True}}, {'scheduled.due': 1})
+        return sorted(s['due'] for doc in res for s in doc.get('scheduled', []))
+
+    def deliver_due(self, now):
+        """
+        finds the queues with due items with the ``scheduled.due`` index,
+        then moves each queue's due items with one find-and-modify
+        """
+        self._ensure_indexes()
+        due = {'$lte': ['$$s.due', now]}
+        delivered = []
+        for name in sorted(self.db.helga_queue.distinct('_id', {'scheduled.due': {'$lte': now}})):
+            res = self.db.helga_queue.find_one_and_update(
+                {'_id': name, 'scheduled.due': {'$lte': now}},
+                [{'$set': {
+                    'queue': {'$concatArrays': [
+                        {'$ifNull': ['$queue', []]},
+                        {'$map': {'input': {'$filter': {'input': '$scheduled', 'as': 's', 'cond': due}},
+                                  'as': 's', 'in': '$$s.item'}}
+                    ]},
+                    'scheduled': {'$filter': {'input': '$scheduled', 'as': 's', 'cond': {'$not': [due]}}},
+                    'version': NEXT_VERSION,
+                }}],
+                projection={'scheduled': 1}
+            )
+            if res is None:
+                # another process delivered them first
+                continue
+            delivered.extend((s['due'], name, s['item'], s.get('channel'))
+                             for s in res['scheduled'] if s['due'] <= now)
+        return [d[1:] for d in sorted(delivered, key=lambda d: d[0])]
+
+    def is_empty(self, name):
+        """checks only for the existence of an item that hasn't expired"""
+        res = self.db.helga_queue.find_one(
+            {'_id': name, '$or': [
+                {'queue': {'$type': 'string'}},
+                {'queue': {'$elemMatch': {'item': {'$exists': True}, 'expires': {'$exists': False}}}},
+                {'queue.expires': {'$gt': time.time()}},
+            ]},
+            {'_id': 1}
+        )
+        return res is None
+
+    def ttls(self):
+        """reads only the queues the sparse ``ttl`` index has"""
+        self._ensure_indexes()
+        res = self.db.helga_queue.find({'ttl': {'$exists': True}}, {'ttl': 1})
+        return dict((doc['_id'], doc['ttl']) for doc in res)
+
+    def set_ttl(self, name, ttl):
+        self._ensure_indexes()
+        if ttl is None:
+            self.db.helga_queue.update_one({'_id': name}, {'$unset': {'ttl': ''}})
+        else:
+            self.db.helga_queue.update_one(
+                {'_id': name}, {'$set': {'ttl': ttl}, '$setOnInsert': {'queue': []}}, upsert=True
+            )
+
+    def expire(self, now, limit):
+        """
+        finds up to ``limit`` queues with expired items with the
+        ``queue.expires`` index, then drops their expired items with one
+        multi-document pipeline update
+        """
+        self._ensure_indexes()
+        res = self.db.helga_queue.find({'queue.expires': {'$lte': now}}, {'_id': 1}).limit(limit)
+        names = sorted(doc['_id'] for doc in res)
+        if len(names) > 0:
+            self.db.helga_queue.update_many(
+                {'_id': {'$in': names}}, [{'$set': {'queue': live(now), 'version': NEXT_VERSION}}]
+            )
+        return names, len(names) == limit
+
+    def history(self, name, count):
+        """``$slice`` of ``history`` on the server"""
+        res = list(self.db.helga_queue.aggregate([
+            {'$match': {'_id': name}},
+            {'$project': {'history': {'$slice': [{'$ifNull': ['$history', []]}, -count]}}}
+        ]))
+        if len(res) == 0:
+            return []
+        return [public_change(change_of(r)) for r in res[0]['history']]
+
+    def undo(self, name):
+        """
+        reads the queue and its last change, then writes the reverted queue
+        and pops the change with one update conditional on ``version``,
+        retrying like :py:meth:`~helga_queue.backends.base.Backend.update`
+        """
+        delay = CAS_BACKOFF
+        for _ in range(CAS_RETRIES):
+            doc = self.db.helga_queue.find_one({'_id': name}, {'queue': 1, 'version': 1, 'history': 1})
+            if doc is None or len(doc.get('history', [])) == 0:
+                return None
+            change = change_of(doc['history'][-1])
+            old = [(e[0], e[1:]) for e in live_entries(doc.get('queue', []), time.time())]
+            kept = sorted(revert(old, change), key=lambda e: -e[1][1])
+            if doc.get('version', 0) == 0:
+                query = {'_id': name, 'version': {'$exists': False}}
+            else:
+                query = {'_id': name, 'version': doc['version']}
+            res = self.db.helga_queue.update_one(query, {
+                '$set': {'queue': [entry_of(item, expires, priority) for item, (expires, priority) in kept]},
+                '$pop': {'history': 1},
+                '$inc': {'version': 1},
+            })
+            if res.matched_count == 1:
+                return public_change(change)
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, CAS_MAX_BACKOFF)
+        raise ConflictError("undo of queue '{n}' conflicted {c} times".format(n=name, c=CAS_RETRIES))
+
+    def move(self, name, target, idxs=None):
+        """
+        two-phase: a find-and-modify moves the items into a ``moving``
+        record, then :py:meth:`_finish_move` adds them to the target and
+        drops the record; three round trips, whatever the number of items
+        """
+        self._ensure_indexes()
+        move_id = ObjectId()
+        if idxs is None:
+            query = {'_id': name, 'queue.0': {'$exists': True}}
+            remaining, entries = [], '$queue'
+        else:
+            query = {'_id': name, 'queue.{i}'.format(i=idxs[-1]): {'$exists': True}}
+            remaining, entries = self._without(idxs), [{'$arrayElemAt': ['$queue', i]} for i in idxs]
+        res = self._modify_live(
+            name,
+            query,
+            [{'$set': {
+                'queue': remaining,
+                'moving': {'$concatArrays': [{'$ifNull': ['$moving', []]}, [{
+                    'id': move_id, 'to': {'$literal': target}, 'at': time.time(), 'entries': entries
+                }]]},
+                'version': NEXT_VERSION,
+            }}],
+            projection={'moving': {'$elemMatch': {'id': move_id}}},
+            return_document=ReturnDocument.AFTER
+        )
+        if res is None:
+            return [] if idxs is None else None
+        move = res['moving'][0]
+        self._finish_move(name, move)
+        return [item_of(e) for e in move['entries']]
+
+    def _finish_move(self, name, move):
+        """
+        add the entries of a ``moving`` record of queue ``name`` to the
+        target, in priority order, unless that was already done, then drop
+        the record
+        """
+        stages = []
+        for priority in sorted(set(unpack(e)[2] for e in move['entries']), reverse=True):
+            entries = [e for e in move['entries'] if unpack(e)[2] == priority]
+            stages.append({'$set': {'queue': self._inserted(entries, priority)}})
+        stages.append({'$set': {
+            'moved_in': {'$slice': [
+                {'$concatArrays': [{'$ifNull': ['$moved_in', []]}, [move['id']]]}, -MOVED_IN_SIZE
+            ]},
+            'version': NEXT_VERSION,
+        }})
+        try:
+            self.db.helga_queue.update_one({'_id': move['to'], 'moved_in': {'$ne': move['id']}}, stages, upsert=True)
+        except DuplicateKeyError:
+            # the target exists and already has the items
+            pass
+        self.db.helga_queue.update_one({'_id': name}, {'$pull': {'moving': {'id': move['id']}}})
+
+    def recover_moves(self, now):
+        """
+        finds the queues with moves started over ``MOVE_TIMEOUT`` seconds
+        ago with the ``moving.at`` index, and finishes them
+        """
+        self._ensure_indexes()
+        cutoff = now - MOVE_TIMEOUT
+        names = set()
+        for doc in self.db.helga_queue.find({'moving.at': {'$lte': cutoff}}, {'moving': 1}):
+            for move in doc['moving']:
+                if move['at'] <= cutoff:
+                    self._finish_move(doc['_id'], move)
+                    names.update([doc['_id'], move['to']])
+        return sorted(names)
+
+    def export(self, name=None, batch_size=1000):
+        """
+        streams the queue documents through one cursor in ``_id`` order;
+        the server also caps each cursor batch at 16MB
+        """
+        query = {} if name is None else {'_id': name}
+        now = time.time()
+        cursor = self.db.helga_queue.find(query, {'queue': 1}, sort=[('_id', ASCENDING)], batch_size=batch_size)
+        for doc in cursor:
+            for entry in doc.get('queue') or []:
+                item, expires, priority = unpack(entry)
+                if expires is None or expires > now:
+                    yield doc['_id'], item, expires, priority
@@ -0,0 +1,884 @@
+"""
+Segmented MongoDB storage layout for very large queues.
+
+Instead of one ``helga_queue`` document holding the whole ``queue`` array,
+each queue has a small metadata document in ``helga_queue_meta``::
+
+    {'_id': <queue name>, 'head': <abs index of first item>,
+     'tail': <abs index of next append>, 'version': <int>,
+     'owner': <creator nick>, 'channel': <channel created in>,
+     'claim_seq': <last claim id>,
+     'scheduled': [{'item': <item>, 'due': <unix time>,
+                    'channel': <channel to announce in>}, ...]}
+
+and its items live in fixed-size segment documents in
+``helga_queue_segments``::
+
+    {'_id': '<queue name>:<segment number>', 'q': <queue name>,
+     'n': <segment number>, 'items': {'<offset>': <item>, ...}}
+
+where an item's absolute index ``i`` lives in segment ``i // segment_size``
+at offset ``i % segment_size``. Appends reserve a slot by incrementing
+``tail`` and write only the tail segment; head pops read the head slot and
+then move ``head`` past it with a compare-and-set, touching only the head
+segment (deleting it once it is used up), so both are a constant number of
+small round trips regardless of queue length.
+
+Pops from the middle of a queue shift the items before it, under a short
+lock on the metadata document, with one write per segment shifted, and
+only then move ``head``; so they cost O(index), and a failed shift pops
+nothing. Every write increments
+``version``; a compare-and-set takes the lock only if ``version`` is still
+the one it read, and appends wait while a queue is locked.
+
+Segments have a wildcard text index, so a search only reads the segments
+holding matching items.
+
+Claimed items are head pops that move to ``helga_queue_claims``::
+
+    {'_id': '<queue name>:<claim id>', 'q': <queue name>, 'id': <claim id>,
+     'item': <item>, 'nick': <nick>, 'expires': <unix time>}
+
+and are put back by decrementing ``head`` and writing the slot before it.
+Unlike the single-document layout, moving an item between its queue and
+its claim is two writes, not one. Scheduled items wait in ``scheduled``,
+indexed on ``scheduled.due``; delivering them reserves their slots at the
+tail in the same update that removes them, then writes the slots.
+
+Item expiry and priorities aren't supported: filtering expired items out
+of a range of slots, or inserting items in front of others, would stop
+reads and pops from addressing segments by index.
+
+Queues still in the single-document layout are migrated the first time the
+backend is used, keeping their owner and channel, claims and scheduled
+items; the original documents are kept in ``helga_queue_migrated``. Queues
+with items that expire or have a priority, a TTL, or a move in progress,
+or whose name a segmented queue already has, are left where they are, and
+the backend refuses to start until they are dealt with.
+"""
+
+import re
+import time
+
+from pymongo import ASCENDING, DESCENDING, TEXT, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from helga_queue.backends.base import Backend, ConflictError, matches
+from helga_queue.backends.mongo import NEXT_VERSION, live_entries
+
+# seconds after which a lock left behind by a dead process may be broken
+LOCK_TIMEOUT = 30
+
+# how many times to retry an operation blocked by a lock, or a read of a
+# slot that a concurrent append has reserved but not yet written
+RETRIES = 50
+RETRY_DELAY = 0.01
+
+
+class SegmentedMongoBackend(Backend):
+    """
+    MongoDB backend using the segmented layout.
+
+    :param db: pymongo database
+    :type db: pymongo.database.Database
+    :param segment_size: number of items per segment document
+    :type segment_size: int
+    """
+
+    name = 'mongo-segmented'
+
+    def __init__(self, db, segment_size=1000):
+        self.db = db
+        self.segment_size = segment_size
+        self._ready = False
+
+    def _ensure_ready(self):
+        """create indexes and migrate legacy queues, once"""
+        if self._ready:
+            return
+        self.db.helga_queue_segments.create_index([('q', ASCENDING), ('n', ASCENDING)])
+        self.db.helga_queue_meta.create_index([('owner', ASCENDING)])
+        self.db.helga_queue_meta.create_index([('channel', ASCENDING)])
+        self.db.helga_queue_segments.create_index([('$**', TEXT)], default_language='none')
+        self.db.helga_queue_claims.create_index([('expires', ASCENDING)])
+        self.db.helga_queue_meta.create_index([('scheduled.due', ASCENDING)], sparse=True)
+        # until every queue has been migrated, nothing is served, rather
+        # than serving the queues that were left behind as empty
+        self.migrate_all()
+        self._ready = True
+
+    def _seg_id(self, name, n):
+        return '{q}:{n}'.format(q=name, n=n)
+
+    def _locate(self, abs_idx):
+        """return (segment number, offset key) for an absolute index"""
+        return abs_idx // self.segment_size, str(abs_idx % self.segment_size)
+
+    def _meta(self, name):
+        res = self.db.helga_queue_meta.find_one({'_id': name})
+        if res is None:
+            return {'_id': name, 'head': 0, 'tail': 0}
+        return res
+
+    def _read(self, name, first, count):
+        """
+        Return items at absolute indexes ``first`` to ``first + count - 1``,
+        fetching only the segments (and offsets) that hold them.
+        """
+        if count <= 0:
+            return []
+        wanted = {}
+        for abs_idx in range(first, first + count):
+            n, off = self._locate(abs_idx)
+            wanted.setdefault(n, []).append(off)
+        items = {}
+        for n, offsets in wanted.items():
+            projection = dict(('items.' + off, 1) for off in offsets)
+            seg = self.db.helga_queue_segments.find_one({'_id': self._seg_id(name, n)}, projection)
+            seg_items = {} if seg is None else seg.get('items', {})
+            for off in offsets:
+                if off in seg_items:
+                    items[n * self.segment_size + int(off)] = seg_items[off]
+        return [items[i] for i in range(first, first + count) if i in items]
+
+    def _read_one(self, name, abs_idx):
+        """read one item, waiting for a concurrent append to finish writing it"""
+        for _ in range(RETRIES):
+            res = self._read(name, abs_idx, 1)
+            if len(res) > 0:
+                return res[0]
+            time.sleep(RETRY_DELAY)
+        return None
+
+    def _read_all(self, name, first, count):
+        """
+        Read items at absolute indexes ``first`` to ``first + count - 1``,
+        waiting for concurrent appends to finish writing their slots.
+
+        :raises: :py:exc:`~helga_queue.backends.base.ConflictError` if a
+          slot stays unwritten
+        """
+        for _ in range(RETRIES):
+            items = self._read(name, first, count)
+            if len(items) == count:
+                return items
+            time.sleep(RETRY_DELAY)
+        raise ConflictError("queue '{n}' has a slot an append never wrote".format(n=name))
+
+    def _write_many(self, name, first, items, segments=None, written=None):
+        """
+        Write items to consecutive slots from absolute index ``first``, with
+        one update per segment.
+
+        :param segments: only write the slots in these segment numbers
+        :type segments: list
+        :param written: list the number of each segment is appended to once
+          it has been written
+        :type written: list
+        """
+        segs = {}
+        for abs_idx, item in enumerate(items, first):
+            n, off = self._locate(abs_idx)
+            if segments is None or n in segments:
+                segs.setdefault(n, {})['items.' + off] = item
+        for n, fields in sorted(segs.items()):
+            self.db.helga_queue_segments.update_one(
+                {'_id': self._seg_id(name, n)},
+                {'$set': fields, '$setOnInsert': {'q': name, 'n': n}},
+                upsert=True
+            )
+            if written is not None:
+                written.append(n)
+
+    def _write(self, name, abs_idx, item):
+        n, off = self._locate(abs_idx)
+        self.db.helga_queue_segments.update_one(
+            {'_id': self._seg_id(name, n)},
+            {'$set': {'items.' + off: item}, '$setOnInsert': {'q': name, 'n': n}},
+            upsert=True
+        )
+
+    def _drop_segments_before(self, name, abs_idx):
+        """delete segments wholly before absolute index ``abs_idx``"""
+        n = abs_idx // self.segment_size
+        if n > 0:
+            self.db.helga_queue_segments.delete_many({'q': name, 'n': {'$lt': n}})
+
+    def length(self, name):
+        """
+        :param name: name of the queue
+        :type name: string
+        :rtype: int
+        """
+        self._ensure_ready()
+        meta = self._meta(name)
+        return meta['tail'] - meta['head']
+
+    def stamp(self, name):
+        """
+        :param name: name of the queue
+        :type name: string
+        :rtype: tuple
+        """
+        self._ensure_ready()
+        meta = self._meta(name)
+        return meta.get('version', 0), meta['tail'] - meta['head']
+
+    def range(self, name, start, count):
+        """
+        :param name: name of the queue
+        :type name: string
+        :param start: index of the first item
+        :type start: int
+        :param count: maximum number of items
+        :type count: int
+        :rtype: list
+        """
+        self._ensure_ready()
+        meta = self._meta(name)
+        first = meta['head'] + start
+        count = min(count, meta['tail'] - first)
+        return self._read(name, first, count)
+
+    def get(self, name):
+        """
+        :param name: name of the queue
+        :type name: string
+        :rtype: list
+        """
+        self._ensure_ready()
+        meta = self._meta(name)
+        items = {}
+        for seg in self.db.helga_queue_segments.find({'q': name}):
+            base = seg['n'] * self.segment_size
+            for off, item in seg.get('items', {}).items():
+                items[base + int(off)] = item
+        return [items[i] for i in range(meta['head'], meta['tail']) if i in items]
+
+    def set(self, name, q):
+        """
+        Replace the whole contents of a queue. Unlike the other operations,
+        this is not atomic with respect to concurrent writers.
+
+        :param name: name of the queue
+        :type name: string
+        :param q: new queue contents
+        :type q: list
+        """
+        self._ensure_ready()
+        self._replace(name, q)
+
+    def _replace(self, name, q):
+        self.db.helga_queue_segments.delete_many({'q': name})
+        segs = {}
+        for abs_idx, item in enumerate(q):
+            n, off = self._locate(abs_idx)
+            segs.setdefault(n, {})[off] = item
+        if len(segs) > 0:
+            self.db.helga_queue_segments.insert_many([
+                {'_id': self._seg_id(name, segno), 'q': name, 'n': segno, 'items': items}
+                for segno, items in sorted(segs.items())
+            ])
+        self.db.helga_queue_meta.update_one(
+            {'_id': name}, {'$set': {'head': 0, 'tail': len(q)}, '$inc': {'version': 1}}, upsert=True
+        )
+
+    def get_versioned(self, name):
+        """
+        :param name: name of the queue
+        :type name: string
+        :returns: ``(contents, version)``
+        :rtype: tuple
+        """
+        self._ensure_ready()
+        meta = self.db.helga_queue_meta.find_one({'_id': name})
+        if meta is None:
+            return [], None
+        # a truncated read would be written back by compare_and_set
+        q = self._read_all(name, meta['head'], meta['tail'] - meta['head'])
+        return q, meta.get('version', 0)
+
+    def compare_and_set(self, name, q, version):
+        """
+        Replace the contents of a queue under its lock, if its version is
+        still ``version``.
+
+        :param name: name of the queue
+        :type name: string
+        :param q: new queue contents
+        :type q: list
+        :param version: version returned by :py:meth:`get_versioned`
+        :rtype: bool
+        """
+        self._ensure_ready()
+        if version is None:
+            try:
+                self.db.helga_queue_meta.insert_one(
+                    {'_id': name, 'head': 0, 'tail': 0, 'locked': True, 'locked_at': time.time()}
+                )
+            except DuplicateKeyError:
+                return False
+        else:
+            query = {'_id': name, 'locked': {'$ne': True}}
+            if version == 0:
+                query['version'] = {'$exists': False}
+            else:
+                query['version'] = version
+            for _ in range(RETRIES):
+                meta = self.db.helga_queue_meta.find_one_and_update(
+                    query, {'$set': {'locked': True, 'locked_at': time.time()}}
+                )
+                if meta is not None:
+                    break
+                if not self._wait_for_lock(name):
+                    # not locked, so the version has moved on
+                    return False
+            else:
+                return False
+        try:
+            self._replace(name, q)
+        finally:
+            self.db.helga_queue_meta.update_one({'_id': name}, {'$unset': {'locked': '', 'locked_at': ''}})
+        return True
+
+    def _reserve(self, name, count, front=False):
+        """
+        Reserve ``count`` slots at the tail, or just before the head if
+        ``front``, waiting while the queue is locked.
+
+        :returns: absolute index of the first reserved slot
+        :rtype: int
+        """
+        if front:
+            field, other, step = 'head', 'tail', -count
+        else:
+            field, other, step = 'tail', 'head', count
+        for _ in range(RETRIES):
+            try:
+                meta = self.db.helga_queue_meta.find_one_and_update(
+                    {'_id': name, 'locked': {'$ne': True}},
+                    {'$inc': {field: step, 'version': 1}, '$setOnInsert': {other: 0}},
+                    projection={field: 1},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+            except DuplicateKeyError:
+                # the document exists, but is locked
+                self._wait_for_lock(name)
+                continue
+            return meta['head'] if front else meta['tail'] - count
+        raise ConflictError("queue '{n}' stayed locked".format(n=name))
+
+    def append(self, name, item, expires=None, priority=0):
+        """
+        Append an item, touching only the metadata and tail segment.
+
+        :param name: name of the queue
+        :type name: string
+        :param item: item to append
+        :type item: string
+        :param expires: must be None; item expiry isn't supported
+        :param priority: must be 0; priorities aren't supported
+        :raises: NotImplementedError if ``expires`` or ``priority`` is given
+        """
+        if expires is not None or priority != 0:
+            raise NotImplementedError()
+        self._ensure_ready()
+        self._write(name, self._reserve(name, 1), item)
+
+    def append_many(self, name, items, expires=None, priority=0):
+        """
+        Append several items, reserving all of their slots with one
+        metadata update and writing each affected segment once.
+
+        :param name: name of the queue
+        :type name: string
+        :param items: items to append
+        :type items: list
+        :param expires: must be None; item expiry isn't supported
+        :param priority: must be 0; priorities aren't supported
+        :raises: NotImplementedError if ``expires`` or ``priority`` is given
+        """
+        if expires is not None or priority != 0:
+            raise NotImplementedError()
+        items = list(items)
+        if len(items) == 0:
+            return
+        self._ensure_ready()
+        self._write_many(name, self._reserve(name, len(items)), items)
+
+    def pop(self, name, idx=0):
+        """
+        Remove and return the item at ``idx``.
+
+        :param name: name of the queue
+        :type name: string
+        :param idx: index of the item to remove
+        :type idx: int
+        :returns: the removed item, or None if there is no item at ``idx``
+        :rtype: string or None
+        """
+        self._ensure_ready()
+        if idx == 0:
+            res = self._pop_head(name)
+            return None if res is None else res[0]
+        return self._pop_index(name, idx)
+
+    def _pop_head(self, name, inc=None):
+        """
+        Remove and return the first item, also applying the ``$inc`` of
+        ``inc`` to the metadata document. The item is read before ``head``
+        is moved past it, with a compare-and-set on ``head``, so a
+        concurrent pop can't drop its segment first, and pops commit in slot
+        order.
+
+        :returns: ``(item, metadata before the update)``, or None if the
+          queue is empty
+        :rtype: tuple or None
+        :raises: :py:exc:`~helga_queue.backends.base.ConflictError` if the
+          head slot stays unwritten or the queue stays too busy to pop from
+        """
+        update = {'head': 1, 'version': 1}
+        update.update(inc or {})
+        projection = dict((k, 1) for k in update if k != 'version')
+        for _ in range(RETRIES):
+            meta = self._meta(name)
+            if meta['head'] >= meta['tail']:
+                return None
+            if meta.get('locked', False):
+                self._wait_for_lock(name)
+                continue
+            items = self._read(name, meta['head'], 1)
+            if len(items) == 0:
+                # an append hasn't written the slot yet, or another pop
+                # has taken it
+                time.sleep(RETRY_DELAY)
+                continue
+            res = self.db.helga_queue_meta.find_one_and_update(
+                {'_id': name, 'head': meta['head'], 'locked': {'$ne': True}},
+                {'$inc': update},
+                projection=projection
+            )
+            if res is not None:
+                break
+        else:
+            raise ConflictError("queue '{n}' stayed too busy to pop from".format(n=name))
+        # every pop of an earlier slot has committed, so nothing still
+        # needs the segments before the new head
+        if (res['head'] + 1) % self.segment_size == 0:
+            self._drop_segments_before(name, res['head'] + 1)
+        return items[0], res
+
+    def pop_many(self, name, idxs):
+        """
+        Remove and return the items at several indexes, all or nothing.
+        Costs O(largest index), like a single pop from the middle.
+
+        :param name: name of the queue
+        :type name: string
+        :param idxs: indexes of the items to remove, sorted and unique
+        :type idxs: list
+        :returns: the removed items, in index order, or None if there is no
+          item at one of ``idxs``
+        :rtype: list or None
+        """
+        self._ensure_ready()
+        return self._pop_indexes(name, idxs)
+
+    def _pop_index(self, name, idx):
+        res = self._pop_indexes(name, [idx])
+        if res is None:
+            return None
+        return res[0]
+
+    def _pop_indexes(self, name, idxs):
+        last = idxs[-1]
+        for _ in range(RETRIES):
+            meta = self.db.helga_queue_meta.find_one_and_update(
+                {'_id': name, 'locked': {'$ne': True},
+                 '$expr': {'$lt': [{'$add': ['$head', last]}, '$tail']}},
+                {'$set': {'locked': True, 'locked_at': time.time()}}
+            )
+            if meta is not None:
+                break
+            if not self._wait_for_lock(name):
+                return None
+        else:
+            return None
+        head = meta['head']
+        count = len(idxs)
+        drop = set(idxs)
+        written = []
+        shifted = False
+        try:
+            prefix = self._read_all(name, head, last + 1)
+            items = [prefix[i] for i in idxs]
+            # shift the survivors before the last index towards the tail
+            keep = [val for i, val in enumerate(prefix) if i not in drop]
+            self._write_many(name, head + count, keep, written=written)
+            shifted = True
+        finally:
+            if not shifted:
+                # head stays where it was, so nothing is popped; put back
+                # the segments that were already shifted
+                try:
+                    if len(written) > 0:
+                        self._write_many(name, head + count, prefix[count:], segments=written)
+                finally:
+                    self.db.helga_queue_meta.update_one({'_id': name}, {'$unset': {'locked': '', 'locked_at': ''}})
+        self.db.helga_queue_meta.update_one(
+            {'_id': name},
+            {'$inc': {'head': count, 'version': 1}, '$unset': {'locked': '', 'locked_at': ''}}
+        )
+        self._drop_segments_before(name, head + count)
+        return items
+
+    def set_owner(self, name, owner, channel):
+        """
+        :param name: name of the queue
+        :type name: string
+        :param owner: nick of the queue's creator
+        :type owner: string
+        :param channel: channel the queue was created in
+        :type channel: string
+        """
+        self._ensure_ready()
+        self.db.helga_queue_meta.update_one({'_id': name}, [{'$set': {
+            'head': {'$ifNull': ['$head', 0]},
+            'tail': {'$ifNull': ['$tail', 0]},
+            'owner': {'$ifNull': ['$owner', owner]},
+            'channel': {'$ifNull': ['$channel', channel]},
+        }}], upsert=True)
+
+    def queues(self, owner=None, channel=None):
+        """
+        Summarize every queue with one query of the metadata collection and
+        one of the head segments, however many queues there are.
+
+        :param owner: only include queues created by this nick
+        :type owner: string
+        :param channel: only include queues created in a channel starting
+          with this prefix
+        :type channel: string
+        :rtype: list
+        """
+        self._ensure_ready()
+        query = {}
+        if owner is not None:
+            query['owner'] = owner
+        if channel is not None:
+            query['channel'] = {'$regex': '^' + re.escape(channel)}
+        metas = list(self.db.helga_queue_meta.find(query).sort('_id', ASCENDING))
+        heads = {}
+        seg_ids = []
+        for meta in metas:
+            if meta['head'] < meta['tail']:
+                n, off = self._locate(meta['head'])
+                heads[meta['_id']] = (self._seg_id(meta['_id'], n), off)
+                seg_ids.append(self._seg_id(meta['_id'], n))
+        segs = {}
+        if len(seg_ids) > 0:
+            for seg in self.db.helga_queue_segments.find({'_id': {'$in': seg_ids}}):
+                segs[seg['_id']] = seg.get('items', {})
+        res = []
+        for meta in metas:
+            head = None
+            if meta['_id'] in heads:
+                seg_id, off = heads[meta['_id']]
+                head = segs.get(seg_id, {}).get(off)
+            res.append({
+                'name': meta['_id'], 'length': meta['tail'] - meta['head'], 'head': head,
+                'owner': meta.get('owner'), 'channel': meta.get('channel')
+            })
+        return res
+
+    def search(self, terms, name=None):
+        """
+        Find matching items, reading only the segments the text index says
+        hold all of ``terms``.
+
+        :param terms: words to search for
+        :type terms: list
+        :param name: only search this queue; None to search every queue
+        :type name: string
+        :returns: list of ``(queue name, index, item)``
+        :rtype: list
+        """
+        self._ensure_ready()
+        query = {'$text': {'$search': ' '.join('"{t}"'.format(t=t) for t in terms)}}
+        if name is not None:
+            query['q'] = name
+        found = []
+        for seg in self.db.helga_queue_segments.find(query, {'q': 1, 'n': 1, 'items': 1}):
+            base = seg['n'] * self.segment_size
+            for off, item in seg.get('items', {}).items():
+                if matches(item, terms):
+                    found.append((seg['q'], base + int(off), item))
+        if len(found) == 0:
+            return []
+        metas = dict(
+            (meta['_id'], meta) for meta in
+            self.db.helga_queue_meta.find({'_id': {'$in': sorted(set(f[0] for f in found))}})
+        )
+        res = []
+        for qname, abs_idx, item in found:
+            meta = metas.get(qname)
+            # skip slots already popped, but not yet dropped with their segment
+            if meta is not None and meta['head'] <= abs_idx < meta['tail']:
+                res.append((qname, abs_idx - meta['head'], item))
+        return sorted(res)
+
+    def claim(self, name, nick, expires):
+        """
+        Pop the first item, as :py:meth:`pop` does, and record the claim.
+
+        :param name: name of the queue
+        :type name: string
+        :param nick: nick claiming the item
+        :type nick: string
+        :param expires: unix time the lease expires at
+        :type expires: float
+        :returns: ``(claim id, item)``, or None if the queue is empty
+        :rtype: tuple or None
+        """
+        self._ensure_ready()
+        res = self._pop_head(name, {'claim_seq': 1})
+        if res is None:
+            return None
+        item, meta = res
+        claim_id = meta.get('claim_seq', 0) + 1
+        self.db.helga_queue_claims.insert_one({
+            '_id': '{q}:{c}'.format(q=name, c=claim_id), 'q': name, 'id': claim_id,
+            'item': item, 'nick': nick, 'expires': expires
+        })
+        return claim_id, item
+
+    def ack(self, name, nick, claim_id):
+        """
+        :param name: name of the queue
+        :type name: string
+        :param nick: nick holding the claim
+        :type nick: string
+        :param claim_id: id returned by :py:meth:`claim`
+        :type claim_id: int
+        :returns: the item, or None if ``nick`` holds no such claim
+        :rtype: string or None
+        """
+        self._ensure_ready()
+        doc = self.db.helga_queue_claims.find_one_and_delete(
+            {'_id': '{q}:{c}'.format(q=name, c=claim_id), 'nick': nick}
+        )
+        if doc is None:
+            return None
+        return doc['item']
+
+    def release(self, name, nick, claim_id):
+        """
+        :param name: name of the queue
+        :type name: string
+        :param nick: nick holding the claim
+        :type nick: string
+        :param claim_id: id returned by :py:meth:`claim`
+        :type claim_id: int
+        :returns: the item, or None if ``nick`` holds no such claim
+        :rtype: string or None
+        """
+        item = self.ack(name, nick, claim_id)
+        if item is not None:
+            self._write(name, self._reserve(name, 1, front=True), item)
+        return item
+
+    def reap(self, now):
+        """
+        :param now: current unix time
+        :type now: float
+        :returns: names of the queues items were returned to
+        :rtype: list
+        """
+        self._ensure_ready()
+        names = []
+        # newest first within each queue, so the oldest ends up at the head
+        expired = self.db.helga_queue_claims.find({'expires': {'$lt': now}}, {'_id': 1, 'q': 1})
+        for doc in expired.sort([('q', ASCENDING), ('id', DESCENDING)]):
+            # another reaper may have got there first
+            doc = self.db.helga_queue_claims.find_one_and_delete({'_id': doc['_id'], 'expires': {'$lt': now}})
+            if doc is None:
+                continue
+            self._write(doc['q'], self._reserve(doc['q'], 1, front=True), doc['item'])
+            if doc['q'] not in names:
+                names.append(doc['q'])
+        return names
+
+    def schedule(self, name, item, due, channel=None):
+        """
+        :param name: name of the queue
+        :type name: string
+        :param item: item to append
+        :type item: string
+        :param due: unix time the item is due at
+        :type due: float
+        :param channel: channel to announce the item in when it is due
+        :type channel: string
+        """
+        self._ensure_ready()
+        self.db.helga_queue_meta.update_one(
+            {'_id': name},
+            {
+                '$push': {'scheduled': {
+                    '$each': [{'item': item, 'due': due, 'channel': channel}], '$sort': {'due': 1}
+                }},
+                '$setOnInsert': {'head': 0, 'tail': 0},
+            },
+            upsert=True
+        )
+
+    def scheduled_times(self):
+        """
+        :returns: due times of every scheduled item
+        :rtype: list
+        """
+        self._ensure_ready()
+        res = self.db.helga_queue_meta.find({'scheduled.due': {'$exists': True}}, {'scheduled.due': 1})
+        return sorted(s['due'] for doc in res for s in doc.get('scheduled', []))
+
+    def deliver_due(self, now):
+        """
+        :param now: current unix time
+        :type now: float
+        :returns: list of ``(queue name, item, channel)``
+        :rtype: list
+        """
+        self._ensure_ready()
+        due = {'$lte': ['$$s.due', now]}
+        delivered = []
+        for name in sorted(self.db.helga_queue_meta.distinct('_id', {'scheduled.due': {'$lte': now}})):
+            for _ in range(RETRIES):
+                meta = self.db.helga_queue_meta.find_one_and_update(
+                    {'_id': name, 'locked': {'$ne': True}, 'scheduled.due': {'$lte': now}},
+                    [{'$set': {
+                        'tail': {'$add': [
+                            '$tail', {'$size': {'$filter': {'input': '$scheduled', 'as': 's', 'cond': due}}}
+                        ]},
+                        'scheduled': {'$filter': {'input': '$scheduled', 'as': 's', 'cond': {'$not': [due]}}},
+                        'version': NEXT_VERSION,
+                    }}],
+                    projection={'tail': 1, 'scheduled': 1}
+                )
+                if meta is not None:
+                    break
+                if not self._wait_for_lock(name):
+                    # another process delivered them first
+                    break
+            if meta is None:
+                continue
+            items = [s for s in meta['scheduled'] if s['due'] <= now]
+            for abs_idx, s in enumerate(items, meta['tail']):
+                self._write(name, abs_idx, s['item'])
+                delivered.append((s['due'], name, s['item'], s.get('channel')))
+        return [d[1:] for d in sorted(delivered, key=lambda d: d[0])]
+
+    def _wait_for_lock(self, name):
+        """
+        Wait briefly if ``name`` is locked, breaking a stale lock.
+
+        :returns: True if it makes sense to retry, False if the operation
+          failed because the queue is too short
+        """
+        meta = self.db.helga_queue_meta.find_one({'_id': name}, {'locked': 1, 'locked_at': 1})
+        if meta is None or not meta.get('locked', False):
+            return False
+        if time.time() - meta.get('locked_at', 0) > LOCK_TIMEOUT:
+            self.db.helga_queue_meta.update_one(
+                {'_id': name, 'locked_at': meta.get('locked_at')},
+                {'$unset': {'locked': '', 'locked_at': ''}}
+            )
+        else:
+            time.sleep(RETRY_DELAY)
+        return True
+
+    def migrate(self, name):
+        """
+        Move a queue from the single-document ``helga_queue`` layout to the
+        segmented layout: its items, owner and channel, claims and scheduled
+        items. The original document is kept in ``helga_queue_migrated``,
+        since the segmented layout has nowhere for its history.
+
+        :param name: name of the queue
+        :type name: string
+        :returns: whether there was a queue to migrate
+        :rtype: bool
+        :raises: ValueError, leaving the queue where it is, if it has items
+          that expire or have a priority, a TTL, or a move to another queue
+          in progress, none of which the segmented layout supports, or if a
+          segmented queue of the same name already exists
+        """
+        res = self.db.helga_queue.find_one({'_id': name})
+        if res is None:
+            return False
+        items = self._migrated_items(res)
+        # claim the name, locked so nothing appends until the items are in;
+        # a claim left by an interrupted migration is taken over
+        try:
+            self.db.helga_queue_meta.insert_one(
+                {'_id': name, 'head': 0, 'tail': 0, 'migrating': True, 'locked': True, 'locked_at': time.time()}
+            )
+        except DuplicateKeyError:
+            if self.db.helga_queue_meta.find_one({'_id': name, 'migrating': True}, {'_id': 1}) is None:
+                raise ValueError("queue '{n}' already exists in the segmented layout".format(n=name))
+        self._replace(name, items)
+        update = {'$unset': {'migrating': '', 'locked': '', 'locked_at': ''}}
+        meta = dict((k, res[k]) for k in ['owner', 'channel', 'claim_seq', 'scheduled'] if k in res)
+        if len(meta) > 0:
+            update['$set'] = meta
+        self.db.helga_queue_meta.update_one({'_id': name}, update)
+        for claim in res.get('claims', []):
+            claim_id = '{q}:{c}'.format(q=name, c=claim['id'])
+            # upserts, so that a migration interrupted after this can be re-run
+            self.db.helga_queue_claims.replace_one({'_id': claim_id}, {
+                '_id': claim_id, 'q': name, 'id': claim['id'],
+                'item': claim['item'], 'nick': claim['nick'], 'expires': claim['expires']
+            }, upsert=True)
+        self.db.helga_queue_migrated.replace_one({'_id': name}, res, upsert=True)
+        self.db.helga_queue.delete_one({'_id': name})
+        return True
+
+    def _migrated_items(self, doc):
+        """
+        Return the items of a single-document queue as plain items, dropping
+        those that have expired.
+
+        :raises: ValueError if it can't be migrated; see :py:meth:`migrate`
+        """
+        name = doc['_id']
+        if doc.get('ttl') is not None:
+            raise ValueError("queue '{n}' has a TTL".format(n=name))
+        if len(doc.get('moving', [])) > 0:
+            raise ValueError("queue '{n}' has a move to another queue in progress".format(n=name))
+        entries = live_entries(doc.get('queue', []), time.time())
+        if any(expires is not None or priority != 0 for _, expires, priority in entries):
+            raise ValueError("queue '{n}' has items that expire or have a priority".format(n=name))
+        return [item for item, _, _ in entries]
+
+    def migrate_all(self):
+        """
+        Migrate all queues still stored in the single-document layout.
+
+        :returns: number of queues migrated
+        :rtype: int
+        :raises: ValueError naming the queues that couldn't be migrated,
+          once every other queue has been
+        """
+        count = 0
+        refused = []
+        for doc in list(self.db.helga_queue.find({}, {'_id': 1})):
+            try:
+                if self.migrate(doc['_id']):
+                    count += 1
+            except ValueError as ex:
+                refused.append(str(ex))
+        if len(refused) > 0:
+            raise ValueError(
+                "can't move these queues to the segmented layout, which doesn't support item expiry, priorities, "
+                "TTLs or moves: " + '; '.join(refused)
+            )
+        return count
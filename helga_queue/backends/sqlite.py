@@ -0,0 +1,496 @@
+"""
+Local SQLite backend, for deployments that don't want to run MongoDB.
+
+Items are rows of a single table keyed by ``(queue, seq)``, where ``seq``
+increases with each append. Queues are read in ``(priority DESC, seq)``
+order, highest priority first and FIFO within a priority, through an index
+on ``(queue, priority DESC, seq)``, so every operation is an indexed lookup
+and appending or taking the head is O(log n). The database runs in WAL
+mode, and all SQL is constant, parameterized text so that sqlite3's
+per-connection statement cache re-uses the prepared statements. Item text
+is indexed with an external-content FTS5 table kept up to date by
+triggers, for searching, and other triggers bump a per-queue version on
+every insert or delete, for compare-and-set. Claimed items are moved to a
+separate table, indexed by lease expiry for reaping, and scheduled items
+wait in another, indexed by due time. Items that expire have an
+``expires`` time, covered by a partial index for the reaper, and reads only
+select rows that haven't expired. Recorded changes are JSON rows of a
+history table, inserted and trimmed in the transaction making the change.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from helga_queue.backends.base import Backend, carry_over, matches, public_change, revert
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS queue_items ('
+    'queue TEXT NOT NULL, seq INTEGER NOT NULL, item TEXT NOT NULL, expires REAL, '
+    'priority INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (queue, seq))'
+)
+SCHEMA_META = (
+    'CREATE TABLE IF NOT EXISTS queue_meta ('
+    'queue TEXT NOT NULL PRIMARY KEY, owner TEXT, channel TEXT, ttl REAL)'
+)
+SCHEMA_FTS = (
+    "CREATE VIRTUAL TABLE queue_items_fts USING fts5(item, content='queue_items')"
+)
+SCHEMA_FTS_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS queue_items_ai AFTER INSERT ON queue_items BEGIN '
+    'INSERT INTO queue_items_fts (rowid, item) VALUES (new.rowid, new.item); END',
+    'CREATE TRIGGER IF NOT EXISTS queue_items_ad AFTER DELETE ON queue_items BEGIN '
+    "INSERT INTO queue_items_fts (queue_items_fts, rowid, item) VALUES ('delete', old.rowid, old.item); END",
+]
+SCHEMA_VERSIONS = (
+    'CREATE TABLE IF NOT EXISTS queue_versions ('
+    'queue TEXT NOT NULL PRIMARY KEY, version INTEGER NOT NULL)'
+)
+SCHEMA_VERSION_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS queue_items_version_ai AFTER INSERT ON queue_items BEGIN '
+    'INSERT OR IGNORE INTO queue_versions (queue, version) VALUES (new.queue, 0); '
+    'UPDATE queue_versions SET version = version + 1 WHERE queue = new.queue; END',
+    'CREATE TRIGGER IF NOT EXISTS queue_items_version_ad AFTER DELETE ON queue_items BEGIN '
+    'INSERT OR IGNORE INTO queue_versions (queue, version) VALUES (old.queue, 0); '
+    'UPDATE queue_versions SET version = version + 1 WHERE queue = old.queue; END',
+]
+SCHEMA_CLAIMS = (
+    'CREATE TABLE IF NOT EXISTS queue_claims ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, item TEXT NOT NULL, '
+    'nick TEXT NOT NULL, expires REAL NOT NULL)'
+)
+SCHEMA_CLAIMS_INDEX = 'CREATE INDEX IF NOT EXISTS queue_claims_expires ON queue_claims (expires)'
+SCHEMA_SCHEDULED = (
+    'CREATE TABLE IF NOT EXISTS queue_scheduled ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, item TEXT NOT NULL, '
+    'due REAL NOT NULL, channel TEXT)'
+)
+SCHEMA_SCHEDULED_INDEX = 'CREATE INDEX IF NOT EXISTS queue_scheduled_due ON queue_scheduled (due)'
+SCHEMA_HISTORY = (
+    'CREATE TABLE IF NOT EXISTS queue_history ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, change TEXT NOT NULL)'
+)
+SCHEMA_HISTORY_INDEX = 'CREATE INDEX IF NOT EXISTS queue_history_queue ON queue_history (queue, id)'
+SCHEMA_EXPIRES_INDEX = (
+    'CREATE INDEX IF NOT EXISTS queue_items_expires ON queue_items (expires) WHERE expires IS NOT NULL'
+)
+SCHEMA_ORDER_INDEX = (
+    'CREATE INDEX IF NOT EXISTS queue_items_order ON queue_items (queue, priority DESC, seq)'
+)
+SCHEMA_META_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS queue_meta_owner ON queue_meta (owner)',
+    'CREATE INDEX IF NOT EXISTS queue_meta_channel ON queue_meta (channel)',
+]
+
+SQL_COLUMNS = 'PRAGMA table_info({t})'
+SQL_ADD_EXPIRES = 'ALTER TABLE queue_items ADD COLUMN expires REAL'
+SQL_ADD_TTL = 'ALTER TABLE queue_meta ADD COLUMN ttl REAL'
+SQL_ADD_PRIORITY = 'ALTER TABLE queue_items ADD COLUMN priority INTEGER NOT NULL DEFAULT 0'
+# selects only the rows that haven't expired; takes the current time
+LIVE = '(expires IS NULL OR expires > ?)'
+# queue order
+ORDER = ' ORDER BY priority DESC, seq'
+SQL_GET = 'SELECT item FROM queue_items WHERE queue = ? AND ' + LIVE + ORDER
+SQL_ENTRIES = 'SELECT item, expires, priority FROM queue_items WHERE queue = ? AND ' + LIVE + ORDER
+SQL_DELETE_ALL = 'DELETE FROM queue_items WHERE queue = ?'
+SQL_INSERT = 'INSERT INTO queue_items (queue, seq, item, expires, priority) VALUES (?, ?, ?, ?, ?)'
+SQL_APPEND = (
+    'INSERT INTO queue_items (queue, seq, item, expires, priority) '
+    'SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ? FROM queue_items WHERE queue = ?'
+)
+# in front of the head, with its priority
+SQL_PREPEND = (
+    'INSERT INTO queue_items (queue, seq, item, priority) '
+    'SELECT ?, COALESCE(MIN(seq), 1) - 1, ?, COALESCE(MAX(priority), 0) FROM queue_items WHERE queue = ?'
+)
+SQL_AT = (
+    'SELECT seq, item, expires, priority FROM queue_items WHERE queue = ? AND ' + LIVE + ORDER + ' LIMIT 1 OFFSET ?'
+)
+SQL_DELETE = 'DELETE FROM queue_items WHERE queue = ? AND seq = ?'
+SQL_LENGTH = 'SELECT COUNT(*) FROM queue_items WHERE queue = ? AND ' + LIVE
+SQL_RANGE_ROWS = (
+    'SELECT seq, item, expires, priority FROM queue_items WHERE queue = ? AND ' + LIVE + ORDER + ' LIMIT ?'
+)
+SQL_RANGE = 'SELECT item FROM queue_items WHERE queue = ? AND ' + LIVE + ORDER + ' LIMIT ? OFFSET ?'
+SQL_EXISTS = 'SELECT 1 FROM queue_items WHERE queue = ? AND ' + LIVE + ' LIMIT 1'
+SQL_HAS_FTS = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'queue_items_fts'"
+SQL_FTS_REBUILD = "INSERT INTO queue_items_fts (queue_items_fts) VALUES ('rebuild')"
+SQL_SEARCH = (
+    'SELECT i.queue, '
+    '(SELECT COUNT(*) FROM queue_items p WHERE p.queue = i.queue '
+    'AND (p.priority > i.priority OR (p.priority = i.priority AND p.seq < i.seq)) '
+    'AND (p.expires IS NULL OR p.expires > ?)), '
+    'i.item '
+    'FROM queue_items_fts f JOIN queue_items i ON i.rowid = f.rowid '
+    'WHERE queue_items_fts MATCH ? AND (? IS NULL OR i.queue = ?) '
+    'AND (i.expires IS NULL OR i.expires > ?) '
+    'ORDER BY i.queue, i.priority DESC, i.seq'
+)
+SQL_VERSION = 'SELECT version FROM queue_versions WHERE queue = ?'
+SQL_CLAIM = 'INSERT INTO queue_claims (queue, item, nick, expires) VALUES (?, ?, ?, ?)'
+SQL_CLAIMED = 'SELECT item FROM queue_claims WHERE queue = ? AND id = ? AND nick = ?'
+SQL_UNCLAIM = 'DELETE FROM queue_claims WHERE id = ?'
+SQL_EXPIRED = 'SELECT id, queue, item FROM queue_claims WHERE expires < ? ORDER BY queue, id DESC'
+SQL_SCHEDULE = 'INSERT INTO queue_scheduled (queue, item, due, channel) VALUES (?, ?, ?, ?)'
+SQL_SCHEDULED_TIMES = 'SELECT due FROM queue_scheduled ORDER BY due'
+SQL_DUE = 'SELECT id, queue, item, channel FROM queue_scheduled WHERE due <= ? ORDER BY due, id'
+SQL_RECORD = 'INSERT INTO queue_history (queue, change) VALUES (?, ?)'
+# drops all but the newest history_size changes to a queue
+SQL_TRIM_HISTORY = (
+    'DELETE FROM queue_history WHERE queue = ? AND id <= '
+    '(SELECT id FROM queue_history WHERE queue = ? ORDER BY id DESC LIMIT 1 OFFSET ?)'
+)
+SQL_HISTORY = 'SELECT change FROM queue_history WHERE queue = ? ORDER BY id DESC LIMIT ?'
+SQL_LAST_CHANGE = 'SELECT id, change FROM queue_history WHERE queue = ? ORDER BY id DESC LIMIT 1'
+SQL_DELETE_CHANGE = 'DELETE FROM queue_history WHERE id = ?'
+SQL_UNSCHEDULE = 'DELETE FROM queue_scheduled WHERE id = ?'
+# keyset paging for export: every query is a seek on the primary key or the
+# (queue, priority DESC, seq) index, however far into a queue it is
+SQL_NEXT_QUEUE = 'SELECT queue FROM queue_items WHERE queue > ? ORDER BY queue LIMIT 1'
+SQL_NEXT_PRIORITY = 'SELECT priority FROM queue_items WHERE queue = ? AND priority < ? ORDER BY priority DESC LIMIT 1'
+SQL_EXPORT = (
+    'SELECT seq, item, expires FROM queue_items WHERE queue = ? AND priority = ? AND seq > ? AND {live} '
+    'ORDER BY seq LIMIT ?'.format(live=LIVE)
+)
+SQL_SET_OWNER = 'INSERT OR IGNORE INTO queue_meta (queue, owner, channel) VALUES (?, ?, ?)'
+SQL_ADD_META = 'INSERT OR IGNORE INTO queue_meta (queue) VALUES (?)'
+SQL_SET_TTL = 'UPDATE queue_meta SET ttl = ? WHERE queue = ?'
+SQL_TTLS = 'SELECT queue, ttl FROM queue_meta WHERE ttl IS NOT NULL'
+SQL_EXPIRED_ITEMS = 'SELECT rowid, queue FROM queue_items WHERE expires <= ? ORDER BY expires LIMIT ?'
+SQL_DELETE_ROW = 'DELETE FROM queue_items WHERE rowid = ?'
+SQL_QUEUES = (
+    'WITH names AS (SELECT DISTINCT queue FROM queue_items UNION SELECT queue FROM queue_meta) '
+    'SELECT n.queue, '
+    '(SELECT COUNT(*) FROM queue_items i WHERE i.queue = n.queue AND (i.expires IS NULL OR i.expires > ?)), '
+    '(SELECT item FROM queue_items h WHERE h.queue = n.queue AND (h.expires IS NULL OR h.expires > ?) '
+    'ORDER BY priority DESC, seq LIMIT 1), '
+    'm.owner, m.channel '
+    'FROM names n LEFT JOIN queue_meta m ON m.queue = n.queue '
+    'WHERE (? IS NULL OR m.owner = ?) '
+    'AND (? IS NULL OR substr(m.channel, 1, length(?)) = ?) '
+    'ORDER BY n.queue'
+)
+
+
+class SQLiteBackend(Backend):
+    """
+    SQLite backend. One connection is shared between threads, serialized
+    by a lock; multi-statement mutations run in ``BEGIN IMMEDIATE``
+    transactions so they are also atomic across processes.
+
+    :param path: path to the database file, or ``:memory:``
+    :type path: string
+    :param history_size: number of changes recorded per queue
+    :type history_size: int
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path='helga_queue.sqlite', history_size=0):
+        self.path = path
+        self.history_size = history_size
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(SCHEMA)
+        self._conn.execute(SCHEMA_META)
+        # databases from before item expiry was added
+        if 'expires' not in self._columns('queue_items'):
+            self._conn.execute(SQL_ADD_EXPIRES)
+        if 'ttl' not in self._columns('queue_meta'):
+            self._conn.execute(SQL_ADD_TTL)
+        self._conn.execute(SCHEMA_EXPIRES_INDEX)
+        # and before priorities were
+        if 'priority' not in self._columns('queue_items'):
+            self._conn.execute(SQL_ADD_PRIORITY)
+        self._conn.execute(SCHEMA_ORDER_INDEX)
+        for sql in SCHEMA_META_INDEXES:
+            self._conn.execute(sql)
+        if self._conn.execute(SQL_HAS_FTS).fetchone() is None:
+            # new database, or one from before searching was added
+            self._conn.execute(SCHEMA_FTS)
+            self._conn.execute(SQL_FTS_REBUILD)
+        for sql in SCHEMA_FTS_TRIGGERS:
+            self._conn.execute(sql)
+        self._conn.execute(SCHEMA_VERSIONS)
+        for sql in SCHEMA_VERSION_TRIGGERS:
+            self._conn.execute(sql)
+        self._conn.execute(SCHEMA_CLAIMS)
+        self._conn.execute(SCHEMA_CLAIMS_INDEX)
+        self._conn.execute(SCHEMA_SCHEDULED)
+        self._conn.execute(SCHEMA_SCHEDULED_INDEX)
+        self._conn.execute(SCHEMA_HISTORY)
+        self._conn.execute(SCHEMA_HISTORY_INDEX)
+
+    def _columns(self, table):
+        return [row[1] for row in self._conn.execute(SQL_COLUMNS.format(t=table))]
+
+    def close(self):
+        """close the database connection"""
+        with self._lock:
+            self._conn.close()
+
+    def _transaction(self, fn, *args):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                res = fn(*args)
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+            return res
+
+    def _record(self, name, op, rows, idxs=None):
+        """record a change to a queue, if keeping history; ``rows`` are ``(item, expires, priority)``"""
+        if self.history_size == 0:
+            return
+        change = {'op': op, 'at': time.time(), 'items': [r[0] for r in rows], 'attrs': [list(r[1:]) for r in rows]}
+        if idxs is not None:
+            change['idxs'] = list(idxs)
+        self._conn.execute(SQL_RECORD, (name, json.dumps(change)))
+        self._conn.execute(SQL_TRIM_HISTORY, (name, name, self.history_size))
+
+    def get(self, name):
+        with self._lock:
+            return [row[0] for row in self._conn.execute(SQL_GET, (name, time.time()))]
+
+    def _version(self, name):
+        row = self._conn.execute(SQL_VERSION, (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def _replace(self, name, entries):
+        self._conn.execute(SQL_DELETE_ALL, (name,))
+        self._conn.executemany(
+            SQL_INSERT, ((name, seq) + tuple(entry) for seq, entry in enumerate(entries, 1))
+        )
+
+    def set(self, name, q):
+        self._transaction(self._replace, name, [(item, None, 0) for item in q])
+
+    def get_versioned(self, name):
+        def _get_versioned():
+            return [row[0] for row in self._conn.execute(SQL_GET, (name, time.time()))], self._version(name)
+        return self._transaction(_get_versioned)
+
+    def stamp(self, name):
+        with self._lock:
+            return self._version(name) or 0, self._conn.execute(SQL_LENGTH, (name, time.time())).fetchone()[0]
+
+    def compare_and_set(self, name, q, version):
+        """items kept from the queue as read keep their expiry and priority"""
+        def _compare_and_set():
+            if self._version(name) != version:
+                return False
+            old = [(row[0], row[1:]) for row in self._conn.execute(SQL_ENTRIES, (name, time.time()))]
+            self._replace(name, [(item,) + tuple(attrs) for item, attrs in carry_over(old, q, (None, 0))])
+            return True
+        return self._transaction(_compare_and_set)
+
+    def append(self, name, item, expires=None, priority=0):
+        if self.history_size > 0:
+            self.append_many(name, [item], expires, priority)
+            return
+        with self._lock:
+            self._conn.execute(SQL_APPEND, (name, item, expires, priority, name))
+
+    def append_many(self, name, items, expires=None, priority=0):
+        def _append_many():
+            self._conn.executemany(SQL_APPEND, ((name, item, expires, priority, name) for item in items))
+            self._record(name, 'append', [(item, expires, priority) for item in items])
+        items = list(items)
+        self._transaction(_append_many)
+
+    def pop(self, name, idx=0):
+        def _pop():
+            row = self._conn.execute(SQL_AT, (name, time.time(), idx)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(SQL_DELETE, (name, row[0]))
+            self._record(name, 'pop', [row[1:]], [idx])
+            return row[1]
+        return self._transaction(_pop)
+
+    def pop_many(self, name, idxs):
+        def _pop_many():
+            rows = self._conn.execute(SQL_RANGE_ROWS, (name, time.time(), idxs[-1] + 1)).fetchall()
+            if len(rows) <= idxs[-1]:
+                return None
+            self._conn.executemany(SQL_DELETE, ((name, rows[i][0]) for i in idxs))
+            self._record(name, 'pop', [rows[i][1:] for i in idxs], idxs)
+            return [rows[i][1] for i in idxs]
+        return self._transaction(_pop_many)
+
+    def length(self, name):
+        with self._lock:
+            return self._conn.execute(SQL_LENGTH, (name, time.time())).fetchone()[0]
+
+    def range(self, name, start, count):
+        with self._lock:
+            return [row[0] for row in self._conn.execute(SQL_RANGE, (name, time.time(), count, start))]
+
+    def set_owner(self, name, owner, channel):
+        with self._lock:
+            self._conn.execute(SQL_SET_OWNER, (name, owner, channel))
+
+    def queues(self, owner=None, channel=None):
+        with self._lock:
+            now = time.time()
+            rows = self._conn.execute(SQL_QUEUES, (now, now, owner, owner, channel, channel, channel)).fetchall()
+        return [
+            {'name': row[0], 'length': row[1], 'head': row[2], 'owner': row[3], 'channel': row[4]}
+            for row in rows
+        ]
+
+    def search(self, terms, name=None):
+        query = ' '.join('"{t}"'.format(t=t.replace('"', '""')) for t in terms)
+        with self._lock:
+            now = time.time()
+            rows = self._conn.execute(SQL_SEARCH, (now, query, name, name, now)).fetchall()
+        return [tuple(row) for row in rows if matches(row[2], terms)]
+
+    def claim(self, name, nick, expires):
+        def _claim():
+            row = self._conn.execute(SQL_AT, (name, time.time(), 0)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(SQL_DELETE, (name, row[0]))
+            cur = self._conn.execute(SQL_CLAIM, (name, row[1], nick, expires))
+            return cur.lastrowid, row[1]
+        return self._transaction(_claim)
+
+    def _take_claim(self, name, nick, claim_id):
+        row = self._conn.execute(SQL_CLAIMED, (name, claim_id, nick)).fetchone()
+        if row is None:
+            return None
+        self._conn.execute(SQL_UNCLAIM, (claim_id,))
+        return row[0]
+
+    def ack(self, name, nick, claim_id):
+        return self._transaction(self._take_claim, name, nick, claim_id)
+
+    def release(self, name, nick, claim_id):
+        def _release():
+            item = self._take_claim(name, nick, claim_id)
+            if item is not None:
+                self._conn.execute(SQL_PREPEND, (name, item, name))
+            return item
+        return self._transaction(_release)
+
+    def reap(self, now):
+        def _reap():
+            names = []
+            # newest first within each queue, so the oldest ends up at the head
+            for claim_id, name, item in self._conn.execute(SQL_EXPIRED, (now,)).fetchall():
+                self._conn.execute(SQL_UNCLAIM, (claim_id,))
+                self._conn.execute(SQL_PREPEND, (name, item, name))
+                if name not in names:
+                    names.append(name)
+            return names
+        return self._transaction(_reap)
+
+    def schedule(self, name, item, due, channel=None):
+        with self._lock:
+            self._conn.execute(SQL_SCHEDULE, (name, item, due, channel))
+
+    def scheduled_times(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute(SQL_SCHEDULED_TIMES)]
+
+    def deliver_due(self, now):
+        def _deliver_due():
+            delivered = []
+            for sched_id, name, item, channel in self._conn.execute(SQL_DUE, (now,)).fetchall():
+                self._conn.execute(SQL_UNSCHEDULE, (sched_id,))
+                self._conn.execute(SQL_APPEND, (name, item, None, 0, name))
+                delivered.append((name, item, channel))
+            return delivered
+        return self._transaction(_deliver_due)
+
+    def is_empty(self, name):
+        with self._lock:
+            return self._conn.execute(SQL_EXISTS, (name, time.time())).fetchone() is None
+
+    def ttls(self):
+        """``ttl`` is a REAL column, so it is read back as a float"""
+        with self._lock:
+            return dict((name, int(ttl)) for name, ttl in self._conn.execute(SQL_TTLS).fetchall())
+
+    def set_ttl(self, name, ttl):
+        def _set_ttl():
+            self._conn.execute(SQL_ADD_META, (name,))
+            self._conn.execute(SQL_SET_TTL, (ttl, name))
+        self._transaction(_set_ttl)
+
+    def expire(self, now, limit):
+        """deletes the ``limit`` rows that expired first, found with the partial index"""
+        def _expire():
+            rows = self._conn.execute(SQL_EXPIRED_ITEMS, (now, limit)).fetchall()
+            self._conn.executemany(SQL_DELETE_ROW, ((row[0],) for row in rows))
+            return sorted(set(row[1] for row in rows)), len(rows) == limit
+        return self._transaction(_expire)
+
+    def history(self, name, count):
+        with self._lock:
+            rows = self._conn.execute(SQL_HISTORY, (name, count)).fetchall()
+        return [public_change(json.loads(row[0])) for row in reversed(rows)]
+
+    def undo(self, name):
+        def _undo():
+            row = self._conn.execute(SQL_LAST_CHANGE, (name,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(SQL_DELETE_CHANGE, (row[0],))
+            change = json.loads(row[1])
+            old = [(r[0], r[1:]) for r in self._conn.execute(SQL_ENTRIES, (name, time.time()))]
+            self._replace(name, [(item,) + tuple(attrs) for item, attrs in revert(old, change)])
+            return public_change(change)
+        return self._transaction(_undo)
+
+    def move(self, name, target, idxs=None):
+        """deletes the rows and appends them to the target in one transaction"""
+        def _move():
+            if idxs is None:
+                # a negative limit is no limit
+                moved = self._conn.execute(SQL_RANGE_ROWS, (name, time.time(), -1)).fetchall()
+            else:
+                rows = self._conn.execute(SQL_RANGE_ROWS, (name, time.time(), idxs[-1] + 1)).fetchall()
+                if len(rows) <= idxs[-1]:
+                    return None
+                moved = [rows[i] for i in idxs]
+            self._conn.executemany(SQL_DELETE, ((name, row[0]) for row in moved))
+            self._conn.executemany(SQL_APPEND, ((target, row[1], row[2], row[3], target) for row in moved))
+            return [row[1] for row in moved]
+        return self._transaction(_move)
+
+    def export(self, name=None, batch_size=1000):
+        """
+        pages through queue names, then each queue's priorities, then the
+        items of each priority, continuing from the last row of each batch
+        """
+        with self._lock:
+            row = self._conn.execute(SQL_NEXT_QUEUE, ('',)).fetchone() if name is None else (name,)
+        while row is not None:
+            queue, priority = row[0], float('inf')
+            while True:
+                with self._lock:
+                    prow = self._conn.execute(SQL_NEXT_PRIORITY, (queue, priority)).fetchone()
+                if prow is None:
+                    break
+                priority, seq = prow[0], float('-inf')
+                while True:
+                    with self._lock:
+                        rows = self._conn.execute(
+                            SQL_EXPORT, (queue, priority, seq, time.time(), batch_size)
+                        ).fetchall()
+                    for _, item, expires in rows:
+                        yield queue, item, expires, priority
+                    if len(rows) < batch_size:
+                        break
+                    seq = rows[-1][0]
+            if name is not None:
+                break
+            with self._lock:
+                row = self._conn.execute(SQL_NEXT_QUEUE, (queue,)).fetchone()
@@ -0,0 +1,143 @@
+"""
+Benchmarks for the ``queue`` subcommands, driving the command end to end
+against a local storage backend across a range of queue sizes.
+
+Run with ``python -m helga_queue.benchmark --help``; results are written
+as JSON.
+"""
+
+import argparse
+import json
+import sys
+from timeit import default_timer
+
+from helga_queue.backends import make_backend
+from helga_queue.harness import RecordingClient, local_plugin
+from helga_queue.metrics import percentile
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+
+OPERATIONS = ['append', 'pop', 'pop_index', 'list', 'show', 'len', 'next']
+
+
+def _summarize(op, size, timings):
+    timings = sorted(timings)
+    total = sum(timings)
+    return {
+        'op': op,
+        'size': size,
+        'iterations': len(timings),
+        'mean_ms': total / len(timings) * 1000,
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'max_ms': timings[-1] * 1000,
+        'ops_per_sec': len(timings) / total if total > 0 else None,
+    }
+
+
+def _run_op(harness, client, op, size, queue_name):
+    """
+    Run one timed invocation of ``op``, plus whatever untimed fix-up keeps
+    the queue at ``size`` items.
+
+    :returns: elapsed seconds
+    """
+    if op == 'append':
+        args = [queue_name, 'append', 'benchmark item']
+        fixup = [queue_name, 'pop']
+    elif op == 'pop':
+        args = [queue_name, 'pop']
+        fixup = [queue_name, 'append', 'benchmark item']
+    elif op == 'pop_index':
+        args = [queue_name, 'pop', str(size // 2)]
+        fixup = [queue_name, 'append', 'benchmark item']
+    else:
+        args = [queue_name, op]
+        fixup = None
+    start = default_timer()
+    harness.queue(client, '#bench', 'bencher', args)
+    harness.flush()
+    elapsed = default_timer() - start
+    if fixup is not None:
+        harness.queue(client, '#bench', 'bencher', fixup)
+    return elapsed
+
+
+def run(backend, sizes=None, iterations=100, operations=None, cache_entries=0):
+    """
+    Run the benchmarks.
+
+    :param backend: storage backend to run against
+    :type backend: :py:class:`~helga_queue.backends.base.Backend`
+    :param sizes: queue sizes to benchmark at
+    :type sizes: list
+    :param iterations: timed invocations per operation and size
+    :type iterations: int
+    :param operations: operations to run (see :py:data:`OPERATIONS`)
+    :type operations: list
+    :param cache_entries: size of the plugin's queue cache; 0 disables it
+    :type cache_entries: int
+    :returns: list of result dicts, one per operation and size
+    :rtype: list
+    """
+    sizes = sizes or DEFAULT_SIZES
+    operations = operations or OPERATIONS
+    results = []
+    client = RecordingClient(keep=False)
+    with local_plugin(backend, cache_entries=cache_entries) as harness:
+        for size in sizes:
+            queue_name = 'bench{s}'.format(s=size)
+            backend.set(queue_name, ['item {i}'.format(i=i) for i in range(size)])
+            for op in operations:
+                timings = [
+                    _run_op(harness, client, op, size, queue_name) for _ in range(iterations)
+                ]
+                results.append(_summarize(op, size, timings))
+    return results
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description='Benchmark helga-queue subcommands')
+    p.add_argument('-b', '--backend', default='memory', choices=['memory', 'sqlite'],
+                   help='storage backend to benchmark against (default: memory)')
+    p.add_argument('--sqlite-path', default=':memory:',
+                   help='database path for the sqlite backend (default: :memory:)')
+    p.add_argument('-s', '--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                   help='comma-separated queue sizes (default: %(default)s)')
+    p.add_argument('-n', '--iterations', type=int, default=100,
+                   help='timed iterations per operation and size (default: %(default)s)')
+    p.add_argument('-o', '--operations', default=','.join(OPERATIONS),
+                   help='comma-separated operations (default: %(default)s)')
+    p.add_argument('-c', '--cache-entries', type=int, default=0,
+                   help='queue cache size; 0 disables the cache (default: %(default)s)')
+    p.add_argument('--output', default='-', help='file to write JSON results to (default: stdout)')
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    backend = make_backend(args.backend, sqlite_path=args.sqlite_path)
+    results = run(
+        backend,
+        sizes=[int(s) for s in args.sizes.split(',')],
+        iterations=args.iterations,
+        operations=args.operations.split(','),
+        cache_entries=args.cache_entries
+    )
+    doc = {
+        'backend': args.backend,
+        'cache_entries': args.cache_entries,
+        'iterations': args.iterations,
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(doc, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as fh:
+            json.dump(doc, fh, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
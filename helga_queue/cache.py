@@ -0,0 +1,404 @@
+"""
+In-process caches used in front of the database: of queue contents, and of
+rendered views of queues.
+
+Both are bounded, with least-recently-used eviction and optional
+time-based staleness.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class QueueCache(object):
+    """
+    LRU cache mapping queue name to a list of items. All methods are
+    thread-safe.
+
+    Every change to a queue through the cache bumps the queue's generation.
+    A caller reading a queue from the database takes its
+    :py:meth:`generation` first and passes it to :py:meth:`set`, so that a
+    read which raced with a write is never cached over it.
+
+    :param max_entries: maximum number of queues to cache; 0 disables caching
+    :type max_entries: int
+    :param max_bytes: maximum approximate total size of cached items, in bytes;
+      0 or None for no limit
+    :type max_bytes: int
+    :param ttl: seconds after which a cached entry is considered stale and
+      re-read from the database; None to never expire (only safe if this
+      process is the only writer)
+    :type ttl: float or None
+    """
+
+    def __init__(self, max_entries=128, max_bytes=1048576, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # queues never to cache, see exclude()
+        self._excluded = set()
+        # queue name -> number of changes; reset by clear(), along with a
+        # bump of the epoch
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _sizeof(q):
+        """approximate size of a queue's contents in bytes"""
+        return sum(len(item) for item in q)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    @property
+    def size_bytes(self):
+        """approximate total size of all cached items, in bytes"""
+        return self._bytes
+
+    def _lookup(self, name):
+        """
+        Return the cached list for a queue (not a copy), or None if it is not
+        cached or is stale. Updates hit/miss counters and LRU order.
+        """
+        entry = self._entries.get(name)
+        if entry is None:
+            self.misses += 1
+            return None
+        q, size, stamp = entry
+        if self.ttl is not None and time.time() - stamp > self.ttl:
+            self._remove(name)
+            self.misses += 1
+            return None
+        # move to most-recently-used end
+        del self._entries[name]
+        self._entries[name] = entry
+        self.hits += 1
+        return q
+
+    def get(self, name):
+        """
+        Return a copy of the cached contents of a queue, or None if it is not
+        cached (or is stale).
+
+        :param name: name of the queue
+        :type name: string
+        :rtype: list or None
+        """
+        with self._lock:
+            q = self._lookup(name)
+            if q is None:
+                return None
+            return list(q)
+
+    def length(self, name):
+        """
+        Return the length of a cached queue, or None if it is not cached.
+
+        :param name: name of the queue
+        :type name: string
+        :rtype: int or None
+        """
+        with self._lock:
+            q = self._lookup(name)
+            if q is None:
+                return None
+            return len(q)
+
+    def slice(self, name, start, count):
+        """
+        Return up to ``count`` items of a cached queue starting at ``start``,
+        or None if it is not cached.
+
+        :param name: name of the queue
+        :type name: string
+        :param start: index of first item
+        :type start: int
+        :param count: maximum number of items
+        :type count: int
+        :rtype: list or None
+        """
+        with self._lock:
+            q = self._lookup(name)
+            if q is None:
+                return None
+            return q[start:start + count]
+
+    def generation(self, name):
+        """
+        Return a token that changes whenever a queue is changed through the
+        cache; see :py:meth:`set`.
+
+        :param name: name of the queue
+        :type name: string
+        """
+        with self._lock:
+            return (self._epoch, self._generations.get(name, 0))
+
+    def stamp(self, name):
+        """
+        Return a token for what a cached queue shows, which changes whenever
+        it is changed through the cache, like a backend's
+        :py:meth:`~helga_queue.backends.base.Backend.stamp` but without a
+        database call. Queues with items that expire are never cached, so it
+        doesn't need to change as time passes.
+
+        :param name: name of the queue
+        :type name: string
+        :returns: ``(epoch, generation, length)``, or None if the queue is not
+          cached
+        :rtype: tuple or None
+        """
+        with self._lock:
+            q = self._lookup(name)
+            if q is None:
+                return None
+            return self._epoch, self._generations.get(name, 0), len(q)
+
+    def _bump(self, name):
+        self._generations[name] = self._generations.get(name, 0) + 1
+
+    def set(self, name, q, generation=None):
+        """
+        Store the contents of a queue, evicting least-recently-used entries
+        as needed to stay within limits.
+
+        :param name: name of the queue
+        :type name: string
+        :param q: queue contents
+        :type q: list
+        :param generation: the queue's :py:meth:`generation` from before
+          ``q`` was read or written; if the queue has changed since, ``q``
+          may be stale, so the queue is dropped from the cache instead
+        :type generation: tuple
+        """
+        with self._lock:
+            stale = generation is not None and generation != self.generation(name)
+            self._bump(name)
+            self._remove(name)
+            if stale or not self.max_entries or name in self._excluded:
+                return
+            size = self._sizeof(q)
+            if self.max_bytes and size > self.max_bytes:
+                # never fits; don't flush everything else trying
+                return
+            self._entries[name] = (list(q), size, time.time())
+            self._bytes += size
+            self._evict()
+
+    def append(self, name, item):
+        """
+        Write-through an append to a cached queue, if it is cached.
+
+        :param name: name of the queue
+        :type name: string
+        :param item: item appended
+        :type item: string
+        """
+        with self._lock:
+            self._bump(name)
+            entry = self._entries.get(name)
+            if entry is None:
+                return
+            q, size, stamp = entry
+            q.append(item)
+            self._entries[name] = (q, size + len(item), stamp)
+            self._bytes += len(item)
+            self._evict()
+
+    def pop(self, name, idx, item):
+        """
+        Write-through a pop of ``item`` at ``idx`` to a cached queue. If the
+        cached copy doesn't agree with what the database removed, it is
+        dropped instead.
+
+        :param name: name of the queue
+        :type name: string
+        :param idx: index that was popped
+        :type idx: int
+        :param item: item that was removed
+        :type item: string
+        """
+        with self._lock:
+            self._bump(name)
+            entry = self._entries.get(name)
+            if entry is None:
+                return
+            q, size, stamp = entry
+            if idx >= len(q) or q[idx] != item:
+                self._remove(name)
+                return
+            q.pop(idx)
+            self._entries[name] = (q, size - len(item), stamp)
+            self._bytes -= len(item)
+
+    def invalidate(self, name):
+        """
+        Drop a queue from the cache.
+
+        :param name: name of the queue
+        :type name: string
+        """
+        with self._lock:
+            self._bump(name)
+            self._remove(name)
+
+    def exclude(self, name):
+        """
+        Drop a queue from the cache and stop caching it, because its items
+        expire: a cached copy would keep them after they had expired.
+
+        :param name: name of the queue
+        :type name: string
+        """
+        with self._lock:
+            self._bump(name)
+            self._remove(name)
+            self._excluded.add(name)
+
+    def clear(self):
+        """drop all entries, exclusions and reset counters"""
+        with self._lock:
+            self._entries.clear()
+            self._excluded.clear()
+            self._generations.clear()
+            self._epoch += 1
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """
+        Return a dict of cache counters, for sizing the cache.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _evict(self):
+        """evict least-recently-used entries until within limits"""
+        while len(self._entries) > self.max_entries or (
+                self.max_bytes and self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+
+class RenderCache(object):
+    """
+    LRU cache of rendered views of queues (listings, pages of items), keyed
+    by queue name, view and the queue's stamp (see
+    :py:meth:`~helga_queue.backends.base.Backend.stamp`), so that a view is
+    re-used until the queue changes, whichever process changed it. Only the
+    latest stamp's rendering of each view is kept. All methods are
+    thread-safe.
+
+    :param max_entries: maximum number of views to cache; 0 disables caching
+    :type max_entries: int
+    :param ttl: seconds after which a rendering is re-done even if the stamp
+      is unchanged, to bound how long it can reflect a stale
+      :py:class:`QueueCache` entry; None to keep it until the queue changes
+    :type ttl: float or None
+    """
+
+    def __init__(self, max_entries=256, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # (name, view) -> (stamp, rendered, time)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name, view, stamp):
+        """
+        Return the rendering of a view of a queue at ``stamp``, or None if it
+        isn't cached.
+
+        :param name: name of the queue
+        :type name: string
+        :param view: hashable identifier of the view, e.g. ``('show', 0, 9)``
+        :param stamp: the queue's current stamp
+        :type stamp: tuple
+        """
+        key = (name, view)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != stamp or (
+                    self.ttl is not None and time.time() - entry[2] > self.ttl):
+                self.misses += 1
+                return None
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, name, view, stamp, rendered):
+        """
+        Store the rendering of a view of a queue at ``stamp``, replacing any
+        earlier one and evicting least-recently-used views as needed.
+
+        :param name: name of the queue
+        :type name: string
+        :param view: hashable identifier of the view
+        :param stamp: stamp of the queue the view was rendered from
+        :type stamp: tuple
+        :param rendered: the rendering; must not be None
+        """
+        if self.max_entries == 0:
+            return
+        key = (name, view)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (stamp, rendered, time.time())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """drop all entries and reset counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """
+        Return a dict of cache counters, for sizing the cache.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,137 @@
+"""
+Group commit of queue appends: appends arriving close together are buffered
+and written with one storage call per queue, instead of one each.
+"""
+
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+
+
+class WriteCoalescer(object):
+    """
+    Buffers appends for up to ``window`` seconds, or until ``max_ops``
+    appends are buffered, then hands them to ``flush`` as one batch. Only
+    one batch is being flushed at a time, so appends to a queue are written
+    in the order they arrived. Must only be used from the reactor thread.
+
+    :param flush: called as ``flush(batch)``, where ``batch`` is a list of
+      ``(queue name, [items])`` in arrival order; returns a dict of queue
+      name to result, or a Deferred firing with one
+    :type flush: callable
+    :param window: seconds to wait for more appends before flushing
+    :type window: float
+    :param max_ops: number of buffered appends that triggers an immediate
+      flush
+    :type max_ops: int
+    :param clock: object providing ``callLater``; defaults to the reactor
+    """
+
+    def __init__(self, flush, window=0.05, max_ops=100, clock=None):
+        self._flush = flush
+        self.window = window
+        self.max_ops = max_ops
+        self._clock = clock or reactor
+        self._call = None
+        # queue name -> list of (item, Deferred) not yet being flushed
+        self._batch = OrderedDict()
+        self._ops = 0
+        self._waiters = []
+        # whether the buffered batch is due, but waiting on the in-flight one
+        self._due = False
+        # the batch being flushed, and who is waiting for it
+        self._inflight = None
+        self._inflight_waiters = []
+
+    def __len__(self):
+        return self._ops
+
+    def pending(self, name):
+        """
+        Return whether there are appends to ``name`` that are buffered or
+        being flushed.
+
+        :param name: name of the queue
+        :type name: string
+        :rtype: bool
+        """
+        return name in self._batch or (self._inflight is not None and name in self._inflight)
+
+    def append(self, name, item):
+        """
+        Buffer an append.
+
+        :param name: name of the queue
+        :type name: string
+        :param item: item to append
+        :type item: string
+        :returns: Deferred firing with the flush result for ``name`` once the
+          batch holding this append has been written
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        d = defer.Deferred()
+        self._batch.setdefault(name, []).append((item, d))
+        self._ops += 1
+        if self._ops >= self.max_ops:
+            self._start_flush()
+        elif self._call is None:
+            self._call = self._clock.callLater(self.window, self._start_flush)
+        return d
+
+    def flush(self):
+        """
+        Flush buffered appends now, rather than at the end of the window.
+
+        :returns: Deferred firing once every append buffered before this
+          call has been written (or has failed)
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        if len(self._batch) > 0:
+            d = defer.Deferred()
+            self._waiters.append(d)
+            self._start_flush()
+            return d
+        if self._inflight is not None:
+            d = defer.Deferred()
+            self._inflight_waiters.append(d)
+            return d
+        return defer.succeed(None)
+
+    def _start_flush(self):
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+        if len(self._batch) == 0:
+            return
+        if self._inflight is not None:
+            # picked up again once the in-flight batch is done
+            self._due = True
+            return
+        self._due = False
+        self._inflight = self._batch
+        self._inflight_waiters = self._waiters
+        self._batch = OrderedDict()
+        self._ops = 0
+        self._waiters = []
+        batch = [(name, [item for item, _ in ops]) for name, ops in self._inflight.items()]
+        d = defer.maybeDeferred(self._flush, batch)
+        d.addBoth(self._flushed)
+
+    def _flushed(self, res):
+        inflight, waiters = self._inflight, self._inflight_waiters
+        self._inflight = None
+        self._inflight_waiters = []
+        for name, ops in inflight.items():
+            for _, d in ops:
+                if isinstance(res, dict):
+                    d.callback(res.get(name))
+                else:
+                    d.errback(res)
+        for d in waiters:
+            d.callback(None)
+        if len(self._batch) > 0:
+            if self._due:
+                self._start_flush()
+            elif self._call is None:
+                self._call = self._clock.callLater(self.window, self._start_flush)
@@ -0,0 +1,218 @@
+"""
+Helpers for driving the ``queue`` command end to end outside of a running
+bot, against a local storage backend; used by the benchmark and load-test
+tools.
+"""
+
+from contextlib import contextmanager
+
+from helga.plugins import ResponseNotReady
+from twisted.internet import defer, reactor
+from twisted.internet.task import Clock
+
+import helga_queue.plugin as plugin
+from helga_queue.cache import QueueCache, RenderCache
+from helga_queue.coalesce import WriteCoalescer
+from helga_queue.output import OutputScheduler
+from helga_queue.threads import StoragePool
+
+
+class RecordingClient(object):
+    """
+    Stand-in for a helga client, recording everything sent through it.
+
+    :param keep: whether to keep the messages themselves, or only count them
+    :type keep: bool
+    """
+
+    def __init__(self, keep=True, nickname='helga'):
+        self.keep = keep
+        self.nickname = nickname
+        self.operators = set()
+        self.msgs = []
+        self.mes = []
+        self.msg_count = 0
+        self.me_count = 0
+
+    def msg(self, channel, message):
+        self.msg_count += 1
+        if self.keep:
+            self.msgs.append((channel, message))
+
+    def me(self, channel, message):
+        self.me_count += 1
+        if self.keep:
+            self.mes.append((channel, message))
+
+
+class _ImmediateReactor(object):
+    """runs callFromThread calls immediately, in the calling thread"""
+
+    def callFromThread(self, fn, *args, **kwargs):
+        fn(*args, **kwargs)
+
+
+class LocalPlugin(object):
+    """
+    Handle on the plugin while it is set up by :py:func:`local_plugin`.
+
+    :param clock: fake clock driving the paced output scheduler
+    :type clock: :py:class:`twisted.internet.task.Clock`
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def queue(self, client, channel, nick, args):
+        """
+        Invoke the ``queue`` command as if ``nick`` sent it in ``channel``.
+
+        :param args: command arguments
+        :type args: list
+        :returns: the command's response
+        """
+        message = 'queue ' + ' '.join(args)
+        return plugin.queue_plugin(client, channel, nick, message, 'queue', list(args))
+
+    def flush(self):
+        """send all output still waiting in the paced output scheduler"""
+        while len(plugin._output) > 0:
+            self.clock.advance(1)
+        self.clock.advance(1)
+
+
+@contextmanager
+def local_plugin(backend, cache_entries=0):
+    """
+    Context manager that points the plugin at ``backend``, runs subcommands
+    synchronously without write coalescing, and sends paced output through
+    a fake clock instead of the reactor. All plugin state is restored on
+    exit.
+
+    :param backend: storage backend to use
+    :type backend: :py:class:`~helga_queue.backends.base.Backend`
+    :param cache_entries: max entries for a fresh queue cache; 0 disables it
+    :type cache_entries: int
+    :rtype: :py:class:`LocalPlugin`
+    """
+    saved = dict(
+        (attr, getattr(plugin, attr)) for attr in ['_backend', '_cache', '_render_cache', '_output', '_coalescer', 'reactor']
+    )
+    saved_pool_size = plugin._pool.size
+    clock = Clock()
+    try:
+        plugin._backend = backend
+        plugin._cache = QueueCache(max_entries=cache_entries, max_bytes=0)
+        plugin._render_cache = RenderCache(max_entries=plugin._render_cache.max_entries)
+        plugin._output = OutputScheduler(rate=1000000.0, clock=clock)
+        plugin._coalescer = None
+        plugin.reactor = _ImmediateReactor()
+        plugin._pool.size = 0
+        yield LocalPlugin(clock)
+    finally:
+        for attr, val in saved.items():
+            setattr(plugin, attr, val)
+        plugin._pool.size = saved_pool_size
+
+
+class _PendingClient(object):
+    """
+    Wraps the client of one ``queue`` invocation; ``deferred`` fires with
+    the invocation's response once the plugin has sent it.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self.deferred = defer.Deferred()
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class ConcurrentPlugin(object):
+    """
+    Handle on the plugin while it is set up by :py:func:`concurrent_plugin`.
+    """
+
+    def queue(self, client, channel, nick, args):
+        """
+        Invoke the ``queue`` command as if ``nick`` sent it in ``channel``,
+        sending its response to ``channel`` as helga would.
+
+        :param args: command arguments
+        :type args: list
+        :returns: Deferred firing with the command's response once it has
+          been sent, or failing if the command failed or timed out
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        pending = _PendingClient(client)
+        message = 'queue ' + ' '.join(args)
+        try:
+            res = plugin.queue_plugin(pending, channel, nick, message, 'queue', list(args))
+        except ResponseNotReady:
+            return pending.deferred
+        if res:
+            client.msg(channel, res)
+        return defer.succeed(res)
+
+
+@contextmanager
+def concurrent_plugin(backend, pool_size=4, cache_entries=0, coalesce_window=None, clock=None):
+    """
+    Context manager that points the plugin at ``backend`` and runs
+    subcommands as a running bot does: in a pool of ``pool_size`` storage
+    threads, with appends coalesced over ``coalesce_window`` seconds if
+    given. Unlike :py:func:`local_plugin`, responses arrive asynchronously,
+    so the reactor must be running unless ``pool_size`` is 0. All plugin
+    state is restored on exit.
+
+    :param backend: storage backend to use
+    :type backend: :py:class:`~helga_queue.backends.base.Backend`
+    :param pool_size: storage threads; 0 runs subcommands on the calling thread
+    :type pool_size: int
+    :param cache_entries: max entries for a fresh queue cache; 0 disables it
+    :type cache_entries: int
+    :param coalesce_window: seconds to buffer appends for; None to write each
+      append on its own
+    :type coalesce_window: float
+    :param clock: object providing ``callLater`` for paced output and the
+      write coalescer; defaults to the reactor
+    :rtype: :py:class:`ConcurrentPlugin`
+    """
+    attrs = [
+        '_backend', '_cache', '_render_cache', '_owned', '_output', '_coalescer', '_pool', '_respond',
+        '_respond_error', 'reactor'
+    ]
+    saved = dict((attr, getattr(plugin, attr)) for attr in attrs)
+    clock = clock or reactor
+    pool = StoragePool(size=pool_size, timeout=plugin._pool.timeout)
+
+    def _respond(res, client, channel):
+        saved['_respond'](res, client, channel)
+        if isinstance(client, _PendingClient):
+            client.deferred.callback(res)
+
+    def _respond_error(failure, client, channel, cmdname):
+        saved['_respond_error'](failure, client, channel, cmdname)
+        if isinstance(client, _PendingClient):
+            client.deferred.errback(failure)
+
+    try:
+        plugin._backend = backend
+        plugin._cache = QueueCache(max_entries=cache_entries, max_bytes=0)
+        plugin._render_cache = RenderCache(max_entries=plugin._render_cache.max_entries)
+        plugin._owned = set()
+        plugin._output = OutputScheduler(rate=1000000.0, clock=clock)
+        plugin._coalescer = None
+        if coalesce_window:
+            plugin._coalescer = WriteCoalescer(plugin._flush_appends, window=coalesce_window, clock=clock)
+        plugin._pool = pool
+        plugin._respond = _respond
+        plugin._respond_error = _respond_error
+        if pool_size == 0:
+            plugin.reactor = _ImmediateReactor()
+        yield ConcurrentPlugin()
+    finally:
+        pool.stop()
+        for attr, val in saved.items():
+            setattr(plugin, attr, val)
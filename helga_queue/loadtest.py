@@ -0,0 +1,370 @@
+"""
+Load test for the ``queue`` command: many simulated IRC users in many
+channels running a mix of subcommands at once against a local storage
+backend, through the plugin's storage thread pool under the Twisted
+reactor, as in a running bot.
+
+Reports throughput, latency percentiles, lost updates (acknowledged
+appends whose item was neither popped nor left in its queue) and how long
+the reactor thread was blocked.
+
+Run with ``python -m helga_queue.loadtest --help``; results are written as
+JSON.
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+from collections import Counter
+from timeit import default_timer
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall, react
+
+from helga_queue.backends import make_backend
+from helga_queue.harness import RecordingClient, concurrent_plugin
+from helga_queue.metrics import percentile
+
+OPERATIONS = ['append', 'pop', 'list', 'show', 'len', 'next']
+
+DEFAULT_MIX = 'append=40,pop=20,list=5,show=10,len=15,next=10'
+
+# appended items are 'load <n>', unique within a run
+ITEM_PREFIX = 'load '
+
+POPPED_RE = re.compile(r"^Popped item \d+ from queue \S+: '(.*)'$", re.DOTALL)
+
+
+def parse_mix(spec):
+    """
+    Parse a subcommand mix such as ``append=40,pop=20,len=40``.
+
+    :param spec: comma-separated ``operation=weight`` pairs
+    :type spec: string
+    :returns: list of ``(operation, weight)``
+    :rtype: list
+    :raises: ValueError if an operation is unknown or a weight isn't a
+      positive integer
+    """
+    mix = []
+    for part in spec.split(','):
+        op, _, weight = part.strip().partition('=')
+        if op not in OPERATIONS:
+            raise ValueError("unknown operation '{o}'".format(o=op))
+        try:
+            weight = int(weight)
+        except ValueError:
+            weight = 0
+        if weight <= 0:
+            raise ValueError("weight for '{o}' must be a positive integer".format(o=op))
+        mix.append((op, weight))
+    return mix
+
+
+class StallMonitor(object):
+    """
+    Measures how long the reactor thread is blocked: a timer due every
+    ``interval`` seconds records how late it runs.
+
+    :param interval: seconds between checks
+    :type interval: float
+    :param clock: object providing ``seconds`` and ``callLater``; defaults to
+      the reactor
+    """
+
+    def __init__(self, interval=0.01, clock=None):
+        self.interval = interval
+        self.lags = []
+        self._call = LoopingCall(self._tick)
+        if clock is not None:
+            self._call.clock = clock
+        self._last = None
+
+    def start(self):
+        self._last = self._call.clock.seconds()
+        self._call.start(self.interval, now=False)
+
+    def stop(self):
+        if self._call.running:
+            self._call.stop()
+
+    def _tick(self):
+        now = self._call.clock.seconds()
+        self.lags.append(max(now - self._last - self.interval, 0))
+        self._last = now
+
+    def summary(self):
+        """
+        :returns: total blocked time, longest stall and 99th percentile lag,
+          in milliseconds
+        :rtype: dict
+        """
+        lags = sorted(self.lags)
+        return {
+            'checks': len(lags),
+            'blocked_ms': sum(lags) * 1000,
+            'max_stall_ms': lags[-1] * 1000 if lags else 0,
+            'p99_lag_ms': percentile(lags, 99) * 1000 if lags else 0,
+        }
+
+
+def _latency(timings):
+    timings = sorted(timings)
+    return {
+        'count': len(timings),
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'max_ms': timings[-1] * 1000,
+    }
+
+
+class _LoadRun(object):
+    """state of one load test run; see :py:func:`run`"""
+
+    def __init__(self, backend, harness, requests, users, channels, mix, queues, hot_queues, hot_fraction, rng,
+                 clock):
+        self.backend = backend
+        self.harness = harness
+        self.requests = requests
+        self.users = users
+        self.channels = channels
+        self.ops = [op for op, weight in mix for _ in range(weight)]
+        self.queues = queues
+        self.hot_queues = hot_queues
+        self.hot_fraction = hot_fraction
+        self.rng = rng
+        self.clock = clock
+        self.client = RecordingClient(keep=False)
+        self.issued = 0
+        self.completed = 0
+        self.errors = 0
+        self.timings = dict((op, []) for op in OPERATIONS)
+        # item -> queue, for appends that were acknowledged
+        self.acked = {}
+        self.popped = []
+        self.done = defer.Deferred()
+
+    def _pick_queue(self):
+        cold = self.queues[self.hot_queues:]
+        if len(cold) == 0 or (self.hot_queues > 0 and self.rng.random() < self.hot_fraction):
+            return self.rng.choice(self.queues[:self.hot_queues])
+        return self.rng.choice(cold)
+
+    def next(self):
+        """issue the next request, if any are left"""
+        if self.issued >= self.requests:
+            return
+        self.issued += 1
+        op = self.rng.choice(self.ops)
+        queue_name = self._pick_queue()
+        user = self.rng.randrange(self.users)
+        nick = 'user{u}'.format(u=user)
+        channel = '#chan{c}'.format(c=user % self.channels)
+        args = [queue_name, op]
+        item = None
+        if op == 'append':
+            item = ITEM_PREFIX + str(self.issued)
+            args.append(item)
+        start = default_timer()
+        d = self.harness.queue(self.client, channel, nick, args)
+        d.addCallbacks(self._finished, self._failed, callbackArgs=(op, queue_name, item, start))
+
+    def _finished(self, res, op, queue_name, item, start):
+        self.timings[op].append(default_timer() - start)
+        if res is not None and res.startswith('ERROR'):
+            self.errors += 1
+        elif op == 'append':
+            self.acked[item] = queue_name
+        elif op == 'pop' and res is not None:
+            m = POPPED_RE.match(res)
+            if m is not None and m.group(1).startswith(ITEM_PREFIX):
+                self.popped.append(m.group(1))
+        self._completed()
+
+    def _failed(self, failure):
+        self.errors += 1
+        self._completed()
+
+    def _completed(self):
+        self.completed += 1
+        if self.completed == self.requests:
+            self.done.callback(None)
+        else:
+            # off this call stack, so synchronous responses don't recurse
+            self.clock.callLater(0, self.next)
+
+    def lost_updates(self):
+        """
+        :returns: number of acknowledged appends whose item was neither
+          popped nor is still in its queue, and number of extra copies of
+          appended items that were popped or are still queued
+        :rtype: tuple
+        """
+        seen = Counter(self.popped)
+        for name in self.queues:
+            seen.update(i for i in (self.backend.get(name) or []) if i.startswith(ITEM_PREFIX))
+        lost = sum(1 for item in self.acked if seen[item] == 0)
+        duplicated = sum(n - 1 for n in seen.values() if n > 1)
+        return lost, duplicated
+
+
+def run(backend, requests=2000, users=200, channels=50, concurrency=50, mix=None, hot_queues=5, cold_queues=100,
+        hot_fraction=0.8, initial_size=10, pool_size=4, cache_entries=0, coalesce_window=None, seed=None,
+        clock=None):
+    """
+    Run a load test. Each of ``concurrency`` simulated users sends a
+    request, waits for its response, and sends the next, until
+    ``requests`` have been answered. Requests come from one of ``users``
+    nicks in one of ``channels`` channels, and go to one of ``hot_queues``
+    busy queues with probability ``hot_fraction``, else to one of
+    ``cold_queues`` others.
+
+    :param backend: storage backend to run against
+    :type backend: :py:class:`~helga_queue.backends.base.Backend`
+    :param requests: total requests
+    :type requests: int
+    :param concurrency: requests in flight at once
+    :type concurrency: int
+    :param mix: list of ``(operation, weight)`` (see :py:func:`parse_mix`)
+    :type mix: list
+    :param initial_size: items each queue starts with
+    :type initial_size: int
+    :param pool_size: storage threads; 0 runs subcommands on the reactor
+      thread
+    :type pool_size: int
+    :param cache_entries: size of the plugin's queue cache; 0 disables it
+    :type cache_entries: int
+    :param coalesce_window: seconds appends are coalesced over; None to
+      write each append on its own
+    :type coalesce_window: float
+    :param seed: random seed, for repeatable runs
+    :param clock: object providing ``seconds`` and ``callLater``; defaults
+      to the reactor, which must be running
+    :returns: Deferred firing with a results dict
+    :rtype: :py:class:`twisted.internet.defer.Deferred`
+    """
+    clock = clock or reactor
+    mix = mix or parse_mix(DEFAULT_MIX)
+    queues = ['hot{i}'.format(i=i) for i in range(hot_queues)] + ['cold{i}'.format(i=i) for i in range(cold_queues)]
+    for name in queues:
+        backend.set(name, ['seed {i}'.format(i=i) for i in range(initial_size)])
+    plugin_cm = concurrent_plugin(
+        backend, pool_size=pool_size, cache_entries=cache_entries, coalesce_window=coalesce_window, clock=clock
+    )
+    harness = plugin_cm.__enter__()
+    load = _LoadRun(
+        backend, harness, requests, users, channels, mix, queues, hot_queues, hot_fraction, random.Random(seed), clock
+    )
+    monitor = StallMonitor(clock=clock)
+    monitor.start()
+    start = default_timer()
+
+    def _report(_):
+        elapsed = default_timer() - start
+        monitor.stop()
+        plugin_cm.__exit__(None, None, None)
+        lost, duplicated = load.lost_updates()
+        every = [t for op in OPERATIONS for t in load.timings[op]]
+        return {
+            'requests': load.completed,
+            'errors': load.errors,
+            'elapsed_s': elapsed,
+            'throughput_per_sec': load.completed / elapsed if elapsed > 0 else None,
+            'latency': _latency(every) if every else None,
+            'ops': dict((op, _latency(t)) for op, t in load.timings.items() if t),
+            'acked_appends': len(load.acked),
+            'lost_updates': lost,
+            'duplicated_items': duplicated,
+            'reactor': monitor.summary(),
+        }
+
+    load.done.addCallback(_report)
+    if requests == 0:
+        load.done.callback(None)
+    for _ in range(min(concurrency, requests)):
+        load.next()
+    return load.done
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description='Load test helga-queue with many concurrent simulated users')
+    p.add_argument('-b', '--backend', default='memory', choices=['memory', 'sqlite'],
+                   help='storage backend to run against (default: memory)')
+    p.add_argument('--sqlite-path', default=':memory:',
+                   help='database path for the sqlite backend (default: :memory:)')
+    p.add_argument('-n', '--requests', type=int, default=2000, help='total requests (default: %(default)s)')
+    p.add_argument('-u', '--users', type=int, default=200, help='simulated nicks (default: %(default)s)')
+    p.add_argument('--channels', type=int, default=50, help='channels the users are in (default: %(default)s)')
+    p.add_argument('-c', '--concurrency', type=int, default=50,
+                   help='requests in flight at once (default: %(default)s)')
+    p.add_argument('-m', '--mix', default=DEFAULT_MIX,
+                   help='comma-separated operation=weight pairs (default: %(default)s)')
+    p.add_argument('--hot-queues', type=int, default=5, help='number of busy queues (default: %(default)s)')
+    p.add_argument('--cold-queues', type=int, default=100, help='number of quiet queues (default: %(default)s)')
+    p.add_argument('--hot-fraction', type=float, default=0.8,
+                   help='fraction of requests going to the busy queues (default: %(default)s)')
+    p.add_argument('--initial-size', type=int, default=10, help='items each queue starts with (default: %(default)s)')
+    p.add_argument('-t', '--threads', type=int, default=4,
+                   help='storage threads; 0 runs subcommands on the reactor thread (default: %(default)s)')
+    p.add_argument('--cache-entries', type=int, default=0,
+                   help='queue cache size; 0 disables the cache (default: %(default)s)')
+    p.add_argument('--coalesce-window', type=float, default=None,
+                   help='seconds to coalesce appends over (default: no coalescing)')
+    p.add_argument('--seed', type=int, default=None, help='random seed, for repeatable runs')
+    p.add_argument('--output', default='-', help='file to write JSON results to (default: stdout)')
+    return p.parse_args(argv)
+
+
+def _write(results, args):
+    doc = dict(
+        (key, getattr(args, key)) for key in [
+            'backend', 'requests', 'users', 'channels', 'concurrency', 'mix', 'hot_queues', 'cold_queues',
+            'hot_fraction', 'threads', 'cache_entries', 'coalesce_window'
+        ]
+    )
+    doc['results'] = results
+    if args.output == '-':
+        json.dump(doc, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as fh:
+            json.dump(doc, fh, indent=2, sort_keys=True)
+
+
+def _main(reactor, args):
+    d = run(
+        make_backend(args.backend, sqlite_path=args.sqlite_path),
+        requests=args.requests,
+        users=args.users,
+        channels=args.channels,
+        concurrency=args.concurrency,
+        mix=parse_mix(args.mix),
+        hot_queues=args.hot_queues,
+        cold_queues=args.cold_queues,
+        hot_fraction=args.hot_fraction,
+        initial_size=args.initial_size,
+        pool_size=args.threads,
+        cache_entries=args.cache_entries,
+        coalesce_window=args.coalesce_window,
+        seed=args.seed,
+        clock=reactor
+    )
+    d.addCallback(_write, args)
+    return d
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        sys.stderr.write('ERROR - {e}\n'.format(e=e))
+        return 1
+    react(_main, [args])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
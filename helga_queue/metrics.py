@@ -0,0 +1,151 @@
+"""
+Lightweight in-process metrics for the queue command: per-subcommand call
+counts, failures and latency percentiles, and storage call counts, write
+conflicts and (approximate) bytes transferred.
+"""
+
+import threading
+from collections import deque
+
+# str and unicode on python 2; str on python 3
+STRING_TYPES = (str, type(u''))
+
+
+def percentile(values, pct):
+    """
+    Return the ``pct`` percentile of a sorted list, by nearest rank.
+
+    :param values: sorted values
+    :type values: list
+    :param pct: percentile, 0-100
+    :type pct: float
+    """
+    if len(values) == 0:
+        return None
+    idx = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+
+def sizeof(value):
+    """
+    Approximate size in bytes of an item or list of items.
+
+    :rtype: int
+    """
+    if isinstance(value, (list, tuple)):
+        return sum(len(v) for v in value if isinstance(v, STRING_TYPES))
+    if isinstance(value, STRING_TYPES):
+        return len(value)
+    return 0
+
+
+class Metrics(object):
+    """
+    Thread-safe metrics registry. When disabled, every ``record_*`` call
+    returns immediately.
+
+    :param enabled: whether to record anything
+    :type enabled: bool
+    :param window: number of most recent latency samples kept per
+      subcommand for computing percentiles
+    :type window: int
+    """
+
+    def __init__(self, enabled=True, window=1000):
+        self.enabled = enabled
+        self.window = window
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """clear all recorded metrics"""
+        with self._lock:
+            self._commands = {}
+            self.db_calls = 0
+            self.db_failures = 0
+            self.db_conflicts = 0
+            self.bytes_read = 0
+            self.bytes_written = 0
+
+    def record_command(self, name, seconds, failed=False):
+        """
+        Record one invocation of a subcommand.
+
+        :param name: subcommand name
+        :type name: string
+        :param seconds: how long it took
+        :type seconds: float
+        :param failed: whether it raised an exception
+        :type failed: bool
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            cmd = self._commands.get(name)
+            if cmd is None:
+                cmd = self._commands[name] = {
+                    'calls': 0, 'failures': 0, 'latencies': deque(maxlen=self.window)
+                }
+            cmd['calls'] += 1
+            if failed:
+                cmd['failures'] += 1
+            cmd['latencies'].append(seconds)
+
+    def record_db(self, bytes_read=0, bytes_written=0, failed=False):
+        """
+        Record one call to the storage backend.
+
+        :param bytes_read: approximate bytes returned
+        :type bytes_read: int
+        :param bytes_written: approximate bytes sent
+        :type bytes_written: int
+        :param failed: whether it raised an exception
+        :type failed: bool
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.db_calls += 1
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+            if failed:
+                self.db_failures += 1
+
+    def record_conflict(self):
+        """
+        Record a write to the storage backend that lost to a concurrent
+        writer and had to be retried.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.db_conflicts += 1
+
+    def snapshot(self):
+        """
+        Return all metrics as a JSON-serializable dict; latencies are in
+        milliseconds.
+
+        :rtype: dict
+        """
+        with self._lock:
+            commands = {}
+            for name, cmd in self._commands.items():
+                lat = sorted(cmd['latencies'])
+                commands[name] = {
+                    'calls': cmd['calls'],
+                    'failures': cmd['failures'],
+                    'p50_ms': percentile(lat, 50) * 1000,
+                    'p95_ms': percentile(lat, 95) * 1000,
+                    'p99_ms': percentile(lat, 99) * 1000,
+                }
+            return {
+                'commands': commands,
+                'db': {
+                    'calls': self.db_calls,
+                    'failures': self.db_failures,
+                    'conflicts': self.db_conflicts,
+                    'bytes_read': self.bytes_read,
+                    'bytes_written': self.bytes_written,
+                },
+            }
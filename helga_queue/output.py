@@ -0,0 +1,52 @@
+"""
+Rate-paced output of multi-line responses, so long listings don't get the
+bot kicked for excess flood.
+"""
+
+from collections import deque
+
+from twisted.internet import reactor
+
+
+class OutputScheduler(object):
+    """
+    Single outgoing line queue shared by all targets, drained at no more than
+    ``rate`` lines per second. Must only be used from the reactor thread.
+
+    :param rate: maximum lines per second
+    :type rate: float
+    :param clock: object providing ``callLater``; defaults to the reactor
+    """
+
+    def __init__(self, rate=2.0, clock=None):
+        self.rate = rate
+        self._clock = clock or reactor
+        self._pending = deque()
+        self._call = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def send(self, client, target, lines):
+        """
+        Queue lines to be sent with ``client.msg(target, line)``.
+
+        :param client: helga client
+        :param target: nick or channel to send to
+        :type target: string
+        :param lines: lines to send
+        :type lines: iterable
+        """
+        for line in lines:
+            self._pending.append((client, target, line))
+        if self._call is None:
+            self._send_next()
+
+    def _send_next(self):
+        self._call = None
+        if len(self._pending) == 0:
+            return
+        client, target, line = self._pending.popleft()
+        client.msg(target, line)
+        # always wait out the interval after a send, even if we're now idle
+        self._call = self._clock.callLater(1.0 / self.rate, self._send_next)
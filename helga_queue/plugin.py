@@ -5,57 +5,699 @@ Plugin to enable users to keep and share a short
 queue of to-do items.
 """
 
-from helga.plugins import command
+import json
+import re
+import textwrap
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+from functools import partial
+from timeit import default_timer
+
+import smokesignal
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
+
+from helga.plugins import command, ResponseNotReady
 from helga.db import db
+from helga import settings, log
+
+from helga_queue.cache import QueueCache, RenderCache
+from helga_queue.threads import StoragePool, ReactorClient
+from helga_queue.output import OutputScheduler
+from helga_queue.backends import make_backend
+from helga_queue.backends.base import ConflictError, tokenize
+from helga_queue.metrics import Metrics, sizeof
+from helga_queue.profiler import Profiler
+from helga_queue.coalesce import WriteCoalescer
+from helga_queue.timerwheel import TimerWheel
+from helga_queue.transfer import export_queues, import_queues, open_jsonl
+
+logger = log.getLogger(__name__)
+
+_cache = QueueCache(
+    max_entries=getattr(settings, 'QUEUE_CACHE_MAX_ENTRIES', 128),
+    max_bytes=getattr(settings, 'QUEUE_CACHE_MAX_BYTES', 1048576),
+    ttl=getattr(settings, 'QUEUE_CACHE_TTL', None)
+)
+
+_render_cache = RenderCache(
+    max_entries=getattr(settings, 'QUEUE_RENDER_CACHE_ENTRIES', 256),
+    ttl=getattr(settings, 'QUEUE_CACHE_TTL', None)
+)
+
+_pool = StoragePool(
+    size=getattr(settings, 'QUEUE_THREADPOOL_SIZE', 4),
+    timeout=getattr(settings, 'QUEUE_DB_TIMEOUT', 10)
+)
+
+_backend_kind = getattr(settings, 'QUEUE_BACKEND', 'mongo')
+if _backend_kind == 'mongo' and getattr(settings, 'QUEUE_STORAGE_LAYOUT', 'document') == 'segmented':
+    _backend_kind = 'mongo-segmented'
+_backend = make_backend(
+    _backend_kind,
+    db=db,
+    segment_size=getattr(settings, 'QUEUE_SEGMENT_SIZE', 1000),
+    sqlite_path=getattr(settings, 'QUEUE_SQLITE_PATH', 'helga_queue.sqlite'),
+    history_size=getattr(settings, 'QUEUE_HISTORY_SIZE', 20)
+)
+
+# queues whose owner has been recorded by this process
+_owned = set()
+
+# queue name -> seconds items appended to it last, reloaded from storage by
+# the expiry reaper
+_queue_ttls = {}
+
+_metrics = Metrics(enabled=getattr(settings, 'QUEUE_METRICS_ENABLED', True))
+
+_profiler = Profiler(
+    enabled=getattr(settings, 'QUEUE_PROFILE_ENABLED', False),
+    sample=getattr(settings, 'QUEUE_PROFILE_SAMPLE', 0.01)
+)
+
+_output = OutputScheduler(rate=getattr(settings, 'QUEUE_OUTPUT_RATE', 2.0))
+
+# maximum length of a single line of output; IRC lines are 512 bytes
+# including the protocol prefix
+LINE_LENGTH = getattr(settings, 'QUEUE_LINE_LENGTH', 400)
+
+# maximum number of lines sent for one 'queue list'
+LIST_MAX_LINES = getattr(settings, 'QUEUE_LIST_MAX_LINES', 50)
+
+# separator between items for 'queue append-many'
+APPEND_MANY_DELIMITER = getattr(settings, 'QUEUE_APPEND_MANY_DELIMITER', '|')
+
+# seconds a claimed item is leased for before it goes back on its queue
+CLAIM_LEASE = getattr(settings, 'QUEUE_CLAIM_LEASE', 3600)
+
+# seconds between returning the items of expired claims to their queues
+CLAIM_REAP_INTERVAL = getattr(settings, 'QUEUE_CLAIM_REAP_INTERVAL', 60)
+
+# seconds between background runs of the expired item reaper
+EXPIRE_INTERVAL = getattr(settings, 'QUEUE_EXPIRE_INTERVAL', 60)
+
+# number of expired items (queues, for MongoDB) the reaper deletes per batch
+EXPIRE_BATCH = getattr(settings, 'QUEUE_EXPIRE_BATCH', 500)
+
+# durations for 'queue append-in', 'append-ttl' and 'ttl', such as 90s, 15m
+# or 1h30m
+DURATION_RE = re.compile(r'^(?:(\d+)d)?(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?$')
+
+# number of changes shown by 'queue history' by default
+HISTORY_SHOW = 5
+
+# most indexes one 'queue pop' or 'queue move' range or list may name
+MAX_INDEXES = 1000
+
+MOVE_USAGE = "ERROR - usage: queue [queue name] move <index> <position>, or queue [queue name] move " \
+    "<index|range|list> to <target queue>"
+
+# number of items fetched per database round trip when listing a queue
+LIST_PAGE_SIZE = 100
+
+# number of items read or written per storage call by 'queue export' and
+# 'queue import'
+TRANSFER_BATCH_SIZE = getattr(settings, 'QUEUE_TRANSFER_BATCH_SIZE', 1000)
+
+# path and file name prefix the profiler's stats are written to
+PROFILE_PATH = getattr(settings, 'QUEUE_PROFILE_PATH', 'helga_queue_profile')
+
+#######################
+# subcommand registry #
+#######################
+
+_commands = {}
+
+def register_subcommand(name, fn, aliases=None):
+    """
+    Register a handler function for a queue subcommand (and optional aliases).
+    Handlers are called as ``fn(client, channel, nick, queue_name, args)``
+    and should return a response string (or None).
+
+    :param name: subcommand name
+    :type name: string
+    :param fn: handler function
+    :type fn: callable
+    :param aliases: other names to register for the same handler
+    :type aliases: list
+    """
+    _commands[name] = fn
+    for alias in (aliases or []):
+        _commands[alias] = fn
+
+def subcommand(name, aliases=None):
+    """
+    Decorator form of :py:func:`register_subcommand`.
+
+    :param name: subcommand name
+    :type name: string
+    :param aliases: other names to register for the same handler
+    :type aliases: list
+    """
+    def decorator(fn):
+        register_subcommand(name, fn, aliases=aliases)
+        return fn
+    return decorator
 
 #######################
 # subcommand handlers #
 #######################
 
+@subcommand('list')
 def handle_list(client, channel, nick, queue_name, args):
-    q = _get_queue(queue_name)
+    stamp = _queue_stamp(queue_name)
+    total = _queue_len(queue_name) if stamp is None else stamp[-1]
     if channel != nick:
-        client.me(channel, 'whispers to {0} all {1} items in queue'.format(nick, len(q)))
-    client.msg(nick, _queue_repr(queue_name, q))
+        client.me(channel, 'whispers to {0} all {1} items in queue'.format(nick, total))
+    if total == 0:
+        client.msg(nick, 'Queue "{n}" is empty.'.format(n=queue_name))
+        return
+    lines = _rendered(queue_name, 'list', stamp, _list_lines, queue_name, total)
+    reactor.callFromThread(_output.send, client, nick, lines)
 
+@subcommand('show')
 def handle_show(client, channel, nick, queue_name, args):
-    q = _get_queue(queue_name)
-    return _queue_repr(queue_name, q)
+    if len(args) > 0:
+        try:
+            start, end = [int(x) for x in args[0].split('-', 1)]
+        except ValueError:
+            return "ERROR - range must be in the form <start>-<end>; '{a}' is invalid".format(a=args[0])
+        if start < 0 or end < start:
+            return "ERROR - range must be in the form <start>-<end>; '{a}' is invalid".format(a=args[0])
+        return _rendered(
+            queue_name, ('show', args[0]), _queue_stamp(queue_name), _show_range, queue_name, start, end, args[0]
+        )
+    return _rendered(queue_name, 'show', _queue_stamp(queue_name), _show_queue, queue_name)
 
+@subcommand('pop')
 def handle_pop(client, channel, nick, queue_name, args):
     idx = 0
     if len(args) > 0:
         try:
             idx = int(args[0])
         except ValueError:
+            if '-' in args[0] or ',' in args[0]:
+                return _handle_pop_many(queue_name, args[0])
             return "ERROR - {a} is not a valid index (int)".format(a=args[0])
-    q = _get_queue(queue_name)
-    if len(q) == 0:
-        return "Queue {n} is empty.".format(n=queue_name)
-    if idx >= len(q):
-        return "ERROR - there are only {c} items in queue qname".format(c=len(q))
-    val = q.pop(idx)
-    _set_queue(queue_name, q)
+        if idx < 0:
+            return "ERROR - {a} is not a valid index (int)".format(a=args[0])
+    val = _pop_item(queue_name, idx)
+    if val is None:
+        count = _queue_len(queue_name)
+        if count == 0:
+            return "Queue {n} is empty.".format(n=queue_name)
+        return "ERROR - there are only {c} items in queue {n}".format(c=count, n=queue_name)
     return "Popped item {i} from queue {n}: '{v}'".format(n=queue_name, v=val, i=idx)
 
+@subcommand('append')
 def handle_append(client, channel, nick, queue_name, args):
-    queue = _get_queue(queue_name)
-    item = ' '.join(args)
-    queue.append(item)
-    return _set_queue(queue_name, queue)
+    if args[:1] != ['-p']:
+        item = ' '.join(args)
+        return _append_item(queue_name, item, owner=nick, channel=channel)
+    # -p <priority>: ahead of items of lower priority
+    if len(args) < 3:
+        return "ERROR - usage: queue [queue name] append [-p <priority>] <item>"
+    try:
+        priority = int(args[1])
+    except ValueError:
+        priority = -1
+    if priority < 0:
+        return "ERROR - '{a}' is not a valid priority (an integer, 0 or more)".format(a=args[1])
+    try:
+        return _append_item(queue_name, ' '.join(args[2:]), owner=nick, channel=channel, priority=priority)
+    except NotImplementedError:
+        return "ERROR - the {b} backend doesn't support priorities".format(b=_backend.name)
 
+@subcommand('append-many')
+def handle_append_many(client, channel, nick, queue_name, args):
+    """append several items at once, separated by APPEND_MANY_DELIMITER"""
+    items = [i.strip() for i in ' '.join(args).split(APPEND_MANY_DELIMITER)]
+    items = [i for i in items if i != '']
+    if len(items) == 0:
+        return "ERROR - no items to append; separate items with '{d}'".format(d=APPEND_MANY_DELIMITER)
+    res = _append_items(queue_name, items, owner=nick, channel=channel)
+    if res.startswith('ERROR'):
+        return res
+    return "appended {c} items to queue '{n}'".format(c=len(items), n=queue_name)
+
+@subcommand('len')
 def handle_len(client, channel, nick, queue_name, args):
-    q = _get_queue(nick)
-    return "{i} items in queue {q}".format(i=len(q), q=queue_name)
+    return "{i} items in queue {q}".format(i=_queue_len(queue_name), q=queue_name)
 
+@subcommand('next')
 def handle_next(client, channel, nick, queue_name, args):
-    q = _get_queue(nick)
-    return "Next item in queue {q}: {i}".format(i=q[0], q=queue_name)
+    item = _queue_peek(queue_name)
+    if item is None:
+        return "Queue {n} is empty.".format(n=queue_name)
+    return "Next item in queue {q}: {i}".format(i=item, q=queue_name)
+
+@subcommand('append-at')
+def handle_append_at(client, channel, nick, queue_name, args):
+    """append an item once a time (server local) is reached: HH:MM or YYYY-MM-DDTHH:MM[:SS]"""
+    return _handle_schedule(channel, nick, queue_name, args, 'append-at', _parse_at,
+                            '<HH:MM|YYYY-MM-DDTHH:MM>')
+
+@subcommand('append-in')
+def handle_append_in(client, channel, nick, queue_name, args):
+    """append an item after a delay, such as 90s, 15m or 1h30m"""
+    return _handle_schedule(channel, nick, queue_name, args, 'append-in', _parse_in, '<duration>')
+
+@subcommand('append-ttl')
+def handle_append_ttl(client, channel, nick, queue_name, args):
+    """append an item that expires after a duration, such as 90s, 15m or 7d"""
+    if len(args) < 2:
+        return "ERROR - usage: queue [queue name] append-ttl <duration> <item>"
+    ttl = _parse_duration(args[0])
+    if not ttl:
+        return "ERROR - '{a}' is not a valid duration, such as 90s, 15m or 7d".format(a=args[0])
+    try:
+        return _append_item(queue_name, ' '.join(args[1:]), owner=nick, channel=channel, ttl=ttl)
+    except NotImplementedError:
+        return "ERROR - the {b} backend doesn't support item expiry".format(b=_backend.name)
+
+@subcommand('ttl')
+def handle_ttl(client, channel, nick, queue_name, args):
+    """show or set how long items appended to a queue last (a duration, or off); existing items are unchanged"""
+    if len(args) == 0:
+        ttl = _load_ttls().get(queue_name)
+        if ttl is None:
+            return "Items appended to queue {n} don't expire".format(n=queue_name)
+        return "Items appended to queue {n} expire after {s} seconds".format(n=queue_name, s=ttl)
+    if args[0] == 'off':
+        ttl = None
+    else:
+        ttl = _parse_duration(args[0])
+        if not ttl:
+            return "ERROR - '{a}' is not a valid duration, such as 90s, 15m or 7d; or off".format(a=args[0])
+    try:
+        _db_call(_backend.set_ttl, queue_name, ttl)
+    except NotImplementedError:
+        return "ERROR - the {b} backend doesn't support item expiry".format(b=_backend.name)
+    if ttl is None:
+        _queue_ttls.pop(queue_name, None)
+        return "Items appended to queue {n} no longer expire".format(n=queue_name)
+    _queue_ttls[queue_name] = ttl
+    _cache.exclude(queue_name)
+    return "Items appended to queue {n} now expire after {s} seconds".format(n=queue_name, s=ttl)
+
+@subcommand('claim')
+def handle_claim(client, channel, nick, queue_name, args):
+    """take the next item, leased to you until you ack or release it"""
+    try:
+        res = _claim_item(queue_name, nick)
+    except NotImplementedError:
+        return "ERROR - the {b} backend doesn't support claims".format(b=_backend.name)
+    if res is None:
+        return "Queue {n} is empty.".format(n=queue_name)
+    claim_id, val = res
+    return "{u} claimed item '{v}' from queue {n} as claim {c}; ack it within {s} seconds or it goes back " \
+        "on the queue".format(u=nick, v=val, n=queue_name, c=claim_id, s=CLAIM_LEASE)
+
+@subcommand('ack')
+def handle_ack(client, channel, nick, queue_name, args):
+    """finish with a claimed item"""
+    return _finish_claim(queue_name, nick, args, release=False)
+
+@subcommand('release')
+def handle_release(client, channel, nick, queue_name, args):
+    """give up a claimed item, putting it back at the head of the queue"""
+    return _finish_claim(queue_name, nick, args, release=True)
+
+@subcommand('history')
+def handle_history(client, channel, nick, queue_name, args):
+    """show the most recent appends and pops (default 5), which undo reverts newest first"""
+    count = HISTORY_SHOW
+    if len(args) > 0:
+        try:
+            count = int(args[0])
+        except ValueError:
+            count = 0
+        if count <= 0:
+            return "ERROR - {a} is not a valid count (int)".format(a=args[0])
+    try:
+        changes = _db_call(_backend.history, queue_name, count)
+    except NotImplementedError:
+        return "ERROR - the {b} backend doesn't record history".format(b=_backend.name)
+    if len(changes) == 0:
+        return "No recorded changes to queue {n}.".format(n=queue_name)
+    lines = ["Recent changes to queue {n}, newest last:".format(n=queue_name)]
+    for change in changes:
+        when = datetime.fromtimestamp(change['at']).strftime('%Y-%m-%d %H:%M:%S')
+        lines.append('{t} {d}'.format(t=when, d=_describe_change(change))[:LINE_LENGTH])
+    return '\n'.join(lines)
+
+@subcommand('undo')
+def handle_undo(client, channel, nick, queue_name, args):
+    """revert the most recent append or pop (see history)"""
+    try:
+        change = _db_call(_backend.undo, queue_name)
+    except NotImplementedError:
+        return "ERROR - the {b} backend doesn't record history".format(b=_backend.name)
+    except ConflictError:
+        return "ERROR - queue {n} kept changing while undoing; please try again".format(n=queue_name)
+    finally:
+        _cache.invalidate(queue_name)
+    if change is None:
+        return "Nothing to undo in queue {n}.".format(n=queue_name)
+    return "Undid change to queue {n}: {d}".format(n=queue_name, d=_describe_change(change))[:LINE_LENGTH]
+
+@subcommand('move')
+def handle_move(client, channel, nick, queue_name, args):
+    """move an item within the queue, or items to the end of another queue"""
+    if len(args) > 1 and args[1] == 'to':
+        if len(args) != 3:
+            return MOVE_USAGE
+        return _handle_move_to(channel, nick, queue_name, args[0], args[2])
+    if len(args) != 2:
+        return MOVE_USAGE
+    idxs = []
+    for arg in args:
+        try:
+            idxs.append(int(arg))
+        except ValueError:
+            return "ERROR - index must be an integer; '{a}' is invalid".format(a=arg)
+        if idxs[-1] < 0:
+            return "ERROR - index must be an integer; '{a}' is invalid".format(a=arg)
+    idx, pos = idxs
+    q = _get_queue(queue_name)
+    if len(q) == 0:
+        return "Queue {n} is empty.".format(n=queue_name)
+    if idx >= len(q):
+        return "ERROR - queue {n} only has {c} items; cannot move index {i}".format(n=queue_name, c=len(q), i=idx)
+    if pos >= len(q):
+        return "ERROR - queue {n} only has {c} items; cannot move to index {p}".format(n=queue_name, c=len(q), p=pos)
+    q.insert(pos, q.pop(idx))
+    res = _set_queue(queue_name, q)
+    if res.startswith('ERROR'):
+        return res
+    return "Queue {n} item {i} moved to position {p}".format(n=queue_name, i=idx, p=pos)
+
+@subcommand('move-all')
+def handle_move_all(client, channel, nick, queue_name, args):
+    """move every item to the end of another queue"""
+    if len(args) != 1:
+        return "ERROR - usage: queue [queue name] move-all <target queue>"
+    target = args[0]
+    if target == queue_name:
+        return "ERROR - can't move items from queue {n} to itself".format(n=queue_name)
+    try:
+        vals = _move_items(queue_name, target, None, owner=nick, channel=channel)
+    except NotImplementedError:
+        return "ERROR - the {b} backend doesn't support moving items".format(b=_backend.name)
+    if len(vals) == 0:
+        return "Queue {n} is empty.".format(n=queue_name)
+    return "Moved {c} items from queue {n} to queue {t}".format(c=len(vals), n=queue_name, t=target)
+
+@subcommand('queues')
+def handle_queues(client, channel, nick, queue_name, args):
+    """list all queues, optionally only those of a nick or channel prefix"""
+    owner = prefix = None
+    if len(args) > 0 and args[0][:1] in ('#', '&'):
+        prefix = args[0]
+    elif len(args) > 0:
+        owner = args[0]
+    try:
+        queues = _db_call(_backend.queues, owner, prefix)
+    except NotImplementedError:
+        return "ERROR - the {b} backend can't list queues".format(b=_backend.name)
+    if channel != nick:
+        client.me(channel, 'whispers to {0} a list of {1} queues'.format(nick, len(queues)))
+    if len(queues) == 0:
+        client.msg(nick, 'No queues found.')
+        return
+    lines = ['Queues:']
+    for q in queues[:LIST_MAX_LINES]:
+        line = '{n}: {c} items'.format(n=q['name'], c=q['length'])
+        if q['owner'] is not None:
+            line += ' (created by {o} in {ch})'.format(o=q['owner'], ch=q['channel'])
+        if q['head'] is not None:
+            line += ' - next: {h}'.format(h=q['head'])
+        lines.append(line[:LINE_LENGTH])
+    if len(queues) > LIST_MAX_LINES:
+        lines.append('... {n} more queues'.format(n=len(queues) - LIST_MAX_LINES))
+    reactor.callFromThread(_output.send, client, nick, lines)
+
+@subcommand('search')
+def handle_search(client, channel, nick, queue_name, args):
+    """find items containing all of the given words; -a searches every queue"""
+    everywhere = len(args) > 0 and args[0] == '-a'
+    if everywhere:
+        args = args[1:]
+    terms = tokenize(' '.join(args))
+    if len(terms) == 0:
+        return "ERROR - usage: queue [queue name] search [-a] <words>"
+    try:
+        hits = _db_call(_backend.search, terms, None if everywhere else queue_name)
+    except NotImplementedError:
+        return "ERROR - the {b} backend can't search across queues".format(b=_backend.name)
+    if len(hits) == 0:
+        return "No items found matching '{t}'.".format(t=' '.join(terms))
+    if channel != nick:
+        client.me(channel, 'whispers to {0} {1} matching items'.format(nick, len(hits)))
+    lines = ["Found {c} items matching '{t}':".format(c=len(hits), t=' '.join(terms))]
+    for qname, idx, item in hits[:LIST_MAX_LINES]:
+        if everywhere:
+            line = '{q} {i}. {v}'.format(q=qname, i=idx, v=item)
+        else:
+            line = '{i}. {v}'.format(i=idx, v=item)
+        lines.append(line[:LINE_LENGTH])
+    if len(hits) > LIST_MAX_LINES:
+        lines.append('... {n} more items'.format(n=len(hits) - LIST_MAX_LINES))
+    reactor.callFromThread(_output.send, client, nick, lines)
+
+@subcommand('stats')
+def handle_stats(client, channel, nick, queue_name, args):
+    """show performance metrics (operators only)"""
+    if nick not in client.operators:
+        return "ERROR - only operators may use 'queue stats'"
+    snap = _metrics.snapshot()
+    if not _metrics.enabled:
+        lines = ['Queue metrics are disabled.']
+    else:
+        lines = ['Queue metrics:']
+    for name, cmd in sorted(snap['commands'].items()):
+        lines.append('{n}: {c} calls, {f} failed, p50 {p50:.1f}ms p95 {p95:.1f}ms p99 {p99:.1f}ms'.format(
+            n=name, c=cmd['calls'], f=cmd['failures'],
+            p50=cmd['p50_ms'], p95=cmd['p95_ms'], p99=cmd['p99_ms']
+        ))
+    lines.append('db: {c} calls, {f} failed, {x} conflicts, {r} bytes read, {w} bytes written'.format(
+        c=snap['db']['calls'], f=snap['db']['failures'], x=snap['db']['conflicts'],
+        r=snap['db']['bytes_read'], w=snap['db']['bytes_written']
+    ))
+    cache = _cache.stats()
+    lines.append('cache: {e} queues, {b} bytes, {h} hits, {m} misses, {v} evictions'.format(
+        e=cache['entries'], b=cache['bytes'], h=cache['hits'], m=cache['misses'], v=cache['evictions']
+    ))
+    rendered = _render_cache.stats()
+    lines.append('render cache: {e} views, {h} hits, {m} misses, {v} evictions'.format(
+        e=rendered['entries'], h=rendered['hits'], m=rendered['misses'], v=rendered['evictions']
+    ))
+    return '\n'.join(lines)
+
+@subcommand('export')
+def handle_export(client, channel, nick, queue_name, args):
+    """write every queue to a JSON Lines file on the bot's host, gzipped if it ends in .gz (operators only)"""
+    if nick not in client.operators:
+        return "ERROR - only operators may use 'queue export'"
+    if len(args) != 1 or args[0] == '-':
+        return "ERROR - usage: queue export <path>"
+    try:
+        with closing(open_jsonl(args[0], 'w')) as fh:
+            count = export_queues(_backend, fh, batch_size=TRANSFER_BATCH_SIZE)
+    except NotImplementedError:
+        return "ERROR - the {b} backend can't list every queue".format(b=_backend.name)
+    except (IOError, OSError) as ex:
+        return "ERROR - can't write {p}: {e}".format(p=args[0], e=ex)
+    return "Exported {c} items to {p}".format(c=count, p=args[0])
+
+@subcommand('import')
+def handle_import(client, channel, nick, queue_name, args):
+    """append the items in a JSON Lines file on the bot's host (from export) to their queues (operators only)"""
+    if nick not in client.operators:
+        return "ERROR - only operators may use 'queue import'"
+    if len(args) != 1 or args[0] == '-':
+        return "ERROR - usage: queue import <path>"
+    try:
+        with closing(open_jsonl(args[0], 'r')) as fh:
+            counts = import_queues(_backend, fh, batch_size=TRANSFER_BATCH_SIZE)
+    except (IOError, OSError) as ex:
+        return "ERROR - can't read {p}: {e}".format(p=args[0], e=ex)
+    except ValueError as ex:
+        _cache.clear()
+        return "ERROR - {p}: {e}; the lines before it were imported".format(p=args[0], e=ex)
+    except NotImplementedError:
+        _cache.clear()
+        return "ERROR - the {b} backend doesn't support the expiry or priority of some items in {p}".format(
+            b=_backend.name, p=args[0]
+        )
+    for name in counts:
+        _cache.invalidate(name)
+    return "Imported {c} items into {q} queues from {p}".format(c=sum(counts.values()), q=len(counts), p=args[0])
+
+@subcommand('profile')
+def handle_profile(client, channel, nick, queue_name, args):
+    """profile a fraction of queue commands: profile [on [<fraction>]|off|dump] (operators only)"""
+    if nick not in client.operators:
+        return "ERROR - only operators may use 'queue profile'"
+    if len(args) == 0:
+        samples = _profiler.samples()
+        return "Profiling is {s}, sampling {f:g}% of queue commands; {c} profiled so far.".format(
+            s='on' if _profiler.enabled else 'off', f=_profiler.sample * 100, c=sum(samples.values())
+        )
+    if args[0] == 'on' and len(args) <= 2:
+        sample = None
+        if len(args) == 2:
+            try:
+                sample = float(args[1])
+            except ValueError:
+                sample = -1
+            if not 0 < sample <= 1:
+                return "ERROR - '{a}' is not a valid fraction (more than 0, at most 1)".format(a=args[1])
+        _profiler.start(sample)
+        return "Profiling {f:g}% of queue commands; 'queue profile off' writes the results to {p}.*".format(
+            f=_profiler.sample * 100, p=PROFILE_PATH
+        )
+    if args == ['off']:
+        _profiler.stop()
+        return _write_profile()
+    if args == ['dump']:
+        return _write_profile()
+    return "ERROR - usage: queue profile [on [<fraction>]|off|dump]"
 
 ######################
 # internal functions #
 ######################
 
+def _parse_indexes(arg):
+    """
+    Parse a ``<start>-<end>`` range or ``<i>,<j>,<k>`` list of queue indexes.
+
+    :param arg: the argument to parse
+    :type arg: string
+    :returns: sorted, unique indexes, or None if ``arg`` is invalid or names
+      more than ``MAX_INDEXES`` indexes
+    :rtype: list or None
+    """
+    try:
+        if ',' in arg:
+            idxs = [int(x) for x in arg.split(',')]
+        else:
+            start, end = [int(x) for x in arg.split('-', 1)]
+            # checked before building the list, so a huge range costs nothing
+            if end < start or end - start >= MAX_INDEXES:
+                return None
+            idxs = list(range(start, end + 1))
+    except ValueError:
+        return None
+    if min(idxs) < 0 or len(idxs) > MAX_INDEXES:
+        return None
+    return sorted(set(idxs))
+
+def _indexed_lines(header, idxs, vals):
+    """
+    Render a header line followed by ``<index>. '<item>'`` for each item, at
+    most ``LIST_MAX_LINES`` of them.
+
+    :param header: first line
+    :type header: string
+    :param idxs: indexes of the items
+    :type idxs: list
+    :param vals: the items
+    :type vals: list
+    :rtype: string
+    """
+    lines = [header]
+    lines.extend("{i}. '{v}'".format(i=idx, v=val) for idx, val in zip(idxs[:LIST_MAX_LINES], vals))
+    if len(vals) > LIST_MAX_LINES:
+        lines.append('... {n} more items'.format(n=len(vals) - LIST_MAX_LINES))
+    return '\n'.join(lines)
+
+def _handle_pop_many(queue_name, arg):
+    """pop several items given as a range or list of indexes"""
+    idxs = _parse_indexes(arg)
+    if idxs is None:
+        return "ERROR - '{a}' is not a valid range (<start>-<end>) or list (<i>,<j>,...) of at most {m} " \
+            "indexes".format(a=arg, m=MAX_INDEXES)
+    vals = _pop_items(queue_name, idxs)
+    if vals is None:
+        count = _queue_len(queue_name)
+        if count == 0:
+            return "Queue {n} is empty.".format(n=queue_name)
+        return "ERROR - there are only {c} items in queue {n}".format(c=count, n=queue_name)
+    return _indexed_lines('Popped {c} items from queue {n}:'.format(c=len(vals), n=queue_name), idxs, vals)
+
+def _handle_move_to(channel, nick, queue_name, arg, target):
+    """move items given as an index, range or list of indexes to the end of another queue"""
+    try:
+        idxs = [int(arg)]
+    except ValueError:
+        if '-' in arg or ',' in arg:
+            idxs = _parse_indexes(arg)
+            if idxs is None:
+                return "ERROR - '{a}' is not a valid range (<start>-<end>) or list (<i>,<j>,...) of at most " \
+                    "{m} indexes".format(a=arg, m=MAX_INDEXES)
+        else:
+            return "ERROR - index must be an integer; '{a}' is invalid".format(a=arg)
+    if idxs[0] < 0:
+        return "ERROR - index must be an integer; '{a}' is invalid".format(a=arg)
+    if target == queue_name:
+        return "ERROR - can't move items from queue {n} to itself".format(n=queue_name)
+    try:
+        vals = _move_items(queue_name, target, idxs, owner=nick, channel=channel)
+    except NotImplementedError:
+        return "ERROR - the {b} backend doesn't support moving items".format(b=_backend.name)
+    if vals is None:
+        count = _queue_len(queue_name)
+        if count == 0:
+            return "Queue {n} is empty.".format(n=queue_name)
+        return "ERROR - queue {n} only has {c} items; cannot move index {i}".format(
+            n=queue_name, c=count, i=idxs[-1]
+        )
+    if len(vals) == 1:
+        return "Moved item {i} of queue {n} to queue {t}: '{v}'".format(i=idxs[0], n=queue_name, t=target, v=vals[0])
+    return _indexed_lines(
+        'Moved {c} items from queue {n} to queue {t}:'.format(c=len(vals), n=queue_name, t=target), idxs, vals
+    )
+
+def _db_call(fn, *args, **kwargs):
+    """
+    Call a storage backend method, recording it in the metrics.
+
+    :param fn: backend method
+    :type fn: callable
+    :param written: approximate bytes being written (keyword-only)
+    :type written: int
+    :returns: whatever ``fn`` returns
+    """
+    written = kwargs.pop('written', 0)
+    if not _metrics.enabled:
+        return fn(*args)
+    try:
+        res = fn(*args)
+    except Exception:
+        _metrics.record_db(bytes_written=written, failed=True)
+        raise
+    _metrics.record_db(bytes_read=sizeof(res), bytes_written=written)
+    return res
+
+def _record_owner(name, owner, channel):
+    """
+    Record who created a queue, once per queue per process.
+
+    :param name: name of the queue
+    :type name: string
+    :param owner: nick of the queue's creator
+    :type owner: string
+    :param channel: channel the queue was created in
+    :type channel: string
+    """
+    if owner is None or name in _owned:
+        return
+    _db_call(_backend.set_owner, name, owner, channel)
+    _owned.add(name)
+
 def _get_queue(name):
     """
     Return the contents of a queue
@@ -64,41 +706,833 @@ def _get_queue(name):
     :type name: string
     :rtype: list or None
     """
-    res = db.helga_queue.find_one({'_id': name})
-    if res is None:
-        return []
-    return res['queue']
+    q = _cache.get(name)
+    if q is not None:
+        return q
+    # a write landing while we read makes what we read stale
+    generation = _cache.generation(name)
+    q = _db_call(_backend.get, name)
+    _cache.set(name, q, generation)
+    return q
 
 def _set_queue(name, q):
+    generation = _cache.generation(name)
+    try:
+        _db_call(_backend.set, name, q, written=sizeof(q))
+        _cache.set(name, q, generation)
+        return "queue '{n}' updated".format(n=name)
+    except Exception:
+        logger.exception('update to queue %s failed', name)
+        _cache.invalidate(name)
+        return "ERROR - update to queue '{n}' failed".format(n=name)
+
+def _update_queue(name, fn):
+    """
+    Read-modify-write a queue, safely against concurrent writers (see
+    :py:meth:`~helga_queue.backends.base.Backend.update`), keeping the cache
+    in step.
+
+    :param name: name of the queue
+    :type name: string
+    :param fn: called with the current contents of the queue; returns
+      ``(new contents, result)``, where new contents of None means nothing
+      needs writing
+    :type fn: callable
+    :returns: the result returned by ``fn``
+    :raises: :py:exc:`~helga_queue.backends.base.ConflictError` if the
+      update kept conflicting
+    """
+    written = [None]
+
+    def _fn(q):
+        new_q, res = fn(q)
+        written[0] = new_q
+        return new_q, res
+
+    generation = _cache.generation(name)
+    try:
+        res = _db_call(_backend.update, name, _fn, _metrics.record_conflict)
+    except Exception:
+        _cache.invalidate(name)
+        raise
+    if written[0] is not None:
+        _cache.set(name, written[0], generation)
+    return res
+
+def _queue_len(name):
+    """
+    Return the number of items in a queue, without fetching the items
+    themselves where the backend allows.
+
+    :param name: name of the queue
+    :type name: string
+    :rtype: int
+    """
+    n = _cache.length(name)
+    if n is not None:
+        return n
+    return _db_call(_backend.length, name)
+
+def _queue_range(name, start, count):
+    """
+    Return up to ``count`` items of a queue beginning at index ``start``,
+    fetching only that page where the backend allows.
+
+    :param name: name of the queue
+    :type name: string
+    :param start: index of the first item
+    :type start: int
+    :param count: maximum number of items to return
+    :type count: int
+    :rtype: list
+    """
+    q = _cache.slice(name, start, count)
+    if q is not None:
+        return q
+    return _db_call(_backend.range, name, start, count)
+
+def _queue_peek(name):
+    """
+    Return the first item in a queue without removing it.
+
+    :param name: name of the queue
+    :type name: string
+    :rtype: string or None
+    """
+    q = _cache.slice(name, 0, 1)
+    if q is not None:
+        return q[0] if len(q) > 0 else None
+    return _db_call(_backend.peek, name)
+
+def _queue_is_empty(name):
+    """
+    Return whether a queue is empty (or doesn't exist).
+
+    :param name: name of the queue
+    :type name: string
+    :rtype: bool
+    """
+    n = _cache.length(name)
+    if n is not None:
+        return n == 0
+    return _db_call(_backend.is_empty, name)
+
+def _expires_at(name, ttl=None):
+    """
+    Return when an item appended to a queue now expires.
+
+    :param name: name of the queue
+    :type name: string
+    :param ttl: seconds the item lasts; None for the queue's TTL
+    :type ttl: float
+    :returns: unix time, or None if the item doesn't expire
+    :rtype: float or None
+    """
+    ttl = ttl or _queue_ttls.get(name)
+    if not ttl:
+        return None
+    return time.time() + ttl
+
+def _append_item(name, item, owner=None, channel=None, ttl=None, priority=0):
+    """
+    Atomically append an item to the end of a queue, or with a priority,
+    after the last item of at least that priority, creating the queue if it
+    does not exist yet. The item expires after ``ttl`` seconds, or the
+    queue's TTL if it has one.
+
+    :param name: name of the queue
+    :type name: string
+    :param item: item to append
+    :type item: string
+    :param owner: nick appending, recorded as the owner of a new queue
+    :type owner: string
+    :param channel: channel appended from, recorded for a new queue
+    :type channel: string
+    :param ttl: seconds the item lasts
+    :type ttl: float
+    :param priority: priority of the item
+    :type priority: int
+    :rtype: string
+    :raises: NotImplementedError if the item expires or has a priority and
+      the backend doesn't support item expiry or priorities
+    """
+    expires = _expires_at(name, ttl)
     try:
-        db.helga_queue.save({'_id': name, 'queue': q})
+        _record_owner(name, owner, channel)
+        _db_call(_backend.append, name, item, expires, priority, written=sizeof(item))
+        if expires is not None:
+            _cache.exclude(name)
+        elif priority != 0:
+            _cache.invalidate(name)
+        else:
+            _cache.append(name, item)
         return "queue '{n}' updated".format(n=name)
-    except:
+    except NotImplementedError:
+        raise
+    except Exception:
+        logger.exception('append to queue %s failed', name)
+        _cache.invalidate(name)
         return "ERROR - update to queue '{n}' failed".format(n=name)
 
-def _queue_repr(name, q):
+def _append_items(name, items, owner=None, channel=None):
+    """
+    Atomically append several items, in order, to the end of a queue,
+    creating the queue if it does not exist yet. The items expire after the
+    queue's TTL, if it has one.
+
+    :param name: name of the queue
+    :type name: string
+    :param items: items to append
+    :type items: list
+    :param owner: nick appending, recorded as the owner of a new queue
+    :type owner: string
+    :param channel: channel appended from, recorded for a new queue
+    :type channel: string
+    :rtype: string
+    """
+    expires = _expires_at(name)
+    try:
+        _record_owner(name, owner, channel)
+        _db_call(_backend.append_many, name, items, expires, written=sizeof(items))
+        if expires is None:
+            for item in items:
+                _cache.append(name, item)
+        else:
+            _cache.exclude(name)
+        return "queue '{n}' updated".format(n=name)
+    except Exception:
+        logger.exception('append to queue %s failed', name)
+        _cache.invalidate(name)
+        return "ERROR - update to queue '{n}' failed".format(n=name)
+
+def _write_batch(batch):
+    """
+    Write a batch of buffered appends, one storage call per queue.
+
+    :param batch: list of ``(queue name, [(item, nick, channel), ...])``
+    :type batch: list
+    :returns: dict of queue name to response string
+    :rtype: dict
+    """
+    res = {}
+    for name, entries in batch:
+        _, owner, channel = entries[0]
+        res[name] = _append_items(name, [e[0] for e in entries], owner=owner, channel=channel)
+    return res
+
+def _flush_appends(batch):
+    """flush callable for the write coalescer; writes in the thread pool"""
+    return _pool.run(_write_batch, batch)
+
+def _coalesced_append(name, item, owner, channel):
+    """
+    Buffer an append in the write coalescer, recording its latency (up to
+    when it was written) in the metrics.
+
+    :returns: Deferred firing with the response string
+    :rtype: :py:class:`twisted.internet.defer.Deferred`
+    """
+    start = default_timer()
+
+    def _record(res):
+        _metrics.record_command('append', default_timer() - start, failed=isinstance(res, Failure))
+        return res
+
+    d = _coalescer.append(name, (item, owner, channel))
+    d.addBoth(_record)
+    return d
+
+def _pop_item(name, idx=0):
+    """
+    Atomically remove and return the item at ``idx`` in a queue.
+
+    :param name: name of the queue
+    :type name: string
+    :param idx: index of the item to remove
+    :type idx: int
+    :returns: the removed item, or None if there is no item at ``idx``
+    :rtype: string or None
+    """
+    val = _db_call(_backend.pop, name, idx)
+    if val is not None:
+        _cache.pop(name, idx, val)
+    return val
+
+def _pop_items(name, idxs):
+    """
+    Atomically remove and return the items at several indexes of a queue;
+    either all of them are removed, or none.
+
+    :param name: name of the queue
+    :type name: string
+    :param idxs: indexes of the items to remove, sorted and unique
+    :type idxs: list
+    :returns: the removed items, in index order, or None if there is no item
+      at one of ``idxs``
+    :rtype: list or None
+    """
+    vals = _db_call(_backend.pop_many, name, idxs)
+    if vals is not None:
+        # highest index first, so the lower indexes are still valid
+        for idx, val in reversed(list(zip(idxs, vals))):
+            _cache.pop(name, idx, val)
+    return vals
+
+def _move_items(name, target, idxs, owner=None, channel=None):
+    """
+    Atomically move items from one queue to the end of another.
+
+    :param name: name of the queue to move items from
+    :type name: string
+    :param target: name of the queue to move them to
+    :type target: string
+    :param idxs: indexes of the items to move, sorted and unique, or None to
+      move every item
+    :type idxs: list
+    :param owner: nick creating the target queue, if it doesn't exist
+    :type owner: string
+    :param channel: channel the target queue is created in
+    :type channel: string
+    :returns: the moved items, in index order, or None if there is no item
+      at one of ``idxs``
+    :rtype: list or None
+    """
+    _record_owner(target, owner, channel)
+    try:
+        return _db_call(_backend.move, name, target, idxs)
+    finally:
+        _cache.invalidate(name)
+        _cache.invalidate(target)
+
+def _describe_change(change):
+    """
+    Describe a recorded change to a queue, for ``history`` and ``undo``.
+
+    :param change: change, as returned by
+      :py:meth:`~helga_queue.backends.base.Backend.history`
+    :type change: dict
+    :rtype: string
+    """
+    if change['op'] == 'append':
+        return 'appended ' + ', '.join("'{v}'".format(v=v) for v in change['items'])
+    return 'popped ' + ', '.join(
+        "'{v}' (item {i})".format(v=v, i=i) for i, v in zip(change['idxs'], change['items'])
+    )
+
+def _parse_at(arg, now):
+    """
+    Parse an ``append-at`` time, ``HH:MM`` (its next occurrence) or
+    ``YYYY-MM-DDTHH:MM[:SS]``, in server local time.
+
+    :param arg: the argument to parse
+    :type arg: string
+    :param now: current unix time
+    :type now: float
+    :returns: unix time, or None if ``arg`` is invalid or in the past
+    :rtype: float or None
+    """
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M'):
+        try:
+            when = datetime.strptime(arg, fmt)
+            break
+        except ValueError:
+            pass
+    else:
+        try:
+            hhmm = datetime.strptime(arg, '%H:%M')
+        except ValueError:
+            return None
+        when = datetime.fromtimestamp(now).replace(hour=hhmm.hour, minute=hhmm.minute, second=0, microsecond=0)
+        if time.mktime(when.timetuple()) <= now:
+            when += timedelta(days=1)
+    due = time.mktime(when.timetuple())
+    if due <= now:
+        return None
+    return due
+
+def _parse_duration(arg):
+    """
+    Parse a duration, such as ``90s``, ``15m``, ``1h30m`` or ``2d``; a bare
+    number is seconds.
+
+    :param arg: the argument to parse
+    :type arg: string
+    :returns: seconds, or None if ``arg`` is invalid
+    :rtype: int or None
+    """
+    if arg.isdigit():
+        return int(arg)
+    m = DURATION_RE.match(arg)
+    if m is None or arg == '':
+        return None
+    days, hours, minutes, seconds = [int(x or 0) for x in m.groups()]
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+def _parse_in(arg, now):
+    """
+    Parse an ``append-in`` duration (see :py:func:`_parse_duration`).
+
+    :param arg: the argument to parse
+    :type arg: string
+    :param now: current unix time
+    :type now: float
+    :returns: unix time, or None if ``arg`` is invalid
+    :rtype: float or None
+    """
+    duration = _parse_duration(arg)
+    if duration is None:
+        return None
+    return now + duration
+
+def _handle_schedule(channel, nick, queue_name, args, cmdname, parse, syntax):
+    """
+    Shared implementation of ``append-at`` and ``append-in``.
+
+    :param parse: called as ``parse(arg, now)``, returning the due time or
+      None if ``arg`` is invalid
+    :type parse: callable
+    :param syntax: how the time argument is written, for the usage error
+    :type syntax: string
+    :rtype: string
+    """
+    announce = len(args) > 0 and args[0] == '-n'
+    if announce:
+        args = args[1:]
+    if len(args) < 2:
+        return "ERROR - usage: queue [queue name] {c} [-n] {s} <item>".format(c=cmdname, s=syntax)
+    due = parse(args[0], time.time())
+    if due is None:
+        return "ERROR - '{a}' is not a valid time in the future; use {s}".format(a=args[0], s=syntax)
+    item = ' '.join(args[1:])
+    try:
+        _schedule_item(queue_name, item, due, channel if announce else None, owner=nick, channel=channel)
+    except NotImplementedError:
+        return "ERROR - the {b} backend doesn't support scheduled items".format(b=_backend.name)
+    return "Scheduled item '{v}' for queue {n} at {w}".format(
+        v=item, n=queue_name, w=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(due))
+    )
+
+def _schedule_item(name, item, due, announce=None, owner=None, channel=None):
+    """
+    Store an item to be appended to a queue once it is due, and set a timer
+    for it.
+
+    :param name: name of the queue
+    :type name: string
+    :param item: item to append
+    :type item: string
+    :param due: unix time the item is due at
+    :type due: float
+    :param announce: channel to announce the item in when it is due
+    :type announce: string
+    :param owner: nick scheduling the item
+    :type owner: string
+    :param channel: channel the item was scheduled from
+    :type channel: string
+    """
+    _db_call(_backend.schedule, name, item, due, announce, written=sizeof(item))
+    _record_owner(name, owner, channel)
+    reactor.callFromThread(_wheel.add, due, name)
+
+def _deliver_due():
+    """
+    Append due scheduled items to their queues, announcing those that asked
+    to be.
+
+    :returns: list of ``(queue name, item, channel)`` for the delivered items
+    :rtype: list
+    """
+    try:
+        delivered = _db_call(_backend.deliver_due, time.time())
+    except NotImplementedError:
+        return []
+    for name, item, channel in delivered:
+        _cache.invalidate(name)
+        if channel is not None and _client is not None:
+            _client.msg(channel, "Queue {n}: '{v}' is now due".format(n=name, v=item))
+    return delivered
+
+def _on_due(keys):
+    """called by the timer wheel when scheduled items are due"""
+    d = _pool.run(_deliver_due)
+    d.addErrback(lambda failure: logger.error('delivering scheduled items failed: %s', failure.getTraceback()))
+    return d
+
+def _scheduled_times():
+    """return the due times of all scheduled items, or [] if unsupported"""
+    try:
+        return _db_call(_backend.scheduled_times)
+    except NotImplementedError:
+        return []
+
+def _load_wheel(times):
+    """add a timer to the wheel for each of ``times``"""
+    for due in times:
+        _wheel.add(due, None)
+
+@smokesignal.on('signon')
+def _on_signon(client):
+    """
+    Keep the client for announcing scheduled items, and rebuild the timer
+    wheel from storage the first time the bot signs on.
+    """
+    global _client, _schedule_loaded
+    _client = ReactorClient(client)
+    if _schedule_loaded:
+        return
+    _schedule_loaded = True
+    d = _pool.run(_scheduled_times)
+    d.addCallback(_load_wheel)
+    d.addErrback(lambda failure: logger.error('loading scheduled items failed: %s', failure.getTraceback()))
+    d = _pool.run(_load_ttls)
+    d.addErrback(lambda failure: logger.error('loading queue TTLs failed: %s', failure.getTraceback()))
+
+def _claim_item(name, nick):
+    """
+    Atomically remove the first item of a queue and lease it to ``nick``
+    for ``CLAIM_LEASE`` seconds.
+
+    :param name: name of the queue
+    :type name: string
+    :param nick: nick claiming the item
+    :type nick: string
+    :returns: ``(claim id, item)``, or None if the queue is empty
+    :rtype: tuple or None
+    """
+    res = _db_call(_backend.claim, name, nick, time.time() + CLAIM_LEASE)
+    if res is not None:
+        _cache.pop(name, 0, res[1])
+    return res
+
+def _finish_claim(name, nick, args, release=False):
+    """
+    Ack or release one of ``nick``'s claims, returning the response.
+
+    :param name: name of the queue
+    :type name: string
+    :param nick: nick holding the claim
+    :type nick: string
+    :param args: subcommand arguments; the first is the claim id
+    :type args: list
+    :param release: put the item back on the queue, rather than ack it
+    :type release: bool
+    :rtype: string
+    """
+    if len(args) == 0:
+        return "ERROR - please give the id of the claim"
+    try:
+        claim_id = int(args[0])
+    except ValueError:
+        return "ERROR - {a} is not a valid claim id (int)".format(a=args[0])
+    try:
+        if release:
+            val = _db_call(_backend.release, name, nick, claim_id)
+        else:
+            val = _db_call(_backend.ack, name, nick, claim_id)
+    except NotImplementedError:
+        return "ERROR - the {b} backend doesn't support claims".format(b=_backend.name)
+    if val is None:
+        return "ERROR - {u} has no claim {c} on queue {n}; it may have expired".format(
+            u=nick, c=claim_id, n=name
+        )
+    if release:
+        _cache.invalidate(name)
+        return "Released claim {c}; '{v}' is back at the head of queue {n}".format(c=claim_id, v=val, n=name)
+    return "Acked claim {c} on queue {n}: '{v}'".format(c=claim_id, v=val, n=name)
+
+def _reap_claims():
+    """
+    Put the items of expired claims back on their queues, and finish moves
+    between queues that were interrupted.
+
+    :returns: names of the queues claimed items were returned to
+    :rtype: list
+    """
+    now = time.time()
+    moved = _db_call(_backend.recover_moves, now)
+    for name in moved:
+        _cache.invalidate(name)
+    if len(moved) > 0:
+        logger.info('finished interrupted moves between queues: %s', ', '.join(moved))
+    try:
+        names = _db_call(_backend.reap, now)
+    except NotImplementedError:
+        return []
+    for name in names:
+        _cache.invalidate(name)
+    if len(names) > 0:
+        logger.info('returned expired claims to queues: %s', ', '.join(names))
+    return names
+
+def _write_profile():
+    """
+    Write the profiler's stats to ``PROFILE_PATH``.
+
+    :returns: response string
+    :rtype: string
+    """
+    samples = _profiler.samples()
+    if len(samples) == 0:
+        return 'No queue commands were profiled.'
+    try:
+        paths = _profiler.dump(PROFILE_PATH)
+    except (IOError, OSError) as ex:
+        return "ERROR - can't write {p}: {e}".format(p=PROFILE_PATH, e=ex)
+    return 'Wrote profiles of {c} queue commands to {p}'.format(c=sum(samples.values()), p=', '.join(paths))
+
+def _schedule_profile_dump():
+    """write the profiler's stats in the thread pool, if profiling; called by a LoopingCall"""
+    if not _profiler.enabled:
+        return
+    d = _pool.run(_write_profile)
+    d.addErrback(lambda failure: logger.error('writing the profile failed: %s', failure.getTraceback()))
+    return d
+
+def _schedule_reap():
+    """run :py:func:`_reap_claims` in the thread pool; called by a LoopingCall"""
+    d = _pool.run(_reap_claims)
+    d.addErrback(lambda failure: logger.error('reaping claims failed: %s', failure.getTraceback()))
+    return d
+
+def _load_ttls():
+    """
+    Reload the TTLs of all queues from storage, so that TTLs set by other
+    processes apply here too, and stop caching the queues that have one.
+
+    :returns: dict of queue name to seconds
+    :rtype: dict
+    """
+    ttls = _db_call(_backend.ttls)
+    _queue_ttls.clear()
+    _queue_ttls.update(ttls)
+    for name in ttls:
+        _cache.exclude(name)
+    return ttls
+
+def _expire_items():
+    """
+    Delete expired items in batches of ``EXPIRE_BATCH``, until none are
+    left, then reload the queue TTLs.
+
+    :returns: names of the queues items were deleted from
+    :rtype: list
+    """
+    names = []
+    more = True
+    try:
+        while more:
+            reaped, more = _db_call(_backend.expire, time.time(), EXPIRE_BATCH)
+            for name in reaped:
+                _cache.exclude(name)
+                if name not in names:
+                    names.append(name)
+    except NotImplementedError:
+        return []
+    if len(names) > 0:
+        logger.info('deleted expired items from queues: %s', ', '.join(names))
+    _load_ttls()
+    return names
+
+def _schedule_expire():
+    """run :py:func:`_expire_items` in the thread pool; called by a LoopingCall"""
+    d = _pool.run(_expire_items)
+    d.addErrback(lambda failure: logger.error('deleting expired items failed: %s', failure.getTraceback()))
+    return d
+
+def _queue_repr(name, q, start=0):
     if len(q) == 0:
         return 'Queue "{n}" is empty.'.format(n=name)
-    s = 'Contents of queue "{n}":\n'.format(n=name)
-    for idx, item in enumerate(q):
-        s += '{idx}. {item}\n'.format(idx=idx, item=item)
-    return s
+    lines = ['Contents of queue "{n}":'.format(n=name)]
+    lines.extend('{idx}. {item}'.format(idx=idx, item=item) for idx, item in enumerate(q, start))
+    lines.append('')
+    return '\n'.join(lines)
+
+def _show_queue(name):
+    """the output of 'queue show' for a whole queue"""
+    return _queue_repr(name, _get_queue(name))
+
+def _show_range(name, start, end, arg):
+    """the output of 'queue show <start>-<end>', where ``arg`` is the range as given"""
+    q = _queue_range(name, start, end - start + 1)
+    if len(q) == 0:
+        return 'Queue "{n}" has no items in range {a}.'.format(n=name, a=arg)
+    return _queue_repr(name, q, start=start)
+
+def _list_lines(name, total):
+    """the lines 'queue list' sends for a queue of ``total`` items"""
+    lines = ['Contents of queue "{n}":'.format(n=name)]
+    lines.extend(_listing_lines(name, total, LIST_MAX_LINES))
+    return lines
+
+def _queue_stamp(name):
+    """
+    Return the stamp of a queue, whose last element is its length: from
+    the queue cache if it holds the queue (see
+    :py:meth:`~helga_queue.cache.QueueCache.stamp`), so a cached queue is
+    shown without any storage call, and otherwise from the backend (see
+    :py:meth:`~helga_queue.backends.base.Backend.stamp`). None if the render
+    cache is disabled or the backend doesn't keep versions.
+
+    :param name: name of the queue
+    :type name: string
+    :rtype: tuple or None
+    """
+    if _render_cache.max_entries == 0:
+        return None
+    stamp = _cache.stamp(name)
+    if stamp is not None:
+        return stamp
+    return _db_call(_backend.stamp, name)
+
+def _rendered(name, view, stamp, render, *args):
+    """
+    Return ``render(*args)``, a rendered view of a queue, from the render
+    cache if it was rendered at the queue's current ``stamp``, so repeated
+    views of an unchanged queue are neither re-read nor re-formatted.
+
+    :param name: name of the queue
+    :type name: string
+    :param view: hashable identifier of the view
+    :param stamp: current stamp of the queue, from :py:func:`_queue_stamp`;
+      None to always render
+    :type stamp: tuple or None
+    :param render: function rendering the view
+    :type render: callable
+    """
+    if stamp is None:
+        return render(*args)
+    res = _render_cache.get(name, view, stamp)
+    if res is None:
+        res = render(*args)
+        _render_cache.set(name, view, stamp, res)
+    return res
+
+def _iter_queue_lines(name, page_size=LIST_PAGE_SIZE):
+    """
+    Lazily yield ``(index, line)`` for a listing of a queue, fetching items
+    a page at a time and wrapping long items at :py:data:`LINE_LENGTH`.
+
+    :param name: name of the queue
+    :type name: string
+    :param page_size: number of items to fetch per round trip
+    :type page_size: int
+    """
+    start = 0
+    while True:
+        page = _queue_range(name, start, page_size)
+        for idx, item in enumerate(page, start):
+            line = '{idx}. {item}'.format(idx=idx, item=item)
+            for part in textwrap.wrap(line, LINE_LENGTH, subsequent_indent='    ') or [line]:
+                yield idx, part
+        if len(page) < page_size:
+            return
+        start += page_size
+
+def _listing_lines(name, total, max_lines):
+    """
+    Yield at most ``max_lines`` lines of a queue listing, followed by a
+    trailer saying how many items were left out, if any.
+
+    :param name: name of the queue
+    :type name: string
+    :param total: number of items in the queue
+    :type total: int
+    :param max_lines: maximum number of lines of items
+    :type max_lines: int
+    """
+    count = 0
+    for idx, line in _iter_queue_lines(name):
+        if count == max_lines:
+            yield '... {n} more items'.format(n=total - idx)
+            return
+        count += 1
+        yield line
 
 def _commands_dict():
     """return a dict of all subcommands to their handler functions"""
-    commands = {}
-    for funcname, fn in globals().iteritems():
-        if not funcname.startswith('handle_'):
-            continue
-        commands[funcname[7:]] = fn
-    return commands
+    return _commands
+
+def _respond(res, client, channel):
+    """callback to send a subcommand's result once it is available"""
+    if res:
+        client.msg(channel, res)
+
+def _respond_error(failure, client, channel, cmdname):
+    """errback for a failed or timed-out subcommand"""
+    if failure.check(defer.TimeoutError):
+        client.msg(channel, "ERROR - queue {c} timed out".format(c=cmdname))
+        return
+    logger.error('queue %s failed: %s', cmdname, failure.getTraceback())
+    client.msg(channel, "ERROR - queue {c} failed".format(c=cmdname))
+
+def _timed(cmdname, fn, *args):
+    """call a subcommand handler, recording its latency and any failure, and profiling it if sampled"""
+    if _profiler.enabled and _profiler.sampled():
+        fn = partial(_profiler.run, cmdname, fn)
+    if not _metrics.enabled:
+        return fn(*args)
+    start = default_timer()
+    try:
+        res = fn(*args)
+    except Exception:
+        _metrics.record_command(cmdname, default_timer() - start, failed=True)
+        raise
+    _metrics.record_command(cmdname, default_timer() - start)
+    return res
+
+def _dump_metrics(path=None):
+    """
+    Write a JSON snapshot of the metrics to ``path``, or log it if ``path``
+    is None.
+    """
+    doc = _metrics.snapshot()
+    doc['cache'] = _cache.stats()
+    doc['render_cache'] = _render_cache.stats()
+    if path is None:
+        logger.info('queue metrics: %s', json.dumps(doc, sort_keys=True))
+        return
+    with open(path, 'w') as fh:
+        json.dump(doc, fh, sort_keys=True)
+
+
+if getattr(settings, 'QUEUE_METRICS_DUMP_INTERVAL', None):
+    LoopingCall(_dump_metrics, getattr(settings, 'QUEUE_METRICS_DUMP_PATH', None)).start(
+        settings.QUEUE_METRICS_DUMP_INTERVAL, now=False
+    )
+
+if getattr(settings, 'QUEUE_PROFILE_DUMP_INTERVAL', None):
+    LoopingCall(_schedule_profile_dump).start(settings.QUEUE_PROFILE_DUMP_INTERVAL, now=False)
+
+if CLAIM_REAP_INTERVAL:
+    LoopingCall(_schedule_reap).start(CLAIM_REAP_INTERVAL, now=False)
+
+if EXPIRE_INTERVAL:
+    LoopingCall(_schedule_expire).start(EXPIRE_INTERVAL, now=False)
+
+_wheel = TimerWheel(
+    _on_due,
+    tick=getattr(settings, 'QUEUE_SCHEDULE_TICK', 1.0),
+    slots=getattr(settings, 'QUEUE_SCHEDULE_WHEEL_SLOTS', 512)
+)
+
+# client used to announce scheduled items, set on signon
+_client = None
+_schedule_loaded = False
+
+_coalescer = None
+if getattr(settings, 'QUEUE_WRITE_COALESCE_WINDOW', None):
+    _coalescer = WriteCoalescer(
+        _flush_appends,
+        window=settings.QUEUE_WRITE_COALESCE_WINDOW,
+        max_ops=getattr(settings, 'QUEUE_WRITE_COALESCE_MAX_OPS', 100)
+    )
 
 @command('queue', help='Keep a simple queue of to-do items. Usage: queue help')
 def queue_plugin(client, channel, nick, message, cmd, args):
     """
     Entry point for queue plugin.
     """
-    if db is None:
+    if _backend is None:
         return "ERROR: MongoDB connection is None - check configuration."
     if len(args) == 0:
         args = ['list']
@@ -115,5 +1549,21 @@ def queue_plugin(client, channel, nick, message, cmd, args):
         cmdname = args.pop(0)
     else:
         return "queue subcommand '{s}' not known - please use 'queue help' for available commands".format(s=args[0])
-    res = commands[cmdname](client, channel, nick, queue, args)
-    return res
+    if _coalescer is not None and commands[cmdname] is handle_append and args[:1] != ['-p']:
+        d = _coalesced_append(queue, ' '.join(args), nick, channel)
+    elif _coalescer is not None and _coalescer.pending(queue):
+        # let appends to this queue that are still buffered land first
+        d = _coalescer.flush()
+        d.addCallback(
+            lambda _: _pool.run(_timed, cmdname, commands[cmdname], ReactorClient(client), channel, nick, queue, args)
+        )
+    elif not _pool.enabled:
+        return _timed(cmdname, commands[cmdname], client, channel, nick, queue, args)
+    else:
+        d = _pool.run(_timed, cmdname, commands[cmdname], ReactorClient(client), channel, nick, queue, args)
+    d.addCallbacks(
+        _respond, _respond_error,
+        callbackArgs=(client, channel),
+        errbackArgs=(client, channel, cmdname)
+    )
+    raise ResponseNotReady
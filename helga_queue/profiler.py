@@ -0,0 +1,193 @@
+"""
+Opt-in sampling profiler for the queue command: a fraction of subcommand
+invocations are run under cProfile, and their stats are aggregated per
+subcommand and written out in pstats and collapsed-stack (flame graph)
+format.
+"""
+
+import cProfile
+import os
+import pstats
+import random
+import threading
+from collections import defaultdict
+
+# method called to stop profiling, which cProfile records as a call
+_DISABLE = ('~', 0, "<method 'disable' of '_lsprof.Profiler' objects>")
+
+# paths whose time along the way falls below this, in seconds, are dropped
+# from collapsed stacks
+MIN_STACK_TIME = 0.000001
+
+# deepest stack written to collapsed stacks
+MAX_STACK_DEPTH = 64
+
+
+def _label(func):
+    filename, line, name = func
+    if filename == '~':
+        label = name
+    else:
+        label = '{n} ({f}:{l})'.format(n=name, f=os.path.basename(filename), l=line)
+    # ';' separates frames in collapsed stacks
+    return label.replace(';', ',')
+
+
+def collapse(stats, root):
+    """
+    Convert profile stats to collapsed stacks, as read by flame graph tools.
+    cProfile only records caller to callee edges, so stacks are rebuilt by
+    walking down from the functions nothing else called, splitting each
+    function's time between its callers in proportion to the time spent in
+    it from each.
+
+    :param stats: stats to convert
+    :type stats: :py:class:`pstats.Stats`
+    :param root: name of the frame every stack starts with
+    :type root: string
+    :returns: dict of ``;``-separated stack to microseconds spent in the
+      last frame of the stack
+    :rtype: dict
+    """
+    raw = stats.stats
+    callees = defaultdict(list)
+    for func, (_, _, _, _, callers) in raw.items():
+        for caller, edge in callers.items():
+            # edge is (calls, primitive calls, own time, cumulative time)
+            callees[caller].append((func, edge[3]))
+    roots = [
+        func for func, (_, _, _, _, callers) in raw.items()
+        if func != _DISABLE and not any(caller in raw and caller != func for caller in callers)
+    ]
+    res = defaultdict(int)
+
+    def _walk(func, path, funcs, spent):
+        own, total = raw[func][2], raw[func][3]
+        share = spent / total if total > 0 else 0
+        path = path + (_label(func),)
+        us = int(round(own * share * 1000000))
+        if us > 0:
+            res[';'.join(path)] += us
+        if len(path) > MAX_STACK_DEPTH:
+            return
+        for callee, callee_spent in callees.get(func, []):
+            # recursion is folded into the outermost call
+            if callee in funcs or callee_spent * share < MIN_STACK_TIME:
+                continue
+            _walk(callee, path, funcs | set([callee]), callee_spent * share)
+
+    for func in roots:
+        _walk(func, (root,), set([func]), raw[func][3])
+    return dict(res)
+
+
+class Profiler(object):
+    """
+    Thread-safe sampling profiler. When disabled, :py:meth:`sampled` is never
+    true, and callers check :py:attr:`enabled` before calling it, so nothing
+    is profiled and nothing is called.
+
+    :param enabled: whether to profile anything
+    :type enabled: bool
+    :param sample: fraction of invocations to profile, 0-1
+    :type sample: float
+    """
+
+    def __init__(self, enabled=False, sample=0.01):
+        self.enabled = enabled
+        self.sample = sample
+        self._lock = threading.Lock()
+        self._random = random.random
+        self.reset()
+
+    def reset(self):
+        """discard everything profiled so far"""
+        with self._lock:
+            # subcommand name -> pstats.Stats
+            self._stats = {}
+            self._samples = defaultdict(int)
+
+    def start(self, sample=None):
+        """
+        Start profiling afresh.
+
+        :param sample: fraction of invocations to profile; None to keep the
+          current fraction
+        :type sample: float
+        """
+        self.reset()
+        if sample is not None:
+            self.sample = sample
+        self.enabled = True
+
+    def stop(self):
+        """stop profiling, keeping what was profiled"""
+        self.enabled = False
+
+    def sampled(self):
+        """return whether to profile the next invocation"""
+        return self.enabled and self._random() < self.sample
+
+    def samples(self):
+        """
+        :returns: dict of subcommand name to number of invocations profiled
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(self._samples)
+
+    def run(self, cmdname, fn, *args):
+        """
+        Call ``fn(*args)`` under cProfile, adding its stats to those of
+        ``cmdname``.
+
+        :param cmdname: subcommand being run
+        :type cmdname: string
+        :returns: whatever ``fn`` returns
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active; python 3.12+ only allows one
+            return fn(*args)
+        try:
+            return fn(*args)
+        finally:
+            profile.disable()
+            self._add(cmdname, profile)
+
+    def _add(self, cmdname, profile):
+        with self._lock:
+            if cmdname in self._stats:
+                self._stats[cmdname].add(profile)
+            else:
+                self._stats[cmdname] = pstats.Stats(profile)
+            self._samples[cmdname] += 1
+
+    def dump(self, path):
+        """
+        Write the stats profiled so far: ``<path>-<subcommand>.pstats`` per
+        subcommand, readable with :py:mod:`pstats`, and ``<path>.folded``,
+        collapsed stacks of every subcommand with the subcommand as the root
+        frame, for flame graph tools.
+
+        :param path: path and file name prefix to write to
+        :type path: string
+        :returns: paths of the files written
+        :rtype: list
+        """
+        written = []
+        with self._lock:
+            stacks = {}
+            for cmdname, stats in sorted(self._stats.items()):
+                pstats_path = '{p}-{c}.pstats'.format(p=path, c=cmdname)
+                stats.dump_stats(pstats_path)
+                written.append(pstats_path)
+                stacks.update(collapse(stats, 'queue ' + cmdname))
+        folded_path = path + '.folded'
+        with open(folded_path, 'w') as fh:
+            for stack, us in sorted(stacks.items()):
+                fh.write('{s} {t}\n'.format(s=stack, t=us))
+        written.append(folded_path)
+        return written
@@ -0,0 +1,680 @@
+import re
+import pytest
+from mock import call, patch, Mock
+from pymongo import ASCENDING, TEXT, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from helga_queue.backends.base import CAS_RETRIES, ConflictError
+from helga_queue.backends.mongo import MOVE_TIMEOUT, MOVED_IN_SIZE, NEXT_VERSION, MongoBackend, live, live_items, unwrap
+
+# not expired at the tests' current time
+LIVE = {'$not': {'$lte': 1000}}
+
+
+class TestMongoBackend:
+
+    def setup_method(self, method):
+        self.db = Mock()
+        self.backend = MongoBackend(self.db)
+        self.time_patcher = patch('helga_queue.backends.mongo.time')
+        self.time_patcher.start().time.return_value = 1000
+
+    def teardown_method(self, method):
+        self.time_patcher.stop()
+
+    def test_get(self):
+        self.db.helga_queue.find_one.return_value = {'_id': 'qname', 'queue': ['zero', 'one', 'two']}
+        assert self.backend.get('qname') == ['zero', 'one', 'two']
+        assert self.db.mock_calls == [call.helga_queue.find_one({'_id': 'qname'})]
+
+    def test_get_expiring(self):
+        self.db.helga_queue.find_one.return_value = {'_id': 'qname', 'queue': [
+            'zero', {'item': 'gone', 'expires': 999}, {'item': 'one', 'expires': 1001}, 'two'
+        ]}
+        assert self.backend.get('qname') == ['zero', 'one', 'two']
+
+    def test_get_none(self):
+        self.db.helga_queue.find_one.return_value = None
+        assert self.backend.get('qname') == []
+        assert self.db.mock_calls == [call.helga_queue.find_one({'_id': 'qname'})]
+
+    def test_set(self):
+        self.backend.set('qname', ['zero', 'one', 'two'])
+        assert self.db.mock_calls == [
+            call.helga_queue.update_one(
+                {'_id': 'qname'}, {'$set': {'queue': ['zero', 'one', 'two']}, '$inc': {'version': 1}}, upsert=True
+            )
+        ]
+
+    def test_get_versioned(self):
+        self.db.helga_queue.find_one.return_value = {'_id': 'qname', 'queue': ['zero'], 'version': 4}
+        assert self.backend.get_versioned('qname') == (['zero'], 4)
+        assert self.db.mock_calls == [call.helga_queue.find_one({'_id': 'qname'}, {'queue': 1, 'version': 1})]
+        self.db.helga_queue.find_one.return_value = {'_id': 'qname', 'queue': ['zero']}
+        assert self.backend.get_versioned('qname') == (['zero'], 0)
+        self.db.helga_queue.find_one.return_value = None
+        assert self.backend.get_versioned('qname') == ([], None)
+
+    def test_compare_and_set(self):
+        self.db.helga_queue.update_one.return_value.matched_count = 1
+        assert self.backend.compare_and_set('qname', ['a'], 4) is True
+        self.db.helga_queue.update_one.return_value.matched_count = 0
+        self.db.helga_queue.find_one.return_value = None
+        assert self.backend.compare_and_set('qname', ['a'], 0) is False
+        assert self.db.helga_queue.update_one.mock_calls == [
+            call(
+                {'_id': 'qname', 'version': 4, 'queue.item': {'$exists': False}},
+                {'$set': {'queue': ['a']}, '$inc': {'version': 1}}
+            ),
+            call(
+                {'_id': 'qname', 'version': {'$exists': False}, 'queue.item': {'$exists': False}},
+                {'$set': {'queue': ['a']}, '$inc': {'version': 1}}
+            ),
+        ]
+        assert self.db.helga_queue.find_one.mock_calls == [
+            call({'_id': 'qname', 'version': {'$exists': False}}, {'queue': 1})
+        ]
+
+    def test_compare_and_set_expiring(self):
+        self.db.helga_queue.update_one.side_effect = [Mock(matched_count=0), Mock(matched_count=1)]
+        self.db.helga_queue.find_one.return_value = {'_id': 'qname', 'queue': [
+            {'item': 'a', 'expires': 2000}, {'item': 'gone', 'expires': 999}, 'b'
+        ]}
+        assert self.backend.compare_and_set('qname', ['b', 'c', 'a'], 4) is True
+        assert self.db.helga_queue.update_one.mock_calls[1] == call(
+            {'_id': 'qname', 'version': 4},
+            {'$set': {'queue': ['b', 'c', {'item': 'a', 'expires': 2000}]}, '$inc': {'version': 1}}
+        )
+
+    def test_compare_and_set_priority(self):
+        self.db.helga_queue.update_one.side_effect = [Mock(matched_count=0), Mock(matched_count=1)]
+        self.db.helga_queue.find_one.return_value = {'_id': 'qname', 'queue': [
+            {'item': 'a', 'p': 2}, {'item': 'b', 'expires': 2000, 'p': 1}, 'c'
+        ]}
+        assert self.backend.compare_and_set('qname', ['d', 'c', 'b', 'a'], 4) is True
+        # kept in priority order
+        assert self.db.helga_queue.update_one.mock_calls[1] == call(
+            {'_id': 'qname', 'version': 4},
+            {'$set': {'queue': [{'item': 'a', 'p': 2}, {'item': 'b', 'expires': 2000, 'p': 1}, 'd', 'c']},
+             '$inc': {'version': 1}}
+        )
+
+    def test_compare_and_set_new(self):
+        assert self.backend.compare_and_set('qname', ['a'], None) is True
+        self.db.helga_queue.insert_one.side_effect = DuplicateKeyError('dup')
+        assert self.backend.compare_and_set('qname', ['a'], None) is False
+        assert self.db.helga_queue.insert_one.mock_calls == [
+            call({'_id': 'qname', 'queue': ['a'], 'version': 1})
+        ] * 2
+
+    def test_append(self):
+        self.backend.append('qname', 'foo bar')
+        assert self.db.mock_calls == [
+            call.helga_queue.update_one(
+                {'_id': 'qname'}, {'$push': {'queue': 'foo bar'}, '$inc': {'version': 1}}, upsert=True
+            )
+        ]
+
+    def test_append_many(self):
+        self.backend.append_many('qname', ['foo', 'bar'])
+        assert self.db.mock_calls == [
+            call.helga_queue.update_one(
+                {'_id': 'qname'}, {'$push': {'queue': {'$each': ['foo', 'bar']}}, '$inc': {'version': 1}}, upsert=True
+            )
+        ]
+
+    def test_append_expires(self):
+        self.backend._indexed = True
+        self.backend.append('qname', 'foo', 2000)
+        self.backend.append_many('qname', ['a', 'b'], 2000)
+        assert self.db.helga_queue.update_one.mock_calls == [
+            call(
+                {'_id': 'qname'}, {'$push': {'queue': {'item': 'foo', 'expires': 2000}}, '$inc': {'version': 1}},
+                upsert=True
+            ),
+            call(
+                {'_id': 'qname'},
+                {'$push': {'queue': {'$each': [{'item': 'a', 'expires': 2000}, {'item': 'b', 'expires': 2000}]}},
+                 '$inc': {'version': 1}},
+                upsert=True
+            ),
+        ]
+
+    def test_append_priority(self):
+        self.backend._indexed = True
+        self.backend.append('qname', 'foo', priority=2)
+        self.backend.append_many('qname', ['a', 'b'], 2000, 1)
+        args = self.db.helga_queue.update_one.call_args_list
+        assert args[0][0][0] == {'_id': 'qname'}
+        assert args[0][1] == {'upsert': True}
+        update = args[0][0][1][0]['$set']
+        assert update['version'] == NEXT_VERSION
+        insert = update['queue']['$let']
+        assert insert['vars']['at']['$size']['$filter']['cond'] == {'$gte': [{'$ifNull': ['$$e.p', 0]}, 2]}
+        assert insert['in']['$concatArrays'][1] == {'$literal': [{'item': 'foo', 'p': 2}]}
+        insert = args[1][0][1][0]['$set']['queue']['$let']
+        assert insert['vars']['at']['$size']['$filter']['cond'] == {'$gte': [{'$ifNull': ['$$e.p', 0]}, 1]}
+        assert insert['in']['$concatArrays'][1] == {'$literal': [
+            {'item': 'a', 'expires': 2000, 'p': 1}, {'item': 'b', 'expires': 2000, 'p': 1}
+        ]}
+
+    def test_get_priority(self):
+        self.db.helga_queue.find_one.return_value = {'_id': 'qname', 'queue': [
+            {'item': 'a', 'p': 2}, {'item': 'gone', 'expires': 999, 'p': 1}, 'b'
+        ]}
+        assert self.backend.get('qname') == ['a', 'b']
+
+    def test_pop_many_range(self):
+        self.db.helga_queue.find_one_and_update.return_value = {'_id': 'qname', 'queue': ['two', 'three']}
+        assert self.backend.pop_many('qname', [2, 3]) == ['two', 'three']
+        assert self.db.mock_calls == [
+            call.helga_queue.find_one_and_update(
+                {'_id': 'qname', 'queue.3': {'$exists': True}, 'queue.expires': LIVE},
+                [{'$set': {
+                    'queue': {'$concatArrays': [
+                        {'$slice': ['$queue', 2]},
+                        {'$slice': ['$queue', 4, {'$size': '$queue'}]}
+                    ]},
+                    'version': {'$add': [{'$ifNull': ['$version', 0]}, 1]},
+                }}],
+                projection={'queue': {'$slice': [2, 2]}}
+            )
+        ]
+
+    def test_pop_many_list(self):
+        self.db.helga_queue.find_one_and_update.return_value = {'_id': 'qname', 'queue': ['one', 'two', 'three']}
+        assert self.backend.pop_many('qname', [1, 3]) == ['one', 'three']
+        args, kwargs = self.db.helga_queue.find_one_and_update.call_args
+        assert args[0] == {'_id': 'qname', 'queue.3': {'$exists': True}, 'queue.expires': LIVE}
+        assert args[1][0]['$set']['queue']['$map']['input']['$filter']['cond'] == {'$not': [{'$in': ['$$i', [1, 3]]}]}
+        assert kwargs == {'projection': {'queue': {'$slice': [1, 3]}}}
+
+    def test_pop_many_missing(self):
+        self.db.helga_queue.find_one_and_update.return_value = None
+        self.db.helga_queue.update_one.return_value.modified_count = 0
+        assert self.backend.pop_many('qname', [1, 3]) is None
+
+    def test_set_owner(self):
+        self.backend.set_owner('qname', 'mynick', '#chan')
+        self.backend.set_owner('other', 'mynick', '#chan')
+        assert self.db.mock_calls == [
+            call.helga_queue.create_index([('owner', ASCENDING)]),
+            call.helga_queue.create_index([('channel', ASCENDING)]),
+            call.helga_queue.create_index([('queue', TEXT)], default_language='none'),
+            call.helga_queue.create_index([('claims.expires', ASCENDING)], sparse=True),
+            call.helga_queue.create_index([('scheduled.due', ASCENDING)], sparse=True),
+            call.helga_queue.create_index([('queue.expires', ASCENDING)], sparse=True),
+            call.helga_queue.create_index([('ttl', ASCENDING)], sparse=True),
+            call.helga_queue.create_index([('queue.p', ASCENDING)], sparse=True),
+            call.helga_queue.create_index([('moving.at', ASCENDING)], sparse=True),
+            call.helga_queue.update_one({'_id': 'qname'}, [{'$set': {
+                'queue': {'$ifNull': ['$queue', []]},
+                'owner': {'$ifNull': ['$owner', 'mynick']},
+                'channel': {'$ifNull': ['$channel', '#chan']},
+            }}], upsert=True),
+            call.helga_queue.update_one({'_id': 'other'}, [{'$set': {
+                'queue': {'$ifNull': ['$queue', []]},
+                'owner': {'$ifNull': ['$owner', 'mynick']},
+                'channel': {'$ifNull': ['$channel', '#chan']},
+            }}], upsert=True),
+        ]
+
+    def test_queues(self):
+        self.backend._indexed = True
+        self.db.helga_queue.aggregate.return_value = [
+            {'_id': 'a', 'length': 2, 'head': 'x', 'owner': 'bob', 'channel': '#ops'},
+            {'_id': 'b', 'length': 0},
+        ]
+        assert self.backend.queues(owner='bob', channel='#o.') == [
+            {'name': 'a', 'length': 2, 'head': 'x', 'owner': 'bob', 'channel': '#ops'},
+            {'name': 'b', 'length': 0, 'head': None, 'owner': None, 'channel': None},
+        ]
+        pipeline = self.db.helga_queue.aggregate.call_args[0][0]
+        assert pipeline[0] == {'$match': {'owner': 'bob', 'channel': {'$regex': '^' + re.escape('#o.')}}}
+        assert pipeline[1] == {'$sort': {'_id': 1}}
+        assert pipeline[2]['$project']['length'] == {'$size': live(1000)}
+        assert pipeline[2]['$project']['head'] == {'$arrayElemAt': [live_items(1000), 0]}
+
+    def test_search(self):
+        self.backend._indexed = True
+        self.db.helga_queue.aggregate.return_value = [
+            {'_id': 'a', 'hits': [{'idx': 1, 'item': 'fix build'}, {'idx': 4, 'item': 'Build docs'}]},
+            {'_id': 'b', 'hits': [{'idx': 0, 'item': 'build'}]},
+        ]
+        assert self.backend.search(['build', 'v2'], 'a') == [
+            ('a', 1, 'fix build'), ('a', 4, 'Build docs'), ('b', 0, 'build')
+        ]
+        pipeline = self.db.helga_queue.aggregate.call_args[0][0]
+        assert pipeline[0] == {'$match': {
+            '$or': [{'$text': {'$search': '"build" "v2"'}}, {'queue.expires': {'$gt': 1000}}, {'queue.p': {'$gt': 0}}],
+            '_id': 'a'
+        }}
+        hits = pipeline[2]['$project']['hits']['$let']
+        assert hits['vars'] == {'items': live_items(1000)}
+        cond = hits['in']['$map']['input']['$filter']['cond']
+        assert [c['$regexMatch']['regex'] for c in cond['$and']] == [r'\bbuild\b', r'\bv2\b']
+
+    def test_pop_head(self):
+        self.db.helga_queue.find_one_and_update.return_value = {'_id': 'qname', 'queue': ['zero']}
+        assert self.backend.pop('qname') == 'zero'
+        assert self.db.mock_calls == [
+            call.helga_queue.find_one_and_update(
+                {'_id': 'qname', 'queue.0': {'$exists': True}, 'queue.expires': LIVE},
+                {'$pop': {'queue': -1}, '$inc': {'version': 1}},
+                projection={'queue': {'$slice': [0, 1]}}
+            )
+        ]
+
+    def test_pop_index(self):
+        self.db.helga_queue.find_one_and_update.return_value = {'_id': 'qname', 'queue': ['two']}
+        assert self.backend.pop('qname', 2) == 'two'
+        args, kwargs = self.db.helga_queue.find_one_and_update.call_args
+        assert args[0] == {'_id': 'qname', 'queue.2': {'$exists': True}, 'queue.expires': LIVE}
+        assert args[1] == [{'$set': {
+            'queue': {'$concatArrays': [
+                {'$slice': ['$queue', 2]},
+                {'$slice': ['$queue', 3, {'$size': '$queue'}]}
+            ]},
+            'version': {'$add': [{'$ifNull': ['$version', 0]}, 1]},
+        }}]
+        assert kwargs == {'projection': {'queue': {'$slice': [2, 1]}}}
+
+    def test_pop_missing(self):
+        self.db.helga_queue.find_one_and_update.return_value = None
+        self.db.helga_queue.update_one.return_value.modified_count = 0
+        assert self.backend.pop('qname', 5) is None
+        assert self.db.helga_queue.find_one_and_update.call_count == 1
+        assert self.db.helga_queue.update_one.mock_calls == [call(
+            {'_id': 'qname', 'queue.expires': {'$lte': 1000}},
+            [{'$set': {'queue': live(1000), 'version': NEXT_VERSION}}]
+        )]
+
+    def test_pop_purges_expired(self):
+        self.db.helga_queue.find_one_and_update.side_effect = [None, {'_id': 'qname', 'queue': [
+            {'item': 'one', 'expires': 2000}
+        ]}]
+        self.db.helga_queue.update_one.return_value.modified_count = 1
+        assert self.backend.pop('qname', 1) == 'one'
+        assert self.db.helga_queue.find_one_and_update.call_count == 2
+        assert self.db.helga_queue.update_one.call_count == 1
+
+    def test_length(self):
+        self.db.helga_queue.aggregate.return_value = iter([{'_id': 'qname', 'n': 3}])
+        assert self.backend.length('qname') == 3
+        assert self.db.mock_calls == [call.helga_queue.aggregate([
+            {'$match': {'_id': 'qname'}},
+            {'$project': {'n': {'$size': live(1000)}}}
+        ])]
+
+    def test_stamp(self):
+        self.db.helga_queue.aggregate.return_value = iter([{'_id': 'qname', 'version': 4, 'n': 3}])
+        assert self.backend.stamp('qname') == (4, 3)
+        assert self.db.mock_calls == [call.helga_queue.aggregate([
+            {'$match': {'_id': 'qname'}},
+            {'$project': {'version': 1, 'n': {'$size': live(1000)}}}
+        ])]
+        self.db.helga_queue.aggregate.return_value = iter([{'_id': 'qname', 'n': 3}])
+        assert self.backend.stamp('qname') == (0, 3)
+        self.db.helga_queue.aggregate.return_value = iter([])
+        assert self.backend.stamp('qname') == (0, 0)
+
+    def test_length_none(self):
+        self.db.helga_queue.aggregate.return_value = iter([])
+        assert self.backend.length('qname') == 0
+
+    def test_range(self):
+        self.db.helga_queue.aggregate.return_value = iter([{'_id': 'qname', 'queue': ['two', 'three']}])
+        assert self.backend.range('qname', 2, 2) == ['two', 'three']
+        assert self.db.mock_calls == [call.helga_queue.aggregate([
+            {'$match': {'_id': 'qname'}},
+            {'$project': {'queue': {'$slice': [live_items(1000), 2, 2]}}}
+        ])]
+
+    def test_range_none(self):
+        self.db.helga_queue.aggregate.return_value = iter([])
+        assert self.backend.range('qname', 2, 2) == []
+
+    def test_peek(self):
+        self.db.helga_queue.aggregate.return_value = iter([{'_id': 'qname', 'queue': ['zero']}])
+        assert self.backend.peek('qname') == 'zero'
+        assert self.db.mock_calls == [call.helga_queue.aggregate([
+            {'$match': {'_id': 'qname'}},
+            {'$project': {'queue': {'$slice': [live_items(1000), 0, 1]}}}
+        ])]
+        self.db.helga_queue.aggregate.return_value = iter([{'_id': 'qname', 'queue': []}])
+        assert self.backend.peek('qname') is None
+
+    def test_is_empty(self):
+        self.db.helga_queue.find_one.return_value = None
+        assert self.backend.is_empty('qname') is True
+        assert self.db.mock_calls == [call.helga_queue.find_one(
+            {'_id': 'qname', '$or': [
+                {'queue': {'$type': 'string'}},
+                {'queue': {'$elemMatch': {'item': {'$exists': True}, 'expires': {'$exists': False}}}},
+                {'queue.expires': {'$gt': 1000}},
+            ]},
+            {'_id': 1}
+        )]
+        self.db.helga_queue.find_one.return_value = {'_id': 'qname'}
+        assert self.backend.is_empty('qname') is False
+
+    def test_claim(self):
+        self.backend._indexed = True
+        self.db.helga_queue.find_one_and_update.return_value = {
+            '_id': 'qname', 'claims': [{'id': 3, 'item': 'foo', 'nick': 'bob', 'expires': 100}]
+        }
+        assert self.backend.claim('qname', 'bob', 100) == (3, 'foo')
+        args, kwargs = self.db.helga_queue.find_one_and_update.call_args
+        assert args[0] == {'_id': 'qname', 'queue.0': {'$exists': True}, 'queue.expires': LIVE}
+        assert args[1][0] == {'$set': {'claim_seq': {'$add': [{'$ifNull': ['$claim_seq', 0]}, 1]}}}
+        claim = args[1][1]['$set']['claims']['$concatArrays'][1][0]
+        assert claim == {
+            'id': '$claim_seq', 'item': unwrap({'$arrayElemAt': ['$queue', 0]}),
+            'nick': {'$literal': 'bob'}, 'expires': {'$literal': 100},
+        }
+        assert args[1][1]['$set']['queue'] == {'$slice': ['$queue', 1, {'$size': '$queue'}]}
+        assert kwargs == {'projection': {'claims': {'$slice': -1}}, 'return_document': ReturnDocument.AFTER}
+
+    def test_claim_empty(self):
+        self.backend._indexed = True
+        self.db.helga_queue.find_one_and_update.return_value = None
+        self.db.helga_queue.update_one.return_value.modified_count = 0
+        assert self.backend.claim('qname', 'bob', 100) is None
+
+    def test_ack(self):
+        self.db.helga_queue.find_one_and_update.return_value = {
+            '_id': 'qname', 'claims': [{'id': 3, 'item': 'foo', 'nick': 'bob', 'expires': 100}]
+        }
+        assert self.backend.ack('qname', 'bob', 3) == 'foo'
+        assert self.db.helga_queue.find_one_and_update.mock_calls == [call(
+            {'_id': 'qname', 'claims': {'$elemMatch': {'id': 3, 'nick': 'bob'}}},
+            {'$pull': {'claims': {'id': 3}}},
+            projection={'claims': {'$elemMatch': {'id': 3}}}
+        )]
+        self.db.helga_queue.find_one_and_update.return_value = None
+        assert self.backend.ack('qname', 'bob', 3) is None
+
+    def test_release(self):
+        self.db.helga_queue.find_one_and_update.return_value = {
+            '_id': 'qname', 'claims': [{'id': 3, 'item': 'foo', 'nick': 'bob', 'expires': 100}]
+        }
+        assert self.backend.release('qname', 'bob', 3) == 'foo'
+        args, kwargs = self.db.helga_queue.find_one_and_update.call_args
+        assert args[0] == {'_id': 'qname', 'claims': {'$elemMatch': {'id': 3, 'nick': 'bob'}}}
+        update = args[1][0]['$set']
+        prepend = update['queue']['$let']['in']['$concatArrays'][0]['$map']
+        assert prepend['input']['$filter']['cond'] == {'$eq': ['$$c.id', 3]}
+        # released items take the priority of the head
+        assert prepend['in'] == {'$cond': [{'$gt': ['$$p', 0]}, {'item': '$$c.item', 'p': '$$p'}, '$$c.item']}
+        assert update['claims']['$filter']['cond'] == {'$not': [{'$eq': ['$$c.id', 3]}]}
+        assert update['version'] == NEXT_VERSION
+        assert kwargs == {'projection': {'claims': {'$elemMatch': {'id': 3}}}}
+
+    def test_reap(self):
+        self.backend._indexed = True
+        self.db.helga_queue.distinct.return_value = ['q2', 'q1']
+        assert self.backend.reap(100) == ['q1', 'q2']
+        assert self.db.helga_queue.distinct.mock_calls == [call('_id', {'claims.expires': {'$lt': 100}})]
+        args, kwargs = self.db.helga_queue.update_many.call_args
+        assert args[0] == {'_id': {'$in': ['q1', 'q2']}}
+        assert args[1][0]['$set']['claims']['$filter']['cond'] == {'$not': [{'$lt': ['$$c.expires', 100]}]}
+
+    def test_reap_none(self):
+        self.backend._indexed = True
+        self.db.helga_queue.distinct.return_value = []
+        assert self.backend.reap(100) == []
+        assert self.db.helga_queue.update_many.mock_calls == []
+
+    def test_schedule(self):
+        self.backend._indexed = True
+        self.backend.schedule('qname', 'foo', 100, '#chan')
+        assert self.db.helga_queue.update_one.mock_calls == [call(
+            {'_id': 'qname'},
+            {
+                '$push': {'scheduled': {'$each': [{'item': 'foo', 'due': 100, 'channel': '#chan'}], '$sort': {'due': 1}}},
+                '$setOnInsert': {'queue': []},
+            },
+            upsert=True
+        )]
+
+    def test_scheduled_times(self):
+        self.backend._indexed = True
+        self.db.helga_queue.find.return_value = [
+            {'_id': 'q1', 'scheduled': [{'due': 5}, {'due': 20}]}, {'_id': 'q2', 'scheduled': [{'due': 10}]}
+        ]
+        assert self.backend.scheduled_times() == [5, 10, 20]
+        assert self.db.helga_queue.find.mock_calls == [
+            call({'scheduled.due': {'$exists': True}}, {'scheduled.due': 1})
+        ]
+
+    def test_deliver_due(self):
+        self.backend._indexed = True
+        self.db.helga_queue.distinct.return_value = ['q2', 'q1', 'q3']
+        self.db.helga_queue.find_one_and_update.side_effect = [
+            {'_id': 'q1', 'scheduled': [{'item': 'a', 'due': 50, 'channel': None}, {'item': 'b', 'due': 200}]},
+            {'_id': 'q2', 'scheduled': [{'item': 'c', 'due': 10, 'channel': '#chan'}]},
+            None,
+        ]
+        assert self.backend.deliver_due(100) == [('q2', 'c', '#chan'), ('q1', 'a', None)]
+        assert self.db.helga_queue.distinct.mock_calls == [call('_id', {'scheduled.due': {'$lte': 100}})]
+        args, kwargs = self.db.helga_queue.find_one_and_update.call_args_list[0]
+        assert args[0] == {'_id': 'q1', 'scheduled.due': {'$lte': 100}}
+        update = args[1][0]['$set']
+        assert update['queue']['$concatArrays'][1]['$map']['input']['$filter']['cond'] == {'$lte': ['$$s.due', 100]}
+        assert update['scheduled']['$filter']['cond'] == {'$not': [{'$lte': ['$$s.due', 100]}]}
+        assert kwargs == {'projection': {'scheduled': 1}}
+
+    def test_ttls(self):
+        self.backend._indexed = True
+        self.db.helga_queue.find.return_value = [{'_id': 'q1', 'ttl': 60}, {'_id': 'q2', 'ttl': 3600}]
+        assert self.backend.ttls() == {'q1': 60, 'q2': 3600}
+        assert self.db.helga_queue.find.mock_calls == [call({'ttl': {'$exists': True}}, {'ttl': 1})]
+
+    def test_set_ttl(self):
+        self.backend._indexed = True
+        self.backend.set_ttl('qname', 60)
+        self.backend.set_ttl('qname', None)
+        assert self.db.helga_queue.update_one.mock_calls == [
+            call({'_id': 'qname'}, {'$set': {'ttl': 60}, '$setOnInsert': {'queue': []}}, upsert=True),
+            call({'_id': 'qname'}, {'$unset': {'ttl': ''}}),
+        ]
+
+    def test_expire(self):
+        self.backend._indexed = True
+        self.db.helga_queue.find.return_value.limit.return_value = [{'_id': 'q2'}, {'_id': 'q1'}]
+        assert self.backend.expire(100, 2) == (['q1', 'q2'], True)
+        assert self.db.helga_queue.find.mock_calls == [
+            call({'queue.expires': {'$lte': 100}}, {'_id': 1}), call().limit(2)
+        ]
+        assert self.db.helga_queue.update_many.mock_calls == [call(
+            {'_id': {'$in': ['q1', 'q2']}}, [{'$set': {'queue': live(100), 'version': NEXT_VERSION}}]
+        )]
+
+    def test_expire_none(self):
+        self.backend._indexed = True
+        self.db.helga_queue.find.return_value.limit.return_value = []
+        assert self.backend.expire(100, 2) == ([], False)
+        assert self.db.helga_queue.update_many.mock_calls == []
+
+    def test_append_history(self):
+        self.backend = MongoBackend(self.db, history_size=3)
+        self.backend._indexed = True
+        self.backend.append('qname', 'foo')
+        self.backend.append_many('qname', ['a', 'b'], priority=1)
+        assert self.db.helga_queue.update_one.mock_calls[0] == call(
+            {'_id': 'qname'},
+            {'$push': {'queue': 'foo', 'history': {
+                '$each': [{'op': 'append', 'at': 1000, 'entries': ['foo']}], '$slice': -3
+            }}, '$inc': {'version': 1}},
+            upsert=True
+        )
+        history = self.db.helga_queue.update_one.call_args[0][1][0]['$set']['history']
+        assert history == {'$slice': [{'$concatArrays': [{'$ifNull': ['$history', []]}, [{'$literal': {
+            'op': 'append', 'at': 1000, 'entries': [{'item': 'a', 'p': 1}, {'item': 'b', 'p': 1}]
+        }}]]}, -3]}
+
+    def test_pop_history(self):
+        self.backend = MongoBackend(self.db, history_size=3)
+        self.db.helga_queue.find_one_and_update.return_value = {'_id': 'qname', 'queue': ['zero']}
+        assert self.backend.pop('qname') == 'zero'
+        update = self.db.helga_queue.find_one_and_update.call_args[0][1][0]['$set']
+        # spliced out in a pipeline, so the popped entry can be copied to history
+        assert update['queue']['$concatArrays'][0] == {'$slice': ['$queue', 0]}
+        assert update['history']['$slice'][0]['$concatArrays'][1] == [{
+            'op': 'pop', 'at': 1000, 'idxs': {'$literal': [0]}, 'entries': [{'$arrayElemAt': ['$queue', 0]}]
+        }]
+        self.db.helga_queue.find_one_and_update.return_value = {'_id': 'qname', 'queue': ['one', 'two', 'three']}
+        self.backend.pop_many('qname', [1, 3])
+        update = self.db.helga_queue.find_one_and_update.call_args[0][1][0]['$set']
+        assert update['history']['$slice'][0]['$concatArrays'][1][0]['entries'] == [
+            {'$arrayElemAt': ['$queue', 1]}, {'$arrayElemAt': ['$queue', 3]}
+        ]
+
+    def test_history(self):
+        self.db.helga_queue.aggregate.return_value = iter([{'_id': 'qname', 'history': [
+            {'op': 'append', 'at': 900, 'entries': ['a', {'item': 'b', 'p': 2}]},
+            {'op': 'pop', 'at': 950, 'idxs': [0], 'entries': [{'item': 'b', 'expires': 2000, 'p': 2}]},
+        ]}])
+        assert self.backend.history('qname', 2) == [
+            {'op': 'append', 'at': 900, 'items': ['a', 'b']},
+            {'op': 'pop', 'at': 950, 'items': ['b'], 'idxs': [0]},
+        ]
+        assert self.db.helga_queue.aggregate.call_args[0][0] == [
+            {'$match': {'_id': 'qname'}},
+            {'$project': {'history': {'$slice': [{'$ifNull': ['$history', []]}, -2]}}}
+        ]
+        self.db.helga_queue.aggregate.return_value = iter([])
+        assert self.backend.history('qname', 2) == []
+
+    def test_undo(self):
+        self.db.helga_queue.find_one.return_value = {'_id': 'qname', 'version': 7, 'queue': ['a'], 'history': [
+            {'op': 'pop', 'at': 950, 'idxs': [1], 'entries': [{'item': 'b', 'expires': 2000, 'p': 2}]},
+        ]}
+        self.db.helga_queue.update_one.return_value.matched_count = 1
+        assert self.backend.undo('qname') == {'op': 'pop', 'at': 950, 'items': ['b'], 'idxs': [1]}
+        assert self.db.mock_calls == [
+            call.helga_queue.find_one({'_id': 'qname'}, {'queue': 1, 'version': 1, 'history': 1}),
+            call.helga_queue.update_one({'_id': 'qname', 'version': 7}, {
+                # kept in priority order
+                '$set': {'queue': [{'item': 'b', 'expires': 2000, 'p': 2}, 'a']},
+                '$pop': {'history': 1},
+                '$inc': {'version': 1},
+            }),
+        ]
+
+    def test_undo_nothing(self):
+        self.db.helga_queue.find_one.return_value = {'_id': 'qname', 'queue': ['a']}
+        assert self.backend.undo('qname') is None
+        self.db.helga_queue.find_one.return_value = None
+        assert self.backend.undo('qname') is None
+        assert self.db.helga_queue.update_one.mock_calls == []
+
+    @patch('helga_queue.backends.mongo.random')
+    def test_undo_conflict(self, mock_random):
+        mock_random.uniform.return_value = 0
+        self.db.helga_queue.find_one.return_value = {'_id': 'qname', 'queue': ['a', 'b'], 'history': [
+            {'op': 'append', 'at': 950, 'entries': ['b']},
+        ]}
+        self.db.helga_queue.update_one.return_value.matched_count = 0
+        with pytest.raises(ConflictError):
+            self.backend.undo('qname')
+        assert self.db.helga_queue.update_one.call_args == call(
+            {'_id': 'qname', 'version': {'$exists': False}},
+            {'$set': {'queue': ['a']}, '$pop': {'history': 1}, '$inc': {'version': 1}}
+        )
+        assert len(self.db.helga_queue.update_one.mock_calls) == CAS_RETRIES
+
+    @patch('helga_queue.backends.mongo.ObjectId')
+    def test_move(self, mock_id):
+        self.backend._indexed = True
+        mock_id.return_value = 'm1'
+        move = {'id': 'm1', 'to': 'target', 'at': 1000, 'entries': ['one', {'item': 'three', 'p': 2}]}
+        self.db.helga_queue.find_one_and_update.return_value = {'_id': 'qname', 'moving': [move]}
+        assert self.backend.move('qname', 'target', [1, 3]) == ['one', 'three']
+        args, kwargs = self.db.helga_queue.find_one_and_update.call_args
+        assert args[0] == {'_id': 'qname', 'queue.3': {'$exists': True}, 'queue.expires': LIVE}
+        update = args[1][0]['$set']
+        assert update['queue']['$map']['input']['$filter']['cond'] == {'$not': [{'$in': ['$$i', [1, 3]]}]}
+        assert update['moving'] == {'$concatArrays': [{'$ifNull': ['$moving', []]}, [{
+            'id': 'm1', 'to': {'$literal': 'target'}, 'at': 1000,
+            'entries': [{'$arrayElemAt': ['$queue', 1]}, {'$arrayElemAt': ['$queue', 3]}],
+        }]]}
+        assert update['version'] == NEXT_VERSION
+        assert kwargs == {
+            'projection': {'moving': {'$elemMatch': {'id': 'm1'}}}, 'return_document': ReturnDocument.AFTER
+        }
+        (add, _), (drop, _) = self.db.helga_queue.update_one.call_args_list
+        assert add[0] == {'_id': 'target', 'moved_in': {'$ne': 'm1'}}
+        # one insertion per priority, highest first
+        assert [stage['$set']['queue']['$let']['in']['$concatArrays'][1] for stage in add[1][:2]] == [
+            {'$literal': [{'item': 'three', 'p': 2}]}, {'$literal': ['one']}
+        ]
+        assert add[1][2]['$set']['moved_in'] == {'$slice': [
+            {'$concatArrays': [{'$ifNull': ['$moved_in', []]}, ['m1']]}, -MOVED_IN_SIZE
+        ]}
+        assert self.db.helga_queue.update_one.call_args_list[0][1] == {'upsert': True}
+        assert drop == ({'_id': 'qname'}, {'$pull': {'moving': {'id': 'm1'}}})
+
+    def test_move_all(self):
+        self.backend._indexed = True
+        move = {'id': 'm1', 'to': 'target', 'at': 1000, 'entries': ['zero']}
+        self.db.helga_queue.find_one_and_update.return_value = {'_id': 'qname', 'moving': [move]}
+        assert self.backend.move('qname', 'target') == ['zero']
+        args, kwargs = self.db.helga_queue.find_one_and_update.call_args
+        assert args[0] == {'_id': 'qname', 'queue.0': {'$exists': True}, 'queue.expires': LIVE}
+        assert args[1][0]['$set']['queue'] == []
+        assert args[1][0]['$set']['moving']['$concatArrays'][1][0]['entries'] == '$queue'
+
+    def test_move_missing(self):
+        self.backend._indexed = True
+        self.db.helga_queue.find_one_and_update.return_value = None
+        self.db.helga_queue.update_one.return_value.modified_count = 0
+        assert self.backend.move('qname', 'target', [1]) is None
+        assert self.backend.move('qname', 'target') == []
+
+    def test_move_already_applied(self):
+        self.backend._indexed = True
+        move = {'id': 'm1', 'to': 'target', 'at': 1000, 'entries': ['zero']}
+        self.db.helga_queue.find_one_and_update.return_value = {'_id': 'qname', 'moving': [move]}
+        self.db.helga_queue.update_one.side_effect = [DuplicateKeyError('dup'), Mock()]
+        assert self.backend.move('qname', 'target', [0]) == ['zero']
+        assert self.db.helga_queue.update_one.call_args == call(
+            {'_id': 'qname'}, {'$pull': {'moving': {'id': 'm1'}}}
+        )
+
+    def test_recover_moves(self):
+        self.backend._indexed = True
+        self.db.helga_queue.find.return_value = [{'_id': 'qname', 'moving': [
+            {'id': 'm1', 'to': 'target', 'at': 900, 'entries': ['zero']},
+            {'id': 'm2', 'to': 'other', 'at': 995, 'entries': ['one']},
+        ]}]
+        assert self.backend.recover_moves(1000) == ['qname', 'target']
+        assert self.db.helga_queue.find.mock_calls == [
+            call({'moving.at': {'$lte': 1000 - MOVE_TIMEOUT}}, {'moving': 1})
+        ]
+        # only the interrupted move is finished
+        (add, _), (drop, _) = self.db.helga_queue.update_one.call_args_list
+        assert add[0] == {'_id': 'target', 'moved_in': {'$ne': 'm1'}}
+        assert drop == ({'_id': 'qname'}, {'$pull': {'moving': {'id': 'm1'}}})
+
+    def test_recover_moves_none(self):
+        self.backend._indexed = True
+        self.db.helga_queue.find.return_value = []
+        assert self.backend.recover_moves(1000) == []
+        assert self.db.helga_queue.update_one.mock_calls == []
+
+    def test_export(self):
+        self.db.helga_queue.find.return_value = [
+            {'_id': 'a', 'queue': ['zero', {'item': 'gone', 'expires': 999}, {'item': 'soon', 'expires': 2000}]},
+            {'_id': 'q', 'queue': [{'item': 'urgent', 'p': 2}]},
+            {'_id': 'empty'},
+        ]
+        assert list(self.backend.export(batch_size=10)) == [
+            ('a', 'zero', None, 0), ('a', 'soon', 2000, 0), ('q', 'urgent', None, 2)
+        ]
+        assert self.db.helga_queue.find.mock_calls == [
+            call({}, {'queue': 1}, sort=[('_id', ASCENDING)], batch_size=10)
+        ]
+        list(self.backend.export('q'))
+        assert self.db.helga_queue.find.call_args == call(
+            {'_id': 'q'}, {'queue': 1}, sort=[('_id', ASCENDING)], batch_size=1000
+        )
@@ -0,0 +1,696 @@
+import pytest
+from mock import patch, call, Mock
+from pymongo import ASCENDING, DESCENDING, TEXT, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from helga_queue.backends.base import ConflictError
+from helga_queue.backends.segmented import SegmentedMongoBackend
+
+
+class TestSegmentedMongoBackend:
+
+    def setup_method(self, method):
+        self.db = Mock()
+        self.store = SegmentedMongoBackend(self.db, segment_size=3)
+        self.store._ready = True
+
+    def test_ensure_ready(self):
+        self.store._ready = False
+        self.db.helga_queue.find.return_value = [{'_id': 'q1'}]
+        self.db.helga_queue.find_one.return_value = {'_id': 'q1', 'queue': ['a', 'b', 'c', 'd']}
+        self.store._ensure_ready()
+        self.store._ensure_ready()
+        assert self.db.helga_queue_segments.create_index.mock_calls == [
+            call([('q', ASCENDING), ('n', ASCENDING)]),
+            call([('$**', TEXT)], default_language='none'),
+        ]
+        assert self.db.helga_queue_claims.create_index.mock_calls == [call([('expires', ASCENDING)])]
+        assert call([('scheduled.due', ASCENDING)], sparse=True) in self.db.helga_queue_meta.create_index.mock_calls
+        assert self.db.helga_queue_segments.insert_many.mock_calls == [call([
+            {'_id': 'q1:0', 'q': 'q1', 'n': 0, 'items': {'0': 'a', '1': 'b', '2': 'c'}},
+            {'_id': 'q1:1', 'q': 'q1', 'n': 1, 'items': {'0': 'd'}},
+        ])]
+        assert self.db.helga_queue_meta.update_one.mock_calls == [
+            call({'_id': 'q1'}, {'$set': {'head': 0, 'tail': 4}, '$inc': {'version': 1}}, upsert=True),
+            call({'_id': 'q1'}, {'$unset': {'migrating': '', 'locked': '', 'locked_at': ''}}),
+        ]
+        assert self.db.helga_queue_migrated.replace_one.mock_calls == [
+            call({'_id': 'q1'}, {'_id': 'q1', 'queue': ['a', 'b', 'c', 'd']}, upsert=True)
+        ]
+        assert self.db.helga_queue.delete_one.mock_calls == [call({'_id': 'q1'})]
+        assert self.store._ready
+
+    def test_ensure_ready_refused(self):
+        self.store._ready = False
+        self.db.helga_queue.find.return_value = [{'_id': 'q1'}, {'_id': 'q2'}]
+        docs = {
+            'q1': {'_id': 'q1', 'queue': ['a'], 'ttl': 60},
+            'q2': {'_id': 'q2', 'queue': ['b']},
+        }
+        self.db.helga_queue.find_one.side_effect = lambda q: docs[q['_id']]
+        with pytest.raises(ValueError) as ex:
+            self.store._ensure_ready()
+        assert "queue 'q1' has a TTL" in str(ex.value)
+        assert self.db.helga_queue.delete_one.mock_calls == [call({'_id': 'q2'})]
+        assert not self.store._ready
+
+    def test_migrate_missing(self):
+        self.db.helga_queue.find_one.return_value = None
+        assert self.store.migrate('q1') is False
+        assert self.db.helga_queue_meta.mock_calls == []
+
+    def test_migrate_full(self):
+        doc = {
+            '_id': 'q1', 'version': 12, 'owner': 'bob', 'channel': '#bots', 'ttl': None,
+            'queue': ['a', 'b'],
+            'claims': [{'id': 3, 'item': 'c', 'nick': 'alice', 'expires': 2000}],
+            'claim_seq': 3,
+            'scheduled': [{'item': 'd', 'due': 3000, 'channel': '#bots'}],
+            'history': [{'op': 'append', 'items': ['a']}],
+            'moving': [],
+            'moved_in': [7],
+        }
+        self.db.helga_queue.find_one.return_value = doc
+        assert self.store.migrate('q1') is True
+        assert self.db.helga_queue_segments.insert_many.mock_calls == [
+            call([{'_id': 'q1:0', 'q': 'q1', 'n': 0, 'items': {'0': 'a', '1': 'b'}}])
+        ]
+        assert self.db.helga_queue_meta.update_one.mock_calls == [
+            call({'_id': 'q1'}, {'$set': {'head': 0, 'tail': 2}, '$inc': {'version': 1}}, upsert=True),
+            call({'_id': 'q1'}, {
+                '$set': {
+                    'owner': 'bob', 'channel': '#bots', 'claim_seq': 3,
+                    'scheduled': [{'item': 'd', 'due': 3000, 'channel': '#bots'}],
+                },
+                '$unset': {'migrating': '', 'locked': '', 'locked_at': ''},
+            }),
+        ]
+        assert self.db.helga_queue_claims.replace_one.mock_calls == [
+            call({'_id': 'q1:3'}, {
+                '_id': 'q1:3', 'q': 'q1', 'id': 3, 'item': 'c', 'nick': 'alice', 'expires': 2000
+            }, upsert=True)
+        ]
+        assert self.db.helga_queue_migrated.replace_one.mock_calls == [call({'_id': 'q1'}, doc, upsert=True)]
+        assert self.db.helga_queue.delete_one.mock_calls == [call({'_id': 'q1'})]
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_migrate_claims_name(self, mock_time):
+        mock_time.time.return_value = 1000
+        self.db.helga_queue.find_one.return_value = {'_id': 'q1', 'queue': ['a']}
+        assert self.store.migrate('q1') is True
+        assert self.db.helga_queue_meta.insert_one.mock_calls == [call(
+            {'_id': 'q1', 'head': 0, 'tail': 0, 'migrating': True, 'locked': True, 'locked_at': 1000}
+        )]
+
+    def test_migrate_existing(self):
+        # a segmented queue of the same name already has items
+        self.db.helga_queue.find_one.return_value = {'_id': 'q1', 'queue': ['a']}
+        self.db.helga_queue_meta.insert_one.side_effect = DuplicateKeyError('dup')
+        self.db.helga_queue_meta.find_one.return_value = None
+        with pytest.raises(ValueError) as ex:
+            self.store.migrate('q1')
+        assert "queue 'q1' already exists in the segmented layout" in str(ex.value)
+        assert self.db.helga_queue_meta.find_one.mock_calls == [call({'_id': 'q1', 'migrating': True}, {'_id': 1})]
+        assert self.db.helga_queue_meta.update_one.mock_calls == []
+        assert self.db.helga_queue_segments.mock_calls == []
+        assert self.db.helga_queue_claims.mock_calls == []
+        assert self.db.helga_queue.delete_one.mock_calls == []
+
+    def test_migrate_interrupted(self):
+        # an earlier migration of the queue claimed the name, then stopped
+        self.db.helga_queue.find_one.return_value = {'_id': 'q1', 'queue': ['a']}
+        self.db.helga_queue_meta.insert_one.side_effect = DuplicateKeyError('dup')
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1'}
+        assert self.store.migrate('q1') is True
+        assert self.db.helga_queue_segments.insert_many.mock_calls == [
+            call([{'_id': 'q1:0', 'q': 'q1', 'n': 0, 'items': {'0': 'a'}}])
+        ]
+        assert self.db.helga_queue.delete_one.mock_calls == [call({'_id': 'q1'})]
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_migrate_entries(self, time):
+        time.time.return_value = 1000
+        self.db.helga_queue.find_one.return_value = {'_id': 'q1', 'queue': [
+            'a', {'item': 'b'}, {'item': 'c', 'p': 0}, {'item': 'd', 'expires': 900}, 'e',
+        ]}
+        assert self.store.migrate('q1') is True
+        assert self.db.helga_queue_segments.insert_many.mock_calls == [call([
+            {'_id': 'q1:0', 'q': 'q1', 'n': 0, 'items': {'0': 'a', '1': 'b', '2': 'c'}},
+            {'_id': 'q1:1', 'q': 'q1', 'n': 1, 'items': {'0': 'e'}},
+        ])]
+
+    @pytest.mark.parametrize('extra', [
+        {'ttl': 60},
+        {'moving': [{'id': 1, 'to': 'q2', 'at': 1000, 'entries': ['a']}]},
+        {'queue': ['a', {'item': 'b', 'p': 1}]},
+        {'queue': ['a', {'item': 'b', 'expires': 4102444800}]},
+    ])
+    def test_migrate_refused(self, extra):
+        doc = {'_id': 'q1', 'queue': ['a']}
+        doc.update(extra)
+        self.db.helga_queue.find_one.return_value = doc
+        with pytest.raises(ValueError):
+            self.store.migrate('q1')
+        assert self.db.helga_queue_segments.mock_calls == []
+        assert self.db.helga_queue_meta.mock_calls == []
+        assert self.db.helga_queue.delete_one.mock_calls == []
+
+    def test_length(self):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 4, 'tail': 10}
+        assert self.store.length('q1') == 6
+        self.db.helga_queue_meta.find_one.return_value = None
+        assert self.store.length('q1') == 0
+
+    def test_stamp(self):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 4, 'tail': 10, 'version': 9}
+        assert self.store.stamp('q1') == (9, 6)
+        self.db.helga_queue_meta.find_one.return_value = None
+        assert self.store.stamp('q1') == (0, 0)
+
+    def test_range(self):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 4, 'tail': 8}
+        segs = {
+            'q1:1': {'_id': 'q1:1', 'items': {'2': 'e'}},
+            'q1:2': {'_id': 'q1:2', 'items': {'0': 'f', '1': 'g'}},
+        }
+        self.db.helga_queue_segments.find_one.side_effect = lambda q, p: segs[q['_id']]
+        assert self.store.range('q1', 1, 10) == ['e', 'f', 'g']
+        assert self.db.helga_queue_segments.find_one.call_count == 2
+        self.db.helga_queue_segments.find_one.assert_has_calls([
+            call({'_id': 'q1:1'}, {'items.2': 1}),
+            call({'_id': 'q1:2'}, {'items.0': 1, 'items.1': 1}),
+        ], any_order=True)
+
+    def test_range_past_end(self):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 0, 'tail': 2}
+        assert self.store.range('q1', 5, 10) == []
+        assert self.db.helga_queue_segments.mock_calls == []
+
+    def test_get(self):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 2, 'tail': 5}
+        self.db.helga_queue_segments.find.return_value = [
+            {'n': 0, 'items': {'0': 'a', '1': 'b', '2': 'c'}},
+            {'n': 1, 'items': {'0': 'd', '1': 'e'}},
+        ]
+        assert self.store.get('q1') == ['c', 'd', 'e']
+        assert self.db.helga_queue_segments.find.mock_calls == [call({'q': 'q1'})]
+
+    def test_append(self):
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'tail': 5}
+        self.store.append('q1', 'foo')
+        assert self.db.helga_queue_meta.find_one_and_update.mock_calls == [call(
+            {'_id': 'q1', 'locked': {'$ne': True}},
+            {'$inc': {'tail': 1, 'version': 1}, '$setOnInsert': {'head': 0}},
+            projection={'tail': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )]
+        assert self.db.helga_queue_segments.update_one.mock_calls == [call(
+            {'_id': 'q1:1'},
+            {'$set': {'items.1': 'foo'}, '$setOnInsert': {'q': 'q1', 'n': 1}},
+            upsert=True
+        )]
+
+    def test_append_many(self):
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'tail': 7}
+        self.store.append_many('q1', ['a', 'b', 'c'])
+        assert self.db.helga_queue_meta.find_one_and_update.mock_calls == [call(
+            {'_id': 'q1', 'locked': {'$ne': True}},
+            {'$inc': {'tail': 3, 'version': 1}, '$setOnInsert': {'head': 0}},
+            projection={'tail': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )]
+        assert self.db.helga_queue_segments.update_one.mock_calls == [
+            call(
+                {'_id': 'q1:1'},
+                {'$set': {'items.1': 'a', 'items.2': 'b'}, '$setOnInsert': {'q': 'q1', 'n': 1}},
+                upsert=True
+            ),
+            call(
+                {'_id': 'q1:2'},
+                {'$set': {'items.0': 'c'}, '$setOnInsert': {'q': 'q1', 'n': 2}},
+                upsert=True
+            ),
+        ]
+
+    def test_append_many_empty(self):
+        self.store.append_many('q1', [])
+        assert self.db.mock_calls == []
+
+    def test_append_expires(self):
+        with pytest.raises(NotImplementedError):
+            self.store.append('q1', 'foo', 100)
+        with pytest.raises(NotImplementedError):
+            self.store.append_many('q1', ['foo'], 100)
+        with pytest.raises(NotImplementedError):
+            self.store.set_ttl('q1', 60)
+        assert self.db.mock_calls == []
+
+    def test_append_priority(self):
+        with pytest.raises(NotImplementedError):
+            self.store.append('q1', 'foo', priority=1)
+        with pytest.raises(NotImplementedError):
+            self.store.append_many('q1', ['foo'], priority=1)
+        assert self.db.mock_calls == []
+
+    def test_history(self):
+        with pytest.raises(NotImplementedError):
+            self.store.history('q1', 5)
+        with pytest.raises(NotImplementedError):
+            self.store.undo('q1')
+        assert self.db.mock_calls == []
+
+    def test_move(self):
+        with pytest.raises(NotImplementedError):
+            self.store.move('q1', 'q2', [0])
+        assert self.store.recover_moves(1000) == []
+        assert self.db.mock_calls == []
+
+    def test_pop_head(self):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 4, 'tail': 6}
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'head': 4}
+        self.db.helga_queue_segments.find_one.return_value = {'items': {'1': 'foo'}}
+        assert self.store.pop('q1') == 'foo'
+        assert self.db.helga_queue_meta.find_one_and_update.mock_calls == [call(
+            {'_id': 'q1', 'head': 4, 'locked': {'$ne': True}},
+            {'$inc': {'head': 1, 'version': 1}},
+            projection={'head': 1}
+        )]
+        assert self.db.helga_queue_segments.delete_many.mock_calls == []
+
+    def test_pop_head_drops_segment(self):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 5, 'tail': 6}
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'head': 5}
+        self.db.helga_queue_segments.find_one.return_value = {'items': {'2': 'foo'}}
+        assert self.store.pop('q1') == 'foo'
+        assert self.db.helga_queue_segments.delete_many.mock_calls == [
+            call({'q': 'q1', 'n': {'$lt': 2}})
+        ]
+
+    def test_pop_head_empty(self):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 3, 'tail': 3}
+        assert self.store.pop('q1') is None
+        self.db.helga_queue_meta.find_one.return_value = None
+        assert self.store.pop('q1') is None
+        assert self.db.helga_queue_meta.find_one_and_update.mock_calls == []
+        assert self.db.helga_queue_segments.mock_calls == []
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_pop_head_locked(self, mock_time):
+        mock_time.time.return_value = 100
+        self.db.helga_queue_meta.find_one.side_effect = [
+            {'_id': 'q1', 'head': 0, 'tail': 1, 'locked': True, 'locked_at': 99},
+            {'_id': 'q1', 'locked': True, 'locked_at': 99},
+            {'_id': 'q1', 'head': 0, 'tail': 1},
+        ]
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'head': 0}
+        self.db.helga_queue_segments.find_one.return_value = {'items': {'0': 'foo'}}
+        assert self.store.pop('q1') == 'foo'
+        assert mock_time.sleep.call_count == 1
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_pop_head_stale_lock(self, mock_time):
+        mock_time.time.return_value = 100
+        self.db.helga_queue_meta.find_one.side_effect = [
+            {'_id': 'q1', 'head': 0, 'tail': 1, 'locked': True, 'locked_at': 1},
+            {'_id': 'q1', 'locked': True, 'locked_at': 1},
+            {'_id': 'q1', 'head': 0, 'tail': 1},
+        ]
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'head': 0}
+        self.db.helga_queue_segments.find_one.return_value = {'items': {'0': 'foo'}}
+        assert self.store.pop('q1') == 'foo'
+        assert self.db.helga_queue_meta.update_one.mock_calls == [
+            call({'_id': 'q1', 'locked_at': 1}, {'$unset': {'locked': '', 'locked_at': ''}})
+        ]
+        assert mock_time.sleep.call_count == 0
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_pop_head_unwritten(self, mock_time):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 0, 'tail': 1}
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'head': 0}
+        self.db.helga_queue_segments.find_one.side_effect = [None, {'items': {'0': 'foo'}}]
+        assert self.store.pop('q1') == 'foo'
+        assert mock_time.sleep.call_count == 1
+        assert len(self.db.helga_queue_meta.find_one_and_update.mock_calls) == 1
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_pop_head_never_written(self, mock_time):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 0, 'tail': 1}
+        self.db.helga_queue_segments.find_one.return_value = None
+        with pytest.raises(ConflictError):
+            self.store.pop('q1')
+        with pytest.raises(ConflictError):
+            self.store.claim('q1', 'bob', 100)
+        # head never moves past an item that wasn't read
+        assert self.db.helga_queue_meta.find_one_and_update.mock_calls == []
+        assert self.db.helga_queue_claims.mock_calls == []
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_pop_head_concurrent(self, mock_time):
+        # another pop takes slot 2 and drops its segment between this pop
+        # reading the head and moving it; this pop retries on slot 3
+        self.db.helga_queue_meta.find_one.side_effect = [
+            {'_id': 'q1', 'head': 2, 'tail': 5},
+            {'_id': 'q1', 'head': 3, 'tail': 5},
+        ]
+        self.db.helga_queue_meta.find_one_and_update.side_effect = [None, {'_id': 'q1', 'head': 3}]
+        self.db.helga_queue_segments.find_one.side_effect = [{'items': {'2': 'two'}}, {'items': {'0': 'three'}}]
+        assert self.store.pop('q1') == 'three'
+        assert self.db.helga_queue_meta.find_one_and_update.mock_calls[1] == call(
+            {'_id': 'q1', 'head': 3, 'locked': {'$ne': True}},
+            {'$inc': {'head': 1, 'version': 1}},
+            projection={'head': 1}
+        )
+        assert mock_time.sleep.call_count == 0
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_pop_index(self, mock_time):
+        mock_time.time.return_value = 100
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'head': 2, 'tail': 6}
+        segs = {
+            'q1:0': {'items': {'2': 'a'}},
+            'q1:1': {'items': {'0': 'b', '1': 'c'}},
+        }
+        self.db.helga_queue_segments.find_one.side_effect = lambda q, p: segs[q['_id']]
+        assert self.store.pop('q1', 2) == 'c'
+        assert self.db.helga_queue_meta.find_one_and_update.mock_calls == [call(
+            {'_id': 'q1', 'locked': {'$ne': True}, '$expr': {'$lt': [{'$add': ['$head', 2]}, '$tail']}},
+            {'$set': {'locked': True, 'locked_at': 100}}
+        )]
+        # one write per shifted segment
+        assert self.db.helga_queue_segments.update_one.mock_calls == [
+            call({'_id': 'q1:1'}, {'$set': {'items.0': 'a', 'items.1': 'b'}, '$setOnInsert': {'q': 'q1', 'n': 1}},
+                 upsert=True),
+        ]
+        assert self.db.helga_queue_meta.update_one.mock_calls == [
+            call({'_id': 'q1'}, {'$inc': {'head': 1, 'version': 1}, '$unset': {'locked': '', 'locked_at': ''}})
+        ]
+        assert self.db.helga_queue_segments.delete_many.mock_calls == [
+            call({'q': 'q1', 'n': {'$lt': 1}})
+        ]
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_pop_many(self, mock_time):
+        mock_time.time.return_value = 100
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'head': 2, 'tail': 7}
+        segs = {
+            'q1:0': {'items': {'2': 'a'}},
+            'q1:1': {'items': {'0': 'b', '1': 'c', '2': 'd'}},
+        }
+        self.db.helga_queue_segments.find_one.side_effect = lambda q, p: segs[q['_id']]
+        assert self.store.pop_many('q1', [1, 3]) == ['b', 'd']
+        assert self.db.helga_queue_meta.find_one_and_update.mock_calls == [call(
+            {'_id': 'q1', 'locked': {'$ne': True}, '$expr': {'$lt': [{'$add': ['$head', 3]}, '$tail']}},
+            {'$set': {'locked': True, 'locked_at': 100}}
+        )]
+        assert self.db.helga_queue_segments.update_one.mock_calls == [
+            call({'_id': 'q1:1'}, {'$set': {'items.1': 'a', 'items.2': 'c'}, '$setOnInsert': {'q': 'q1', 'n': 1}},
+                 upsert=True),
+        ]
+        assert self.db.helga_queue_meta.update_one.mock_calls == [
+            call({'_id': 'q1'}, {'$inc': {'head': 2, 'version': 1}, '$unset': {'locked': '', 'locked_at': ''}})
+        ]
+        assert self.db.helga_queue_segments.delete_many.mock_calls == [
+            call({'q': 'q1', 'n': {'$lt': 1}})
+        ]
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_pop_index_short_read(self, mock_time):
+        mock_time.time.return_value = 100
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'head': 2, 'tail': 6}
+        # slot 4 was reserved by an append that never wrote it
+        segs = {
+            'q1:0': {'items': {'2': 'a'}},
+            'q1:1': {'items': {'0': 'b'}},
+        }
+        self.db.helga_queue_segments.find_one.side_effect = lambda q, p: segs[q['_id']]
+        with pytest.raises(ConflictError):
+            self.store.pop('q1', 2)
+        assert self.db.helga_queue_segments.update_one.mock_calls == []
+        # head doesn't move: nothing is lost
+        assert self.db.helga_queue_meta.update_one.mock_calls == [
+            call({'_id': 'q1'}, {'$unset': {'locked': '', 'locked_at': ''}})
+        ]
+        assert self.db.helga_queue_segments.delete_many.mock_calls == []
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_pop_index_shift_fails(self, mock_time):
+        mock_time.time.return_value = 100
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'head': 2, 'tail': 8}
+        segs = {
+            'q1:0': {'items': {'2': 'a'}},
+            'q1:1': {'items': {'0': 'b', '1': 'c', '2': 'd'}},
+            'q1:2': {'items': {'0': 'e'}},
+        }
+        self.db.helga_queue_segments.find_one.side_effect = lambda q, p: segs[q['_id']]
+        self.db.helga_queue_segments.update_one.side_effect = [None, RuntimeError('network'), None]
+        with pytest.raises(RuntimeError):
+            self.store.pop('q1', 4)
+        upsert = {'q': 'q1', 'n': 1}
+        assert self.db.helga_queue_segments.update_one.mock_calls == [
+            # the shift writes segment 1, then fails on segment 2...
+            call({'_id': 'q1:1'}, {'$set': {'items.0': 'a', 'items.1': 'b', 'items.2': 'c'}, '$setOnInsert': upsert},
+                 upsert=True),
+            call({'_id': 'q1:2'}, {'$set': {'items.0': 'd'}, '$setOnInsert': {'q': 'q1', 'n': 2}}, upsert=True),
+            # ...so segment 1 is put back as it was
+            call({'_id': 'q1:1'}, {'$set': {'items.0': 'b', 'items.1': 'c', 'items.2': 'd'}, '$setOnInsert': upsert},
+                 upsert=True),
+        ]
+        assert self.db.helga_queue_meta.update_one.mock_calls == [
+            call({'_id': 'q1'}, {'$unset': {'locked': '', 'locked_at': ''}})
+        ]
+
+    def test_set_owner(self):
+        self.store.set_owner('q1', 'mynick', '#chan')
+        assert self.db.helga_queue_meta.update_one.mock_calls == [call({'_id': 'q1'}, [{'$set': {
+            'head': {'$ifNull': ['$head', 0]},
+            'tail': {'$ifNull': ['$tail', 0]},
+            'owner': {'$ifNull': ['$owner', 'mynick']},
+            'channel': {'$ifNull': ['$channel', '#chan']},
+        }}], upsert=True)]
+
+    def test_queues(self):
+        self.db.helga_queue_meta.find.return_value.sort.return_value = [
+            {'_id': 'a', 'head': 4, 'tail': 6, 'owner': 'bob', 'channel': '#ops'},
+            {'_id': 'b', 'head': 2, 'tail': 2},
+        ]
+        self.db.helga_queue_segments.find.return_value = [{'_id': 'a:1', 'items': {'1': 'x', '2': 'y'}}]
+        assert self.store.queues(owner='bob') == [
+            {'name': 'a', 'length': 2, 'head': 'x', 'owner': 'bob', 'channel': '#ops'},
+            {'name': 'b', 'length': 0, 'head': None, 'owner': None, 'channel': None},
+        ]
+        assert self.db.helga_queue_meta.find.mock_calls[0] == call({'owner': 'bob'})
+        assert self.db.helga_queue_segments.find.mock_calls == [call({'_id': {'$in': ['a:1']}})]
+
+    def test_search(self):
+        self.db.helga_queue_segments.find.return_value = [
+            {'q': 'q1', 'n': 1, 'items': {'0': 'old build', '1': 'build it', '2': 'other'}},
+            {'q': 'q2', 'n': 0, 'items': {'0': 'Build'}},
+        ]
+        self.db.helga_queue_meta.find.return_value = [
+            {'_id': 'q1', 'head': 4, 'tail': 6},
+            {'_id': 'q2', 'head': 0, 'tail': 1},
+        ]
+        assert self.store.search(['build']) == [('q1', 0, 'build it'), ('q2', 0, 'Build')]
+        assert self.db.helga_queue_segments.find.mock_calls == [
+            call({'$text': {'$search': '"build"'}}, {'q': 1, 'n': 1, 'items': 1})
+        ]
+        assert self.db.helga_queue_meta.find.mock_calls == [call({'_id': {'$in': ['q1', 'q2']}})]
+
+    def test_search_queue_none(self):
+        self.db.helga_queue_segments.find.return_value = []
+        assert self.store.search(['build'], 'q1') == []
+        assert self.db.helga_queue_segments.find.mock_calls == [
+            call({'$text': {'$search': '"build"'}, 'q': 'q1'}, {'q': 1, 'n': 1, 'items': 1})
+        ]
+        assert self.db.helga_queue_meta.find.mock_calls == []
+
+    def test_pop_index_missing(self):
+        self.db.helga_queue_meta.find_one_and_update.return_value = None
+        self.db.helga_queue_meta.find_one.return_value = None
+        assert self.store.pop('q1', 5) is None
+        assert self.db.helga_queue_meta.update_one.mock_calls == []
+
+    def test_set(self):
+        self.store.set('q1', [])
+        assert self.db.helga_queue_segments.mock_calls == [call.delete_many({'q': 'q1'})]
+        assert self.db.helga_queue_meta.mock_calls == [
+            call.update_one({'_id': 'q1'}, {'$set': {'head': 0, 'tail': 0}, '$inc': {'version': 1}}, upsert=True)
+        ]
+
+    def test_get_versioned(self):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 2, 'tail': 4, 'version': 7}
+        self.db.helga_queue_segments.find_one.side_effect = [
+            {'items': {'2': 'foo'}}, {'items': {'0': 'bar'}},
+        ]
+        assert self.store.get_versioned('q1') == (['foo', 'bar'], 7)
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_get_versioned_short_read(self, mock_time):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 2, 'tail': 4, 'version': 7}
+        self.db.helga_queue_segments.find_one.return_value = {'items': {'2': 'foo'}}
+        with pytest.raises(ConflictError):
+            self.store.get_versioned('q1')
+        assert self.db.helga_queue_meta.find_one_and_update.mock_calls == []
+
+    def test_get_versioned_missing(self):
+        self.db.helga_queue_meta.find_one.return_value = None
+        assert self.store.get_versioned('q1') == ([], None)
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_compare_and_set(self, mock_time):
+        mock_time.time.return_value = 100
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'version': 3}
+        assert self.store.compare_and_set('q1', ['foo'], 3) is True
+        assert self.db.helga_queue_meta.find_one_and_update.mock_calls == [
+            call({'_id': 'q1', 'locked': {'$ne': True}, 'version': 3},
+                 {'$set': {'locked': True, 'locked_at': 100}})
+        ]
+        assert self.db.helga_queue_segments.insert_many.mock_calls == [
+            call([{'_id': 'q1:0', 'q': 'q1', 'n': 0, 'items': {'0': 'foo'}}])
+        ]
+        assert self.db.helga_queue_meta.update_one.mock_calls == [
+            call({'_id': 'q1'}, {'$set': {'head': 0, 'tail': 1}, '$inc': {'version': 1}}, upsert=True),
+            call({'_id': 'q1'}, {'$unset': {'locked': '', 'locked_at': ''}}),
+        ]
+
+    def test_compare_and_set_conflict(self):
+        self.db.helga_queue_meta.find_one_and_update.return_value = None
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1'}
+        assert self.store.compare_and_set('q1', ['foo'], 3) is False
+        assert self.db.helga_queue_segments.mock_calls == []
+        assert self.db.helga_queue_meta.update_one.mock_calls == []
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_compare_and_set_new(self, mock_time):
+        mock_time.time.return_value = 100
+        assert self.store.compare_and_set('q1', ['foo'], None) is True
+        assert self.db.helga_queue_meta.insert_one.mock_calls == [
+            call({'_id': 'q1', 'head': 0, 'tail': 0, 'locked': True, 'locked_at': 100})
+        ]
+        self.db.helga_queue_meta.insert_one.side_effect = DuplicateKeyError('dup')
+        assert self.store.compare_and_set('q1', ['foo'], None) is False
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_append_locked(self, mock_time):
+        mock_time.time.return_value = 100
+        self.db.helga_queue_meta.find_one_and_update.side_effect = [DuplicateKeyError('dup'), {'tail': 1}]
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'locked': True, 'locked_at': 99}
+        self.store.append('q1', 'foo')
+        assert mock_time.sleep.call_count == 1
+        assert self.db.helga_queue_segments.update_one.call_count == 1
+
+    @patch('helga_queue.backends.segmented.time')
+    def test_append_stays_locked(self, mock_time):
+        mock_time.time.return_value = 100
+        self.db.helga_queue_meta.find_one_and_update.side_effect = DuplicateKeyError('dup')
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'locked': True, 'locked_at': 99}
+        with pytest.raises(ConflictError):
+            self.store.append('q1', 'foo')
+        assert self.db.helga_queue_segments.mock_calls == []
+
+    def test_claim(self):
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1', 'head': 0, 'tail': 2}
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'_id': 'q1', 'head': 0, 'claim_seq': 4}
+        self.db.helga_queue_segments.find_one.return_value = {'items': {'0': 'foo'}}
+        assert self.store.claim('q1', 'bob', 100) == (5, 'foo')
+        assert self.db.helga_queue_meta.find_one_and_update.mock_calls == [call(
+            {'_id': 'q1', 'head': 0, 'locked': {'$ne': True}},
+            {'$inc': {'head': 1, 'version': 1, 'claim_seq': 1}},
+            projection={'head': 1, 'claim_seq': 1}
+        )]
+        assert self.db.helga_queue_claims.insert_one.mock_calls == [call(
+            {'_id': 'q1:5', 'q': 'q1', 'id': 5, 'item': 'foo', 'nick': 'bob', 'expires': 100}
+        )]
+
+    def test_claim_empty(self):
+        self.db.helga_queue_meta.find_one.return_value = None
+        assert self.store.claim('q1', 'bob', 100) is None
+        assert self.db.helga_queue_claims.mock_calls == []
+
+    def test_ack(self):
+        self.db.helga_queue_claims.find_one_and_delete.return_value = {'_id': 'q1:5', 'item': 'foo'}
+        assert self.store.ack('q1', 'bob', 5) == 'foo'
+        assert self.db.helga_queue_claims.find_one_and_delete.mock_calls == [
+            call({'_id': 'q1:5', 'nick': 'bob'})
+        ]
+        self.db.helga_queue_claims.find_one_and_delete.return_value = None
+        assert self.store.ack('q1', 'bob', 5) is None
+
+    def test_release(self):
+        self.db.helga_queue_claims.find_one_and_delete.return_value = {'_id': 'q1:5', 'item': 'foo'}
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'head': 2}
+        assert self.store.release('q1', 'bob', 5) == 'foo'
+        assert self.db.helga_queue_meta.find_one_and_update.mock_calls == [call(
+            {'_id': 'q1', 'locked': {'$ne': True}},
+            {'$inc': {'head': -1, 'version': 1}, '$setOnInsert': {'tail': 0}},
+            projection={'head': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )]
+        assert self.db.helga_queue_segments.update_one.mock_calls == [call(
+            {'_id': 'q1:0'}, {'$set': {'items.2': 'foo'}, '$setOnInsert': {'q': 'q1', 'n': 0}}, upsert=True
+        )]
+
+    def test_release_missing(self):
+        self.db.helga_queue_claims.find_one_and_delete.return_value = None
+        assert self.store.release('q1', 'bob', 5) is None
+        assert self.db.helga_queue_meta.mock_calls == []
+
+    def test_reap(self):
+        self.db.helga_queue_claims.find.return_value.sort.return_value = [
+            {'_id': 'q1:2', 'q': 'q1'}, {'_id': 'q1:1', 'q': 'q1'}, {'_id': 'q2:1', 'q': 'q2'},
+        ]
+        self.db.helga_queue_claims.find_one_and_delete.side_effect = [
+            {'_id': 'q1:2', 'q': 'q1', 'item': 'two'}, None, {'_id': 'q2:1', 'q': 'q2', 'item': 'other'},
+        ]
+        # reserving the slot before the head, which is 0 in both queues
+        self.db.helga_queue_meta.find_one_and_update.return_value = {'head': -1}
+        assert self.store.reap(100) == ['q1', 'q2']
+        assert self.db.helga_queue_claims.find.mock_calls[0] == call({'expires': {'$lt': 100}}, {'_id': 1, 'q': 1})
+        assert self.db.helga_queue_claims.find.return_value.sort.mock_calls == [
+            call([('q', ASCENDING), ('id', DESCENDING)])
+        ]
+        assert self.db.helga_queue_segments.update_one.mock_calls == [
+            call({'_id': 'q1:-1'}, {'$set': {'items.2': 'two'}, '$setOnInsert': {'q': 'q1', 'n': -1}}, upsert=True),
+            call({'_id': 'q2:-1'}, {'$set': {'items.2': 'other'}, '$setOnInsert': {'q': 'q2', 'n': -1}}, upsert=True),
+        ]
+
+    def test_schedule(self):
+        self.store.schedule('q1', 'foo', 100)
+        assert self.db.helga_queue_meta.update_one.mock_calls == [call(
+            {'_id': 'q1'},
+            {
+                '$push': {'scheduled': {'$each': [{'item': 'foo', 'due': 100, 'channel': None}], '$sort': {'due': 1}}},
+                '$setOnInsert': {'head': 0, 'tail': 0},
+            },
+            upsert=True
+        )]
+
+    def test_scheduled_times(self):
+        self.db.helga_queue_meta.find.return_value = [{'_id': 'q1', 'scheduled': [{'due': 7}, {'due': 3}]}]
+        assert self.store.scheduled_times() == [3, 7]
+
+    def test_deliver_due(self):
+        self.db.helga_queue_meta.distinct.return_value = ['q1']
+        self.db.helga_queue_meta.find_one_and_update.return_value = {
+            '_id': 'q1', 'tail': 5,
+            'scheduled': [{'item': 'a', 'due': 50, 'channel': '#chan'}, {'item': 'b', 'due': 60}, {'item': 'c', 'due': 200}]
+        }
+        assert self.store.deliver_due(100) == [('q1', 'a', '#chan'), ('q1', 'b', None)]
+        args, kwargs = self.db.helga_queue_meta.find_one_and_update.call_args
+        assert args[0] == {'_id': 'q1', 'locked': {'$ne': True}, 'scheduled.due': {'$lte': 100}}
+        assert args[1][0]['$set']['tail'] == {'$add': [
+            '$tail', {'$size': {'$filter': {'input': '$scheduled', 'as': 's', 'cond': {'$lte': ['$$s.due', 100]}}}}
+        ]}
+        assert self.db.helga_queue_segments.update_one.mock_calls == [
+            call({'_id': 'q1:1'}, {'$set': {'items.2': 'a'}, '$setOnInsert': {'q': 'q1', 'n': 1}}, upsert=True),
+            call({'_id': 'q1:2'}, {'$set': {'items.0': 'b'}, '$setOnInsert': {'q': 'q1', 'n': 2}}, upsert=True),
+        ]
+
+    def test_deliver_due_already_delivered(self):
+        self.db.helga_queue_meta.distinct.return_value = ['q1']
+        self.db.helga_queue_meta.find_one_and_update.return_value = None
+        self.db.helga_queue_meta.find_one.return_value = {'_id': 'q1'}
+        assert self.store.deliver_due(100) == []
+        assert self.db.helga_queue_segments.mock_calls == []
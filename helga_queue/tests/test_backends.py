@@ -0,0 +1,742 @@
+import os
+import sqlite3
+import tempfile
+import time
+
+import pytest
+from mock import patch, Mock
+
+from helga_queue.backends import (
+    make_backend, Backend, ConflictError, MemoryBackend, MongoBackend, SegmentedMongoBackend, SQLiteBackend
+)
+from helga_queue.backends.base import CAS_RETRIES, carry_over, matches, tokenize
+from helga_queue.backends.sqlite import SCHEMA, SQL_EXPIRED_ITEMS, SQL_RANGE
+
+
+class TestSearchHelpers:
+
+    def test_tokenize(self):
+        assert tokenize('Fix the BUILD, then deploy-v2!') == ['fix', 'the', 'build', 'then', 'deploy', 'v2']
+        assert tokenize('  ') == []
+
+    def test_matches(self):
+        assert matches('Fix the build', ['build', 'fix']) is True
+        assert matches('Fix the builder', ['build']) is False
+        assert matches('anything', []) is True
+
+
+class DictBackend(Backend):
+    """minimal backend exercising the Backend defaults"""
+
+    def __init__(self):
+        self.queues = {}
+
+    def get(self, name):
+        return list(self.queues.get(name, []))
+
+    def set(self, name, q):
+        self.queues[name] = list(q)
+
+
+class BackendContract(object):
+    """behaviour every backend must share; subclasses provide make()"""
+
+    def setup_method(self, method):
+        self.backend = self.make()
+
+    def test_empty(self):
+        assert self.backend.get('q') == []
+        assert self.backend.length('q') == 0
+        assert self.backend.range('q', 0, 5) == []
+        assert self.backend.peek('q') is None
+        assert self.backend.is_empty('q') is True
+        assert self.backend.pop('q') is None
+
+    def test_append_get(self):
+        for item in ['zero', 'one', 'two']:
+            self.backend.append('q', item)
+        self.backend.append('other', 'x')
+        assert self.backend.get('q') == ['zero', 'one', 'two']
+        assert self.backend.length('q') == 3
+        assert self.backend.peek('q') == 'zero'
+        assert self.backend.is_empty('q') is False
+
+    def test_append_many(self):
+        self.backend.append('q', 'zero')
+        self.backend.append_many('q', ['one', 'two'])
+        self.backend.append_many('other', ['x'])
+        assert self.backend.get('q') == ['zero', 'one', 'two']
+        assert self.backend.get('other') == ['x']
+
+    def test_pop_many(self):
+        self.backend.set('q', ['zero', 'one', 'two', 'three', 'four'])
+        assert self.backend.pop_many('q', [1, 2]) == ['one', 'two']
+        assert self.backend.get('q') == ['zero', 'three', 'four']
+        assert self.backend.pop_many('q', [0, 2]) == ['zero', 'four']
+        assert self.backend.get('q') == ['three']
+
+    def test_pop_many_missing(self):
+        self.backend.set('q', ['zero', 'one'])
+        assert self.backend.pop_many('q', [0, 2]) is None
+        assert self.backend.get('q') == ['zero', 'one']
+        assert self.backend.pop_many('other', [0]) is None
+
+    def test_set(self):
+        self.backend.append('q', 'old')
+        self.backend.set('q', ['zero', 'one'])
+        assert self.backend.get('q') == ['zero', 'one']
+        self.backend.append('q', 'two')
+        assert self.backend.get('q') == ['zero', 'one', 'two']
+
+    def test_pop(self):
+        self.backend.set('q', ['zero', 'one', 'two', 'three'])
+        assert self.backend.pop('q') == 'zero'
+        assert self.backend.pop('q', 1) == 'two'
+        assert self.backend.pop('q', 5) is None
+        assert self.backend.get('q') == ['one', 'three']
+
+    def test_search_queue(self):
+        self.backend.set('q', ['Fix the build', 'deploy', 'build docs', 'rebuild'])
+        self.backend.set('other', ['build'])
+        assert self.backend.search(['build'], 'q') == [('q', 0, 'Fix the build'), ('q', 2, 'build docs')]
+        assert self.backend.search(['build', 'fix'], 'q') == [('q', 0, 'Fix the build')]
+        assert self.backend.search(['nothing'], 'q') == []
+        self.backend.pop('q')
+        assert self.backend.search(['build'], 'q') == [('q', 1, 'build docs')]
+
+    def test_range(self):
+        self.backend.set('q', ['zero', 'one', 'two', 'three'])
+        assert self.backend.range('q', 1, 2) == ['one', 'two']
+        assert self.backend.range('q', 3, 10) == ['three']
+        assert self.backend.range('q', 10, 10) == []
+
+
+class QueuesContract(object):
+    """queue metadata behaviour, for backends that can list queues"""
+
+    def test_queues(self):
+        self.backend.set_owner('b', 'bob', '#ops')
+        self.backend.append('b', 'first')
+        self.backend.append('b', 'second')
+        self.backend.set_owner('b', 'alice', '#dev')
+        self.backend.set('a', ['x'])
+        self.backend.set_owner('c', 'alice', '#dev')
+        assert self.backend.queues() == [
+            {'name': 'a', 'length': 1, 'head': 'x', 'owner': None, 'channel': None},
+            {'name': 'b', 'length': 2, 'head': 'first', 'owner': 'bob', 'channel': '#ops'},
+            {'name': 'c', 'length': 0, 'head': None, 'owner': 'alice', 'channel': '#dev'},
+        ]
+        assert [q['name'] for q in self.backend.queues(owner='alice')] == ['c']
+        assert [q['name'] for q in self.backend.queues(channel='#o')] == ['b']
+        assert self.backend.queues(owner='alice', channel='#o') == []
+
+    def test_search_all(self):
+        self.backend.set('b', ['zero', 'deploy the build'])
+        self.backend.append('a', 'build it')
+        self.backend.append_many('c', ['nope'])
+        assert self.backend.search(['build']) == [('a', 0, 'build it'), ('b', 1, 'deploy the build')]
+
+
+class VersionContract(object):
+    """optimistic concurrency control, for backends that keep versions"""
+
+    def test_get_versioned(self):
+        assert self.backend.get_versioned('q') == ([], None)
+        self.backend.append('q', 'zero')
+        q, v1 = self.backend.get_versioned('q')
+        assert q == ['zero']
+        self.backend.pop('q')
+        q, v2 = self.backend.get_versioned('q')
+        assert q == []
+        assert v2 != v1
+
+    def test_compare_and_set(self):
+        self.backend.append('q', 'zero')
+        q, version = self.backend.get_versioned('q')
+        assert self.backend.compare_and_set('q', ['one'], version) is True
+        assert self.backend.get('q') == ['one']
+        # the write above moved the version on
+        assert self.backend.compare_and_set('q', ['two'], version) is False
+        assert self.backend.get('q') == ['one']
+
+    def test_compare_and_set_new(self):
+        assert self.backend.compare_and_set('q', ['zero'], None) is True
+        assert self.backend.compare_and_set('q', ['one'], None) is False
+        assert self.backend.get('q') == ['zero']
+
+    @patch('helga_queue.backends.base.time')
+    def test_update_conflict(self, mock_time):
+        on_conflict = Mock()
+        self.backend.append('q', 'zero')
+
+        def fn(q):
+            if on_conflict.call_count == 0:
+                # someone else writes between our read and write
+                self.backend.append('q', 'one')
+            return q + ['two'], len(q)
+
+        assert self.backend.update('q', fn, on_conflict) == 2
+        assert self.backend.get('q') == ['zero', 'one', 'two']
+        assert on_conflict.call_count == 1
+        assert mock_time.sleep.call_count == 1
+
+
+class ClaimsContract(object):
+    """claim / ack / release with leases"""
+
+    def test_claim_ack(self):
+        self.backend.append_many('q', ['zero', 'one'])
+        cid, item = self.backend.claim('q', 'bob', 100)
+        assert item == 'zero'
+        assert self.backend.get('q') == ['one']
+        assert self.backend.claim('q', 'alice', 100)[1] == 'one'
+        assert self.backend.claim('q', 'alice', 100) is None
+        # only the claimer may ack
+        assert self.backend.ack('q', 'alice', cid) is None
+        assert self.backend.ack('q', 'bob', cid) == 'zero'
+        assert self.backend.ack('q', 'bob', cid) is None
+        assert self.backend.get('q') == []
+
+    def test_claim_ids(self):
+        self.backend.append_many('q', ['zero', 'one'])
+        first = self.backend.claim('q', 'bob', 100)[0]
+        self.backend.ack('q', 'bob', first)
+        assert self.backend.claim('q', 'bob', 100)[0] != first
+
+    def test_release(self):
+        self.backend.append_many('q', ['zero', 'one'])
+        cid = self.backend.claim('q', 'bob', 100)[0]
+        assert self.backend.release('q', 'alice', cid) is None
+        assert self.backend.release('q', 'bob', cid) == 'zero'
+        assert self.backend.get('q') == ['zero', 'one']
+        assert self.backend.ack('q', 'bob', cid) is None
+
+    def test_reap(self):
+        self.backend.append_many('q', ['zero', 'one', 'two', 'three'])
+        self.backend.append('r', 'other')
+        c0 = self.backend.claim('q', 'bob', 10)[0]
+        self.backend.claim('q', 'bob', 50)
+        self.backend.claim('q', 'alice', 20)
+        self.backend.claim('r', 'alice', 30)
+        assert self.backend.reap(5) == []
+        assert self.backend.reap(40) == ['q', 'r']
+        assert self.backend.get('q') == ['zero', 'two', 'three']
+        assert self.backend.get('r') == ['other']
+        assert self.backend.ack('q', 'bob', c0) is None
+        assert self.backend.reap(40) == []
+
+
+class ScheduleContract(object):
+    """scheduled items"""
+
+    def test_deliver_due(self):
+        self.backend.append('q', 'zero')
+        self.backend.schedule('q', 'later', 30)
+        self.backend.schedule('q', 'soon', 10, '#chan')
+        self.backend.schedule('r', 'other', 20)
+        assert self.backend.scheduled_times() == [10, 20, 30]
+        # not part of the queue until due
+        assert self.backend.get('q') == ['zero']
+        assert self.backend.length('r') == 0
+        assert self.backend.deliver_due(5) == []
+        assert self.backend.deliver_due(20) == [('q', 'soon', '#chan'), ('r', 'other', None)]
+        assert self.backend.get('q') == ['zero', 'soon']
+        assert self.backend.get('r') == ['other']
+        assert self.backend.scheduled_times() == [30]
+        assert self.backend.deliver_due(20) == []
+
+
+class ExpiryContract(object):
+    """item expiry and the expired item reaper"""
+
+    def fill(self):
+        past, future = time.time() - 100, time.time() + 1000
+        self.backend.append('q', 'zero')
+        self.backend.append('q', 'gone', past)
+        self.backend.append_many('q', ['one', 'two'], future)
+        self.backend.append_many('q', ['gone too'], past)
+        self.backend.append('q', 'three')
+
+    def test_reads_skip_expired(self):
+        self.fill()
+        assert self.backend.get('q') == ['zero', 'one', 'two', 'three']
+        assert self.backend.length('q') == 4
+        assert self.backend.range('q', 1, 2) == ['one', 'two']
+        assert self.backend.get_versioned('q')[0] == ['zero', 'one', 'two', 'three']
+        self.backend.append('r', 'gone', time.time() - 100)
+        assert self.backend.is_empty('r') is True
+        assert self.backend.peek('r') is None
+
+    def test_writes_skip_expired(self):
+        self.fill()
+        assert self.backend.pop('q', 1) == 'one'
+        assert self.backend.pop_many('q', [1, 2]) == ['two', 'three']
+        assert self.backend.pop_many('q', [1]) is None
+        assert self.backend.claim('q', 'bob', time.time() + 60) == (1, 'zero')
+        assert self.backend.claim('q', 'bob', time.time() + 60) is None
+
+    def test_update_keeps_expiry(self):
+        self.fill()
+        self.backend.update('q', lambda q: (list(reversed(q)), None))
+        assert self.backend.get('q') == ['three', 'two', 'one', 'zero']
+        assert self.backend.expire(time.time() + 2000, 10)[0] == ['q']
+        assert self.backend.get('q') == ['three', 'zero']
+
+    def test_expire(self):
+        self.fill()
+        self.backend.append('r', 'gone', time.time() - 50)
+        self.backend.append('s', 'later', time.time() + 1000)
+        names, more = self.backend.expire(time.time(), 100)
+        assert names == ['q', 'r']
+        assert more is False
+        assert self.backend.get('q') == ['zero', 'one', 'two', 'three']
+        assert self.backend.length('r') == 0
+        assert self.backend.expire(time.time(), 100) == ([], False)
+        assert self.backend.expire(time.time() + 2000, 100) == (['q', 's'], False)
+        assert self.backend.get('q') == ['zero', 'three']
+
+    def test_expire_batches(self):
+        for i in range(5):
+            self.backend.append('q{i}'.format(i=i), 'gone', time.time() - 100 + i)
+        names, more = self.backend.expire(time.time(), 2)
+        assert names == ['q0', 'q1']
+        assert more is True
+        assert self.backend.expire(time.time(), 2) == (['q2', 'q3'], True)
+        assert self.backend.expire(time.time(), 2) == (['q4'], False)
+
+    def test_ttls(self):
+        assert self.backend.ttls() == {}
+        self.backend.set_ttl('q', 60)
+        self.backend.set_ttl('r', 3600)
+        self.backend.set_ttl('r', 7200)
+        assert self.backend.ttls() == {'q': 60, 'r': 7200}
+        # printed by 'queue ttl', so '60 seconds' everywhere, never '60.0'
+        assert [type(ttl) for ttl in self.backend.ttls().values()] == [int, int]
+        self.backend.set_ttl('q', None)
+        assert self.backend.ttls() == {'r': 7200}
+
+
+class PriorityContract(object):
+    """priorities"""
+
+    def fill_priorities(self):
+        self.backend.append('q', 'zero')
+        self.backend.append('q', 'urgent', priority=5)
+        self.backend.append_many('q', ['high', 'high too'], priority=2)
+        self.backend.append('q', 'one')
+        self.backend.append('q', 'urgent too', priority=5)
+
+    def test_order(self):
+        self.fill_priorities()
+        expected = ['urgent', 'urgent too', 'high', 'high too', 'zero', 'one']
+        assert self.backend.get('q') == expected
+        assert self.backend.range('q', 1, 3) == expected[1:4]
+        assert self.backend.peek('q') == 'urgent'
+        assert self.backend.queues()[0]['head'] == 'urgent'
+        assert self.backend.search(['high']) == [('q', 2, 'high'), ('q', 3, 'high too')]
+
+    def test_pop_order(self):
+        self.fill_priorities()
+        assert self.backend.pop('q') == 'urgent'
+        assert self.backend.pop('q', 2) == 'high too'
+        assert self.backend.pop_many('q', [0, 2]) == ['urgent too', 'zero']
+        assert self.backend.get('q') == ['high', 'one']
+
+    def test_release_to_head(self):
+        self.fill_priorities()
+        cid = self.backend.claim('q', 'bob', time.time() + 60)[0]
+        self.backend.append('q', 'urgent three', priority=5)
+        assert self.backend.release('q', 'bob', cid) == 'urgent'
+        assert self.backend.get('q')[:3] == ['urgent', 'urgent too', 'urgent three']
+
+    def test_update_keeps_priority(self):
+        self.fill_priorities()
+        self.backend.update('q', lambda q: ([i for i in q if i != 'zero'] + ['new'], None))
+        self.backend.append('q', 'high three', priority=2)
+        assert self.backend.get('q') == ['urgent', 'urgent too', 'high', 'high too', 'high three', 'one', 'new']
+
+    def test_expiring_priority(self):
+        self.backend.append('q', 'zero')
+        self.backend.append('q', 'gone', time.time() - 100, 3)
+        self.backend.append('q', 'high', time.time() + 1000, 3)
+        assert self.backend.get('q') == ['high', 'zero']
+        assert self.backend.pop('q') == 'high'
+
+
+class HistoryContract(object):
+    """history and undo"""
+
+    def test_history(self):
+        self.backend = self.make(history_size=3)
+        self.backend.append('q', 'zero')
+        self.backend.append_many('q', ['one', 'two', 'three'])
+        assert self.backend.pop('q', 1) == 'one'
+        assert self.backend.pop_many('q', [0, 2]) == ['zero', 'three']
+        self.backend.append('r', 'other')
+        changes = self.backend.history('q', 10)
+        # capped at the last 3
+        assert [(c['op'], c['items'], c.get('idxs')) for c in changes] == [
+            ('append', ['one', 'two', 'three'], None),
+            ('pop', ['one'], [1]),
+            ('pop', ['zero', 'three'], [0, 2]),
+        ]
+        assert all(abs(c['at'] - time.time()) < 60 for c in changes)
+        assert self.backend.history('q', 1) == changes[2:]
+        assert self.backend.history('nothing', 10) == []
+
+    def test_undo(self):
+        self.backend = self.make(history_size=10)
+        self.backend.append('q', 'zero')
+        self.backend.append_many('q', ['one', 'two', 'three'])
+        self.backend.pop('q', 1)
+        self.backend.pop_many('q', [0, 2])
+        assert self.backend.get('q') == ['two']
+        assert self.backend.undo('q')['items'] == ['zero', 'three']
+        assert self.backend.get('q') == ['zero', 'two', 'three']
+        assert self.backend.undo('q')['op'] == 'pop'
+        assert self.backend.get('q') == ['zero', 'one', 'two', 'three']
+        assert self.backend.undo('q')['op'] == 'append'
+        assert self.backend.get('q') == ['zero']
+        assert len(self.backend.history('q', 10)) == 1
+        self.backend.undo('q')
+        assert self.backend.get('q') == []
+        assert self.backend.undo('q') is None
+
+    def test_undo_append_removes_last(self):
+        self.backend = self.make(history_size=10)
+        self.backend.append('q', 'x')
+        self.backend.append('q', 'y')
+        self.backend.append('q', 'x')
+        self.backend.undo('q')
+        assert self.backend.get('q') == ['x', 'y']
+
+    def test_undo_pop_keeps_attributes(self):
+        self.backend = self.make(history_size=10)
+        self.backend.append('q', 'zero')
+        self.backend.append('q', 'urgent', time.time() + 1000, 2)
+        assert self.backend.pop('q') == 'urgent'
+        self.backend.undo('q')
+        self.backend.append('q', 'urgent too', priority=2)
+        assert self.backend.get('q') == ['urgent', 'urgent too', 'zero']
+        self.backend.expire(time.time() + 2000, 10)
+        assert self.backend.get('q') == ['urgent too', 'zero']
+
+    def test_no_history(self):
+        self.backend.append('q', 'zero')
+        assert self.backend.history('q', 10) == []
+        assert self.backend.undo('q') is None
+        assert self.backend.get('q') == ['zero']
+
+
+class MoveContract(object):
+    """moving items between queues"""
+
+    def test_move(self):
+        self.backend.append_many('q', ['zero', 'one', 'two', 'three'])
+        self.backend.append('t', 'there')
+        assert self.backend.move('q', 't', [1]) == ['one']
+        assert self.backend.move('q', 't', [0, 2]) == ['zero', 'three']
+        assert self.backend.get('q') == ['two']
+        assert self.backend.get('t') == ['there', 'one', 'zero', 'three']
+
+    def test_move_missing(self):
+        self.backend.append_many('q', ['zero', 'one'])
+        assert self.backend.move('q', 't', [1, 2]) is None
+        assert self.backend.move('nothing', 't', [0]) is None
+        assert self.backend.get('q') == ['zero', 'one']
+        assert self.backend.get('t') == []
+
+    def test_move_all(self):
+        self.backend.append_many('q', ['zero', 'one'])
+        assert self.backend.move('q', 't') == ['zero', 'one']
+        assert self.backend.get('q') == []
+        assert self.backend.get('t') == ['zero', 'one']
+        assert self.backend.move('q', 't') == []
+        assert self.backend.get('t') == ['zero', 'one']
+
+    def test_move_keeps_attributes(self):
+        self.backend.append('q', 'zero')
+        self.backend.append('q', 'soon', time.time() + 1000)
+        self.backend.append('q', 'urgent', priority=2)
+        self.backend.append('t', 'there')
+        assert self.backend.move('q', 't') == ['urgent', 'zero', 'soon']
+        assert self.backend.get('t') == ['urgent', 'there', 'zero', 'soon']
+        self.backend.expire(time.time() + 2000, 10)
+        assert self.backend.get('t') == ['urgent', 'there', 'zero']
+
+    def test_move_skips_expired(self):
+        self.backend.append('q', 'gone', time.time() - 1)
+        self.backend.append('q', 'zero')
+        assert self.backend.move('q', 't', [0]) == ['zero']
+        assert self.backend.get('t') == ['zero']
+
+
+class StampContract(object):
+    """stamps change with every change to what a queue shows"""
+
+    def test_stamp(self):
+        assert self.backend.stamp('q') == (0, 0)
+        stamps = []
+        self.backend.append('q', 'zero')
+        stamps.append(self.backend.stamp('q'))
+        self.backend.append_many('q', ['one', 'two'])
+        stamps.append(self.backend.stamp('q'))
+        self.backend.pop('q', 1)
+        stamps.append(self.backend.stamp('q'))
+        self.backend.set('q', ['two', 'zero'])
+        stamps.append(self.backend.stamp('q'))
+        self.backend.move('q', 'r', [0])
+        stamps.append(self.backend.stamp('q'))
+        assert len(set(stamps)) == len(stamps)
+        assert stamps[-1][1] == 1
+        assert self.backend.stamp('q') == stamps[-1]
+
+    def test_stamp_expiry(self):
+        self.backend.append('q', 'zero')
+        self.backend.append('q', 'soon', time.time() + 100)
+        before = self.backend.stamp('q')
+        with patch('time.time', return_value=time.time() + 200):
+            after = self.backend.stamp('q')
+        assert after[1] == before[1] - 1
+
+
+class ExportContract(object):
+    """streaming export"""
+
+    def test_export(self):
+        self.backend.append_many('q', ['zero', 'one', 'two'])
+        self.backend.append('q', 'urgent', priority=2)
+        self.backend.append('q', 'gone', time.time() - 1)
+        self.backend.append('a', 'soon', 5000000000.0)
+        # batches smaller than the queues
+        assert list(self.backend.export(batch_size=2)) == [
+            ('a', 'soon', 5000000000.0, 0),
+            ('q', 'urgent', None, 2),
+            ('q', 'zero', None, 0),
+            ('q', 'one', None, 0),
+            ('q', 'two', None, 0),
+        ]
+        assert list(self.backend.export('a')) == [('a', 'soon', 5000000000.0, 0)]
+        assert list(self.backend.export('nothing')) == []
+
+    def test_export_empty(self):
+        assert list(self.backend.export()) == []
+
+
+class TestBaseBackend(BackendContract):
+
+    def make(self):
+        return DictBackend()
+
+    def test_abstract(self):
+        b = Backend()
+        with pytest.raises(NotImplementedError):
+            b.get('q')
+        with pytest.raises(NotImplementedError):
+            b.set('q', [])
+        with pytest.raises(NotImplementedError):
+            b.queues()
+        with pytest.raises(NotImplementedError):
+            b.search(['foo'])
+        with pytest.raises(NotImplementedError):
+            b.claim('q', 'nick', 100)
+        with pytest.raises(NotImplementedError):
+            b.ack('q', 'nick', 1)
+        with pytest.raises(NotImplementedError):
+            b.release('q', 'nick', 1)
+        with pytest.raises(NotImplementedError):
+            b.reap(100)
+        with pytest.raises(NotImplementedError):
+            b.schedule('q', 'item', 100)
+        with pytest.raises(NotImplementedError):
+            b.scheduled_times()
+        with pytest.raises(NotImplementedError):
+            b.deliver_due(100)
+        with pytest.raises(NotImplementedError):
+            b.set_ttl('q', 60)
+        with pytest.raises(NotImplementedError):
+            b.expire(100, 10)
+        with pytest.raises(NotImplementedError):
+            b.history('q', 10)
+        with pytest.raises(NotImplementedError):
+            b.undo('q')
+        with pytest.raises(NotImplementedError):
+            list(b.export())
+        assert b.ttls() == {}
+        b.set_owner('q', 'nick', '#chan')
+
+    def test_stamp(self):
+        self.backend.set('q', ['zero'])
+        assert self.backend.stamp('q') is None
+
+    def test_export(self):
+        self.backend.set('q', ['zero', 'one', 'two', 'three'])
+        assert list(self.backend.export('q', batch_size=2)) == [
+            ('q', 'zero', None, 0), ('q', 'one', None, 0), ('q', 'two', None, 0), ('q', 'three', None, 0)
+        ]
+
+    def test_append_expires(self):
+        with pytest.raises(NotImplementedError):
+            self.backend.append('q', 'zero', 100)
+        with pytest.raises(NotImplementedError):
+            self.backend.append_many('q', ['zero'], 100)
+
+    def test_append_priority(self):
+        with pytest.raises(NotImplementedError):
+            self.backend.append('q', 'zero', priority=1)
+        with pytest.raises(NotImplementedError):
+            self.backend.append_many('q', ['zero'], priority=1)
+        assert self.backend.get('q') == []
+
+    def test_carry_over(self):
+        old = [('a', (None, 0)), ('b', (10, 1)), ('a', (20, 0)), ('c', (30, 2))]
+        assert carry_over(old, ['a', 'a', 'a', 'b', 'd'], (None, 0)) == [
+            ('a', (None, 0)), ('a', (20, 0)), ('a', (None, 0)), ('b', (10, 1)), ('d', (None, 0))
+        ]
+
+    def test_update_unchanged(self):
+        self.backend.set('q', ['zero'])
+        self.backend.compare_and_set = Mock()
+        assert self.backend.update('q', lambda q: (None, len(q))) == 1
+        assert self.backend.compare_and_set.call_count == 0
+
+    @patch('helga_queue.backends.base.time')
+    def test_update_gives_up(self, mock_time):
+        self.backend.compare_and_set = Mock(return_value=False)
+        on_conflict = Mock()
+        with pytest.raises(ConflictError):
+            self.backend.update('q', lambda q: (q + ['zero'], None), on_conflict)
+        assert on_conflict.call_count == CAS_RETRIES
+        delays = [c[0][0] for c in mock_time.sleep.call_args_list]
+        assert len(delays) == CAS_RETRIES
+        assert all(0 <= d <= 0.2 for d in delays)
+
+
+class TestMemoryBackend(BackendContract, QueuesContract, VersionContract, ClaimsContract, ScheduleContract,
+                        ExpiryContract, PriorityContract, HistoryContract, MoveContract, ExportContract,
+                        StampContract):
+
+    def make(self, history_size=0):
+        return MemoryBackend(history_size=history_size)
+
+    def test_get_is_copy(self):
+        self.backend.append('q', 'zero')
+        self.backend.get('q').append('one')
+        assert self.backend.get('q') == ['zero']
+
+
+class TestSQLiteBackend(BackendContract, QueuesContract, VersionContract, ClaimsContract, ScheduleContract,
+                        ExpiryContract, PriorityContract, HistoryContract, MoveContract, ExportContract,
+                        StampContract):
+
+    def make(self, history_size=0):
+        return SQLiteBackend(':memory:', history_size=history_size)
+
+    def test_file(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'q.sqlite')
+        b = SQLiteBackend(path)
+        b.append('q', 'zero')
+        b.close()
+        b = SQLiteBackend(path)
+        assert b.get('q') == ['zero']
+        assert b._conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        b.close()
+
+    def test_search_existing_database(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'q.sqlite')
+        conn = sqlite3.connect(path)
+        conn.execute(SCHEMA)
+        conn.execute("INSERT INTO queue_items (queue, seq, item) VALUES ('q', 1, 'old item')")
+        conn.commit()
+        conn.close()
+        b = SQLiteBackend(path)
+        assert b.search(['old']) == [('q', 0, 'old item')]
+        b.close()
+
+    def test_expiry_existing_database(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'q.sqlite')
+        conn = sqlite3.connect(path)
+        conn.execute(
+            'CREATE TABLE queue_items (queue TEXT NOT NULL, seq INTEGER NOT NULL, item TEXT NOT NULL, '
+            'PRIMARY KEY (queue, seq))'
+        )
+        conn.execute('CREATE TABLE queue_meta (queue TEXT NOT NULL PRIMARY KEY, owner TEXT, channel TEXT)')
+        conn.execute("INSERT INTO queue_items (queue, seq, item) VALUES ('q', 1, 'old item')")
+        conn.commit()
+        conn.close()
+        b = SQLiteBackend(path)
+        b.append('q', 'gone', time.time() - 100)
+        b.append('q', 'urgent', priority=1)
+        b.set_ttl('q', 60)
+        assert b.get('q') == ['urgent', 'old item']
+        assert b.ttls() == {'q': 60}
+        assert b.expire(time.time(), 10) == (['q'], False)
+        b.close()
+
+    def test_expire_uses_index(self):
+        plan = self.backend._conn.execute('EXPLAIN QUERY PLAN ' + SQL_EXPIRED_ITEMS, (100, 10)).fetchall()
+        assert 'queue_items_expires' in ' '.join(str(row[-1]) for row in plan)
+
+    def test_history_persists(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'q.sqlite')
+        b = SQLiteBackend(path, history_size=5)
+        b.append_many('q', ['zero', 'one'])
+        b.pop('q')
+        b.close()
+        b = SQLiteBackend(path, history_size=5)
+        assert [c['op'] for c in b.history('q', 10)] == ['append', 'pop']
+        b.undo('q')
+        assert b.get('q') == ['zero', 'one']
+        b.close()
+
+    def test_order_uses_index(self):
+        plan = self.backend._conn.execute('EXPLAIN QUERY PLAN ' + SQL_RANGE, ('q', 100, 10, 0)).fetchall()
+        plan = ' '.join(str(row[-1]) for row in plan)
+        assert 'queue_items_order' in plan
+        assert 'TEMP B-TREE' not in plan
+
+    def test_pop_rollback(self):
+        self.backend.set('q', ['zero'])
+        with patch('helga_queue.backends.sqlite.SQL_DELETE', 'not valid sql'):
+            with pytest.raises(Exception):
+                self.backend.pop('q')
+        assert self.backend.get('q') == ['zero']
+
+
+class TestMakeBackend:
+
+    def test_memory(self):
+        assert isinstance(make_backend('memory'), MemoryBackend)
+
+    def test_history_size(self):
+        assert make_backend('memory', history_size=5).history_size == 5
+        assert make_backend('sqlite', sqlite_path=':memory:', history_size=5).history_size == 5
+        assert make_backend('mongo', db=Mock(), history_size=5).history_size == 5
+
+    def test_sqlite(self):
+        b = make_backend('sqlite', sqlite_path=':memory:')
+        assert isinstance(b, SQLiteBackend)
+        assert b.path == ':memory:'
+
+    def test_mongo(self):
+        db = Mock()
+        b = make_backend('mongo', db=db)
+        assert isinstance(b, MongoBackend)
+        assert b.db == db
+
+    def test_mongo_segmented(self):
+        b = make_backend('mongo-segmented', db=Mock(), segment_size=10)
+        assert isinstance(b, SegmentedMongoBackend)
+        assert b.segment_size == 10
+
+    def test_mongo_no_db(self):
+        assert make_backend('mongo', db=None) is None
+        assert make_backend('mongo-segmented', db=None) is None
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            make_backend('foo')
@@ -0,0 +1,30 @@
+import json
+import os
+import tempfile
+
+from helga_queue.backends import MemoryBackend
+from helga_queue.benchmark import run, main, OPERATIONS
+
+
+class TestBenchmark:
+
+    def test_run(self):
+        backend = MemoryBackend()
+        results = run(backend, sizes=[5, 20], iterations=3)
+        assert [(r['op'], r['size']) for r in results] == \
+            [(op, 5) for op in OPERATIONS] + [(op, 20) for op in OPERATIONS]
+        for r in results:
+            assert r['iterations'] == 3
+            assert r['p50_ms'] <= r['max_ms']
+        # mutating operations leave the queue at its original size
+        assert backend.length('bench5') == 5
+        assert backend.length('bench20') == 20
+
+    def test_main(self):
+        path = os.path.join(tempfile.mkdtemp(), 'out.json')
+        main(['-s', '3', '-n', '2', '-o', 'len,next', '--output', path])
+        with open(path) as fh:
+            doc = json.load(fh)
+        assert doc['backend'] == 'memory'
+        assert doc['iterations'] == 2
+        assert [r['op'] for r in doc['results']] == ['len', 'next']
@@ -0,0 +1,242 @@
+from mock import patch
+from helga_queue.cache import QueueCache, RenderCache
+
+
+class TestQueueCache:
+
+    def test_get_miss(self):
+        c = QueueCache()
+        assert c.get('foo') is None
+        assert c.misses == 1
+        assert c.hits == 0
+
+    def test_set_get(self):
+        c = QueueCache()
+        c.set('foo', ['a', 'bb'])
+        assert c.get('foo') == ['a', 'bb']
+        assert c.hits == 1
+        assert c.size_bytes == 3
+
+    def test_get_returns_copy(self):
+        c = QueueCache()
+        c.set('foo', ['a'])
+        c.get('foo').append('b')
+        assert c.get('foo') == ['a']
+
+    def test_disabled(self):
+        c = QueueCache(max_entries=0)
+        c.set('foo', ['a'])
+        assert c.get('foo') is None
+        assert len(c) == 0
+
+    def test_lru_eviction_entries(self):
+        c = QueueCache(max_entries=2)
+        c.set('a', ['1'])
+        c.set('b', ['2'])
+        c.get('a')
+        c.set('c', ['3'])
+        assert 'a' in c
+        assert 'b' not in c
+        assert 'c' in c
+        assert c.evictions == 1
+
+    def test_lru_eviction_bytes(self):
+        c = QueueCache(max_bytes=10)
+        c.set('a', ['12345'])
+        c.set('b', ['1234'])
+        c.set('c', ['123'])
+        assert 'a' not in c
+        assert c.size_bytes == 7
+
+    def test_too_big(self):
+        c = QueueCache(max_bytes=4)
+        c.set('a', ['1'])
+        c.set('b', ['12345'])
+        assert 'a' in c
+        assert 'b' not in c
+
+    def test_ttl(self):
+        c = QueueCache(ttl=10)
+        with patch('helga_queue.cache.time.time') as mock_time:
+            mock_time.return_value = 100
+            c.set('foo', ['a'])
+            mock_time.return_value = 105
+            assert c.get('foo') == ['a']
+            mock_time.return_value = 111
+            assert c.get('foo') is None
+        assert 'foo' not in c
+        assert c.size_bytes == 0
+
+    def test_append(self):
+        c = QueueCache()
+        c.append('foo', 'x')
+        assert 'foo' not in c
+        c.set('foo', ['a'])
+        c.append('foo', 'bb')
+        assert c.get('foo') == ['a', 'bb']
+        assert c.size_bytes == 3
+
+    def test_pop(self):
+        c = QueueCache()
+        c.set('foo', ['a', 'b', 'c'])
+        c.pop('foo', 1, 'b')
+        assert c.get('foo') == ['a', 'c']
+        assert c.size_bytes == 2
+        c.pop('bar', 0, 'x')
+        assert 'bar' not in c
+
+    def test_append_evicts(self):
+        c = QueueCache(max_bytes=3)
+        c.set('a', ['12'])
+        c.set('b', ['1'])
+        c.append('b', '2')
+        assert 'a' not in c
+        assert c.get('b') == ['1', '2']
+
+    def test_length_slice(self):
+        c = QueueCache()
+        assert c.length('foo') is None
+        assert c.slice('foo', 0, 1) is None
+        c.set('foo', ['a', 'b', 'c'])
+        assert c.length('foo') == 3
+        assert c.slice('foo', 1, 5) == ['b', 'c']
+        assert c.hits == 2
+        assert c.misses == 2
+
+    def test_pop_mismatch(self):
+        c = QueueCache()
+        c.set('foo', ['a', 'b'])
+        c.pop('foo', 0, 'z')
+        assert 'foo' not in c
+        c.set('foo', ['a'])
+        c.pop('foo', 5, 'z')
+        assert 'foo' not in c
+
+    def test_invalidate_clear_stats(self):
+        c = QueueCache()
+        c.set('foo', ['a'])
+        c.set('bar', ['b'])
+        c.get('foo')
+        c.invalidate('foo')
+        assert c.stats() == {'entries': 1, 'bytes': 1, 'hits': 1, 'misses': 0, 'evictions': 0}
+        c.clear()
+        assert c.stats() == {'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def test_exclude(self):
+        c = QueueCache()
+        c.set('foo', ['a'])
+        c.exclude('foo')
+        assert 'foo' not in c
+        assert c.size_bytes == 0
+        c.set('foo', ['a'])
+        c.append('foo', 'b')
+        assert c.get('foo') is None
+        c.clear()
+        c.set('foo', ['a'])
+        assert c.get('foo') == ['a']
+
+    def test_generation(self):
+        c = QueueCache()
+        gen = c.generation('foo')
+        c.set('foo', ['a'], gen)
+        assert c.get('foo') == ['a']
+        for change in [
+            lambda: c.append('foo', 'b'),
+            lambda: c.pop('foo', 0, 'a'),
+            lambda: c.invalidate('foo'),
+            lambda: c.set('foo', ['x']),
+            lambda: c.clear(),
+        ]:
+            gen = c.generation('foo')
+            change()
+            assert c.generation('foo') != gen
+
+    def test_stamp(self):
+        c = QueueCache()
+        assert c.stamp('foo') is None
+        c.set('foo', ['a'])
+        stamp = c.stamp('foo')
+        assert stamp[-1] == 1
+        assert c.stamp('foo') == stamp
+        c.append('foo', 'b')
+        assert c.stamp('foo') != stamp
+        assert c.stamp('foo')[-1] == 2
+        c.invalidate('foo')
+        assert c.stamp('foo') is None
+
+    def test_set_stale_generation(self):
+        c = QueueCache()
+        # a reader misses and reads ['a'] from the database...
+        gen = c.generation('foo')
+        # ...while a writer appends 'b' to the uncached queue
+        c.append('foo', 'b')
+        c.set('foo', ['a'], gen)
+        assert 'foo' not in c
+        # a write-through that raced with another one is dropped
+        c.set('foo', ['a', 'b'])
+        gen = c.generation('foo')
+        c.set('foo', ['a', 'b', 'c'])
+        c.set('foo', ['a', 'b', 'd'], gen)
+        assert 'foo' not in c
+        # a stale read from before clear() is never cached
+        gen = c.generation('bar')
+        c.clear()
+        c.set('bar', ['a'], gen)
+        assert 'bar' not in c
+
+
+class TestRenderCache:
+
+    def test_get_set(self):
+        c = RenderCache()
+        assert c.get('q', 'show', (1, 2)) is None
+        c.set('q', 'show', (1, 2), 'rendered')
+        assert c.get('q', 'show', (1, 2)) == 'rendered'
+        assert c.get('q', 'list', (1, 2)) is None
+        assert c.get('other', 'show', (1, 2)) is None
+        assert c.stats() == {'entries': 1, 'hits': 1, 'misses': 3, 'evictions': 0}
+
+    def test_new_stamp(self):
+        c = RenderCache()
+        c.set('q', 'show', (1, 2), 'old')
+        assert c.get('q', 'show', (2, 3)) is None
+        # only the latest stamp is kept
+        c.set('q', 'show', (2, 3), 'new')
+        assert len(c) == 1
+        assert c.get('q', 'show', (2, 3)) == 'new'
+        assert c.get('q', 'show', (1, 2)) is None
+
+    def test_lru_eviction(self):
+        c = RenderCache(max_entries=2)
+        c.set('a', 'show', (1, 1), 'a')
+        c.set('b', 'show', (1, 1), 'b')
+        c.get('a', 'show', (1, 1))
+        c.set('c', 'show', (1, 1), 'c')
+        assert c.get('a', 'show', (1, 1)) == 'a'
+        assert c.get('b', 'show', (1, 1)) is None
+        assert c.get('c', 'show', (1, 1)) == 'c'
+        assert c.evictions == 1
+
+    def test_disabled(self):
+        c = RenderCache(max_entries=0)
+        c.set('q', 'show', (1, 1), 'x')
+        assert c.get('q', 'show', (1, 1)) is None
+        assert len(c) == 0
+
+    @patch('helga_queue.cache.time')
+    def test_ttl(self, mock_time):
+        mock_time.time.return_value = 100
+        c = RenderCache(ttl=10)
+        c.set('q', 'show', (1, 1), 'x')
+        mock_time.time.return_value = 105
+        assert c.get('q', 'show', (1, 1)) == 'x'
+        mock_time.time.return_value = 111
+        assert c.get('q', 'show', (1, 1)) is None
+
+    def test_clear(self):
+        c = RenderCache()
+        c.set('q', 'show', (1, 1), 'x')
+        c.get('q', 'show', (1, 1))
+        c.clear()
+        assert len(c) == 0
+        assert c.stats() == {'entries': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
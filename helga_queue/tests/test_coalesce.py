@@ -0,0 +1,94 @@
+from mock import call, Mock
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from helga_queue.coalesce import WriteCoalescer
+
+
+class TestWriteCoalescer:
+
+    def setup_method(self, method):
+        self.clock = Clock()
+        self.flush = Mock(side_effect=lambda batch: dict((name, 'ok ' + name) for name, _ in batch))
+        self.c = WriteCoalescer(self.flush, window=0.5, max_ops=4, clock=self.clock)
+        self.results = []
+
+    def _append(self, name, item):
+        d = self.c.append(name, item)
+        d.addBoth(self.results.append)
+        return d
+
+    def test_window(self):
+        self._append('q1', 'a')
+        self._append('q2', 'b')
+        self._append('q1', 'c')
+        assert len(self.c) == 3
+        assert self.c.pending('q1') is True
+        assert self.c.pending('q3') is False
+        assert self.flush.mock_calls == []
+        self.clock.advance(0.5)
+        assert self.flush.mock_calls == [call([('q1', ['a', 'c']), ('q2', ['b'])])]
+        assert self.results == ['ok q1', 'ok q1', 'ok q2']
+        assert len(self.c) == 0
+        assert self.c.pending('q1') is False
+        assert self.clock.getDelayedCalls() == []
+
+    def test_max_ops(self):
+        for item in ['a', 'b', 'c', 'd']:
+            self._append('q1', item)
+        assert self.flush.mock_calls == [call([('q1', ['a', 'b', 'c', 'd'])])]
+        assert self.results == ['ok q1'] * 4
+        assert self.clock.getDelayedCalls() == []
+
+    def test_one_flush_in_flight(self):
+        pending = []
+
+        def flush(batch):
+            d = defer.Deferred()
+            pending.append((batch, d))
+            return d
+
+        self.c._flush = flush
+        self._append('q1', 'a')
+        self.clock.advance(0.5)
+        assert [b for b, _ in pending] == [[('q1', ['a'])]]
+        assert self.c.pending('q1') is True
+        self._append('q1', 'b')
+        self.clock.advance(0.5)
+        # second batch waits for the first to be written
+        assert len(pending) == 1
+        pending[0][1].callback({'q1': 'first'})
+        assert self.results == ['first']
+        assert [b for b, _ in pending] == [[('q1', ['a'])], [('q1', ['b'])]]
+        pending[1][1].callback({'q1': 'second'})
+        assert self.results == ['first', 'second']
+
+    def test_flush_failure(self):
+        self.flush.side_effect = RuntimeError('boom')
+        self._append('q1', 'a')
+        self._append('q2', 'b')
+        self.c.flush()
+        assert len(self.results) == 2
+        for res in self.results:
+            assert res.check(RuntimeError)
+
+    def test_flush(self):
+        done = []
+        self.c.flush().addCallback(done.append)
+        assert done == [None]
+        self._append('q1', 'a')
+        self.c.flush().addCallback(done.append)
+        assert self.flush.mock_calls == [call([('q1', ['a'])])]
+        assert done == [None, None]
+        assert self.results == ['ok q1']
+        assert self.clock.getDelayedCalls() == []
+
+    def test_flush_waits_for_in_flight(self):
+        pending = []
+        self.c._flush = lambda batch: pending.append(defer.Deferred()) or pending[-1]
+        done = []
+        self._append('q1', 'a')
+        self.c.flush()
+        self.c.flush().addCallback(done.append)
+        assert done == []
+        pending[0].callback({'q1': 'ok'})
+        assert done == [None]
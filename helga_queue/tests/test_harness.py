@@ -0,0 +1,76 @@
+from mock import Mock
+from twisted.internet.task import Clock
+
+import helga_queue.plugin
+from helga_queue.backends import MemoryBackend
+from helga_queue.harness import RecordingClient, concurrent_plugin, local_plugin
+
+
+class TestRecordingClient:
+
+    def test_keep(self):
+        c = RecordingClient()
+        c.msg('chan', 'foo')
+        c.me('chan', 'bar')
+        assert c.msgs == [('chan', 'foo')]
+        assert c.mes == [('chan', 'bar')]
+        assert c.msg_count == 1
+        assert c.me_count == 1
+
+    def test_no_keep(self):
+        c = RecordingClient(keep=False)
+        c.msg('chan', 'foo')
+        assert c.msgs == []
+        assert c.msg_count == 1
+
+
+class TestLocalPlugin:
+
+    def test_end_to_end(self):
+        backend = MemoryBackend()
+        client = RecordingClient()
+        orig_backend = helga_queue.plugin._backend
+        orig_pool_size = helga_queue.plugin._pool.size
+        with local_plugin(backend) as harness:
+            assert harness.queue(client, '#chan', 'nick', ['append', 'foo', 'bar']) == "queue 'nick' updated"
+            assert harness.queue(client, '#chan', 'nick', ['len']) == '1 items in queue nick'
+            assert harness.queue(client, '#chan', 'nick', ['list']) is None
+            harness.flush()
+        assert backend.get('nick') == ['foo bar']
+        assert client.mes == [('#chan', 'whispers to nick all 1 items in queue')]
+        assert client.msgs == [('nick', 'Contents of queue "nick":'), ('nick', '0. foo bar')]
+        assert helga_queue.plugin._backend is orig_backend
+        assert helga_queue.plugin._pool.size == orig_pool_size
+
+
+class TestConcurrentPlugin:
+
+    def test_end_to_end(self):
+        backend = MemoryBackend()
+        client = RecordingClient()
+        clock = Clock()
+        orig_pool = helga_queue.plugin._pool
+        orig_respond = helga_queue.plugin._respond
+        res = []
+        with concurrent_plugin(backend, pool_size=0, coalesce_window=0.1, clock=clock) as harness:
+            harness.queue(client, '#chan', 'nick', ['append', 'foo']).addCallback(res.append)
+            assert res == []
+            clock.advance(0.1)
+            harness.queue(client, '#chan', 'nick', ['len']).addCallback(res.append)
+        assert res == ["queue 'nick' updated", '1 items in queue nick']
+        assert client.msgs == [('#chan', "queue 'nick' updated"), ('#chan', '1 items in queue nick')]
+        assert helga_queue.plugin._pool is orig_pool
+        assert helga_queue.plugin._respond is orig_respond
+        assert helga_queue.plugin._coalescer is None
+
+    def test_failure(self):
+        backend = Mock()
+        backend.length.side_effect = Exception('boom')
+        client = RecordingClient()
+        res = []
+        with concurrent_plugin(backend, pool_size=0, coalesce_window=0.1, clock=Clock()) as harness:
+            # buffered appends to the queue make the len go through a Deferred
+            harness.queue(client, '#chan', 'nick', ['append', 'foo'])
+            harness.queue(client, '#chan', 'nick', ['len']).addErrback(res.append)
+        assert len(res) == 1
+        assert client.msgs[-1] == ('#chan', 'ERROR - queue len failed')
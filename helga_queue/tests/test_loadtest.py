@@ -0,0 +1,100 @@
+import pytest
+from twisted.internet.task import Clock
+
+from helga_queue.backends import MemoryBackend
+from helga_queue.loadtest import StallMonitor, parse_mix, parse_args, run, OPERATIONS
+
+
+def _wait(clock, d):
+    res = []
+    d.addBoth(res.append)
+    while len(res) == 0:
+        clock.advance(0.01)
+    return res[0]
+
+
+class TestParseMix:
+
+    def test_parse(self):
+        assert parse_mix('append=3, pop=1') == [('append', 3), ('pop', 1)]
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            parse_mix('append=3,frob=1')
+        with pytest.raises(ValueError):
+            parse_mix('append=0')
+        with pytest.raises(ValueError):
+            parse_mix('append')
+
+
+class TestStallMonitor:
+
+    def test_summary(self):
+        clock = Clock()
+        monitor = StallMonitor(interval=0.01, clock=clock)
+        monitor.start()
+        clock.advance(0.01)
+        # the reactor was blocked
+        clock.advance(0.05)
+        monitor.stop()
+        summary = monitor.summary()
+        assert summary['checks'] == 2
+        assert 39 < summary['blocked_ms'] < 41
+        assert 39 < summary['max_stall_ms'] < 41
+
+
+class TestRun:
+
+    def test_run(self):
+        backend = MemoryBackend()
+        clock = Clock()
+        res = _wait(clock, run(
+            backend, requests=200, users=20, channels=5, concurrency=10, hot_queues=2, cold_queues=3,
+            initial_size=3, pool_size=0, seed=1, clock=clock
+        ))
+        assert res['requests'] == 200
+        assert res['errors'] == 0
+        assert sum(res['ops'][op]['count'] for op in res['ops']) == 200
+        assert set(res['ops']) <= set(OPERATIONS)
+        assert res['latency']['p50_ms'] <= res['latency']['max_ms']
+        assert res['acked_appends'] == res['ops']['append']['count']
+        assert res['lost_updates'] == 0
+        assert res['duplicated_items'] == 0
+        assert [q['name'] for q in backend.queues()] == ['cold0', 'cold1', 'cold2', 'hot0', 'hot1']
+
+    def test_coalesced(self):
+        backend = MemoryBackend()
+        clock = Clock()
+        res = _wait(clock, run(
+            backend, requests=50, concurrency=10, mix=parse_mix('append=1'), hot_queues=1, cold_queues=0,
+            initial_size=0, pool_size=0, coalesce_window=0.05, clock=clock
+        ))
+        assert res['acked_appends'] == 50
+        assert res['lost_updates'] == 0
+        assert backend.length('hot0') == 50
+
+    def test_lost_update(self):
+        backend = MemoryBackend()
+        clock = Clock()
+        real_append = backend.append
+
+        def lossy_append(name, item, *args):
+            if item != 'load 1':
+                real_append(name, item, *args)
+        backend.append = lossy_append
+        res = _wait(clock, run(
+            backend, requests=5, concurrency=1, mix=parse_mix('append=1'), hot_queues=1, cold_queues=0,
+            pool_size=0, clock=clock
+        ))
+        assert res['acked_appends'] == 5
+        assert res['lost_updates'] == 1
+
+
+class TestParseArgs:
+
+    def test_defaults(self):
+        args = parse_args([])
+        assert args.backend == 'memory'
+        assert args.threads == 4
+        assert args.coalesce_window is None
+        parse_mix(args.mix)
@@ -0,0 +1,65 @@
+from helga_queue.metrics import Metrics, percentile, sizeof
+
+
+class TestHelpers:
+
+    def test_percentile(self):
+        assert percentile([], 50) is None
+        assert percentile([1, 2, 3, 4, 5], 50) == 3
+        assert percentile([1, 2, 3, 4, 5], 100) == 5
+        assert percentile([1, 2, 3, 4, 5], 0) == 1
+
+    def test_sizeof(self):
+        assert sizeof('abc') == 3
+        assert sizeof(u'abc') == 3
+        assert sizeof(['ab', 'c']) == 3
+        assert sizeof(None) == 0
+        assert sizeof(5) == 0
+        assert sizeof(True) == 0
+
+
+class TestMetrics:
+
+    def test_record_command(self):
+        m = Metrics(window=3)
+        for secs in [0.004, 0.001, 0.002, 0.003]:
+            m.record_command('pop', secs)
+        m.record_command('pop', 0.010, failed=True)
+        snap = m.snapshot()
+        assert snap['commands']['pop']['calls'] == 5
+        assert snap['commands']['pop']['failures'] == 1
+        # only the last 3 samples are kept
+        assert snap['commands']['pop']['p50_ms'] == 3.0
+        assert snap['commands']['pop']['p99_ms'] == 10.0
+
+    def test_record_db(self):
+        m = Metrics()
+        m.record_db(bytes_read=5)
+        m.record_db(bytes_written=3, failed=True)
+        assert m.snapshot()['db'] == {'calls': 2, 'failures': 1, 'conflicts': 0, 'bytes_read': 5, 'bytes_written': 3}
+
+    def test_record_conflict(self):
+        m = Metrics()
+        m.record_conflict()
+        m.record_conflict()
+        assert m.snapshot()['db']['conflicts'] == 2
+        m.enabled = False
+        m.record_conflict()
+        assert m.db_conflicts == 2
+
+    def test_disabled(self):
+        m = Metrics(enabled=False)
+        m.record_command('pop', 1)
+        m.record_db(bytes_read=5)
+        assert m.snapshot() == {
+            'commands': {},
+            'db': {'calls': 0, 'failures': 0, 'conflicts': 0, 'bytes_read': 0, 'bytes_written': 0}
+        }
+
+    def test_reset(self):
+        m = Metrics()
+        m.record_command('pop', 1)
+        m.record_db(bytes_read=5)
+        m.reset()
+        assert m.snapshot()['commands'] == {}
+        assert m.db_calls == 0
@@ -0,0 +1,46 @@
+from mock import call, Mock
+from twisted.internet.task import Clock
+from helga_queue.output import OutputScheduler
+
+
+class TestOutputScheduler:
+
+    def test_paced(self):
+        clock = Clock()
+        client = Mock()
+        o = OutputScheduler(rate=2.0, clock=clock)
+        o.send(client, 'nick', ['a', 'b', 'c'])
+        assert client.mock_calls == [call.msg('nick', 'a')]
+        assert len(o) == 2
+        clock.advance(0.4)
+        assert client.mock_calls == [call.msg('nick', 'a')]
+        clock.advance(0.1)
+        assert client.mock_calls == [call.msg('nick', 'a'), call.msg('nick', 'b')]
+        clock.advance(0.5)
+        assert client.mock_calls == [call.msg('nick', 'a'), call.msg('nick', 'b'), call.msg('nick', 'c')]
+        assert len(o) == 0
+
+    def test_shared_budget(self):
+        clock = Clock()
+        client1 = Mock()
+        client2 = Mock()
+        o = OutputScheduler(rate=1.0, clock=clock)
+        o.send(client1, 'nick1', ['a'])
+        o.send(client2, 'nick2', ['b'])
+        assert client1.mock_calls == [call.msg('nick1', 'a')]
+        assert client2.mock_calls == []
+        clock.advance(1)
+        assert client2.mock_calls == [call.msg('nick2', 'b')]
+
+    def test_idle_still_waits(self):
+        clock = Clock()
+        client = Mock()
+        o = OutputScheduler(rate=1.0, clock=clock)
+        o.send(client, 'nick', ['a'])
+        clock.advance(0.5)
+        o.send(client, 'nick', ['b'])
+        assert client.mock_calls == [call.msg('nick', 'a')]
+        clock.advance(0.5)
+        assert client.mock_calls == [call.msg('nick', 'a'), call.msg('nick', 'b')]
+        clock.advance(1)
+        assert clock.getDelayedCalls() == []
@@ -1,9 +1,32 @@
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
 from mock import patch, call, Mock
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from helga.plugins import ResponseNotReady
+import pytest
 import helga_queue.plugin
+from helga_queue.backends import ConflictError, MemoryBackend
+from helga_queue.coalesce import WriteCoalescer
 
 
 class TestPlugin:
 
+    def setup_method(self, method):
+        helga_queue.plugin._cache.clear()
+        helga_queue.plugin._render_cache.clear()
+        helga_queue.plugin._owned.clear()
+        helga_queue.plugin._queue_ttls.clear()
+        # run subcommands synchronously unless a test says otherwise
+        self.pool_patcher = patch.object(helga_queue.plugin._pool, 'size', 0)
+        self.pool_patcher.start()
+
+    def teardown_method(self, method):
+        self.pool_patcher.stop()
+
     def test_commands_dict(self):
         d = helga_queue.plugin._commands_dict()
         assert 'append' in d
@@ -12,7 +35,27 @@ class TestPlugin:
         for funcname in d:
             assert d['append'].__name__.startswith('handle_')
 
-    @patch('helga_queue.plugin.db', new=None)
+    def test_commands_dict_not_rebuilt(self):
+        assert helga_queue.plugin._commands_dict() is helga_queue.plugin._commands_dict()
+
+    @patch.dict('helga_queue.plugin._commands', clear=True)
+    def test_register_subcommand(self):
+        def fn():
+            pass
+        helga_queue.plugin.register_subcommand('foo', fn, aliases=['f', 'fu'])
+        assert helga_queue.plugin._commands_dict() == {'foo': fn, 'f': fn, 'fu': fn}
+
+    @patch.dict('helga_queue.plugin._commands', clear=True)
+    def test_subcommand_decorator(self):
+        @helga_queue.plugin.subcommand('bar', aliases=['b'])
+        def handle_bar(client, channel, nick, queue_name, args):
+            return 'barreturn'
+        assert handle_bar(None, None, None, None, []) == 'barreturn'
+        assert helga_queue.plugin._commands_dict() == {'bar': handle_bar, 'b': handle_bar}
+        res = helga_queue.plugin.queue_plugin(None, 'chan', 'mynick', 'mymessage', 'queue', ['b'])
+        assert res == 'barreturn'
+
+    @patch('helga_queue.plugin._backend', new=None)
     def test_queue_plugin_no_db(self):
         res = helga_queue.plugin.queue_plugin(None, 'chan', 'mynick', 'mymessage', 'queue', ['arg1', 'arg2'])
         assert res == "ERROR: MongoDB connection is None - check configuration."
@@ -36,6 +79,346 @@ class TestPlugin:
         assert mock_list.mock_calls == [call(None, 'chan', 'mynick', 'mynick', [])]
         assert res == 'mocklistreturn'
 
+    @patch('helga_queue.plugin._pool')
+    @patch('helga_queue.plugin._commands_dict')
+    def test_queue_plugin_async(self, mock_cd, mock_pool):
+        mock_append = Mock()
+        mock_cd.return_value = {'append': mock_append}
+        mock_pool.enabled = True
+        mock_pool.run.return_value = defer.succeed('mockappendreturn')
+        mock_client = Mock()
+        with pytest.raises(ResponseNotReady):
+            helga_queue.plugin.queue_plugin(mock_client, 'chan', 'mynick', 'mymessage', 'queue', ['append', 'foo'])
+        assert len(mock_pool.run.mock_calls) == 1
+        args = mock_pool.run.call_args[0]
+        assert args[0] == helga_queue.plugin._timed
+        assert args[1] == 'append'
+        assert args[2] == mock_append
+        assert args[3]._client == mock_client
+        assert args[4:] == ('chan', 'mynick', 'mynick', ['foo'])
+        assert mock_client.mock_calls == [call.msg('chan', 'mockappendreturn')]
+
+    @patch('helga_queue.plugin._pool')
+    @patch('helga_queue.plugin._commands_dict')
+    def test_queue_plugin_async_none(self, mock_cd, mock_pool):
+        mock_cd.return_value = {'list': Mock()}
+        mock_pool.enabled = True
+        mock_pool.run.return_value = defer.succeed(None)
+        mock_client = Mock()
+        with pytest.raises(ResponseNotReady):
+            helga_queue.plugin.queue_plugin(mock_client, 'chan', 'mynick', 'mymessage', 'queue', [])
+        assert mock_client.mock_calls == []
+
+    @patch('helga_queue.plugin._pool')
+    @patch('helga_queue.plugin._commands_dict')
+    def test_queue_plugin_async_error(self, mock_cd, mock_pool):
+        mock_cd.return_value = {'append': Mock()}
+        mock_pool.enabled = True
+        mock_pool.run.return_value = defer.fail(RuntimeError('foo'))
+        mock_client = Mock()
+        with pytest.raises(ResponseNotReady):
+            helga_queue.plugin.queue_plugin(mock_client, 'chan', 'mynick', 'mymessage', 'queue', ['append', 'foo'])
+        assert mock_client.mock_calls == [call.msg('chan', 'ERROR - queue append failed')]
+
+    @patch('helga_queue.plugin._pool')
+    @patch('helga_queue.plugin._commands_dict')
+    def test_queue_plugin_async_timeout(self, mock_cd, mock_pool):
+        mock_cd.return_value = {'append': Mock()}
+        mock_pool.enabled = True
+        mock_pool.run.return_value = defer.fail(defer.TimeoutError())
+        mock_client = Mock()
+        with pytest.raises(ResponseNotReady):
+            helga_queue.plugin.queue_plugin(mock_client, 'chan', 'mynick', 'mymessage', 'queue', ['append', 'foo'])
+        assert mock_client.mock_calls == [call.msg('chan', 'ERROR - queue append timed out')]
+
+    @patch('helga_queue.plugin._pool')
+    def test_queue_plugin_coalesced(self, mock_pool):
+        mock_pool.enabled = True
+        mock_pool.run.side_effect = lambda fn, *args: defer.succeed(fn(*args))
+        clock = Clock()
+        coalescer = WriteCoalescer(helga_queue.plugin._flush_appends, window=0.5, clock=clock)
+        backend = MemoryBackend()
+        client = Mock()
+        with patch.multiple('helga_queue.plugin', _coalescer=coalescer, _backend=backend):
+            for item in ['a', 'b']:
+                with pytest.raises(ResponseNotReady):
+                    helga_queue.plugin.queue_plugin(client, 'chan', 'mynick', 'm', 'queue', ['q1', 'append', item])
+            assert backend.get('q1') == []
+            assert client.mock_calls == []
+            clock.advance(0.5)
+            assert backend.get('q1') == ['a', 'b']
+            assert client.mock_calls == [
+                call.msg('chan', "queue 'q1' updated"),
+                call.msg('chan', "queue 'q1' updated"),
+            ]
+        assert len(mock_pool.run.mock_calls) == 1
+        assert mock_pool.run.call_args[0] == (
+            helga_queue.plugin._write_batch, [('q1', [('a', 'mynick', 'chan'), ('b', 'mynick', 'chan')])]
+        )
+
+    @patch('helga_queue.plugin._pool')
+    def test_queue_plugin_coalesced_priority(self, mock_pool):
+        mock_pool.enabled = True
+        mock_pool.run.side_effect = lambda fn, *args: defer.succeed(fn(*args))
+        mock_coalescer = Mock()
+        mock_coalescer.pending.return_value = False
+        backend = MemoryBackend()
+        client = Mock()
+        with patch.multiple('helga_queue.plugin', _coalescer=mock_coalescer, _backend=backend):
+            with pytest.raises(ResponseNotReady):
+                helga_queue.plugin.queue_plugin(client, 'chan', 'mynick', 'm', 'queue',
+                                                ['q1', 'append', '-p', '1', 'a'])
+        # written straight away, since buffered appends are all priority 0
+        assert mock_coalescer.mock_calls == [call.pending('q1')]
+        assert backend.get('q1') == ['a']
+        assert client.mock_calls == [call.msg('chan', "queue 'q1' updated")]
+
+    @patch('helga_queue.plugin._pool')
+    @patch('helga_queue.plugin._commands_dict')
+    def test_queue_plugin_coalesced_read_flushes(self, mock_cd, mock_pool):
+        mock_len = Mock()
+        mock_cd.return_value = {'len': mock_len}
+        mock_pool.enabled = True
+        mock_pool.run.return_value = defer.succeed('mocklenreturn')
+        mock_coalescer = Mock()
+        mock_coalescer.pending.return_value = True
+        mock_coalescer.flush.return_value = defer.succeed(None)
+        mock_client = Mock()
+        with patch('helga_queue.plugin._coalescer', mock_coalescer):
+            with pytest.raises(ResponseNotReady):
+                helga_queue.plugin.queue_plugin(mock_client, 'chan', 'mynick', 'm', 'queue', ['q1', 'len'])
+        assert mock_coalescer.mock_calls == [call.pending('q1'), call.flush()]
+        assert mock_pool.run.call_args[0][:3] == (helga_queue.plugin._timed, 'len', mock_len)
+        assert mock_client.mock_calls == [call.msg('chan', 'mocklenreturn')]
+
+    @patch('helga_queue.plugin._metrics')
+    @patch('helga_queue.plugin._commands_dict')
+    def test_queue_plugin_timed(self, mock_cd, mock_metrics):
+        mock_append = Mock(return_value='mockappendreturn')
+        mock_cd.return_value = {'append': mock_append}
+        mock_metrics.enabled = True
+        res = helga_queue.plugin.queue_plugin(None, 'chan', 'mynick', 'mymessage', 'queue', ['append', 'foo'])
+        assert res == 'mockappendreturn'
+        assert len(mock_metrics.record_command.mock_calls) == 1
+        args, kwargs = mock_metrics.record_command.call_args
+        assert args[0] == 'append'
+        assert kwargs == {}
+
+    @patch('helga_queue.plugin._metrics')
+    def test_timed_failure(self, mock_metrics):
+        mock_metrics.enabled = True
+        fn = Mock(side_effect=RuntimeError())
+        with pytest.raises(RuntimeError):
+            helga_queue.plugin._timed('pop', fn, 'a')
+        args, kwargs = mock_metrics.record_command.call_args
+        assert args[0] == 'pop'
+        assert kwargs == {'failed': True}
+
+    @patch('helga_queue.plugin._metrics')
+    def test_timed_disabled(self, mock_metrics):
+        mock_metrics.enabled = False
+        fn = Mock(return_value='foo')
+        assert helga_queue.plugin._timed('pop', fn, 'a') == 'foo'
+        assert mock_metrics.record_command.mock_calls == []
+
+    @patch('helga_queue.plugin._profiler')
+    def test_timed_profiled(self, mock_profiler):
+        mock_profiler.enabled = True
+        mock_profiler.sampled.return_value = True
+        mock_profiler.run.return_value = 'profiled'
+        fn = Mock(return_value='foo')
+        assert helga_queue.plugin._timed('pop', fn, 'a') == 'profiled'
+        assert mock_profiler.run.mock_calls == [call('pop', fn, 'a')]
+        mock_profiler.sampled.return_value = False
+        assert helga_queue.plugin._timed('pop', fn, 'a') == 'foo'
+        assert len(mock_profiler.run.mock_calls) == 1
+
+    @patch('helga_queue.plugin._profiler')
+    def test_timed_not_profiling(self, mock_profiler):
+        mock_profiler.enabled = False
+        fn = Mock(return_value='foo')
+        assert helga_queue.plugin._timed('pop', fn, 'a') == 'foo'
+        assert mock_profiler.sampled.mock_calls == []
+
+    @patch('helga_queue.plugin._metrics')
+    def test_db_call(self, mock_metrics):
+        mock_metrics.enabled = True
+        fn = Mock(return_value=['ab', 'cde'])
+        assert helga_queue.plugin._db_call(fn, 'qname', written=4) == ['ab', 'cde']
+        assert fn.mock_calls == [call('qname')]
+        assert mock_metrics.record_db.mock_calls == [call(bytes_read=5, bytes_written=4)]
+
+    @patch('helga_queue.plugin._metrics')
+    def test_db_call_failure(self, mock_metrics):
+        mock_metrics.enabled = True
+        fn = Mock(side_effect=RuntimeError())
+        with pytest.raises(RuntimeError):
+            helga_queue.plugin._db_call(fn, 'qname')
+        assert mock_metrics.record_db.mock_calls == [call(bytes_written=0, failed=True)]
+
+    @patch('helga_queue.plugin._metrics')
+    def test_db_call_disabled(self, mock_metrics):
+        mock_metrics.enabled = False
+        fn = Mock(return_value='foo')
+        assert helga_queue.plugin._db_call(fn, 'qname', written=3) == 'foo'
+        assert mock_metrics.record_db.mock_calls == []
+
+    def test_handle_stats_not_operator(self):
+        mock_client = Mock()
+        mock_client.operators = set(['someone'])
+        res = helga_queue.plugin.handle_stats(mock_client, 'chan', 'mynick', 'mynick', [])
+        assert res == "ERROR - only operators may use 'queue stats'"
+
+    @patch('helga_queue.plugin._metrics')
+    def test_handle_stats(self, mock_metrics):
+        mock_metrics.enabled = True
+        mock_metrics.snapshot.return_value = {
+            'commands': {
+                'pop': {'calls': 2, 'failures': 1, 'p50_ms': 1.0, 'p95_ms': 2.0, 'p99_ms': 3.0},
+                'append': {'calls': 5, 'failures': 0, 'p50_ms': 0.5, 'p95_ms': 0.75, 'p99_ms': 1.25},
+            },
+            'db': {'calls': 7, 'failures': 1, 'conflicts': 2, 'bytes_read': 10, 'bytes_written': 20},
+        }
+        mock_client = Mock()
+        mock_client.operators = set(['mynick'])
+        res = helga_queue.plugin.handle_stats(mock_client, 'chan', 'mynick', 'mynick', [])
+        assert res == "Queue metrics:\n" + \
+            "append: 5 calls, 0 failed, p50 0.5ms p95 0.8ms p99 1.2ms\n" + \
+            "pop: 2 calls, 1 failed, p50 1.0ms p95 2.0ms p99 3.0ms\n" + \
+            "db: 7 calls, 1 failed, 2 conflicts, 10 bytes read, 20 bytes written\n" + \
+            "cache: 0 queues, 0 bytes, 0 hits, 0 misses, 0 evictions\n" + \
+            "render cache: 0 views, 0 hits, 0 misses, 0 evictions"
+
+    def test_handle_profile_not_operator(self):
+        mock_client = Mock()
+        mock_client.operators = set(['someone'])
+        res = helga_queue.plugin.handle_profile(mock_client, 'chan', 'mynick', 'mynick', ['on'])
+        assert res == "ERROR - only operators may use 'queue profile'"
+
+    def test_handle_profile(self):
+        mock_client = Mock()
+        mock_client.operators = set(['mynick'])
+        path = os.path.join(tempfile.mkdtemp(), 'prof')
+        profiler = helga_queue.plugin.Profiler()
+        with patch('helga_queue.plugin._profiler', profiler), patch('helga_queue.plugin.PROFILE_PATH', path):
+            res = helga_queue.plugin.handle_profile(mock_client, 'chan', 'mynick', 'mynick', [])
+            assert res == "Profiling is off, sampling 1% of queue commands; 0 profiled so far."
+            res = helga_queue.plugin.handle_profile(mock_client, 'chan', 'mynick', 'mynick', ['dump'])
+            assert res == "No queue commands were profiled."
+            res = helga_queue.plugin.handle_profile(mock_client, 'chan', 'mynick', 'mynick', ['on', '1'])
+            assert res == "Profiling 100% of queue commands; 'queue profile off' writes the results to " + path + ".*"
+            assert profiler.enabled is True
+            backend = MemoryBackend()
+            with patch('helga_queue.plugin._backend', backend):
+                helga_queue.plugin.queue_plugin(mock_client, 'chan', 'mynick', 'msg', 'queue', ['append', 'foo'])
+                helga_queue.plugin.queue_plugin(mock_client, 'chan', 'mynick', 'msg', 'queue', ['len'])
+            assert profiler.samples() == {'append': 1, 'len': 1}
+            res = helga_queue.plugin.handle_profile(mock_client, 'chan', 'mynick', 'mynick', ['off'])
+            assert res == "Wrote profiles of 2 queue commands to {p}-append.pstats, {p}-len.pstats, {p}.folded".format(
+                p=path
+            )
+            assert profiler.enabled is False
+            assert os.path.exists(path + '-len.pstats')
+            with open(path + '.folded') as fh:
+                assert 'queue len;handle_len (plugin.py:' in fh.read()
+
+    def test_handle_profile_errors(self):
+        mock_client = Mock()
+        mock_client.operators = set(['mynick'])
+        profiler = helga_queue.plugin.Profiler()
+        with patch('helga_queue.plugin._profiler', profiler):
+            for arg in ['0', '1.5', 'x']:
+                res = helga_queue.plugin.handle_profile(mock_client, 'chan', 'mynick', 'mynick', ['on', arg])
+                assert res == "ERROR - '{a}' is not a valid fraction (more than 0, at most 1)".format(a=arg)
+            assert profiler.enabled is False
+            res = helga_queue.plugin.handle_profile(mock_client, 'chan', 'mynick', 'mynick', ['frob'])
+            assert res == "ERROR - usage: queue profile [on [<fraction>]|off|dump]"
+            profiler.start(1.0)
+            profiler.run('len', len, 'abc')
+            bad = os.path.join(tempfile.mkdtemp(), 'missing', 'prof')
+            with patch('helga_queue.plugin.PROFILE_PATH', bad):
+                res = helga_queue.plugin.handle_profile(mock_client, 'chan', 'mynick', 'mynick', ['dump'])
+            assert res.startswith("ERROR - can't write {p}: ".format(p=bad))
+
+    @patch('helga_queue.plugin._pool')
+    @patch('helga_queue.plugin._profiler')
+    def test_schedule_profile_dump(self, mock_profiler, mock_pool):
+        mock_profiler.enabled = False
+        assert helga_queue.plugin._schedule_profile_dump() is None
+        assert mock_pool.run.mock_calls == []
+        mock_profiler.enabled = True
+        helga_queue.plugin._schedule_profile_dump()
+        assert mock_pool.run.call_args == call(helga_queue.plugin._write_profile)
+
+    def test_handle_export_import_not_operator(self):
+        mock_client = Mock()
+        mock_client.operators = set(['someone'])
+        res = helga_queue.plugin.handle_export(mock_client, 'chan', 'mynick', 'mynick', ['/tmp/q.jsonl'])
+        assert res == "ERROR - only operators may use 'queue export'"
+        res = helga_queue.plugin.handle_import(mock_client, 'chan', 'mynick', 'mynick', ['/tmp/q.jsonl'])
+        assert res == "ERROR - only operators may use 'queue import'"
+
+    def test_handle_export_import(self):
+        mock_client = Mock()
+        mock_client.operators = set(['mynick'])
+        path = os.path.join(tempfile.mkdtemp(), 'q.jsonl.gz')
+        src = MemoryBackend()
+        src.append_many('q', ['zero', 'one'])
+        src.append('r', 'two', priority=1)
+        with patch('helga_queue.plugin._backend', src):
+            res = helga_queue.plugin.handle_export(mock_client, 'chan', 'mynick', 'mynick', [path])
+        assert res == "Exported 3 items to {p}".format(p=path)
+        dest = MemoryBackend()
+        helga_queue.plugin._cache.set('q', ['stale'])
+        with patch('helga_queue.plugin._backend', dest):
+            res = helga_queue.plugin.handle_import(mock_client, 'chan', 'mynick', 'mynick', [path])
+        assert res == "Imported 3 items into 2 queues from {p}".format(p=path)
+        assert dest.get('q') == ['zero', 'one']
+        assert list(dest.export('r')) == [('r', 'two', None, 1)]
+        assert 'q' not in helga_queue.plugin._cache
+
+    def test_handle_export_import_errors(self):
+        mock_client = Mock()
+        mock_client.operators = set(['mynick'])
+        res = helga_queue.plugin.handle_export(mock_client, 'chan', 'mynick', 'mynick', [])
+        assert res == "ERROR - usage: queue export <path>"
+        res = helga_queue.plugin.handle_import(mock_client, 'chan', 'mynick', 'mynick', ['-'])
+        assert res == "ERROR - usage: queue import <path>"
+        missing = os.path.join(tempfile.mkdtemp(), 'missing', 'q.jsonl')
+        res = helga_queue.plugin.handle_import(mock_client, 'chan', 'mynick', 'mynick', [missing])
+        assert res.startswith("ERROR - can't read {p}: ".format(p=missing))
+        path = os.path.join(tempfile.mkdtemp(), 'q.jsonl')
+        with open(path, 'w') as fh:
+            fh.write('{"queue": "q", "item": "a"}\nbad\n')
+        dest = MemoryBackend()
+        with patch('helga_queue.plugin._backend', dest):
+            res = helga_queue.plugin.handle_import(mock_client, 'chan', 'mynick', 'mynick', [path])
+        assert res == "ERROR - {p}: line 2 is not a valid queue item; the lines before it were imported".format(p=path)
+        assert dest.get('q') == ['a']
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_export_unsupported(self, mock_backend):
+        mock_client = Mock()
+        mock_client.operators = set(['mynick'])
+        mock_backend.name = 'other'
+        mock_backend.export.side_effect = NotImplementedError()
+        path = os.path.join(tempfile.mkdtemp(), 'q.jsonl')
+        res = helga_queue.plugin.handle_export(mock_client, 'chan', 'mynick', 'mynick', [path])
+        assert res == "ERROR - the other backend can't list every queue"
+
+    @patch('helga_queue.plugin.logger')
+    def test_dump_metrics_log(self, mock_logger):
+        helga_queue.plugin._dump_metrics()
+        assert len(mock_logger.info.mock_calls) == 1
+        assert mock_logger.info.call_args[0][0] == 'queue metrics: %s'
+
+    def test_dump_metrics_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'metrics.json')
+        helga_queue.plugin._dump_metrics(path)
+        with open(path) as fh:
+            doc = json.load(fh)
+        assert sorted(doc.keys()) == ['cache', 'commands', 'db', 'render_cache']
+
     def test_queue_plugin_unknown_cmd(self):
         res = helga_queue.plugin.queue_plugin(None, 'chan', 'mynick', 'mymessage', 'queue', ['notacommand'])
         assert res == "queue subcommand 'notacommand' not known - please use 'queue help' for available commands"
@@ -68,93 +451,923 @@ class TestPlugin:
         result = helga_queue.plugin._queue_repr('qname', queue)
         assert result == expected
 
+    def test_queue_repr_start(self):
+        expected = 'Contents of queue "qname":\n5. five\n6. six\n'
+        result = helga_queue.plugin._queue_repr('qname', ['five', 'six'], start=5)
+        assert result == expected
+
     def test_queue_repr_empty(self):
         expected = 'Queue "qname" is empty.'
         result = helga_queue.plugin._queue_repr('qname', [])
         assert result == expected
 
-    @patch('helga_queue.plugin.db')
-    def test_get_queue(self, mock_db):
-        mock_db.helga_queue.find_one.return_value = {'_id': 'qname', 'queue': ['zero', 'one', 'two']}
+    @patch('helga_queue.plugin._backend')
+    def test_get_queue(self, mock_backend):
+        mock_backend.get.return_value = ['zero', 'one', 'two']
         result = helga_queue.plugin._get_queue('qname')
         assert result == ['zero', 'one', 'two']
-        assert mock_db.mock_calls == [call.helga_queue.find_one({'_id': 'qname'})]
+        assert mock_backend.mock_calls == [call.get('qname')]
+
+    @patch('helga_queue.plugin._backend')
+    def test_get_queue_cached(self, mock_backend):
+        mock_backend.get.return_value = ['zero', 'one', 'two']
+        assert helga_queue.plugin._get_queue('qname') == ['zero', 'one', 'two']
+        assert helga_queue.plugin._get_queue('qname') == ['zero', 'one', 'two']
+        assert mock_backend.mock_calls == [call.get('qname')]
+        assert helga_queue.plugin._cache.hits == 1
+        assert helga_queue.plugin._cache.misses == 1
+
+    def test_get_queue_races_append(self):
+        backend = MemoryBackend()
+        backend.set('qname', ['a'])
+        real_get = backend.get
+
+        def get_then_append(name):
+            q = real_get(name)
+            # another thread appends after this read, while the queue isn't cached
+            helga_queue.plugin._append_item('qname', 'b')
+            return q
+        backend.get = get_then_append
+        with patch('helga_queue.plugin._backend', backend):
+            assert helga_queue.plugin._get_queue('qname') == ['a']
+            backend.get = real_get
+            assert backend.get('qname') == ['a', 'b']
+            assert helga_queue.plugin.handle_len(None, 'chan', 'nick', 'qname', []) == '2 items in queue qname'
+            assert helga_queue.plugin._get_queue('qname') == ['a', 'b']
+
+    @patch('helga_queue.plugin._backend')
+    def test_set_queue(self, mock_backend):
+        result = helga_queue.plugin._set_queue('qname', ['zero', 'one', 'two'])
+        assert result == "queue 'qname' updated"
+        assert mock_backend.mock_calls == [call.set('qname', ['zero', 'one', 'two'])]
+
+    @patch('helga_queue.plugin._backend')
+    def test_set_queue_write_through(self, mock_backend):
+        helga_queue.plugin._set_queue('qname', ['zero', 'one'])
+        assert helga_queue.plugin._get_queue('qname') == ['zero', 'one']
+        assert mock_backend.mock_calls == [call.set('qname', ['zero', 'one'])]
+
+    @patch('helga_queue.plugin._backend')
+    def test_set_queue_error(self, mock_backend):
+        mock_backend.set.side_effect = RuntimeError()
+        helga_queue.plugin._cache.set('qname', ['zero'])
+        result = helga_queue.plugin._set_queue('qname', ['zero', 'one', 'two'])
+        assert mock_backend.mock_calls == [call.set('qname', ['zero', 'one', 'two'])]
+        assert result == "ERROR - update to queue 'qname' failed"
+        assert 'qname' not in helga_queue.plugin._cache
+
+    def test_update_queue(self):
+        backend = MemoryBackend()
+        backend.set('qname', ['zero', 'one'])
+        helga_queue.plugin._cache.set('qname', ['stale'])
+        with patch('helga_queue.plugin._backend', backend):
+            res = helga_queue.plugin._update_queue('qname', lambda q: (q[::-1], len(q)))
+        assert res == 2
+        assert backend.get('qname') == ['one', 'zero']
+        assert helga_queue.plugin._cache.get('qname') == ['one', 'zero']
+
+    @patch('helga_queue.plugin._backend')
+    def test_update_queue_conflict(self, mock_backend):
+        mock_backend.update.side_effect = ConflictError()
+        helga_queue.plugin._cache.set('qname', ['zero'])
+        with pytest.raises(ConflictError):
+            helga_queue.plugin._update_queue('qname', lambda q: (q, None))
+        assert 'qname' not in helga_queue.plugin._cache
+
+    @patch('helga_queue.plugin._backend')
+    def test_append_item(self, mock_backend):
+        result = helga_queue.plugin._append_item('qname', 'foo bar')
+        assert result == "queue 'qname' updated"
+        assert mock_backend.mock_calls == [call.append('qname', 'foo bar', None, 0)]
 
-    @patch('helga_queue.plugin.db')
-    def test_get_queue_none(self, mock_db):
-        mock_db.helga_queue.find_one.return_value = None
-        result = helga_queue.plugin._get_queue('qname')
-        assert result == []
-        assert mock_db.mock_calls == [call.helga_queue.find_one({'_id': 'qname'})]
+    @patch('helga_queue.plugin._backend')
+    def test_append_item_error(self, mock_backend):
+        mock_backend.append.side_effect = RuntimeError()
+        result = helga_queue.plugin._append_item('qname', 'foo bar')
+        assert result == "ERROR - update to queue 'qname' failed"
 
-    @patch('helga_queue.plugin.db')
-    def test_set_queue(self, mock_db):
-        mock_db.helga_queue.save.return_value = True
-        result = helga_queue.plugin._set_queue('qname', ['zero', 'one', 'two'])
+    @patch('helga_queue.plugin._backend')
+    def test_append_item_owner(self, mock_backend):
+        helga_queue.plugin._append_item('qname', 'foo', owner='mynick', channel='#chan')
+        helga_queue.plugin._append_item('qname', 'bar', owner='other', channel='#chan')
+        assert mock_backend.mock_calls == [
+            call.set_owner('qname', 'mynick', '#chan'),
+            call.append('qname', 'foo', None, 0),
+            call.append('qname', 'bar', None, 0),
+        ]
+
+    @patch('helga_queue.plugin._backend')
+    def test_append_item_owner_error(self, mock_backend):
+        mock_backend.set_owner.side_effect = RuntimeError()
+        result = helga_queue.plugin._append_item('qname', 'foo', owner='mynick', channel='#chan')
+        assert result == "ERROR - update to queue 'qname' failed"
+        assert 'qname' not in helga_queue.plugin._owned
+        assert mock_backend.append.mock_calls == []
+
+    @patch('helga_queue.plugin._backend')
+    def test_append_items(self, mock_backend):
+        helga_queue.plugin._cache.set('qname', ['zero'])
+        result = helga_queue.plugin._append_items('qname', ['one', 'two'])
         assert result == "queue 'qname' updated"
-        assert mock_db.mock_calls == [call.helga_queue.save({'_id': 'qname', 'queue': ['zero', 'one', 'two']})]
+        assert mock_backend.mock_calls == [call.append_many('qname', ['one', 'two'], None)]
+        assert helga_queue.plugin._get_queue('qname') == ['zero', 'one', 'two']
+
+    @patch('helga_queue.plugin.time')
+    @patch('helga_queue.plugin._backend')
+    def test_append_expiring(self, mock_backend, mock_time):
+        mock_time.time.return_value = 1000
+        helga_queue.plugin._queue_ttls['qname'] = 60
+        helga_queue.plugin._cache.set('qname', ['zero'])
+        helga_queue.plugin._cache.set('other', ['zero'])
+        assert helga_queue.plugin._append_items('qname', ['one', 'two']) == "queue 'qname' updated"
+        assert helga_queue.plugin._append_item('qname', 'three', ttl=5) == "queue 'qname' updated"
+        assert helga_queue.plugin._append_item('other', 'one', ttl=5) == "queue 'other' updated"
+        assert mock_backend.mock_calls == [
+            call.append_many('qname', ['one', 'two'], 1060),
+            call.append('qname', 'three', 1005, 0),
+            call.append('other', 'one', 1005, 0),
+        ]
+        # cached copies would keep the items once they expire
+        assert 'qname' not in helga_queue.plugin._cache
+        helga_queue.plugin._cache.set('other', ['zero', 'one'])
+        assert 'other' not in helga_queue.plugin._cache
+
+    @patch('helga_queue.plugin._backend')
+    def test_append_expiring_unsupported(self, mock_backend):
+        mock_backend.name = 'mongo-segmented'
+        mock_backend.append.side_effect = NotImplementedError()
+        result = helga_queue.plugin.handle_append_ttl(None, '#chan', 'mynick', 'qname', ['1h', 'foo'])
+        assert result == "ERROR - the mongo-segmented backend doesn't support item expiry"
+
+    def test_handle_append_priority(self):
+        backend = MemoryBackend()
+        with patch('helga_queue.plugin._backend', backend):
+            helga_queue.plugin._cache.set('qname', [])
+            result = helga_queue.plugin.handle_append(None, '#chan', 'mynick', 'qname', ['zero'])
+            assert result == "queue 'qname' updated"
+            result = helga_queue.plugin.handle_append(None, '#chan', 'mynick', 'qname', ['-p', '2', 'urgent', 'one'])
+            assert result == "queue 'qname' updated"
+            assert 'qname' not in helga_queue.plugin._cache
+            assert helga_queue.plugin._get_queue('qname') == ['urgent one', 'zero']
+            assert helga_queue.plugin.handle_append(None, '#chan', 'mynick', 'qname', ['-p', '2']) == \
+                "ERROR - usage: queue [queue name] append [-p <priority>] <item>"
+            for arg in ['high', '-1']:
+                assert helga_queue.plugin.handle_append(None, '#chan', 'mynick', 'qname', ['-p', arg, 'foo']) == \
+                    "ERROR - '{a}' is not a valid priority (an integer, 0 or more)".format(a=arg)
+
+    @patch('helga_queue.plugin._backend')
+    def test_append_priority_unsupported(self, mock_backend):
+        mock_backend.name = 'mongo-segmented'
+        mock_backend.append.side_effect = NotImplementedError()
+        result = helga_queue.plugin.handle_append(None, '#chan', 'mynick', 'qname', ['-p', '1', 'foo'])
+        assert result == "ERROR - the mongo-segmented backend doesn't support priorities"
+
+    def test_handle_append_ttl(self):
+        backend = MemoryBackend()
+        with patch('helga_queue.plugin._backend', backend):
+            result = helga_queue.plugin.handle_append_ttl(None, '#chan', 'mynick', 'qname', ['1h', 'foo', 'bar'])
+            assert result == "queue 'qname' updated"
+            assert helga_queue.plugin._queue_range('qname', 0, 10) == ['foo bar']
+            assert helga_queue.plugin.handle_append_ttl(None, '#chan', 'mynick', 'qname', ['1h']) == \
+                "ERROR - usage: queue [queue name] append-ttl <duration> <item>"
+            assert helga_queue.plugin.handle_append_ttl(None, '#chan', 'mynick', 'qname', ['0', 'foo']) == \
+                "ERROR - '0' is not a valid duration, such as 90s, 15m or 7d"
+        assert backend.expire(time.time() + 3601, 10) == (['qname'], False)
+
+    def test_handle_ttl(self):
+        backend = MemoryBackend()
+        with patch('helga_queue.plugin._backend', backend):
+            handle = helga_queue.plugin.handle_ttl
+            assert handle(None, '#chan', 'mynick', 'qname', []) == "Items appended to queue qname don't expire"
+            assert handle(None, '#chan', 'mynick', 'qname', ['1h']) == \
+                "Items appended to queue qname now expire after 3600 seconds"
+            assert helga_queue.plugin._queue_ttls == {'qname': 3600}
+            assert backend.ttls() == {'qname': 3600}
+            assert handle(None, '#chan', 'mynick', 'qname', []) == \
+                "Items appended to queue qname expire after 3600 seconds"
+            assert handle(None, '#chan', 'mynick', 'qname', ['soon']) == \
+                "ERROR - 'soon' is not a valid duration, such as 90s, 15m or 7d; or off"
+            assert handle(None, '#chan', 'mynick', 'qname', ['off']) == \
+                "Items appended to queue qname no longer expire"
+            assert helga_queue.plugin._queue_ttls == {}
+            assert backend.ttls() == {}
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_ttl_unsupported(self, mock_backend):
+        mock_backend.name = 'mongo-segmented'
+        mock_backend.set_ttl.side_effect = NotImplementedError()
+        result = helga_queue.plugin.handle_ttl(None, '#chan', 'mynick', 'qname', ['1h'])
+        assert result == "ERROR - the mongo-segmented backend doesn't support item expiry"
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_history(self, mock_backend):
+        mock_backend.history.return_value = [
+            {'op': 'append', 'at': 1000, 'items': ['a', 'b']},
+            {'op': 'pop', 'at': 2000, 'items': ['a', 'c'], 'idxs': [0, 2]},
+        ]
+        result = helga_queue.plugin.handle_history(None, '#chan', 'mynick', 'qname', [])
+        assert result == '\n'.join([
+            'Recent changes to queue qname, newest last:',
+            "{t} appended 'a', 'b'".format(t=datetime.fromtimestamp(1000).strftime('%Y-%m-%d %H:%M:%S')),
+            "{t} popped 'a' (item 0), 'c' (item 2)".format(
+                t=datetime.fromtimestamp(2000).strftime('%Y-%m-%d %H:%M:%S')
+            ),
+        ])
+        helga_queue.plugin.handle_history(None, '#chan', 'mynick', 'qname', ['10'])
+        assert mock_backend.history.mock_calls == [call('qname', 5), call('qname', 10)]
+        for arg in ['0', 'all']:
+            assert helga_queue.plugin.handle_history(None, '#chan', 'mynick', 'qname', [arg]) == \
+                "ERROR - {a} is not a valid count (int)".format(a=arg)
+        mock_backend.history.return_value = []
+        assert helga_queue.plugin.handle_history(None, '#chan', 'mynick', 'qname', []) == \
+            "No recorded changes to queue qname."
+
+    def test_handle_undo(self):
+        backend = MemoryBackend(history_size=5)
+        with patch('helga_queue.plugin._backend', backend):
+            helga_queue.plugin._append_items('qname', ['zero', 'one'])
+            assert helga_queue.plugin.handle_pop(None, '#chan', 'mynick', 'qname', ['1']) == \
+                "Popped item 1 from queue qname: 'one'"
+            assert helga_queue.plugin._get_queue('qname') == ['zero']
+            assert helga_queue.plugin.handle_undo(None, '#chan', 'mynick', 'qname', []) == \
+                "Undid change to queue qname: popped 'one' (item 1)"
+            assert helga_queue.plugin._get_queue('qname') == ['zero', 'one']
+            assert helga_queue.plugin.handle_undo(None, '#chan', 'mynick', 'qname', []) == \
+                "Undid change to queue qname: appended 'zero', 'one'"
+            assert helga_queue.plugin._get_queue('qname') == []
+            assert helga_queue.plugin.handle_undo(None, '#chan', 'mynick', 'qname', []) == \
+                "Nothing to undo in queue qname."
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_undo_errors(self, mock_backend):
+        mock_backend.name = 'mongo-segmented'
+        helga_queue.plugin._cache.set('qname', ['zero'])
+        mock_backend.undo.side_effect = ConflictError()
+        assert helga_queue.plugin.handle_undo(None, '#chan', 'mynick', 'qname', []) == \
+            "ERROR - queue qname kept changing while undoing; please try again"
+        assert 'qname' not in helga_queue.plugin._cache
+        mock_backend.undo.side_effect = NotImplementedError()
+        assert helga_queue.plugin.handle_undo(None, '#chan', 'mynick', 'qname', []) == \
+            "ERROR - the mongo-segmented backend doesn't record history"
+        mock_backend.history.side_effect = NotImplementedError()
+        assert helga_queue.plugin.handle_history(None, '#chan', 'mynick', 'qname', []) == \
+            "ERROR - the mongo-segmented backend doesn't record history"
+
+    @patch('helga_queue.plugin.EXPIRE_BATCH', 2)
+    @patch('helga_queue.plugin._backend')
+    def test_expire_items(self, mock_backend):
+        mock_backend.expire.side_effect = [(['q1', 'q2'], True), (['q2'], False)]
+        mock_backend.ttls.return_value = {'q3': 60}
+        helga_queue.plugin._cache.set('q1', ['zero'])
+        helga_queue.plugin._cache.set('q3', ['zero'])
+        helga_queue.plugin._cache.set('q4', ['zero'])
+        assert helga_queue.plugin._expire_items() == ['q1', 'q2']
+        assert [c[1][1] for c in mock_backend.expire.mock_calls] == [2, 2]
+        assert helga_queue.plugin._queue_ttls == {'q3': 60}
+        assert 'q1' not in helga_queue.plugin._cache
+        assert 'q3' not in helga_queue.plugin._cache
+        assert 'q4' in helga_queue.plugin._cache
+
+    @patch('helga_queue.plugin._backend')
+    def test_expire_items_unsupported(self, mock_backend):
+        mock_backend.expire.side_effect = NotImplementedError()
+        assert helga_queue.plugin._expire_items() == []
+
+    @patch('helga_queue.plugin.logger')
+    @patch('helga_queue.plugin._pool')
+    def test_schedule_expire_error(self, mock_pool, mock_logger):
+        d = defer.Deferred()
+        mock_pool.run.return_value = d
+        assert helga_queue.plugin._schedule_expire() is d
+        assert mock_pool.run.mock_calls == [call(helga_queue.plugin._expire_items)]
+        d.errback(RuntimeError('boom'))
+        assert mock_logger.error.call_count == 1
+
+    @patch('helga_queue.plugin._backend')
+    def test_append_items_error(self, mock_backend):
+        mock_backend.append_many.side_effect = RuntimeError()
+        helga_queue.plugin._cache.set('qname', ['zero'])
+        result = helga_queue.plugin._append_items('qname', ['one'])
+        assert result == "ERROR - update to queue 'qname' failed"
+        assert 'qname' not in helga_queue.plugin._cache
+
+    @patch('helga_queue.plugin._backend')
+    def test_write_batch(self, mock_backend):
+        mock_backend.append_many.side_effect = [None, RuntimeError()]
+        res = helga_queue.plugin._write_batch([
+            ('q1', [('a', 'nick1', '#c1'), ('b', 'nick2', '#c2')]),
+            ('q2', [('c', 'nick2', '#c2')]),
+        ])
+        assert res == {'q1': "queue 'q1' updated", 'q2': "ERROR - update to queue 'q2' failed"}
+        assert mock_backend.mock_calls == [
+            call.set_owner('q1', 'nick1', '#c1'),
+            call.append_many('q1', ['a', 'b'], None),
+            call.set_owner('q2', 'nick2', '#c2'),
+            call.append_many('q2', ['c'], None),
+        ]
 
-    @patch('helga_queue.plugin.db')
-    def test_set_queue_error(self, mock_db):
-        mock_db.helga_queue.save.side_effect = RuntimeError()
-        result = helga_queue.plugin._set_queue('qname', ['zero', 'one', 'two'])
-        assert mock_db.mock_calls == [call.helga_queue.save({'_id': 'qname', 'queue': ['zero', 'one', 'two']})]
+    @patch('helga_queue.plugin._backend')
+    def test_pop_item(self, mock_backend):
+        mock_backend.pop.return_value = 'two'
+        assert helga_queue.plugin._pop_item('qname', 2) == 'two'
+        assert mock_backend.mock_calls == [call.pop('qname', 2)]
+
+    @patch('helga_queue.plugin._backend')
+    def test_pop_item_missing(self, mock_backend):
+        mock_backend.pop.return_value = None
+        helga_queue.plugin._cache.set('qname', ['zero'])
+        assert helga_queue.plugin._pop_item('qname', 5) is None
+        assert helga_queue.plugin._cache.get('qname') == ['zero']
+
+    @patch('helga_queue.plugin._backend')
+    def test_pop_items(self, mock_backend):
+        mock_backend.pop_many.return_value = ['one', 'three']
+        helga_queue.plugin._cache.set('qname', ['zero', 'one', 'two', 'three'])
+        assert helga_queue.plugin._pop_items('qname', [1, 3]) == ['one', 'three']
+        assert mock_backend.mock_calls == [call.pop_many('qname', [1, 3])]
+        assert helga_queue.plugin._cache.get('qname') == ['zero', 'two']
+
+    @patch('helga_queue.plugin._backend')
+    def test_pop_items_missing(self, mock_backend):
+        mock_backend.pop_many.return_value = None
+        helga_queue.plugin._cache.set('qname', ['zero'])
+        assert helga_queue.plugin._pop_items('qname', [0, 5]) is None
+        assert helga_queue.plugin._cache.get('qname') == ['zero']
+
+    @patch('helga_queue.plugin._backend')
+    def test_append_pop_write_through(self, mock_backend):
+        helga_queue.plugin._cache.set('qname', ['zero', 'one'])
+        helga_queue.plugin._append_item('qname', 'two')
+        mock_backend.pop.return_value = 'zero'
+        helga_queue.plugin._pop_item('qname')
+        assert helga_queue.plugin._get_queue('qname') == ['one', 'two']
+        assert mock_backend.get.mock_calls == []
+
+    @patch('helga_queue.plugin._append_item')
+    def test_handle_append(self, mock_append):
+        mock_append.return_value = 'appendreturn'
+        result = helga_queue.plugin.handle_append(None, '#chan', 'mynick', 'qname', ['foo', 'bar', 'baz'])
+        assert result == 'appendreturn'
+        assert mock_append.mock_calls == [call('qname', 'foo bar baz', owner='mynick', channel='#chan')]
+
+    @patch('helga_queue.plugin._append_items')
+    def test_handle_append_many(self, mock_append):
+        mock_append.return_value = "queue 'qname' updated"
+        result = helga_queue.plugin.handle_append_many(None, '#chan', 'mynick', 'qname', ['foo', 'bar|', 'baz', '||', 'x'])
+        assert result == "appended 3 items to queue 'qname'"
+        assert mock_append.mock_calls == [call('qname', ['foo bar', 'baz', 'x'], owner='mynick', channel='#chan')]
+
+    @patch('helga_queue.plugin._append_items')
+    def test_handle_append_many_error(self, mock_append):
+        mock_append.return_value = "ERROR - update to queue 'qname' failed"
+        result = helga_queue.plugin.handle_append_many(None, None, None, 'qname', ['foo|bar'])
         assert result == "ERROR - update to queue 'qname' failed"
 
-    @patch('helga_queue.plugin._get_queue')
-    @patch('helga_queue.plugin._set_queue')
-    def test_handle_append(self, mock_set, mock_get):
-        mock_get.return_value = ['zero', 'one', 'two']
-        mock_set.return_value = 'setreturn'
-        result = helga_queue.plugin.handle_append(None, None, None, 'qname', ['foo', 'bar', 'baz'])
-        assert result == 'setreturn'
-        assert mock_get.mock_calls == [call('qname')]
-        assert mock_set.mock_calls == [call('qname', ['zero', 'one', 'two', 'foo bar baz'])]
+    @patch('helga_queue.plugin._append_items')
+    def test_handle_append_many_empty(self, mock_append):
+        result = helga_queue.plugin.handle_append_many(None, None, None, 'qname', [' | '])
+        assert result == "ERROR - no items to append; separate items with '|'"
+        assert mock_append.mock_calls == []
+
+    @patch('helga_queue.plugin.reactor')
+    @patch('helga_queue.plugin._backend')
+    def test_handle_queues(self, mock_backend, mock_reactor):
+        mock_backend.queues.return_value = [
+            {'name': 'a', 'length': 2, 'head': 'first', 'owner': 'bob', 'channel': '#ops'},
+            {'name': 'b', 'length': 0, 'head': None, 'owner': None, 'channel': None},
+        ]
+        mock_client = Mock()
+        res = helga_queue.plugin.handle_queues(mock_client, '#chan', 'mynick', 'mynick', [])
+        assert res is None
+        assert mock_backend.queues.mock_calls == [call(None, None)]
+        assert mock_client.mock_calls == [call.me('#chan', 'whispers to mynick a list of 2 queues')]
+        assert mock_reactor.callFromThread.mock_calls == [call(
+            helga_queue.plugin._output.send, mock_client, 'mynick',
+            ['Queues:', 'a: 2 items (created by bob in #ops) - next: first', 'b: 0 items']
+        )]
+
+    @patch('helga_queue.plugin.LIST_MAX_LINES', 1)
+    @patch('helga_queue.plugin.reactor')
+    @patch('helga_queue.plugin._backend')
+    def test_handle_queues_filtered(self, mock_backend, mock_reactor):
+        mock_backend.queues.return_value = [
+            {'name': 'a', 'length': 2, 'head': 'first', 'owner': 'bob', 'channel': '#ops'},
+            {'name': 'b', 'length': 1, 'head': 'x', 'owner': 'bob', 'channel': '#ops'},
+        ]
+        mock_client = Mock()
+        helga_queue.plugin.handle_queues(mock_client, 'mynick', 'mynick', 'mynick', ['#op'])
+        helga_queue.plugin.handle_queues(mock_client, 'mynick', 'mynick', 'mynick', ['bob'])
+        assert mock_backend.queues.mock_calls == [call(None, '#op'), call('bob', None)]
+        assert mock_client.mock_calls == []
+        assert mock_reactor.callFromThread.call_args[0][3] == [
+            'Queues:', 'a: 2 items (created by bob in #ops) - next: first', '... 1 more queues'
+        ]
 
-    @patch('helga_queue.plugin._get_queue')
-    @patch('helga_queue.plugin._set_queue')
-    def test_handle_len(self, mock_set, mock_get):
-        mock_get.return_value = ['zero', 'one', 'two']
-        mock_set.return_value = 'setreturn'
-        result = helga_queue.plugin.handle_len(None, None, None, 'qname', [])
+    @patch('helga_queue.plugin._backend')
+    def test_handle_queues_empty(self, mock_backend):
+        mock_backend.queues.return_value = []
+        mock_client = Mock()
+        helga_queue.plugin.handle_queues(mock_client, 'mynick', 'mynick', 'mynick', [])
+        assert mock_client.mock_calls == [call.msg('mynick', 'No queues found.')]
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_queues_unsupported(self, mock_backend):
+        mock_backend.name = 'base'
+        mock_backend.queues.side_effect = NotImplementedError()
+        res = helga_queue.plugin.handle_queues(Mock(), 'mynick', 'mynick', 'mynick', [])
+        assert res == "ERROR - the base backend can't list queues"
+
+    @patch('helga_queue.plugin._backend')
+    @patch('helga_queue.plugin.reactor')
+    def test_handle_search(self, mock_reactor, mock_backend):
+        mock_backend.search.return_value = [('qname', 0, 'Fix build'), ('qname', 3, 'build docs')]
+        mock_client = Mock()
+        res = helga_queue.plugin.handle_search(mock_client, '#chan', 'mynick', 'qname', ['Build,'])
+        assert res is None
+        assert mock_backend.search.mock_calls == [call(['build'], 'qname')]
+        assert mock_client.mock_calls == [call.me('#chan', 'whispers to mynick 2 matching items')]
+        assert mock_reactor.mock_calls == [
+            call.callFromThread(
+                helga_queue.plugin._output.send, mock_client, 'mynick',
+                ["Found 2 items matching 'build':", '0. Fix build', '3. build docs']
+            )
+        ]
+
+    @patch('helga_queue.plugin.LIST_MAX_LINES', 1)
+    @patch('helga_queue.plugin.reactor')
+    @patch('helga_queue.plugin._backend')
+    def test_handle_search_all(self, mock_backend, mock_reactor):
+        mock_backend.search.return_value = [('a', 0, 'Fix build'), ('b', 3, 'build docs')]
+        mock_client = Mock()
+        res = helga_queue.plugin.handle_search(mock_client, 'mynick', 'mynick', 'mynick', ['-a', 'fix', 'build'])
+        assert res is None
+        assert mock_backend.search.mock_calls == [call(['fix', 'build'], None)]
+        assert mock_client.mock_calls == []
+        assert mock_reactor.mock_calls == [
+            call.callFromThread(
+                helga_queue.plugin._output.send, mock_client, 'mynick',
+                ["Found 2 items matching 'fix build':", 'a 0. Fix build', '... 1 more items']
+            )
+        ]
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_search_none(self, mock_backend):
+        mock_backend.search.return_value = []
+        res = helga_queue.plugin.handle_search(None, '#chan', 'mynick', 'qname', ['foo'])
+        assert res == "No items found matching 'foo'."
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_search_usage(self, mock_backend):
+        res = helga_queue.plugin.handle_search(None, '#chan', 'mynick', 'qname', ['-a', '!!'])
+        assert res == "ERROR - usage: queue [queue name] search [-a] <words>"
+        assert mock_backend.mock_calls == []
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_search_unsupported(self, mock_backend):
+        mock_backend.name = 'base'
+        mock_backend.search.side_effect = NotImplementedError()
+        res = helga_queue.plugin.handle_search(None, '#chan', 'mynick', 'qname', ['-a', 'foo'])
+        assert res == "ERROR - the base backend can't search across queues"
+
+    @patch('helga_queue.plugin._queue_len')
+    def test_handle_len(self, mock_len):
+        mock_len.return_value = 3
+        result = helga_queue.plugin.handle_len(None, None, 'mynick', 'qname', [])
         assert result == '3 items in queue qname'
+        assert mock_len.mock_calls == [call('qname')]
 
-    @patch('helga_queue.plugin._get_queue')
-    @patch('helga_queue.plugin._set_queue')
-    def test_handle_next(self, mock_set, mock_get):
-        mock_get.return_value = ['zero', 'one', 'two']
-        mock_set.return_value = 'setreturn'
-        result = helga_queue.plugin.handle_next(None, None, None, 'qname', [])
+    @patch('helga_queue.plugin._queue_peek')
+    def test_handle_next(self, mock_peek):
+        mock_peek.return_value = 'zero'
+        result = helga_queue.plugin.handle_next(None, None, 'mynick', 'qname', [])
         assert result == 'Next item in queue qname: zero'
+        assert mock_peek.mock_calls == [call('qname')]
 
-    @patch('helga_queue.plugin._queue_repr')
-    @patch('helga_queue.plugin._get_queue')
-    def test_handle_list_inchannel(self, mock_get, mock_repr):
-        mock_get.return_value = ['zero', 'one', 'two']
+    @patch('helga_queue.plugin._queue_peek')
+    def test_handle_next_empty(self, mock_peek):
+        mock_peek.return_value = None
+        result = helga_queue.plugin.handle_next(None, None, 'mynick', 'qname', [])
+        assert result == 'Queue qname is empty.'
+
+    def test_parse_in(self):
+        parse = helga_queue.plugin._parse_in
+        assert parse('90', 1000) == 1090
+        assert parse('90s', 1000) == 1090
+        assert parse('15m', 1000) == 1900
+        assert parse('1h30m', 1000) == 1000 + 5400
+        assert parse('2d', 1000) == 1000 + 172800
+        assert parse('', 1000) is None
+        assert parse('1h30', 1000) is None
+        assert parse('soon', 1000) is None
+
+    def test_parse_at(self):
+        parse = helga_queue.plugin._parse_at
+        now = time.mktime((2026, 10, 18, 12, 0, 0, 0, 0, -1))
+        assert parse('2026-10-19T09:30', now) == time.mktime((2026, 10, 19, 9, 30, 0, 0, 0, -1))
+        assert parse('2026-10-19T09:30:15', now) == time.mktime((2026, 10, 19, 9, 30, 15, 0, 0, -1))
+        # the next occurrence of a time of day
+        assert parse('14:00', now) == time.mktime((2026, 10, 18, 14, 0, 0, 0, 0, -1))
+        assert parse('09:00', now) == time.mktime((2026, 10, 19, 9, 0, 0, 0, 0, -1))
+        assert parse('2026-10-17T09:30', now) is None
+        assert parse('tomorrow', now) is None
+
+    @patch('helga_queue.plugin._schedule_item')
+    def test_handle_append_in(self, mock_schedule):
+        with patch.object(helga_queue.plugin.time, 'time', return_value=1000):
+            result = helga_queue.plugin.handle_append_in(None, '#chan', 'mynick', 'qname', ['15m', 'foo', 'bar'])
+        assert result == "Scheduled item 'foo bar' for queue qname at {w}".format(
+            w=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(1900))
+        )
+        assert mock_schedule.mock_calls == [call('qname', 'foo bar', 1900, None, owner='mynick', channel='#chan')]
+
+    @patch('helga_queue.plugin._schedule_item')
+    def test_handle_append_at_announce(self, mock_schedule):
+        result = helga_queue.plugin.handle_append_at(
+            None, '#chan', 'mynick', 'qname', ['-n', '2099-01-01T00:00', 'party']
+        )
+        due = time.mktime((2099, 1, 1, 0, 0, 0, 0, 0, -1))
+        assert result.startswith("Scheduled item 'party' for queue qname at 2099-01-01 00:00:00")
+        assert mock_schedule.mock_calls == [call('qname', 'party', due, '#chan', owner='mynick', channel='#chan')]
+
+    @patch('helga_queue.plugin._schedule_item')
+    def test_handle_append_at_errors(self, mock_schedule):
+        handler = helga_queue.plugin.handle_append_at
+        assert handler(None, '#chan', 'mynick', 'qname', ['-n', '12:00']) == \
+            "ERROR - usage: queue [queue name] append-at [-n] <HH:MM|YYYY-MM-DDTHH:MM> <item>"
+        assert handler(None, '#chan', 'mynick', 'qname', ['2000-01-01T00:00', 'foo']) == \
+            "ERROR - '2000-01-01T00:00' is not a valid time in the future; use <HH:MM|YYYY-MM-DDTHH:MM>"
+        assert mock_schedule.mock_calls == []
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_append_in_unsupported(self, mock_backend):
+        mock_backend.name = 'dict'
+        mock_backend.schedule.side_effect = NotImplementedError()
+        result = helga_queue.plugin.handle_append_in(None, '#chan', 'mynick', 'qname', ['5m', 'foo'])
+        assert result == "ERROR - the dict backend doesn't support scheduled items"
+
+    @patch('helga_queue.plugin.reactor')
+    @patch('helga_queue.plugin._backend')
+    def test_schedule_item(self, mock_backend, mock_reactor):
+        helga_queue.plugin._schedule_item('qname', 'foo', 1900, '#chan', owner='mynick', channel='#chan')
+        assert mock_backend.mock_calls == [
+            call.schedule('qname', 'foo', 1900, '#chan'),
+            call.set_owner('qname', 'mynick', '#chan'),
+        ]
+        assert mock_reactor.callFromThread.mock_calls == [call(helga_queue.plugin._wheel.add, 1900, 'qname')]
+
+    @patch('helga_queue.plugin._client')
+    @patch('helga_queue.plugin._backend')
+    def test_deliver_due(self, mock_backend, mock_client):
+        mock_backend.deliver_due.return_value = [('qname', 'foo', '#chan'), ('other', 'bar', None)]
+        helga_queue.plugin._cache.set('qname', ['zero'])
+        assert helga_queue.plugin._deliver_due() == [('qname', 'foo', '#chan'), ('other', 'bar', None)]
+        assert 'qname' not in helga_queue.plugin._cache
+        assert mock_client.msg.mock_calls == [call('#chan', "Queue qname: 'foo' is now due")]
+
+    @patch('helga_queue.plugin._backend')
+    def test_deliver_due_unsupported(self, mock_backend):
+        mock_backend.deliver_due.side_effect = NotImplementedError()
+        assert helga_queue.plugin._deliver_due() == []
+
+    @patch('helga_queue.plugin._wheel')
+    @patch('helga_queue.plugin._pool')
+    def test_on_signon(self, mock_pool, mock_wheel):
+        mock_pool.run.side_effect = lambda fn: defer.succeed(fn())
+        client = Mock()
+        with patch('helga_queue.plugin._backend') as mock_backend, \
+                patch('helga_queue.plugin._schedule_loaded', False), \
+                patch('helga_queue.plugin._client', None):
+            mock_backend.scheduled_times.return_value = [10, 20]
+            mock_backend.ttls.return_value = {'q': 60}
+            helga_queue.plugin._on_signon(client)
+            helga_queue.plugin._on_signon(client)
+            assert helga_queue.plugin._client._client is client
+        assert mock_backend.mock_calls == [call.scheduled_times(), call.ttls()]
+        assert helga_queue.plugin._queue_ttls == {'q': 60}
+        assert mock_wheel.add.mock_calls == [call(10, None), call(20, None)]
+
+    @patch('helga_queue.plugin.time')
+    def test_handle_claim(self, mock_time):
+        mock_time.time.return_value = 1000
+        backend = MemoryBackend()
+        backend.append_many('qname', ['zero', 'one'])
+        helga_queue.plugin._cache.set('qname', ['zero', 'one'])
+        with patch('helga_queue.plugin._backend', backend):
+            result = helga_queue.plugin.handle_claim(None, '#chan', 'mynick', 'qname', [])
+        assert result == "mynick claimed item 'zero' from queue qname as claim 1; ack it within 3600 " \
+            "seconds or it goes back on the queue"
+        assert helga_queue.plugin._cache.get('qname') == ['one']
+        assert backend.reap(4601) == ['qname']
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_claim_empty(self, mock_backend):
+        mock_backend.claim.return_value = None
+        result = helga_queue.plugin.handle_claim(None, '#chan', 'mynick', 'qname', [])
+        assert result == 'Queue qname is empty.'
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_claim_unsupported(self, mock_backend):
+        mock_backend.name = 'dict'
+        mock_backend.claim.side_effect = NotImplementedError()
+        result = helga_queue.plugin.handle_claim(None, '#chan', 'mynick', 'qname', [])
+        assert result == "ERROR - the dict backend doesn't support claims"
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_ack(self, mock_backend):
+        mock_backend.ack.return_value = 'zero'
+        result = helga_queue.plugin.handle_ack(None, '#chan', 'mynick', 'qname', ['3'])
+        assert result == "Acked claim 3 on queue qname: 'zero'"
+        assert mock_backend.mock_calls == [call.ack('qname', 'mynick', 3)]
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_ack_missing(self, mock_backend):
+        mock_backend.ack.return_value = None
+        result = helga_queue.plugin.handle_ack(None, '#chan', 'mynick', 'qname', ['3'])
+        assert result == "ERROR - mynick has no claim 3 on queue qname; it may have expired"
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_ack_bad_id(self, mock_backend):
+        assert helga_queue.plugin.handle_ack(None, '#chan', 'mynick', 'qname', []) == \
+            "ERROR - please give the id of the claim"
+        assert helga_queue.plugin.handle_ack(None, '#chan', 'mynick', 'qname', ['x']) == \
+            "ERROR - x is not a valid claim id (int)"
+        assert mock_backend.mock_calls == []
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_release(self, mock_backend):
+        mock_backend.release.return_value = 'zero'
+        helga_queue.plugin._cache.set('qname', ['one'])
+        result = helga_queue.plugin.handle_release(None, '#chan', 'mynick', 'qname', ['3'])
+        assert result == "Released claim 3; 'zero' is back at the head of queue qname"
+        assert mock_backend.mock_calls == [call.release('qname', 'mynick', 3)]
+        assert 'qname' not in helga_queue.plugin._cache
+
+    @patch('helga_queue.plugin.time')
+    @patch('helga_queue.plugin._backend')
+    def test_reap_claims(self, mock_backend, mock_time):
+        mock_time.time.return_value = 1000
+        mock_backend.recover_moves.return_value = []
+        mock_backend.reap.return_value = ['qname']
+        helga_queue.plugin._cache.set('qname', ['one'])
+        helga_queue.plugin._cache.set('other', ['one'])
+        assert helga_queue.plugin._reap_claims() == ['qname']
+        assert mock_backend.mock_calls == [call.recover_moves(1000), call.reap(1000)]
+        assert 'qname' not in helga_queue.plugin._cache
+        assert 'other' in helga_queue.plugin._cache
+
+    @patch('helga_queue.plugin._backend')
+    def test_reap_claims_unsupported(self, mock_backend):
+        mock_backend.recover_moves.return_value = []
+        mock_backend.reap.side_effect = NotImplementedError()
+        assert helga_queue.plugin._reap_claims() == []
+
+    @patch('helga_queue.plugin.time')
+    @patch('helga_queue.plugin._backend')
+    def test_reap_claims_recovers_moves(self, mock_backend, mock_time):
+        mock_time.time.return_value = 1000
+        mock_backend.recover_moves.return_value = ['qname', 'target']
+        mock_backend.reap.return_value = []
+        helga_queue.plugin._cache.set('qname', ['one'])
+        helga_queue.plugin._cache.set('target', ['two'])
+        assert helga_queue.plugin._reap_claims() == []
+        assert 'qname' not in helga_queue.plugin._cache
+        assert 'target' not in helga_queue.plugin._cache
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_move_to_queue(self, mock_backend):
+        mock_backend.move.return_value = ['one']
+        helga_queue.plugin._cache.set('qname', ['zero', 'one'])
+        helga_queue.plugin._cache.set('other', ['two'])
+        result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['1', 'to', 'other'])
+        assert result == "Moved item 1 of queue qname to queue other: 'one'"
+        assert mock_backend.mock_calls == [
+            call.set_owner('other', 'mynick', '#chan'),
+            call.move('qname', 'other', [1]),
+        ]
+        assert 'qname' not in helga_queue.plugin._cache
+        assert 'other' not in helga_queue.plugin._cache
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_move_to_numeric_queue(self, mock_backend):
+        helga_queue.plugin._owned.add('42')
+        mock_backend.move.return_value = ['one']
+        result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['1', 'to', '42'])
+        assert result == "Moved item 1 of queue qname to queue 42: 'one'"
+        assert mock_backend.mock_calls == [call.move('qname', '42', [1])]
+
+    def test_handle_move_within_queue(self):
+        backend = MemoryBackend()
+        backend.append_many('qname', ['zero', 'one', 'two', 'three'])
+        with patch.object(helga_queue.plugin, '_backend', backend):
+            result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['3', '1'])
+            assert result == "Queue qname item 3 moved to position 1"
+            assert backend.get('qname') == ['zero', 'three', 'one', 'two']
+            assert helga_queue.plugin._cache.get('qname') == ['zero', 'three', 'one', 'two']
+            result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['4', '1'])
+            assert result == "ERROR - queue qname only has 4 items; cannot move index 4"
+            result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['0', '4'])
+            assert result == "ERROR - queue qname only has 4 items; cannot move to index 4"
+            result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['1', '-1'])
+            assert result == "ERROR - index must be an integer; '-1' is invalid"
+            result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'empty', ['0', '1'])
+            assert result == "Queue empty is empty."
+            assert backend.get('qname') == ['zero', 'three', 'one', 'two']
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_move_range_to_queue(self, mock_backend):
+        helga_queue.plugin._owned.add('other')
+        mock_backend.move.return_value = ['one', 'three']
+        result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['1,3', 'to', 'other'])
+        assert result == "Moved 2 items from queue qname to queue other:\n1. 'one'\n3. 'three'"
+        assert mock_backend.mock_calls == [call.move('qname', 'other', [1, 3])]
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_move_missing_index(self, mock_backend):
+        helga_queue.plugin._owned.add('other')
+        mock_backend.move.return_value = None
+        mock_backend.length.return_value = 2
+        result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['0-4', 'to', 'other'])
+        assert result == "ERROR - queue qname only has 2 items; cannot move index 4"
+        mock_backend.length.return_value = 0
+        result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['0', 'to', 'other'])
+        assert result == "Queue qname is empty."
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_move_errors(self, mock_backend):
+        usage = "ERROR - usage: queue [queue name] move <index> <position>, or queue [queue name] move " \
+            "<index|range|list> to <target queue>"
+        for args in [['1'], ['1', 'to'], ['1', 'to', 'other', 'x'], ['1', '2', '3']]:
+            assert helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', args) == usage
+        result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['x', 'to', 'other'])
+        assert result == "ERROR - index must be an integer; 'x' is invalid"
+        result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['3-1', 'to', 'other'])
+        assert result == (
+            "ERROR - '3-1' is not a valid range (<start>-<end>) or list (<i>,<j>,...) of at most 1000 indexes"
+        )
+        result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['1', 'to', 'qname'])
+        assert result == "ERROR - can't move items from queue qname to itself"
+        assert mock_backend.mock_calls == []
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_move_unsupported(self, mock_backend):
+        helga_queue.plugin._owned.add('other')
+        mock_backend.name = 'segmented'
+        mock_backend.move.side_effect = NotImplementedError()
+        result = helga_queue.plugin.handle_move(None, '#chan', 'mynick', 'qname', ['1', 'to', 'other'])
+        assert result == "ERROR - the segmented backend doesn't support moving items"
+        result = helga_queue.plugin.handle_move_all(None, '#chan', 'mynick', 'qname', ['other'])
+        assert result == "ERROR - the segmented backend doesn't support moving items"
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_move_all(self, mock_backend):
+        helga_queue.plugin._owned.add('other')
+        mock_backend.move.return_value = ['zero', 'one']
+        helga_queue.plugin._cache.set('qname', ['zero', 'one'])
+        result = helga_queue.plugin.handle_move_all(None, '#chan', 'mynick', 'qname', ['other'])
+        assert result == "Moved 2 items from queue qname to queue other"
+        assert mock_backend.mock_calls == [call.move('qname', 'other', None)]
+        assert 'qname' not in helga_queue.plugin._cache
+        mock_backend.move.return_value = []
+        result = helga_queue.plugin.handle_move_all(None, '#chan', 'mynick', 'qname', ['other'])
+        assert result == "Queue qname is empty."
+        result = helga_queue.plugin.handle_move_all(None, '#chan', 'mynick', 'qname', [])
+        assert result == "ERROR - usage: queue [queue name] move-all <target queue>"
+
+    @patch('helga_queue.plugin.logger')
+    @patch('helga_queue.plugin._pool')
+    def test_schedule_reap_error(self, mock_pool, mock_logger):
+        d = defer.Deferred()
+        mock_pool.run.return_value = d
+        assert helga_queue.plugin._schedule_reap() is d
+        assert mock_pool.run.mock_calls == [call(helga_queue.plugin._reap_claims)]
+        d.errback(RuntimeError('boom'))
+        assert mock_logger.error.call_count == 1
+
+    @patch('helga_queue.plugin._backend')
+    def test_queue_len(self, mock_backend):
+        mock_backend.length.return_value = 3
+        assert helga_queue.plugin._queue_len('qname') == 3
+        assert mock_backend.mock_calls == [call.length('qname')]
+
+    @patch('helga_queue.plugin._backend')
+    def test_queue_len_cached(self, mock_backend):
+        helga_queue.plugin._cache.set('qname', ['zero', 'one'])
+        assert helga_queue.plugin._queue_len('qname') == 2
+        assert mock_backend.mock_calls == []
+
+    @patch('helga_queue.plugin._backend')
+    def test_queue_range(self, mock_backend):
+        mock_backend.range.return_value = ['two', 'three']
+        assert helga_queue.plugin._queue_range('qname', 2, 2) == ['two', 'three']
+        assert mock_backend.mock_calls == [call.range('qname', 2, 2)]
+
+    @patch('helga_queue.plugin._backend')
+    def test_queue_range_cached(self, mock_backend):
+        helga_queue.plugin._cache.set('qname', ['zero', 'one', 'two'])
+        assert helga_queue.plugin._queue_range('qname', 1, 1) == ['one']
+        assert mock_backend.mock_calls == []
+
+    @patch('helga_queue.plugin._backend')
+    def test_queue_peek(self, mock_backend):
+        mock_backend.peek.return_value = 'zero'
+        assert helga_queue.plugin._queue_peek('qname') == 'zero'
+        assert mock_backend.mock_calls == [call.peek('qname')]
+
+    @patch('helga_queue.plugin._backend')
+    def test_queue_peek_cached(self, mock_backend):
+        helga_queue.plugin._cache.set('qname', ['zero', 'one'])
+        assert helga_queue.plugin._queue_peek('qname') == 'zero'
+        helga_queue.plugin._cache.set('qname', [])
+        assert helga_queue.plugin._queue_peek('qname') is None
+        assert mock_backend.mock_calls == []
+
+    @patch('helga_queue.plugin._backend')
+    def test_queue_is_empty(self, mock_backend):
+        mock_backend.is_empty.return_value = False
+        assert helga_queue.plugin._queue_is_empty('qname') is False
+        assert mock_backend.mock_calls == [call.is_empty('qname')]
+        helga_queue.plugin._cache.set('qname', [])
+        assert helga_queue.plugin._queue_is_empty('qname') is True
+
+    @patch('helga_queue.plugin.reactor')
+    @patch('helga_queue.plugin._listing_lines')
+    @patch('helga_queue.plugin._queue_stamp')
+    def test_handle_list_inchannel(self, mock_stamp, mock_lines, mock_reactor):
+        mock_stamp.return_value = (7, 3)
+        mock_lines.return_value = iter(['0. zero', '1. one', '2. two'])
         mock_client = Mock()
-        mock_repr.return_value = 'myqrepr'
         helga_queue.plugin.handle_list(mock_client, 'chname', 'mynick', 'qname', [])
         assert mock_client.mock_calls == [
             call.me('chname', 'whispers to mynick all 3 items in queue'),
-            call.msg('mynick', 'myqrepr')
         ]
-        assert mock_repr.mock_calls == [call('qname', ['zero', 'one', 'two'])]
+        assert mock_lines.mock_calls == [call('qname', 3, helga_queue.plugin.LIST_MAX_LINES)]
+        assert mock_reactor.mock_calls == [
+            call.callFromThread(
+                helga_queue.plugin._output.send, mock_client, 'mynick',
+                ['Contents of queue "qname":', '0. zero', '1. one', '2. two']
+            )
+        ]
 
-    @patch('helga_queue.plugin._queue_repr')
-    @patch('helga_queue.plugin._get_queue')
-    def test_handle_list_inpm(self, mock_get, mock_repr):
-        mock_get.return_value = ['zero', 'one', 'two']
+    @patch('helga_queue.plugin.reactor')
+    @patch('helga_queue.plugin._listing_lines')
+    @patch('helga_queue.plugin._queue_stamp')
+    def test_handle_list_inpm(self, mock_stamp, mock_lines, mock_reactor):
+        mock_stamp.return_value = (7, 1)
+        mock_lines.return_value = iter(['0. zero'])
         mock_client = Mock()
-        mock_repr.return_value = 'myqrepr'
         helga_queue.plugin.handle_list(mock_client, 'mynick', 'mynick', 'qname', [])
-        assert mock_client.mock_calls == [
-            call.msg('mynick', 'myqrepr')
+        assert mock_client.mock_calls == []
+        assert mock_reactor.mock_calls == [
+            call.callFromThread(
+                helga_queue.plugin._output.send, mock_client, 'mynick',
+                ['Contents of queue "qname":', '0. zero']
+            )
         ]
-        assert mock_repr.mock_calls == [call('qname', ['zero', 'one', 'two'])]
 
+    @patch('helga_queue.plugin.reactor')
+    @patch('helga_queue.plugin._queue_stamp')
+    def test_handle_list_empty(self, mock_stamp, mock_reactor):
+        mock_stamp.return_value = (7, 0)
+        mock_client = Mock()
+        helga_queue.plugin.handle_list(mock_client, 'chname', 'mynick', 'qname', [])
+        assert mock_client.mock_calls == [
+            call.me('chname', 'whispers to mynick all 0 items in queue'),
+            call.msg('mynick', 'Queue "qname" is empty.')
+        ]
+        assert mock_reactor.mock_calls == []
+
+    @patch('helga_queue.plugin._queue_range')
+    def test_iter_queue_lines(self, mock_range):
+        pages = {0: ['zero', 'one'], 2: ['two']}
+        mock_range.side_effect = lambda name, start, count: pages[start]
+        result = list(helga_queue.plugin._iter_queue_lines('qname', page_size=2))
+        assert result == [(0, '0. zero'), (1, '1. one'), (2, '2. two')]
+        assert mock_range.mock_calls == [call('qname', 0, 2), call('qname', 2, 2)]
+
+    @patch('helga_queue.plugin.LINE_LENGTH', 12)
+    @patch('helga_queue.plugin._queue_range')
+    def test_iter_queue_lines_wrap(self, mock_range):
+        mock_range.return_value = ['aaaa bbbb cccc', '']
+        result = list(helga_queue.plugin._iter_queue_lines('qname'))
+        assert result == [(0, '0. aaaa bbbb'), (0, '    cccc'), (1, '1.')]
+
+    @patch('helga_queue.plugin._iter_queue_lines')
+    def test_listing_lines(self, mock_iter):
+        mock_iter.return_value = iter([(0, '0. zero'), (1, '1. one'), (1, '   cont'), (2, '2. two')])
+        result = list(helga_queue.plugin._listing_lines('qname', 10, 2))
+        assert result == ['0. zero', '1. one', '... 9 more items']
+
+    @patch('helga_queue.plugin._iter_queue_lines')
+    def test_listing_lines_all(self, mock_iter):
+        mock_iter.return_value = iter([(0, '0. zero'), (1, '1. one')])
+        result = list(helga_queue.plugin._listing_lines('qname', 2, 2))
+        assert result == ['0. zero', '1. one']
+
+    @patch('helga_queue.plugin._queue_stamp')
     @patch('helga_queue.plugin._queue_repr')
     @patch('helga_queue.plugin._get_queue')
-    def test_handle_show(self, mock_get, mock_repr):
+    def test_handle_show(self, mock_get, mock_repr, mock_stamp):
+        mock_stamp.return_value = None
         mock_get.return_value = ['zero', 'one', 'two']
         mock_client = Mock()
         mock_repr.return_value = 'myqrepr'
@@ -163,55 +1376,173 @@ class TestPlugin:
         assert mock_repr.mock_calls == [call('qname', ['zero', 'one', 'two'])]
         assert result == 'myqrepr'
 
-    @patch('helga_queue.plugin._get_queue')
-    @patch('helga_queue.plugin._set_queue')
-    def test_handle_pop(self, mock_set, mock_get):
-        mock_get.return_value = ['zero', 'one', 'two']
-        mock_set.return_value = 'setreturn'
+    @patch('helga_queue.plugin._backend')
+    def test_handle_show_rendered_once(self, mock_backend):
+        mock_backend.stamp.return_value = (7, 2)
+        mock_backend.get.return_value = ['zero', 'one']
+        expected = 'Contents of queue "qname":\n0. zero\n1. one\n'
+        assert helga_queue.plugin.handle_show(None, 'chname', 'mynick', 'qname', []) == expected
+        helga_queue.plugin._cache.clear()
+        assert helga_queue.plugin.handle_show(None, 'chname', 'mynick', 'qname', []) == expected
+        # served without reading the queue again
+        assert mock_backend.mock_calls == [call.stamp('qname'), call.get('qname'), call.stamp('qname')]
+        # a new version is rendered again
+        mock_backend.stamp.return_value = (8, 2)
+        mock_backend.get.return_value = ['one', 'two']
+        assert helga_queue.plugin.handle_show(None, 'chname', 'mynick', 'qname', []) == \
+            'Contents of queue "qname":\n0. one\n1. two\n'
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_show_cached_queue(self, mock_backend):
+        helga_queue.plugin._cache.set('qname', ['zero', 'one'])
+        expected = 'Contents of queue "qname":\n0. zero\n1. one\n'
+        assert helga_queue.plugin.handle_show(None, 'chname', 'mynick', 'qname', []) == expected
+        assert helga_queue.plugin.handle_show(None, 'chname', 'mynick', 'qname', []) == expected
+        # the stamp comes from the queue cache, not the backend
+        assert mock_backend.mock_calls == []
+        helga_queue.plugin._cache.append('qname', 'two')
+        assert helga_queue.plugin.handle_show(None, 'chname', 'mynick', 'qname', []) == \
+            'Contents of queue "qname":\n0. zero\n1. one\n2. two\n'
+        assert mock_backend.mock_calls == []
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_show_range_rendered(self, mock_backend):
+        mock_backend.stamp.return_value = (7, 3)
+        mock_backend.range.return_value = ['one', 'two']
+        expected = 'Contents of queue "qname":\n1. one\n2. two\n'
+        assert helga_queue.plugin.handle_show(None, 'chname', 'mynick', 'qname', ['1-2']) == expected
+        assert helga_queue.plugin.handle_show(None, 'chname', 'mynick', 'qname', ['1-2']) == expected
+        assert mock_backend.range.mock_calls == [call('qname', 1, 2)]
+        mock_backend.range.return_value = []
+        result = helga_queue.plugin.handle_show(None, 'chname', 'mynick', 'qname', ['5-6'])
+        assert result == 'Queue "qname" has no items in range 5-6.'
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_show_render_cache_disabled(self, mock_backend):
+        mock_backend.get.return_value = ['zero']
+        with patch.object(helga_queue.plugin._render_cache, 'max_entries', 0):
+            helga_queue.plugin.handle_show(None, 'chname', 'mynick', 'qname', [])
+        assert mock_backend.mock_calls == [call.get('qname')]
+
+    @patch('helga_queue.plugin.reactor')
+    @patch('helga_queue.plugin._backend')
+    def test_handle_list_rendered_once(self, mock_backend, mock_reactor):
+        mock_backend.stamp.return_value = (7, 2)
+        mock_backend.range.return_value = ['zero', 'one']
+        mock_client = Mock()
+        helga_queue.plugin.handle_list(mock_client, 'mynick', 'mynick', 'qname', [])
+        helga_queue.plugin._cache.clear()
+        helga_queue.plugin.handle_list(mock_client, 'mynick', 'mynick', 'qname', [])
+        assert mock_backend.range.call_count == 1
+        lines = ['Contents of queue "qname":', '0. zero', '1. one']
+        assert mock_reactor.mock_calls == [
+            call.callFromThread(helga_queue.plugin._output.send, mock_client, 'mynick', lines),
+        ] * 2
+
+    @patch('helga_queue.plugin._queue_len')
+    @patch('helga_queue.plugin._pop_item')
+    def test_handle_pop(self, mock_pop, mock_len):
+        mock_pop.return_value = 'zero'
         result = helga_queue.plugin.handle_pop(None, None, None, 'qname', [])
         assert result == "Popped item 0 from queue qname: 'zero'"
-        assert mock_get.mock_calls == [call('qname')]
-        assert mock_set.mock_calls == [call('qname', ['one', 'two'])]
-
-    @patch('helga_queue.plugin._get_queue')
-    @patch('helga_queue.plugin._set_queue')
-    def test_handle_pop_empty(self, mock_set, mock_get):
-        mock_get.return_value = []
-        mock_set.return_value = 'setreturn'
+        assert mock_pop.mock_calls == [call('qname', 0)]
+        assert mock_len.mock_calls == []
+
+    @patch('helga_queue.plugin._queue_len')
+    @patch('helga_queue.plugin._pop_item')
+    def test_handle_pop_empty(self, mock_pop, mock_len):
+        mock_pop.return_value = None
+        mock_len.return_value = 0
         result = helga_queue.plugin.handle_pop(None, None, None, 'qname', [])
         assert result == 'Queue qname is empty.'
-        assert mock_get.mock_calls == [call('qname')]
-        assert mock_set.mock_calls == []
+        assert mock_pop.mock_calls == [call('qname', 0)]
+        assert mock_len.mock_calls == [call('qname')]
 
-    @patch('helga_queue.plugin._get_queue')
-    @patch('helga_queue.plugin._set_queue')
-    def test_handle_pop_index(self, mock_set, mock_get):
-        mock_get.return_value = ['zero', 'one', 'two']
-        mock_set.return_value = 'setreturn'
+    @patch('helga_queue.plugin._queue_len')
+    @patch('helga_queue.plugin._pop_item')
+    def test_handle_pop_index(self, mock_pop, mock_len):
+        mock_pop.return_value = 'one'
         result = helga_queue.plugin.handle_pop(None, None, None, 'qname', ['1'])
         assert result == "Popped item 1 from queue qname: 'one'"
-        assert mock_get.mock_calls == [call('qname')]
-        assert mock_set.mock_calls == [call('qname', ['zero', 'two'])]
-
-    @patch('helga_queue.plugin._get_queue')
-    @patch('helga_queue.plugin._set_queue')
-    def test_handle_pop_invalid_index(self, mock_set, mock_get):
-        mock_get.return_value = ['zero', 'one', 'two']
-        mock_set.return_value = 'setreturn'
+        assert mock_pop.mock_calls == [call('qname', 1)]
+        assert mock_len.mock_calls == []
+
+    @patch('helga_queue.plugin._queue_len')
+    @patch('helga_queue.plugin._pop_item')
+    def test_handle_pop_invalid_index(self, mock_pop, mock_len):
+        mock_pop.return_value = None
+        mock_len.return_value = 3
         result = helga_queue.plugin.handle_pop(None, None, None, 'qname', [8])
         assert result == 'ERROR - there are only 3 items in queue qname'
-        assert mock_get.mock_calls == [call('qname')]
-        assert mock_set.mock_calls == []
+        assert mock_pop.mock_calls == [call('qname', 8)]
+        assert mock_len.mock_calls == [call('qname')]
 
-    @patch('helga_queue.plugin._get_queue')
-    @patch('helga_queue.plugin._set_queue')
-    def test_handle_pop_nonint_index(self, mock_set, mock_get):
-        mock_get.return_value = ['zero', 'one', 'two']
-        mock_set.return_value = 'setreturn'
+    @patch('helga_queue.plugin._queue_len')
+    @patch('helga_queue.plugin._pop_item')
+    def test_handle_pop_nonint_index(self, mock_pop, mock_len):
         result = helga_queue.plugin.handle_pop(None, None, None, 'qname', ['foo'])
         assert result == "ERROR - foo is not a valid index (int)"
-        assert mock_get.mock_calls == []
-        assert mock_set.mock_calls == []
+        assert mock_pop.mock_calls == []
+        assert mock_len.mock_calls == []
+
+    @patch('helga_queue.plugin._queue_len')
+    @patch('helga_queue.plugin._pop_item')
+    def test_handle_pop_negative_index(self, mock_pop, mock_len):
+        result = helga_queue.plugin.handle_pop(None, None, None, 'qname', ['-1'])
+        assert result == "ERROR - -1 is not a valid index (int)"
+        assert mock_pop.mock_calls == []
+        assert mock_len.mock_calls == []
+
+    @patch('helga_queue.plugin._queue_len')
+    @patch('helga_queue.plugin._pop_items')
+    def test_handle_pop_range(self, mock_pop, mock_len):
+        mock_pop.return_value = ['one', 'two', 'three']
+        result = helga_queue.plugin.handle_pop(None, None, None, 'qname', ['1-3'])
+        assert result == "Popped 3 items from queue qname:\n1. 'one'\n2. 'two'\n3. 'three'"
+        assert mock_pop.mock_calls == [call('qname', [1, 2, 3])]
+        assert mock_len.mock_calls == []
+
+    @patch('helga_queue.plugin._queue_len')
+    @patch('helga_queue.plugin._pop_items')
+    def test_handle_pop_list(self, mock_pop, mock_len):
+        mock_pop.return_value = ['zero', 'four']
+        result = helga_queue.plugin.handle_pop(None, None, None, 'qname', ['4,0,4'])
+        assert result == "Popped 2 items from queue qname:\n0. 'zero'\n4. 'four'"
+        assert mock_pop.mock_calls == [call('qname', [0, 4])]
+
+    @patch('helga_queue.plugin._queue_len')
+    @patch('helga_queue.plugin._pop_items')
+    def test_handle_pop_many_out_of_range(self, mock_pop, mock_len):
+        mock_pop.return_value = None
+        mock_len.return_value = 3
+        result = helga_queue.plugin.handle_pop(None, None, None, 'qname', ['1,5'])
+        assert result == 'ERROR - there are only 3 items in queue qname'
+        mock_len.return_value = 0
+        result = helga_queue.plugin.handle_pop(None, None, None, 'qname', ['1,5'])
+        assert result == 'Queue qname is empty.'
+
+    @patch('helga_queue.plugin._pop_items')
+    def test_handle_pop_many_invalid(self, mock_pop):
+        for arg in ['3-1', '1-x', '1,,2', '-1,2', '1-2-3', '0-999999999', '5-1005']:
+            result = helga_queue.plugin.handle_pop(None, None, None, 'qname', [arg])
+            assert result == (
+                "ERROR - '{a}' is not a valid range (<start>-<end>) or list (<i>,<j>,...) of at most 1000 "
+                "indexes".format(a=arg)
+            )
+        assert mock_pop.mock_calls == []
+
+    def test_parse_indexes_limit(self):
+        assert helga_queue.plugin._parse_indexes('5-1005') is None
+        assert helga_queue.plugin._parse_indexes('5-1004') == list(range(5, 1005))
+        assert helga_queue.plugin._parse_indexes(','.join(['1'] * 1001)) is None
+
+    @patch('helga_queue.plugin.LIST_MAX_LINES', 2)
+    @patch('helga_queue.plugin._queue_len')
+    @patch('helga_queue.plugin._pop_items')
+    def test_handle_pop_many_truncated(self, mock_pop, mock_len):
+        mock_pop.return_value = ['one', 'two', 'three', 'four']
+        result = helga_queue.plugin.handle_pop(None, None, None, 'qname', ['1-4'])
+        assert result == "Popped 4 items from queue qname:\n1. 'one'\n2. 'two'\n... 2 more items"
 
     @patch('helga_queue.plugin._get_queue')
     @patch('helga_queue.plugin._set_queue')
@@ -535,6 +1866,30 @@ class TestPlugin:
         assert mock_get.mock_calls == [call('qname')]
         assert mock_set.mock_calls == [call('qname', ['zero', 'four', 'one', 'two', 'three', 'five'])]
 
+    @patch('helga_queue.plugin._backend')
+    def test_handle_move_first_to_queue(self, mock_backend):
+        helga_queue.plugin._owned.add('other')
+        mock_backend.move.return_value = ['zero']
+        result = helga_queue.plugin.handle_move(None, None, None, 'qname', ['0', 'to', 'other'])
+        assert result == "Moved item 0 of queue qname to queue other: 'zero'"
+        assert mock_backend.mock_calls == [call.move('qname', 'other', [0])]
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_move_from_pastend_to_queue(self, mock_backend):
+        helga_queue.plugin._owned.add('other')
+        mock_backend.move.return_value = None
+        mock_backend.length.return_value = 3
+        result = helga_queue.plugin.handle_move(None, None, None, 'qname', ['6', 'to', 'other'])
+        assert result == "ERROR - queue qname only has 3 items; cannot move index 6"
+
+    @patch('helga_queue.plugin._backend')
+    def test_handle_move_nonint_to_queue(self, mock_backend):
+        result = helga_queue.plugin.handle_move(None, None, None, 'qname', ['foo', 'to', 'other'])
+        assert result == "ERROR - index must be an integer; 'foo' is invalid"
+        result = helga_queue.plugin.handle_move(None, None, None, 'qname', ['1.5', 'to', 'other'])
+        assert result == "ERROR - index must be an integer; '1.5' is invalid"
+        assert mock_backend.mock_calls == []
+
     @patch('helga_queue.plugin._get_queue')
     @patch('helga_queue.plugin._set_queue')
     def test_handle_find_str(self, mock_set, mock_get):
@@ -0,0 +1,99 @@
+import os
+import pstats
+import tempfile
+
+import pytest
+from mock import Mock
+
+from helga_queue.profiler import Profiler, collapse
+
+
+def _leaf(n):
+    return sum(range(n))
+
+
+def _handler(n):
+    _leaf(n)
+    _leaf(n)
+    return 'done'
+
+
+class _FakeStats(object):
+
+    def __init__(self, stats):
+        self.stats = stats
+
+
+class TestCollapse:
+
+    def test_collapse(self):
+        root = ('/a/plugin.py', 10, 'handle_pop')
+        db = ('/a/plugin.py', 20, '_db_call')
+        fmt = ('/a/plugin.py', 30, 'fmt;x')
+        stats = _FakeStats({
+            root: (1, 1, 0.001, 0.006, {}),
+            # _db_call is called by handle_pop and by fmt
+            db: (2, 2, 0.004, 0.004, {root: (1, 1, 0.002, 0.002), fmt: (1, 1, 0.002, 0.002)}),
+            fmt: (1, 1, 0.001, 0.003, {root: (1, 1, 0.001, 0.003)}),
+            ('~', 0, "<method 'disable' of '_lsprof.Profiler' objects>"): (1, 1, 0.0, 0.0, {}),
+        })
+        assert collapse(stats, 'queue pop') == {
+            'queue pop;handle_pop (plugin.py:10)': 1000,
+            'queue pop;handle_pop (plugin.py:10);_db_call (plugin.py:20)': 2000,
+            'queue pop;handle_pop (plugin.py:10);fmt,x (plugin.py:30)': 1000,
+            'queue pop;handle_pop (plugin.py:10);fmt,x (plugin.py:30);_db_call (plugin.py:20)': 2000,
+        }
+
+    def test_recursion(self):
+        fn = ('/a/x.py', 1, 'fn')
+        stats = _FakeStats({fn: (3, 1, 0.003, 0.003, {fn: (2, 0, 0.002, 0.002)})})
+        assert collapse(stats, 'r') == {'r;fn (x.py:1)': 3000}
+
+
+class TestProfiler:
+
+    def test_disabled(self):
+        p = Profiler()
+        p._random = Mock(return_value=0.0)
+        assert p.enabled is False
+        assert p.sampled() is False
+        p.start()
+        assert p.sampled() is True
+        p.stop()
+        assert p.sampled() is False
+
+    def test_sample_fraction(self):
+        p = Profiler(enabled=True, sample=0.25)
+        p._random = Mock(side_effect=[0.1, 0.3, 0.24])
+        assert [p.sampled() for _ in range(3)] == [True, False, True]
+        p.start(sample=0.5)
+        assert p.sample == 0.5
+
+    def test_run_and_dump(self):
+        p = Profiler(enabled=True, sample=1.0)
+        assert p.run('pop', _handler, 1000) == 'done'
+        assert p.run('pop', _handler, 10) == 'done'
+        assert p.run('len', _leaf, 10) == 45
+        assert p.samples() == {'pop': 2, 'len': 1}
+        path = os.path.join(tempfile.mkdtemp(), 'prof')
+        written = p.dump(path)
+        assert written == [path + '-len.pstats', path + '-pop.pstats', path + '.folded']
+        stats = pstats.Stats(path + '-pop.pstats')
+        calls = dict((func[2], v[1]) for func, v in stats.stats.items())
+        assert calls['_handler'] == 2
+        assert calls['_leaf'] == 4
+        with open(path + '.folded') as fh:
+            lines = fh.read().splitlines()
+        for line in lines:
+            stack, us = line.rsplit(' ', 1)
+            assert stack.split(';')[0] in ['queue len', 'queue pop']
+            assert int(us) > 0
+        assert any(line.startswith('queue pop;_handler (test_profiler.py:') for line in lines)
+        p.start()
+        assert p.samples() == {}
+
+    def test_run_failure(self):
+        p = Profiler(enabled=True, sample=1.0)
+        with pytest.raises(RuntimeError):
+            p.run('pop', Mock(side_effect=RuntimeError()))
+        assert p.samples() == {'pop': 1}
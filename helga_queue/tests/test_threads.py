@@ -0,0 +1,74 @@
+from mock import patch, call, Mock
+from twisted.internet import defer
+from helga_queue.threads import StoragePool, ReactorClient
+
+
+class TestStoragePool:
+
+    def test_disabled(self):
+        p = StoragePool(size=0)
+        assert p.enabled is False
+        fn = Mock(return_value='foo')
+        d = p.run(fn, 'a', b='c')
+        results = []
+        d.addCallback(results.append)
+        assert results == ['foo']
+        assert fn.mock_calls == [call('a', b='c')]
+        assert p._pool is None
+
+    @patch('helga_queue.threads.reactor')
+    @patch('helga_queue.threads.ThreadPool')
+    def test_start_stop(self, mock_tp, mock_reactor):
+        p = StoragePool(size=3)
+        p.start()
+        p.start()
+        assert mock_tp.mock_calls == [
+            call(minthreads=0, maxthreads=3, name='helga_queue'),
+            call().start()
+        ]
+        assert mock_reactor.mock_calls == [call.addSystemEventTrigger('during', 'shutdown', p.stop)]
+        p.stop()
+        p.stop()
+        assert mock_tp.return_value.stop.call_count == 1
+        assert p._pool is None
+
+    @patch('helga_queue.threads.reactor')
+    @patch('helga_queue.threads.ThreadPool')
+    @patch('helga_queue.threads.deferToThreadPool')
+    def test_run(self, mock_dttp, mock_tp, mock_reactor):
+        mock_d = Mock()
+        mock_dttp.return_value = mock_d
+        fn = Mock()
+        p = StoragePool(size=2, timeout=5)
+        assert p.run(fn, 'a', b='c') == mock_d
+        args, kwargs = mock_dttp.call_args
+        assert args == (mock_reactor, mock_tp.return_value, fn, 'a')
+        assert kwargs == {'b': 'c'}
+        assert mock_d.mock_calls == [call.addTimeout(5, mock_reactor)]
+
+    @patch('helga_queue.threads.reactor')
+    @patch('helga_queue.threads.ThreadPool')
+    @patch('helga_queue.threads.deferToThreadPool')
+    def test_run_no_timeout(self, mock_dttp, mock_tp, mock_reactor):
+        mock_dttp.return_value = defer.Deferred()
+        p = StoragePool(size=2, timeout=None)
+        d = p.run(Mock())
+        assert d.called is False
+        assert mock_reactor.callLater.mock_calls == []
+
+
+class TestReactorClient:
+
+    @patch('helga_queue.threads.reactor')
+    def test_msg_me(self, mock_reactor):
+        mock_client = Mock()
+        mock_client.nickname = 'helga'
+        c = ReactorClient(mock_client)
+        c.msg('chan', 'foo')
+        c.me('chan', 'bar')
+        assert c.nickname == 'helga'
+        assert mock_reactor.mock_calls == [
+            call.callFromThread(mock_client.msg, 'chan', 'foo'),
+            call.callFromThread(mock_client.me, 'chan', 'bar')
+        ]
+        assert mock_client.mock_calls == []
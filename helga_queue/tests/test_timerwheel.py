@@ -0,0 +1,69 @@
+from mock import call, Mock
+from twisted.internet.task import Clock
+from helga_queue.timerwheel import TimerWheel
+
+
+class TestTimerWheel:
+
+    def setup_method(self, method):
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.fire = Mock()
+        self.wheel = TimerWheel(self.fire, tick=1.0, slots=8, clock=self.clock)
+
+    def test_idle(self):
+        assert len(self.wheel) == 0
+        assert self.clock.getDelayedCalls() == []
+
+    def test_fires_when_due(self):
+        self.wheel.add(1002.5, 'a')
+        self.wheel.add(1001, 'b')
+        self.wheel.add(1003, 'c')
+        assert len(self.wheel) == 3
+        # one timer for the whole wheel
+        assert len(self.clock.getDelayedCalls()) == 1
+        self.clock.advance(1)
+        assert self.fire.mock_calls == [call(['b'])]
+        self.clock.advance(1)
+        assert self.fire.mock_calls == [call(['b'])]
+        self.clock.advance(1)
+        assert self.fire.mock_calls == [call(['b']), call(['a', 'c'])]
+        assert len(self.wheel) == 0
+        assert self.clock.getDelayedCalls() == []
+
+    def test_past_due(self):
+        self.wheel.add(10, 'a')
+        self.clock.advance(1)
+        assert self.fire.mock_calls == [call(['a'])]
+
+    def test_later_revolution(self):
+        # 1002 and 1010 share a slot
+        self.wheel.add(1010, 'far')
+        self.wheel.add(1002, 'near')
+        self.clock.advance(2)
+        assert self.fire.mock_calls == [call(['near'])]
+        self.clock.advance(7)
+        assert self.fire.mock_calls == [call(['near'])]
+        self.clock.advance(1)
+        assert self.fire.mock_calls == [call(['near']), call(['far'])]
+
+    def test_catch_up(self):
+        self.wheel.add(1002, 'a')
+        self.wheel.add(1005, 'b')
+        self.wheel.add(1030, 'c')
+        # the reactor was busy: the wheel's timer runs late
+        self.clock.rightNow += 20
+        self.clock.advance(0)
+        assert self.fire.mock_calls == [call(['a', 'b'])]
+        self.clock.advance(10)
+        assert self.fire.mock_calls == [call(['a', 'b']), call(['c'])]
+
+    def test_restart_after_idle(self):
+        self.wheel.add(1001, 'a')
+        self.clock.advance(1)
+        self.clock.advance(100)
+        self.wheel.add(1103, 'b')
+        self.clock.advance(1)
+        assert self.fire.mock_calls == [call(['a'])]
+        self.clock.advance(1)
+        assert self.fire.mock_calls == [call(['a']), call(['b'])]
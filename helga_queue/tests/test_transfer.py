@@ -0,0 +1,90 @@
+import gzip
+import io
+import json
+import os
+import tempfile
+
+import pytest
+from mock import call, Mock
+
+from helga_queue.backends import MemoryBackend, SQLiteBackend
+from helga_queue.transfer import export_queues, import_queues, main, open_jsonl
+
+
+class TestTransfer:
+
+    def test_export(self):
+        backend = MemoryBackend()
+        backend.append_many('q', ['zero', u'caf\xe9'])
+        backend.append('q', 'urgent', 5000000000.0, 2)
+        fh = io.BytesIO()
+        assert export_queues(backend, fh, batch_size=1) == 3
+        assert [json.loads(line.decode('ascii')) for line in fh.getvalue().splitlines()] == [
+            {'queue': 'q', 'item': 'urgent', 'expires': 5000000000.0, 'priority': 2},
+            {'queue': 'q', 'item': 'zero'},
+            {'queue': 'q', 'item': u'caf\xe9'},
+        ]
+
+    def test_import_batches(self):
+        backend = Mock()
+        lines = [
+            {'queue': 'q', 'item': 'a'},
+            {'queue': 'q', 'item': 'b'},
+            {'queue': 'q', 'item': 'c'},
+            {'queue': 'q', 'item': 'd', 'priority': 2},
+            {'queue': 'r', 'item': 'e', 'expires': 2000},
+        ]
+        fh = io.BytesIO(b''.join((json.dumps(line) + '\n\n').encode('ascii') for line in lines))
+        assert import_queues(backend, fh, batch_size=2) == {'q': 4, 'r': 1}
+        assert backend.mock_calls == [
+            call.append_many('q', ['a', 'b'], None, 0),
+            call.append_many('q', ['c'], None, 0),
+            call.append_many('q', ['d'], None, 2),
+            call.append_many('r', ['e'], 2000, 0),
+        ]
+
+    def test_import_invalid(self):
+        backend = Mock()
+        fh = io.BytesIO(b'{"queue": "q", "item": "a"}\n{"queue": "q"}\n')
+        with pytest.raises(ValueError) as excinfo:
+            import_queues(backend, fh)
+        assert str(excinfo.value) == 'line 2 is not a valid queue item'
+        assert backend.mock_calls == [call.append_many('q', ['a'], None, 0)]
+        fh = io.BytesIO(b'not json\n')
+        with pytest.raises(ValueError):
+            import_queues(backend, fh)
+
+    def test_round_trip_gzip(self):
+        src = SQLiteBackend(':memory:')
+        src.append_many('q', ['item {i}'.format(i=i) for i in range(25)])
+        src.append('q', 'urgent', priority=1)
+        src.append('r', 'soon', 5000000000.0)
+        path = os.path.join(tempfile.mkdtemp(), 'queues.jsonl.gz')
+        with open_jsonl(path, 'w') as fh:
+            assert export_queues(src, fh, batch_size=10) == 27
+        # really gzipped
+        with gzip.open(path, 'rb') as fh:
+            assert json.loads(fh.readline().decode('ascii')) == {'queue': 'q', 'item': 'urgent', 'priority': 1}
+        dest = MemoryBackend()
+        with open_jsonl(path, 'r') as fh:
+            assert import_queues(dest, fh, batch_size=10) == {'q': 26, 'r': 1}
+        assert dest.get('q') == src.get('q')
+        assert list(dest.export('r')) == [('r', 'soon', 5000000000.0, 0)]
+
+    def test_main(self):
+        tmpdir = tempfile.mkdtemp()
+        db = os.path.join(tmpdir, 'q.sqlite')
+        backend = SQLiteBackend(db)
+        backend.append_many('q', ['zero', 'one'])
+        backend.append('r', 'two')
+        backend.close()
+        path = os.path.join(tmpdir, 'out.jsonl')
+        assert main(['export', path, '-b', 'sqlite', '--sqlite-path', db, '-q', 'q']) == 0
+        with open(path) as fh:
+            assert [json.loads(line)['item'] for line in fh] == ['zero', 'one']
+        other = os.path.join(tmpdir, 'other.sqlite')
+        assert main(['import', path, '-b', 'sqlite', '--sqlite-path', other, '--batch-size', '1']) == 0
+        backend = SQLiteBackend(other)
+        assert backend.get('q') == ['zero', 'one']
+        assert backend.get('r') == []
+        backend.close()
@@ -0,0 +1,83 @@
+"""
+Run queue subcommands (and therefore their blocking MongoDB calls) off of
+the Twisted reactor thread, in a bounded thread pool.
+"""
+
+from twisted.internet import defer, reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+class StoragePool(object):
+    """
+    Lazily-started, bounded thread pool for blocking storage calls.
+
+    :param size: maximum number of worker threads; 0 disables the pool, and
+      calls are made synchronously on the calling thread
+    :type size: int
+    :param timeout: seconds after which a call's Deferred errbacks with
+      :py:exc:`twisted.internet.defer.TimeoutError`; None for no timeout
+    :type timeout: float or None
+    """
+
+    def __init__(self, size=4, timeout=10):
+        self.size = size
+        self.timeout = timeout
+        self._pool = None
+
+    @property
+    def enabled(self):
+        """whether calls are run in the thread pool"""
+        return self.size > 0
+
+    def start(self):
+        """start the thread pool, and stop it when the reactor shuts down"""
+        if self._pool is not None:
+            return
+        self._pool = ThreadPool(minthreads=0, maxthreads=self.size, name='helga_queue')
+        self._pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        """stop the thread pool, if running"""
+        if self._pool is None:
+            return
+        self._pool.stop()
+        self._pool = None
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Call ``fn(*args, **kwargs)`` in the thread pool.
+
+        :returns: Deferred firing with the return value of ``fn``
+        :rtype: :py:class:`twisted.internet.defer.Deferred`
+        """
+        if not self.enabled:
+            return defer.maybeDeferred(fn, *args, **kwargs)
+        self.start()
+        d = deferToThreadPool(reactor, self._pool, fn, *args, **kwargs)
+        if self.timeout is not None:
+            d.addTimeout(self.timeout, reactor)
+        return d
+
+
+class ReactorClient(object):
+    """
+    Wrapper around a helga client for use from worker threads; ``msg`` and
+    ``me`` are scheduled on the reactor thread, everything else is passed
+    through to the wrapped client.
+
+    :param client: helga client
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def msg(self, channel, message):
+        reactor.callFromThread(self._client.msg, channel, message)
+
+    def me(self, channel, message):
+        reactor.callFromThread(self._client.me, channel, message)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
@@ -0,0 +1,96 @@
+"""
+Hashed timer wheel: many timers driven by one reactor timer, instead of a
+``callLater`` each.
+"""
+
+import math
+
+from twisted.internet import reactor
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel. A timer due at ``due`` goes in slot
+    ``ceil(due / tick) % slots``, along with the absolute tick it is due
+    at, so timers more than one revolution away share slots with nearer
+    ones and are skipped until their revolution comes round. Each tick only
+    looks at one slot, and the wheel's own timer only runs while it holds
+    timers. Must only be used from the reactor thread.
+
+    :param fire: called as ``fire(keys)`` with the keys of the timers that
+      became due on a tick
+    :type fire: callable
+    :param tick: resolution of the wheel, in seconds
+    :type tick: float
+    :param slots: number of slots in the wheel
+    :type slots: int
+    :param clock: object providing ``seconds`` and ``callLater``; defaults to
+      the reactor
+    """
+
+    def __init__(self, fire, tick=1.0, slots=512, clock=None):
+        self._fire = fire
+        self.tick = tick
+        self.slots = slots
+        self._clock = clock or reactor
+        # each slot is a list of (absolute tick, key)
+        self._wheel = [[] for _ in range(slots)]
+        self._count = 0
+        # last tick processed
+        self._cursor = self._current_tick()
+        self._call = None
+
+    def __len__(self):
+        return self._count
+
+    def _current_tick(self):
+        return int(self._clock.seconds() // self.tick)
+
+    def add(self, due, key):
+        """
+        Add a timer.
+
+        :param due: unix time the timer is due at; timers already due fire
+          on the next tick
+        :type due: float
+        :param key: passed to ``fire`` when the timer is due
+        """
+        if self._count == 0:
+            # nothing was pending, so no ticks were being processed
+            self._cursor = self._current_tick()
+        at = max(int(math.ceil(due / self.tick)), self._cursor + 1)
+        self._wheel[at % self.slots].append((at, key))
+        self._count += 1
+        if self._call is None:
+            self._schedule()
+
+    def _schedule(self):
+        delay = (self._cursor + 1) * self.tick - self._clock.seconds()
+        self._call = self._clock.callLater(max(delay, 0), self._advance)
+
+    def _advance(self):
+        self._call = None
+        now = self._current_tick()
+        if now - self._cursor >= self.slots:
+            # fell behind by a whole revolution: every slot is due
+            ticks = range(self.slots)
+        else:
+            ticks = range(self._cursor + 1, now + 1)
+        fired = []
+        for t in ticks:
+            slot = self._wheel[t % self.slots]
+            if len(slot) == 0:
+                continue
+            keep = []
+            for at, key in slot:
+                if at <= now:
+                    fired.append(key)
+                else:
+                    keep.append((at, key))
+            self._wheel[t % self.slots] = keep
+        self._cursor = max(now, self._cursor)
+        self._count -= len(fired)
+        if self._count > 0:
+            self._schedule()
+        if len(fired) > 0:
+            self._fire(fired)
@@ -0,0 +1,159 @@
+"""
+Streaming export and import of queues as JSON Lines, for backups,
+migrations between backends and seeding. Each line is one item::
+
+    {"queue": "jdoe", "item": "write the docs", "expires": 1500000000.0, "priority": 2}
+
+where ``expires`` and ``priority`` are left out for items that don't
+expire and have priority 0. Files whose name ends in ``.gz`` are gzipped.
+
+Run with ``helga-queue-transfer --help`` (or ``python -m
+helga_queue.transfer --help``).
+"""
+
+import argparse
+import gzip
+import json
+import sys
+
+from helga_queue.backends import make_backend
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def open_jsonl(path, mode='r'):
+    """
+    Open a JSON Lines file in binary mode, gzipped if ``path`` ends in
+    ``.gz``; ``-`` is standard input or output.
+
+    :param path: path of the file
+    :type path: string
+    :param mode: ``r`` or ``w``
+    :type mode: string
+    :returns: file object
+    """
+    if path == '-':
+        fh = sys.stdin if mode == 'r' else sys.stdout
+        return getattr(fh, 'buffer', fh)
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    return open(path, mode + 'b')
+
+
+def export_queues(backend, fh, name=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Write the items of one or every queue to ``fh`` as JSON Lines, reading
+    them from storage in batches, so memory use stays constant.
+
+    :param backend: storage backend to export from
+    :type backend: :py:class:`~helga_queue.backends.base.Backend`
+    :param fh: file object opened for binary writing
+    :param name: only export this queue; None to export every queue
+    :type name: string
+    :param batch_size: number of items read per storage call
+    :type batch_size: int
+    :returns: number of items written
+    :rtype: int
+    """
+    count = 0
+    for queue, item, expires, priority in backend.export(name, batch_size):
+        rec = {'queue': queue, 'item': item}
+        if expires is not None:
+            rec['expires'] = expires
+        if priority != 0:
+            rec['priority'] = priority
+        fh.write((json.dumps(rec, sort_keys=True) + '\n').encode('ascii'))
+        count += 1
+    return count
+
+
+def import_queues(backend, fh, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Append the items in a JSON Lines file to their queues. Runs of items
+    for the same queue with the same expiry and priority are written with
+    one :py:meth:`~helga_queue.backends.base.Backend.append_many` call of
+    up to ``batch_size`` items.
+
+    :param backend: storage backend to import into
+    :type backend: :py:class:`~helga_queue.backends.base.Backend`
+    :param fh: file object opened for binary reading
+    :param batch_size: maximum number of items per storage call
+    :type batch_size: int
+    :returns: dict of queue name to number of items appended to it
+    :rtype: dict
+    :raises: ValueError if a line isn't a valid item, once the items on
+      the lines before it have been appended
+    """
+    counts = {}
+    key, batch = None, []
+    for lineno, line in enumerate(fh, 1):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            rec = json.loads(line.decode('utf-8'))
+            rec_key = (rec['queue'], rec.get('expires'), rec.get('priority', 0))
+            item = rec['item']
+        except (ValueError, KeyError, TypeError):
+            # the items before it are still imported
+            _flush_batch(backend, key, batch, counts)
+            raise ValueError('line {n} is not a valid queue item'.format(n=lineno))
+        if rec_key != key or len(batch) == batch_size:
+            _flush_batch(backend, key, batch, counts)
+            key, batch = rec_key, []
+        batch.append(item)
+    _flush_batch(backend, key, batch, counts)
+    return counts
+
+
+def _flush_batch(backend, key, batch, counts):
+    if len(batch) == 0:
+        return
+    name, expires, priority = key
+    backend.append_many(name, batch, expires, priority)
+    counts[name] = counts.get(name, 0) + len(batch)
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description='Export or import helga-queue queues as JSON Lines')
+    p.add_argument('action', choices=['export', 'import'])
+    p.add_argument('path', help='file to write or read; - for standard output or input, and gzipped if it '
+                   'ends in .gz')
+    p.add_argument('-b', '--backend', default='mongo', choices=['mongo', 'mongo-segmented', 'sqlite'],
+                   help='storage backend; MongoDB is the database configured in helga\'s settings '
+                   '(default: %(default)s)')
+    p.add_argument('--sqlite-path', default='helga_queue.sqlite',
+                   help='database path for the sqlite backend (default: %(default)s)')
+    p.add_argument('-q', '--queue', default=None, help='only export this queue (default: every queue)')
+    p.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                   help='items per storage call (default: %(default)s)')
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    db = None
+    if args.backend != 'sqlite':
+        # connects to the database in helga's settings, as the plugin does
+        from helga.db import db as helga_db
+        db = helga_db
+    backend = make_backend(args.backend, db=db, sqlite_path=args.sqlite_path)
+    if backend is None:
+        sys.stderr.write('ERROR - no MongoDB connection; check helga\'s settings\n')
+        return 1
+    fh = open_jsonl(args.path, 'w' if args.action == 'export' else 'r')
+    try:
+        if args.action == 'export':
+            count = export_queues(backend, fh, name=args.queue, batch_size=args.batch_size)
+            sys.stderr.write('exported {c} items\n'.format(c=count))
+        else:
+            counts = import_queues(backend, fh, batch_size=args.batch_size)
+            sys.stderr.write('imported {c} items into {q} queues\n'.format(c=sum(counts.values()), q=len(counts)))
+    finally:
+        if args.path != '-':
+            fh.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
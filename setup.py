@@ -25,7 +25,7 @@ setup(
     version=VERSION,
     author='Jason Antman',
     author_email='jason@jasonantman.com',
-    packages=['helga_queue', 'helga_queue.tests'],
+    packages=['helga_queue', 'helga_queue.backends', 'helga_queue.tests'],
     url='http://github.com/jantman/helga-queue/',
     description='A simple helga IRC bot plugin to let you manage a short queue (FIFO) of strings (eg. todo items).',
     long_description=long_description,
@@ -36,5 +36,8 @@ setup(
         helga_plugins=[
             'queue = helga_queue.plugin:queue_plugin',
         ],
+        console_scripts=[
+            'helga-queue-transfer = helga_queue.transfer:main',
+        ],
     ),
 )